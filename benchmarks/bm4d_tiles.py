@@ -0,0 +1,107 @@
+"""
+@author: J.M. Algarín, MRILab, i3M, CSIC, Valencia
+@email: josalggui@i3m.upv.es
+@Summary: benchmark of the tiled BM4D filter against the single bm4d call on the full volume, on a noisy 3D phantom.
+Run from the MaRGE folder: python benchmarks/bm4d_tiles.py
+"""
+
+import os
+import sys
+import time
+import argparse
+#*****************************************************************************
+# Add the MaRGE and marcos_client folders to sys.path
+main_directory = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+parent_directory = os.path.dirname(main_directory)
+sys.path.insert(0, main_directory)
+sys.path.append(os.path.join(parent_directory, 'marcos_client'))
+#******************************************************************************
+import numpy as np
+import bm4d
+from manager.bm4dmanager import bm4d_filter, estimate_noise_std
+from manager.fftmanager import ifftnc, fftnc
+
+
+def get_phantom(shape):
+    """
+    Build a phantom of nested ellipsoids with values between 0 and 100.
+
+    Args:
+        shape (list): Number of points [nz, ny, nx].
+
+    Returns:
+        np.ndarray: The phantom.
+    """
+    z, y, x = np.meshgrid(*[np.linspace(-1, 1, n) for n in shape], indexing='ij')
+    phantom = 60.0 * ((x / 0.8) ** 2 + (y / 0.9) ** 2 + (z / 0.9) ** 2 < 1)
+    phantom += 40.0 * (((x - 0.3) / 0.25) ** 2 + (y / 0.4) ** 2 + (z / 0.5) ** 2 < 1)
+    phantom -= 30.0 * (((x + 0.3) / 0.2) ** 2 + ((y - 0.2) / 0.2) ** 2 + (z / 0.3) ** 2 < 1)
+    return phantom
+
+
+def run(shape, sigma, tile_size, overlap, n_workers):
+    """
+    Denoise the noisy phantom with the single bm4d call and with the tiled filter, and print time and error.
+
+    Args:
+        shape (list): Number of points [nz, ny, nx].
+        sigma (float): Standard deviation of the noise in k-space.
+        tile_size (int): Number of points of the tiles.
+        overlap (int): Number of points of the overlap between tiles.
+        n_workers (int): Number of threads and of processes.
+    """
+    np.random.seed(0)
+    phantom = get_phantom(shape)
+    n_points = phantom.size
+    k_space = fftnc(phantom) + sigma * (np.random.randn(*shape) + 1j * np.random.randn(*shape))
+    noisy = np.abs(ifftnc(k_space))
+
+    # Noise estimated from a noise acquisition with the same sigma, oversampled as the rx data
+    noise = sigma * (np.random.randn(6000) + 1j * np.random.randn(6000))
+    std = estimate_noise_std(noise, n_points, factor=1)
+    print("Noise std of the image: %0.3f (true %0.3f)" % (std, sigma / np.sqrt(n_points)))
+
+    def error(image):
+        return np.sqrt(np.mean((image - phantom) ** 2))
+
+    print("%-30s %10s %10s %14s %8s" % ('method', 'time (s)', 'rmse', 'diff to full', 'speedup'))
+    print("%-30s %10s %10.3f %14s %8s" % ('noisy', '-', error(noisy), '-', '-'))
+
+    t0 = time.time()
+    full = bm4d.bm4d(noisy, sigma_psd=std, profile=bm4d.BM4DProfile(), stage_arg=bm4d.BM4DStages.ALL_STAGES,
+                     blockmatches=(False, False))
+    t_full = time.time() - t0
+    print("%-30s %10.2f %10.3f %14s %8s" % ('bm4d full volume', t_full, error(full), '-', '-'))
+
+    # The tiles in one worker, in threads (bm4d releases the GIL in its compiled library) and in forked processes
+    for fast in [False, True]:
+        t_sequential = None
+        for workers, processes in [(1, False), (n_workers, False), (n_workers, True)]:
+            t0 = time.time()
+            tiled = bm4d_filter(noisy, std, fast=fast, tile_size=tile_size, overlap=overlap, n_workers=workers,
+                                processes=processes)
+            t_tiled = time.time() - t0
+            if t_sequential is None:
+                t_sequential = t_tiled
+            if workers == 1:
+                name = 'tiled %s, sequential' % ('fast' if fast else 'all stages')
+            else:
+                name = 'tiled %s, %i %s' % ('fast' if fast else 'all stages', workers,
+                                            'processes' if processes else 'threads')
+            print("%-30s %10.2f %10.3f %14.3f %8.1f" % (name, t_tiled, error(tiled),
+                                                        np.sqrt(np.mean((tiled - full) ** 2)), t_sequential / t_tiled))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tiled BM4D benchmark")
+    parser.add_argument('--shape', type=int, nargs=3, default=[32, 96, 96])
+    parser.add_argument('--sigma', type=float, default=3000.0, help="Noise standard deviation in k-space")
+    parser.add_argument('--tile', type=int, default=64)
+    parser.add_argument('--overlap', type=int, default=12)
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help="Number of threads and of processes")
+    args = parser.parse_args()
+    run(args.shape, args.sigma, args.tile, args.overlap, args.workers)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+"""
+@author: J.M. Algarín, MRILab, i3M, CSIC, Valencia
+@email: josalggui@i3m.upv.es
+@Summary: benchmark of the RARE sequence compilation time (flo_dict generation) versus the number of phase encodings,
+slices and echo train length. Run from the MaRGE folder: python benchmarks/rare_compile.py
+"""
+
+import os
+import sys
+import time
+import argparse
+#*****************************************************************************
+# Add the MaRGE and marcos_client folders to sys.path
+main_directory = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+parent_directory = os.path.dirname(main_directory)
+sys.path.insert(0, main_directory)
+sys.path.append(os.path.join(parent_directory, 'marcos_client'))
+#******************************************************************************
+import numpy as np
+import seq.rare as rare
+from manager.flomanager import FloDict
+
+
+class ConcatChannel:
+    """
+    Flo channel that reallocates the full arrays on every event with np.concatenate, as the flo_dict did before the
+    growable buffers. Only used as reference for the benchmark.
+    """
+
+    def __init__(self, dtype=float):
+        self.data = [np.array([], dtype=float), np.array([], dtype=dtype)]
+
+    def __len__(self):
+        return self.data[0].shape[0]
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __getitem__(self, index):
+        return self.data[index]
+
+    def __setitem__(self, index, value):
+        self.data[index] = np.asarray(value)
+
+    def append(self, times, amps):
+        times = np.ravel(times)
+        amps = np.ravel(amps) * np.ones(times.shape[0])
+        self.data[0] = np.concatenate((self.data[0], times), axis=0)
+        self.data[1] = np.concatenate((self.data[1], amps), axis=0)
+
+    def set(self, times, amps):
+        self.data = [np.array([], dtype=float), np.array([], dtype=self.data[1].dtype)]
+        self.append(times, amps)
+
+    def clear(self):
+        self.set([], [])
+
+
+def run(nPH, nSL, etl, legacy=False):
+    """
+    Build the RARE sequence in demo mode without acquisition and return the compilation time.
+
+    Args:
+        nPH (int): Number of phase encoding steps.
+        nSL (int): Number of slices.
+        etl (int): Echo train length.
+        legacy (bool): If True, use np.concatenate based channels instead of the growable buffers.
+
+    Returns:
+        tuple: Compilation time in seconds and number of flo instructions.
+    """
+    seq = rare.RARE()
+    seq.mapVals['nPoints'] = [60, nPH, nSL]
+    seq.mapVals['etl'] = etl
+    seq.mapVals['axesEnable'] = [1, 1, int(nSL > 1)]
+    seq.mapVals['dummyPulses'] = 0
+    seq.mapVals['echoSpacing'] = 10.0
+    seq.mapVals['repetitionTime'] = 10.0 * (etl + 2)
+    seq.sequenceAtributes()
+    if legacy:
+        seq.flo_dict = FloDict(channel_class=ConcatChannel)
+
+    # Count the instructions of every batch
+    n_instructions = [0]
+    end_sequence = seq.endSequence
+
+    def endSequence(tEnd):
+        end_sequence(tEnd)
+        n_instructions[0] += sum([len(channel) for channel in seq.flo_dict.values()])
+
+    seq.endSequence = endSequence
+
+    t0 = time.time()
+    if seq.sequenceRun(plotSeq=True, demo=True) is False:
+        print("ERROR: sequence waveforms out of hardware bounds for nPH=%i, nSL=%i, etl=%i" % (nPH, nSL, etl))
+    return time.time() - t0, n_instructions[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="RARE compilation benchmark")
+    parser.add_argument('--nPH', type=int, nargs='+', default=[32, 64, 128])
+    parser.add_argument('--nSL', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--etl', type=int, nargs='+', default=[4, 16])
+    parser.add_argument('--legacy', action='store_true', help="Also time the np.concatenate based flo_dict")
+    args = parser.parse_args()
+
+    header = "%6s %6s %6s %12s %12s" % ('nPH', 'nSL', 'etl', 'orders', 'buffer (s)')
+    if args.legacy:
+        header += " %12s %8s" % ('concat (s)', 'speedup')
+    print(header)
+    results = []
+    for nPH in args.nPH:
+        for nSL in args.nSL:
+            for etl in args.etl:
+                if nPH % etl != 0:
+                    continue
+                t_buffer, orders = run(nPH, nSL, etl)
+                line = "%6i %6i %6i %12i %12.3f" % (nPH, nSL, etl, orders, t_buffer)
+                if args.legacy:
+                    t_concat = run(nPH, nSL, etl, legacy=True)[0]
+                    line += " %12.3f %8.1f" % (t_concat, t_concat / t_buffer)
+                results.append(line)
+    print(header)
+    for line in results:
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""
+@author: J.M. Algarín, MRILab, i3M, CSIC, Valencia
+@email: josalggui@i3m.upv.es
+@Summary: benchmark of the PyPulseq RARE batch compilation time versus the number of processes compiling the batches.
+Run from the MaRGE folder: python benchmarks/rare_pp_compile.py
+"""
+
+import os
+import sys
+import time
+import argparse
+import contextlib
+#*****************************************************************************
+# Add the MaRGE and marcos_client folders to sys.path
+main_directory = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+parent_directory = os.path.dirname(main_directory)
+sys.path.insert(0, main_directory)
+sys.path.append(os.path.join(parent_directory, 'marcos_client'))
+#******************************************************************************
+import configs.hw_config as hw
+import seq.rare_pp as rare_pp
+from manager.cachemanager import waveform_cache
+from manager.pulseqmanager import get_batch_workers
+
+
+def run(nPH, nSL, etl, n_workers):
+    """
+    Build the PyPulseq RARE sequence in demo mode and return the time spent creating and interpreting the batches.
+
+    Args:
+        nPH (int): Number of phase encoding steps.
+        nSL (int): Number of slices.
+        etl (int): Echo train length.
+        n_workers (int): Number of processes compiling the batches.
+
+    Returns:
+        tuple: Compilation time in seconds and number of batches.
+    """
+    seq = rare_pp.RarePyPulseq()
+    seq.mapVals['nPoints'] = [120, nPH, nSL]
+    seq.mapVals['etl'] = etl
+    seq.sequenceAtributes()
+    seq.batch_workers = n_workers
+    seq.save_seq = False
+
+    # Time only compileBatches, not the demo acquisition
+    compile_time = [0.0]
+    compile_batches = seq.compileBatches
+
+    def compileBatches(*args):
+        t0 = time.time()
+        output = compile_batches(*args)
+        compile_time[0] += time.time() - t0
+        return output
+
+    seq.compileBatches = compileBatches
+
+    # Compile the batches again in every run
+    waveform_cache.clear()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        seq.sequenceRun(demo=True)
+    return compile_time[0], len(seq.seq_batches)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="PyPulseq RARE batch compilation benchmark")
+    parser.add_argument('--nPH', type=int, nargs='+', default=[120])
+    parser.add_argument('--nSL', type=int, nargs='+', default=[10, 40])
+    parser.add_argument('--etl', type=int, nargs='+', default=[6])
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, get_batch_workers()],
+                        help="Numbers of processes to compare, the first one is the reference")
+    parser.add_argument('--maxRdPoints', type=int, default=hw.maxRdPoints,
+                        help="Readout points per batch, smaller values give more batches")
+    args = parser.parse_args()
+    hw.maxRdPoints = args.maxRdPoints
+
+    header = "%6s %6s %6s %8s" % ('nPH', 'nSL', 'etl', 'batches')
+    for n_workers in args.workers:
+        header += " %12s" % ('%i proc (s)' % n_workers)
+    header += " %8s" % 'speedup'
+    results = []
+    for nPH in args.nPH:
+        for nSL in args.nSL:
+            for etl in args.etl:
+                if nPH % etl != 0:
+                    continue
+                times = []
+                for n_workers in args.workers:
+                    t, n_batches = run(nPH, nSL, etl, n_workers)
+                    times.append(t)
+                line = "%6i %6i %6i %8i" % (nPH, nSL, etl, n_batches)
+                for t in times:
+                    line += " %12.3f" % t
+                line += " %8.1f" % (times[0] / min(times))
+                results.append(line)
+    print(header)
+    for line in results:
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
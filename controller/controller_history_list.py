@@ -19,6 +19,7 @@ from controller.controller_smith_chart import PlotSmithChartController as SmithC
 from seq.sequences import defaultsequences
 from widgets.widget_history_list import HistoryListWidget
 from manager.dicommanager import DICOMImage
+from manager.historymanager import ImageHistory
 import numpy as np
 import configs.hw_config as hw
 
@@ -88,7 +89,11 @@ class HistoryListController(HistoryListWidget):
         item_name = self.clicked_item.text().split(' | ')[1]
         path = self.main.session['directory']
         self.main.post_gui.showMaximized()
-        self.main.post_gui.toolbar_image.rawDataLoading(file_path=path + "/mat/", file_name=item_name)
+        if os.path.exists(path + "/mat/" + item_name):
+            self.main.post_gui.toolbar_image.rawDataLoading(file_path=path + "/mat/", file_name=item_name)
+        else:
+            # The .mat file is not saved if save_mat is False
+            self.main.post_gui.toolbar_image.rawDataLoading(file_path=path + "/raw/", file_name=item_name[0:-4] + ".h5")
 
     def deleteTask(self, item_number=None):
         """
@@ -436,7 +441,7 @@ class HistoryListControllerPos(HistoryListWidget):
     Inherits from HistoryListWidget.
 
     Attributes:
-        image_hist: Dictionary to store images.
+        image_hist: Dictionary to store images, with a RAM budget. Least recently used images are moved to disk.
         operations_hist: Dictionary to store operations' history.
         image_key: Information about the matrix.
         image_view: Reference to the ImageViewWidget.
@@ -456,7 +461,7 @@ class HistoryListControllerPos(HistoryListWidget):
         self.labels = None
         self.figures = None
         self.orientations = None
-        self.image_hist = {}  # Dictionary to store historical images
+        self.image_hist = ImageHistory()  # Dictionary to store historical images, with a RAM budget
         self.image_orientation = {}
         self.operations_hist = {}  # Dictionary to store operations history
         self.space = {}  # Dictionary to retrieve if matrix is in k-space or image-space
@@ -590,6 +595,7 @@ class HistoryListControllerPos(HistoryListWidget):
         self.addItem(self.image_key)
 
         # Update the history dictionary with the new main matrix
+        self.image_hist.directory = self.main.session['directory'] + "/history"
         self.image_hist[self.image_key] = image
         self.image_orientation[self.image_key] = orientation
 
@@ -606,6 +612,9 @@ class HistoryListControllerPos(HistoryListWidget):
         # Update the space dictionary
         self.space[self.image_key] = space
 
+        # Update the memory used by the items
+        self.updateMemoryUsage()
+
         return 0
 
     def updateHistoryFigure(self, item):
@@ -620,6 +629,7 @@ class HistoryListControllerPos(HistoryListWidget):
         if image_key in self.image_hist.keys():
             self.main.image_view_widget.main_matrix = self.image_hist[image_key]
             self.main.image_view_widget.image_key = image_key
+            self.updateMemoryUsage()
             orientation = self.image_orientation[image_key]
             if self.space[image_key] == 'k':
                 image = np.log10(np.abs(self.main.image_view_widget.main_matrix))
@@ -687,6 +697,21 @@ class HistoryListControllerPos(HistoryListWidget):
         for value in values:
             self.main.methods_list.append(value)
 
+        # Print the memory used by the image
+        if selected_text in self.image_hist:
+            ram, disk = self.image_hist.get_usage(selected_text)
+            self.main.methods_list.append("Memory: %0.1f MB in RAM, %0.1f MB on disk" % (ram / 1e6, disk / 1e6))
+
+    def updateMemoryUsage(self):
+        """
+        Show the memory used by each image of the history in the tooltip of its item.
+        """
+        for row in range(self.count()):
+            item = self.item(row)
+            if item.text() in self.image_hist:
+                ram, disk = self.image_hist.get_usage(item.text())
+                item.setToolTip("RAM: %0.1f MB\nDisk: %0.1f MB" % (ram / 1e6, disk / 1e6))
+
     def moveKeyAndValuesToEnd(self, dictionary, key):
         """
         Move the given key and its associated values to the end of the dictionary.
@@ -751,6 +776,8 @@ class HistoryListControllerPos(HistoryListWidget):
         if selected_item.text() in self.operations_hist:
             del self.operations_hist[selected_item.text()]
 
+        self.updateMemoryUsage()
+
     # def plotPhase(self):
     #     selected_items = self.selectedItems()
     #     if selected_items:
@@ -72,6 +72,10 @@ class MainController(MainWindow):
         """
         # Return stdout to defaults.
         sys.stdout = sys.__stdout__
+
+        # Close the post-processing window and delete the images of its history moved to disk
+        self.post_gui.close()
+        self.post_gui.history_list.image_hist.clear()
             
         print('\nMain GUI closed successfully!')
 
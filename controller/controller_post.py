@@ -1,10 +1,10 @@
-import bm4d
 import threading
 import numpy as np
 from scipy.ndimage import gaussian_filter
 from widgets.widget_post import PostProcessingTabWidget
 from skimage.util import view_as_blocks
 from skimage.measure import shannon_entropy
+from manager.bm4dmanager import bm4d_filter, estimate_noise_std
 
 
 class PostProcessingTabController(PostProcessingTabWidget):
@@ -65,7 +65,16 @@ class PostProcessingTabController(PostProcessingTabWidget):
         image_rescaled = image_data/reference*100
 
         # Calculate the standard deviation (sigma_psd) for BM4D filter
-        if self.auto_checkbox.isChecked():
+        mat_data = self.main.toolbar_image.mat_data
+        noise_key = None
+        if self.auto_checkbox.isChecked() and mat_data:
+            noise_key = 'noiseData' if 'noiseData' in mat_data else 'noise_data' if 'noise_data' in mat_data else None
+        if noise_key is not None and np.size(image_data) == np.prod(mat_data['nPoints']):
+            # Noise of the image from the noise acquired by the sequence
+            n_scans = mat_data['nScans'][0][0] if 'nScans' in mat_data else 1
+            std = estimate_noise_std(mat_data[noise_key], np.size(image_data), n_scans=n_scans) / reference * 100
+            print("Standard deviation for BM4D from the noise data: %0.2f" % std)
+        elif self.auto_checkbox.isChecked():
             # Quantize image
             num_bins = 1000
             image_quantized = np.digitize(image_rescaled, bins=np.linspace(0, 1, num_bins + 1)) - 1
@@ -98,14 +107,8 @@ class PostProcessingTabController(PostProcessingTabWidget):
         else:
             std = float(self.std_text_field.text())
 
-        # Create a BM4D profile and set the stage argument and blockmatches options
-        profile = bm4d.BM4DProfile()
-        stage_arg = bm4d.BM4DStages.ALL_STAGES
-        blockmatches = (False, False)
-
-        # Apply the BM4D filter to the rescaled image
-        denoised_rescaled = bm4d.bm4d(image_rescaled, sigma_psd=std, profile=profile, stage_arg=stage_arg,
-                                      blockmatches=blockmatches)
+        # Apply the BM4D filter to the rescaled image, in tiles processed in parallel
+        denoised_rescaled = bm4d_filter(image_rescaled, std, fast=self.fast_checkbox.isChecked())
 
         # Rescale the denoised image back to its original dimensions
         denoised_image = denoised_rescaled/100*reference
@@ -3,6 +3,10 @@ import time
 import threading
 import numpy as np
 from widgets.widget_reconstruction import ReconstructionTabWidget
+from manager.artmanager import art_reconstruction
+from manager.fftmanager import ifftnc, fftnc
+from manager.pocsmanager import pocs_reconstruction, homodyne_reconstruction
+from manager.csmanager import cs_reconstruction
 try:
     import cupy as cp
     print("GPU will be used for ART reconstruction")
@@ -57,41 +61,6 @@ def ramp(kSpace, n, m, nb_point):
     return kSpace_ramp
 
 
-def hanningFilter(kSpace, mm, nb_point):
-    """
-    Apply a Hanning filter to the k-space data.
-
-    Args:
-        kSpace (ndarray): K-space data.
-        n (int): Number of zero-filled points in k-space.
-        m (int): Number of acquired points in k-space.
-        nb_point (int): Number of points before m+n where reconstruction begins to go to zero.
-
-    Returns:
-        ndarray: K-space data with the Hanning filter applied.
-    """
-    kSpace_hanning = np.copy(kSpace)
-    kSpace_hanning[mm[0]::, :, :] = 0.0
-    kSpace_hanning[:, mm[1]::, :] = 0.0
-    kSpace_hanning[:, :, mm[2]::] = 0.0
-
-    # Calculate the Hanning window
-    hanning_window = np.hanning(nb_point * 2)
-    hanning_window = hanning_window[int(len(hanning_window)/2)::]
-
-    if not mm[0] == np.size(kSpace, 0):
-        for ii in range(nb_point):
-            kSpace_hanning[mm[0]-nb_point+ii+1, :, :] *= hanning_window[ii]
-    if not mm[1] == np.size(kSpace, 1):
-        for ii in range(nb_point):
-            kSpace_hanning[:, mm[1]-nb_point+ii+1, :] *= hanning_window[ii]
-    if not mm[2] == np.size(kSpace, 2):
-        for ii in range(nb_point):
-            kSpace_hanning[:, :, mm[2]-nb_point+ii+1] *= hanning_window[ii]
-
-    return kSpace_hanning
-
-
 class ReconstructionTabController(ReconstructionTabWidget):
     """
     Controller class for the ReconstructionTabWidget.
@@ -100,6 +69,8 @@ class ReconstructionTabController(ReconstructionTabWidget):
 
     Attributes:
         pocs_button: QPushButton for performing POCS.
+        homodyne_button: QPushButton for performing homodyne reconstruction.
+        cs_button: QPushButton for performing compressed sensing reconstruction.
         image_fft_button: QPushButton for performing FFT reconstruction.
         image_art_button: QPushButton for performing ART reconstruction.
     """
@@ -116,6 +87,8 @@ class ReconstructionTabController(ReconstructionTabWidget):
 
         # Connect the image_fft_button clicked signal to the fftReconstruction method
         self.pocs_button.clicked.connect(self.pocsReconstruction)
+        self.homodyne_button.clicked.connect(self.homodyneReconstruction)
+        self.cs_button.clicked.connect(self.csReconstruction)
         self.zero_button.clicked.connect(self.zeroReconstruction)
         self.ifft_button.clicked.connect(self.ifft)
         self.dfft_button.clicked.connect(self.dfft)
@@ -133,7 +106,7 @@ class ReconstructionTabController(ReconstructionTabWidget):
         image = self.main.image_view_widget.main_matrix
 
         # Perform direct FFT shift, inverse FFT, and inverse FFT shift to reconstruct the image in the spatial domain
-        k_space = np.fft.fftshift(np.fft.fftn(np.fft.fftshift(image)))
+        k_space = fftnc(image)
 
         # Update the main matrix of the image view widget with the image fft data
         self.main.image_view_widget.main_matrix = k_space
@@ -171,7 +144,7 @@ class ReconstructionTabController(ReconstructionTabWidget):
         k_space = self.main.image_view_widget.main_matrix
 
         # Perform inverse FFT shift, inverse FFT, and inverse FFT shift to reconstruct the image in the spatial domain
-        image = np.fft.ifftshift(np.fft.ifftn(np.fft.ifftshift(k_space)))
+        image = ifftnc(k_space)
 
         # Update the main matrix of the image view widget with the image fft data
         self.main.image_view_widget.main_matrix = image
@@ -221,10 +194,10 @@ class ReconstructionTabController(ReconstructionTabWidget):
         s = sampled[:, 3]
 
         # Points where rho will be estimated
-        x = np.linspace(-fov[0] / 2, fov[0] / 2, nPoints[0])
-        y = np.linspace(-fov[1] / 2, fov[1] / 2, nPoints[1])
-        z = np.linspace(-fov[2] / 2, fov[2] / 2, nPoints[2])
-        y, z, x = np.meshgrid(y, z, x)
+        x_axis = np.linspace(-fov[0] / 2, fov[0] / 2, nPoints[0])
+        y_axis = np.linspace(-fov[1] / 2, fov[1] / 2, nPoints[1])
+        z_axis = np.linspace(-fov[2] / 2, fov[2] / 2, nPoints[2])
+        y, z, x = np.meshgrid(y_axis, z_axis, x_axis)
         x = np.reshape(x, (-1, 1))
         y = np.reshape(y, (-1, 1))
         z = np.reshape(z, (-1, 1))
@@ -237,6 +210,7 @@ class ReconstructionTabController(ReconstructionTabWidget):
         # Iterative process
         lbda = float(self.lambda_text_field.text())
         n_iter = int(self.niter_text_field.text())
+        block_size = int(self.block_text_field.text())
         index = np.arange(len(s))
 
         def iterative_process_gpu(kx, ky, kz, x, y, z, s, rho, lbda, n_iter, index):
@@ -260,27 +234,6 @@ class ReconstructionTabController(ReconstructionTabWidget):
 
             return rho
 
-        def iterative_process_cpu(kx, ky, kz, x, y, z, s, rho, lbda, n_iter, index):
-            n = 0
-            n_samples = len(s)
-            m = 0
-            for iteration in range(n_iter):
-                np.random.shuffle(index)
-                for jj in range(n_samples):
-                    ii = index[jj]
-                    x0 = np.exp(-1j * 2 * np.pi * (kx[ii] * x + ky[ii] * y + kz[ii] * z))
-                    x1 = (x0.T @ rho) - s[ii]
-                    x2 = x1 * np.conj(x0) / (np.conj(x0.T) @ x0)
-                    d_rho = lbda * x2
-                    rho -= d_rho
-                    n += 1
-                    if n / n_samples > 0.01:
-                        m += 1
-                        n = 0
-                        print("ART iteration %i: %i %%" % (iteration + 1, m))
-
-            return rho
-
         # Launch the GPU function
         rho = np.reshape(np.zeros((nPoints[0] * nPoints[1] * nPoints[2]), dtype=complex), (-1, 1))
         start = time.time()
@@ -305,8 +258,8 @@ class ReconstructionTabController(ReconstructionTabWidget):
         else:
             print('Executing ART in CPU...')
 
-            rho = iterative_process_cpu(kx, ky, kz, x, y, z, s, rho, lbda, n_iter,
-                                            index)
+            # Block-Kaczmarz over the grid axes, without building the encoding matrix
+            rho = art_reconstruction(k, s, x_axis, y_axis, z_axis, lbda=lbda, n_iter=n_iter, block_size=block_size)
         end = time.time()
         print("Reconstruction time = %0.1f s" % (end - start))
 
@@ -323,7 +276,7 @@ class ReconstructionTabController(ReconstructionTabWidget):
         self.main.history_list.addNewItem(stamp="ART",
                                           image=figure,
                                           orientation=orientation,
-                                          operation="ART n = %i, lambda = %0.3f" % (n_iter, lbda),
+                                          operation="ART n = %i, lambda = %0.3f, block = %i" % (n_iter, lbda, block_size),
                                           space="i",
                                           image_key=self.main.image_view_widget.image_key)
 
@@ -344,7 +297,7 @@ class ReconstructionTabController(ReconstructionTabWidget):
         """
         # Get the k_space data and its shape
         k_space = self.main.image_view_widget.main_matrix.copy()
-        img_ref = np.abs(np.fft.ifftshift(np.fft.ifftn(np.fft.ifftshift(k_space))))
+        img_ref = np.abs(ifftnc(k_space))
         nPoints = self.main.toolbar_image.nPoints[-1::-1]
 
         # Percentage for partial reconstruction from the text field
@@ -358,7 +311,7 @@ class ReconstructionTabController(ReconstructionTabWidget):
         k_space[:, :, mm[2]::] = 0.0
 
         # Calculate logarithmic scale
-        image = np.abs(np.fft.ifftshift(np.fft.ifftn(np.fft.ifftshift(k_space))))
+        image = np.abs(ifftnc(k_space))
 
         # Get correlation with reference image
         correlation = np.corrcoef(img_ref.flatten(), image.flatten())[0, 1]
@@ -400,33 +353,6 @@ class ReconstructionTabController(ReconstructionTabWidget):
         Adds the "POCS" operation to the history widget and updates the history dictionary and operations history.
         """
 
-        def getCenterKSpace(k_space, n, m_vec):
-            # fix n_vec
-            output = np.zeros(np.shape(k_space), dtype=complex)
-            n_vec = np.array(np.shape(k_space))
-
-            # fill with zeros
-            idx0 = n_vec // 2 - m_vec
-            idx1 = n_vec // 2 + m_vec
-            output[idx0[0]:idx1[0], idx0[1]:idx1[1], idx0[2]:idx1[2]] = \
-                k_space[idx0[0]:idx1[0], idx0[1]:idx1[1], idx0[2]:idx1[2]]
-
-            return output
-            # # fix n_vec
-            # output = k_space.copy()
-            # n_vec = np.array([0, 0, 0])
-            # for ii in range(3):
-            #     if m_vec[ii] == n[ii]:
-            #         n_vec[ii] = np.size(k_space, ii)
-            #     else:
-            #         n_vec[ii] = n[ii]
-            #
-            # # fill with zeros
-            # output[0:n_vec[0] - m_vec[0], 0:n_vec[1] - m_vec[1], 0:n_vec[2] - m_vec[2]] = 0.0
-            # output[n_vec[0] + m_vec[0]::, n_vec[1] + m_vec[1]::, n_vec[2] + m_vec[2]::] = 0.0
-            #
-            # return output
-
         mat_data = self.main.toolbar_image.mat_data
         nPoints = mat_data['nPoints'][0][-1::-1]
 
@@ -434,63 +360,78 @@ class ReconstructionTabController(ReconstructionTabWidget):
         factors = self.partial_reconstruction_factor.text().split(',')
         factors = [float(num) for num in factors][-1::-1]
         mm = np.array([int(num) for num in (nPoints * factors)])
-
-        n = np.array([int(num) for num in (nPoints / 2.0)])  # Divide the data per 2
         m = np.array([int(num) for num in (nPoints * factors - nPoints / 2)])
 
-
         # Get the k_space data
         kSpace_ref = self.main.image_view_widget.main_matrix.copy()
-        img_ref = np.abs(np.fft.ifftshift(np.fft.ifftn(np.fft.ifftshift(kSpace_ref))))
-
-        # Create a copy with the center of k-space
-        kSpace_center = getCenterKSpace(kSpace_ref, n, m)
+        img_ref = np.abs(ifftnc(kSpace_ref))
 
         # Number of points before m+n where we begin to go to zero
         nb_point = int(self.nb_points_text_field.text())
 
-        # Set the correlation threshold for stopping the iterations
+        # Set the threshold of the relative change between iterations for stopping the iterations
         threshold = float(self.threshold_text_field.text())
 
-        # Get image phase
-        img_center = np.fft.ifftshift(np.fft.ifftn(np.fft.ifftshift(kSpace_center)))
-        phase = img_center / abs(img_center)
+        # Iterative reconstruction with phase correction
+        img_reconstructed = pocs_reconstruction(kSpace_ref, mm, m, nb_point=nb_point, threshold=threshold,
+                                                single=self.single_checkbox.isChecked())
 
-        # Generate the corresponding image with the Hanning filter
-        kSpace_hanning = hanningFilter(kSpace_ref, mm, nb_point)
-        img_hanning = np.abs(np.fft.ifftshift(np.fft.ifftn(np.fft.ifftshift(kSpace_hanning))))
+        # Update the main matrix of the image view widget with the interpolated image
+        self.main.image_view_widget.main_matrix = img_reconstructed
 
-        num_iterations = 0  # Initialize the iteration counter
-        previous_img = img_hanning.copy()  # you have the choice between img_hanning or img_ramp
+        figure = img_reconstructed / np.max(np.abs(img_reconstructed)) * 100
+
+        # Get correlation with reference image
+        correlation = np.corrcoef(img_ref.flatten(), img_reconstructed.flatten())[0, 1]
+        print("Respect the reference image:")
+        print("Convergence: %0.2e" % (1 - correlation))
+        orientation=None
+        if self.main.toolbar_image.mat_data and 'axesOrientation' in self.main.toolbar_image.mat_data:
+            orientation = self.main.toolbar_image.mat_data['axesOrientation'][0]
+        # Add new item to the history list
+        self.main.history_list.addNewItem(stamp="POCS",
+                                          image=figure,
+                                          orientation=orientation,
+                                          operation="POCS - " + str(factors[-1::-1]),
+                                          space="i",
+                                          image_key=self.main.image_view_widget.image_key)
 
-        while True:
-            # Iterative reconstruction
-            img_iterative = previous_img * phase
-            kSpace_new = np.fft.fftshift(np.fft.fftn(np.fft.fftshift(img_iterative)))
+    def homodyneReconstruction(self):
+        """
+        Perform homodyne reconstruction in a separate thread.
 
-            # Apply constraint: Keep the region of k-space from n+m onwards and restore the rest
-            kSpace_new[0:mm[0], 0:mm[1], 0:mm[2]] = kSpace_ref[0:mm[0], 0:mm[1], 0:mm[2]]
+        Creates a new thread and runs the runHomodyneReconstruction method in that thread.
+        """
 
-            # Reconstruct the image from the modified k-space
-            img_reconstructed = np.abs(np.fft.ifftshift(np.fft.ifftn(np.fft.ifftshift(kSpace_new))))
+        thread = threading.Thread(target=self.runHomodyneReconstruction)
+        thread.start()
 
-            # Compute correlation between consecutive reconstructed images
-            correlation = np.corrcoef(previous_img.flatten(), img_reconstructed.flatten())[0, 1]
+    def runHomodyneReconstruction(self):
+        """
+        Perform homodyne reconstruction.
 
-            # Display correlation and current iteration number
-            print("Iteration: %i, Convergence: %0.2e" % (num_iterations, (1-correlation)))
+        Faster alternative to POCS without iterations: the acquired k-space is weighted to compensate the missing
+        points and the image is demodulated with the phase of the center of k-space.
+        Updates the main matrix of the image view widget with the reconstructed image.
+        Adds the "Homodyne" operation to the history widget.
+        """
+        mat_data = self.main.toolbar_image.mat_data
+        nPoints = mat_data['nPoints'][0][-1::-1]
 
-            # Check if correlation reaches the desired threshold
-            if (1-correlation) <= threshold or num_iterations >= 100:
-                break
+        # Number of extra lines which has been taken past the center of k-space
+        factors = self.partial_reconstruction_factor.text().split(',')
+        factors = [float(num) for num in factors][-1::-1]
+        mm = np.array([int(num) for num in (nPoints * factors)])
+        m = np.array([int(num) for num in (nPoints * factors - nPoints / 2)])
 
-            # Update previous_img for the next iteration
-            previous_img = img_reconstructed.copy()
+        # Get the k_space data
+        kSpace_ref = self.main.image_view_widget.main_matrix.copy()
+        img_ref = np.abs(ifftnc(kSpace_ref))
 
-            # Increment the iteration counter
-            num_iterations += 1
+        # Reconstruction
+        img_reconstructed = homodyne_reconstruction(kSpace_ref, mm, m, single=self.single_checkbox.isChecked())
 
-        # Update the main matrix of the image view widget with the interpolated image
+        # Update the main matrix of the image view widget with the reconstructed image
         self.main.image_view_widget.main_matrix = img_reconstructed
 
         figure = img_reconstructed / np.max(np.abs(img_reconstructed)) * 100
@@ -503,9 +444,61 @@ class ReconstructionTabController(ReconstructionTabWidget):
         if self.main.toolbar_image.mat_data and 'axesOrientation' in self.main.toolbar_image.mat_data:
             orientation = self.main.toolbar_image.mat_data['axesOrientation'][0]
         # Add new item to the history list
-        self.main.history_list.addNewItem(stamp="POCS",
+        self.main.history_list.addNewItem(stamp="Homodyne",
                                           image=figure,
                                           orientation=orientation,
-                                          operation="POCS - " + str(factors[-1::-1]),
+                                          operation="Homodyne - " + str(factors[-1::-1]),
+                                          space="i",
+                                          image_key=self.main.image_view_widget.image_key)
+
+    def csReconstruction(self):
+        """
+        Perform compressed sensing reconstruction in a separate thread.
+
+        Creates a new thread and runs the runCSReconstruction method in that thread.
+        """
+
+        thread = threading.Thread(target=self.runCSReconstruction)
+        thread.start()
+
+    def runCSReconstruction(self):
+        """
+        Perform compressed sensing reconstruction.
+
+        The acquired points are given by the mask of the sequence if the raw data has it (e.g. SPDS), otherwise the
+        points of the k-space equal to zero are taken as not acquired. The rest are recovered with total variation
+        (ADMM) or L1-wavelet (FISTA).
+        Updates the main matrix of the image view widget with the reconstructed image.
+        Adds the "CS" operation to the history widget.
+        """
+        method = self.cs_method_combo_box.currentText()
+        lam = float(self.cs_lambda_text_field.text())
+        n_iter = int(self.cs_niter_text_field.text())
+
+        # Get the k_space data and the mask of the acquired points
+        kSpace_ref = self.main.image_view_widget.main_matrix.copy()
+        mat_data = self.main.toolbar_image.mat_data
+        if mat_data and 'mask' in mat_data and np.size(mat_data['mask']) == np.size(kSpace_ref):
+            mask = np.reshape(np.asarray(mat_data['mask'], dtype=bool), kSpace_ref.shape)
+        else:
+            mask = kSpace_ref != 0
+        print("Acquired points: %0.1f %%" % (np.sum(mask) / np.size(mask) * 100))
+
+        # Reconstruction
+        img_reconstructed = np.abs(cs_reconstruction(kSpace_ref, mask=mask, method=method, lam=lam, n_iter=n_iter))
+
+        # Update the main matrix of the image view widget with the reconstructed image
+        self.main.image_view_widget.main_matrix = img_reconstructed
+
+        figure = img_reconstructed / np.max(np.abs(img_reconstructed)) * 100
+
+        orientation=None
+        if self.main.toolbar_image.mat_data and 'axesOrientation' in self.main.toolbar_image.mat_data:
+            orientation = self.main.toolbar_image.mat_data['axesOrientation'][0]
+        # Add new item to the history list
+        self.main.history_list.addNewItem(stamp="CS",
+                                          image=figure,
+                                          orientation=orientation,
+                                          operation="CS - %s, lambda %s" % (method.upper(), lam),
                                           space="i",
                                           image_key=self.main.image_view_widget.image_key)
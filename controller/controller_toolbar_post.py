@@ -5,7 +5,10 @@ import ctypes
 import scipy as sp
 import numpy as np
 from PyQt5.QtWidgets import QFileDialog, QLabel, QSizePolicy, QApplication, QMainWindow, QTableWidget, QTableWidgetItem, QVBoxLayout, QSlider, QWidget,QTextEdit, QTabWidget
-from scipy.interpolate import griddata
+from manager.nufftmanager import get_gridder
+from manager.mrdmanager import MrdReader, append_acquisitions, get_rare_header, get_gre_header
+from manager.matmanager import MatReader
+from manager.rawmanager import RawDataReader
 from widgets.widget_toolbar_post import ToolBarWidgetPost
 from controller.controller_plot3d import Plot3DController as Spectrum3DPlot
 from PyQt5 import QtCore
@@ -28,7 +31,7 @@ class ToolBarControllerPost(ToolBarWidgetPost):
 
     Attributes:
         k_space_raw (ndarray): Raw k-space data loaded from a .mat file.
-        mat_data (dict): Data loaded from a .mat file.
+        mat_data (MatReader): Data loaded from a .mat file. Large arrays are read on first access.
         nPoints (ndarray): Array containing the number of points in each dimension.
         k_space (ndarray): Processed k-space data.
         image_loading_button: QPushButton for loading the file and getting the k-space.
@@ -60,11 +63,15 @@ class ToolBarControllerPost(ToolBarWidgetPost):
         self.img = ismrmrd.Image()
         self.header= ismrmrd.xsd.ismrmrdHeader() 
         self.current_slice = 0
+        self.mrd_reader = None
+
+        # The data of the acquisitions are read only for the rows shown in the table
+        self.main_window.tableWidget1.verticalScrollBar().valueChanged.connect(self.fillDataColumn)
         
         
     def rawDataLoading(self, file_path=None, file_name=None):
         """
-        Load raw data from a .mat file and update the image view widget.
+        Load raw data from a .mat file or a raw .h5 file and update the image view widget.
         """
         # self.clearCurrentImage()
         # Prompt the user to select a .mat file
@@ -74,23 +81,26 @@ class ToolBarControllerPost(ToolBarWidgetPost):
         else:
             file_path = file_path+file_name
         self.main.file_name = file_name
-        self.mat_data = sp.io.loadmat(file_path)
+        if file_path.endswith('.h5'):
+            self.mat_data = RawDataReader(file_path)
+            if not self.mat_data.complete:
+                print("WARNING: The acquisition of this file did not finish.")
+        else:
+            self.mat_data = MatReader(file_path)
         self.nPoints = np.reshape(self.mat_data['nPoints'], -1)
 
+        # Only the arrays required to show the k-space are read from the file
         if self.mat_data['seqName'] == 'PETRA':
             print("Executing regridding...")
+            self.mat_data.load(['kCartesian', 'kSpaceRaw'])
 
             kCartesian = self.mat_data['kCartesian']
             self.k_space_raw = self.mat_data['kSpaceRaw']
 
-            kxOriginal = np.reshape(np.real(self.k_space_raw[:, 0]), -1)
-            kyOriginal = np.reshape(np.real(self.k_space_raw[:, 1]), -1)
-            kzOriginal = np.reshape(np.real(self.k_space_raw[:, 2]), -1)
-            kxTarget = np.reshape(kCartesian[:, 0], -1)
-            kyTarget = np.reshape(kCartesian[:, 1], -1)
-            kzTarget = np.reshape(kCartesian[:, 2], -1)
-            valCartesian = griddata((kxOriginal, kyOriginal, kzOriginal), np.reshape(self.k_space_raw[:, 3], -1),
-                                    (kxTarget, kyTarget, kzTarget), method="linear", fill_value=0, rescale=False)
+            # NUFFT gridding along the axes sampled by the trajectory
+            k = np.real(self.k_space_raw[:, 0:3])
+            axes = tuple(axis for axis in range(3) if np.ptp(k[:, axis]) > 0)
+            valCartesian = get_gridder(k, kCartesian, self.nPoints, axes=axes).grid(self.k_space_raw[:, 3])
 
             self.k_space = np.reshape(valCartesian, (self.nPoints[2], self.nPoints[1], self.nPoints[0]))
 
@@ -158,8 +168,8 @@ class ToolBarControllerPost(ToolBarWidgetPost):
         default_dir = "C:/Users/Portatil PC 6/PycharmProjects/pythonProject1/Results"
 
         # Open the file dialog and prompt the user to select a .mat file
-        file_name, _ = QFileDialog.getOpenFileName(self, "Select a .mat file", default_dir, "MAT Files (*.mat)",
-                                                   options=options)
+        file_name, _ = QFileDialog.getOpenFileName(self, "Select a .mat file", default_dir,
+                                                   "MAT Files (*.mat);;Raw Data Files (*.h5)", options=options)
 
         return file_name
     
@@ -210,7 +220,8 @@ class ToolBarControllerPost(ToolBarWidgetPost):
         Load raw data from a .h5 file and update the image view widget.
 
         Note : 
-        This code will verify if the .h5 file is from a conversion (.mat to .h5) or directly from an acquisition because both contains different information and data.
+        The acquisitions are placed in k-space with the indexes of their headers, and the points to discard are taken
+        from the headers, so files from a conversion (.mat to .h5) and from an acquisition are read in the same way.
         """
         
         if not file_path_rmd:
@@ -220,66 +231,15 @@ class ToolBarControllerPost(ToolBarWidgetPost):
             file_path_rmd = file_path_rmd+file_name_rmd
         self.main.file_name_rmd = file_name_rmd
         
-        self.load_data(file_path_rmd) #load data_rearranged
-        data=self.data #put data_rearanged into data
-        
-        if "from_mat" in file_name_rmd : # file created after a conversion
-            nPhases=self.ntotPhases
-            nSlices=self.ntotSlices
-            data3d=np.zeros((nSlices, nPhases, data[0].shape[0]))
-            count=0
-            while count<data.shape[0]:
-                for slice in range(nSlices):
-                    for phase in range(nPhases):
-                        data3d[slice, phase, :]=data[count]
-                        count+=1
-                            
-            self.data3draw=data3d
-            nReadout = data3d.shape[2]
-            complex_data3d=np.zeros((nSlices, nPhases, nReadout//2), dtype=complex)
-            
-            for slice in range(nSlices):
-                for phase in range(nPhases):
-                    for readout in range(nReadout // 2):
-                        real_part = data3d[slice, phase, 2 * readout]
-                        imag_part = data3d[slice, phase, 2 * readout + 1]
-                        complex_data3d[slice, phase, readout] = complex(real_part, imag_part)
-            self.data3d = complex_data3d             
-            self.data3dabs = np.abs(complex_data3d)    
-                       
-                            
-        else : #file created after an acquisition
-            nPhases=self.ntotPhases
-            nSlices=self.ntotSlices
-            nScans=self.ntotScans
-            
-            data4d=np.zeros((nScans, nSlices, nPhases, data[0].shape[0]))
-            count=0
-            while count<data.shape[0]:
-                for scan in range (nScans):
-                    for slice in range(nSlices):
-                        for phase in range(nPhases):
-                            data4d[scan, slice, phase, :]=data[count]
-                            count+=1
-                            
-            self.data4d=data4d
-            nReadout = data4d.shape[3]
-            addRdPoints = hw.addRdPoints
-            complex_data4d=np.zeros((nScans, nSlices, nPhases, (nReadout-2*addRdPoints)//2), dtype=complex)
-            ## Delete addRdPoints before and after
-            for scan in range(nScans):
-                for slice in range(nSlices):
-                    for phase in range(nPhases):
-                        for readout in range((nReadout-2*addRdPoints) // 2):
-                            real_part = data4d[scan, slice, phase, 2 * (readout + addRdPoints)]
-                            imag_part = data4d[scan, slice, phase, 2 * (readout + addRdPoints) + 1]
-                            complex_data4d[scan, slice, phase, readout] = complex(real_part, imag_part)
-            
-            self.complex_data4d=complex_data4d
-            self.data3d=np.mean(complex_data4d, axis=0) #mean over scans
-            self.data3dabs = np.abs(self.data3d) #abs value
-            
-            
+        # Read the k-space averaged over the scans. Readout points added by the sequence are discarded according to the
+        # header (files converted from .mat have no scans and no added points)
+        with MrdReader(file_path_rmd) as reader:
+            self.ntotPhases = reader.n_phases
+            self.ntotSlices = reader.n_slices
+            self.ntotScans = reader.n_averages
+            self.data3d = reader.read_mean()
+        self.data3dabs = np.abs(self.data3d)
+
         self.main.image_view_widget.main_matrix = self.data3d ## not abs
         
         image2show, x_label, y_label, title = self.fixImage(self.data3dabs) #abs
@@ -312,83 +272,51 @@ class ToolBarControllerPost(ToolBarWidgetPost):
     def load_data(self, file_name): 
 
         """
-        Load MRI data and header information from the specified HDF5 file,
-        rearranges the data if necessary, and populates a table in the main window with the loaded data.
+        Load the header information from the specified HDF5 file and populate a table in the main window.
+
+        The rows are sorted as k-space (scan, slice, phase) with the indexes of the headers. The data of the
+        acquisitions are read later, only for the rows shown in the table.
     
         Returns:
         None
         """
-        
-        f = h5py.File(file_name, 'r')
-        group = f['dataset']  
-        
-        header_data = group['data']['head'][()]
-        data = group['data']['data'][()]
-        
-        
-        if "from_mat" in file_name : 
-            phase_ind = np.zeros(len(header_data), dtype=int)
-            nSlices = np.zeros(len(header_data), dtype=int)
-            for i in range(len(header_data)):
-                phase_ind[i] = header_data[i][21][0]
-                nSlices[i] = header_data[i][21][3]
-            
-            ntotSlices = max(nSlices)
-            ntotPhases = max(phase_ind) 
-            
-            self.ntotSlices = ntotSlices
-            self.ntotPhases = ntotPhases
-            
-            self.data = data
-            self.header_data = header_data
-              
-            # No need to rearrange data because kSpace3D is already rearranged
+        if self.mrd_reader is not None:
+            self.mrd_reader.close()
+        self.mrd_reader = MrdReader(file_name)
+        self.ntotPhases = self.mrd_reader.n_phases
+        self.ntotSlices = self.mrd_reader.n_slices
+        self.ntotScans = self.mrd_reader.n_averages
+        self.header_data = self.mrd_reader.header[self.mrd_reader.order]
 
-        
-        else : 
-            phase_ind = np.zeros(len(header_data), dtype=int)
-            nSlices = np.zeros(len(header_data), dtype=int)
-            nScans = np.zeros(len(header_data), dtype=int)
-            for i in range(len(header_data)):
-                phase_ind[i] = header_data[i][21][0]
-                nSlices[i] = header_data[i][21][3]
-                nScans[i] = header_data[i][21][2]
-            
-            ntotSlices = max(nSlices)
-            ntotScans = max(nScans)
-            ntotPhases = max(phase_ind) 
-            
-            self.ntotSlices = ntotSlices
-            self.ntotScans = ntotScans
-            self.ntotPhases = ntotPhases
-            
-            # Rearrange data if necessary
-            
-            data_rearranged = np.zeros_like(data)
-            header_rearranged = np.zeros_like(header_data)
-            phase_counters = [0] * ntotPhases*ntotSlices*ntotScans
-            
-            for scan in range(ntotScans):
-                for slice in range(ntotSlices):
-                    for phase in range(ntotPhases):
-                        ## suppr les addrdpoints premiers et derniers
-                        index = phase + ntotPhases * (slice + ntotSlices * scan)
-                        phase_index = phase_ind[phase]-1
-                        position = phase_index + ntotPhases * (slice + ntotSlices * scan)
-                        data_rearranged[position] = data[index]
-                        header_rearranged[position] = header_data[index]
-                        phase_counters[position] += 1
-            
-            
-            self.data = data_rearranged
-            self.header_data = header_rearranged
-            
-        
         fields = [field[0] for field in ismrmrd.AcquisitionHeader._fields_]
         
-        f.close()
-        
-        self.populate_table(self.main_window.tableWidget1, self.header_data, self.data, fields)
+        self.populate_table(self.main_window.tableWidget1, self.header_data, None, fields)
+        self.fillDataColumn()
+
+    def fillDataColumn(self, value=None):
+        """
+        Fill the data column of the k-space table for the rows that are visible and not filled yet.
+
+        Args:
+            value (int, optional): Position of the scroll bar. Not used, the visible rows are taken from the table.
+
+        Returns:
+        None
+        """
+        if self.mrd_reader is None:
+            return
+        table = self.main_window.tableWidget1
+        column = table.columnCount() - 1
+        first = max(table.rowAt(0), 0)
+        last = table.rowAt(table.viewport().height() - 1)
+        if last < 0:
+            last = min(first + 50, table.rowCount()) - 1
+        rows = [row for row in range(first, last + 1) if table.item(row, column) is None]
+        if len(rows) == 0:
+            return
+        lines = self.mrd_reader.read_lines(self.mrd_reader.order[rows])
+        for row, line in zip(rows, lines):
+            table.setItem(row, column, QTableWidgetItem(str(line)))
         
     def load_image_data(self, file_name): 
 
@@ -435,7 +363,8 @@ class ToolBarControllerPost(ToolBarWidgetPost):
     
         Parameters:
         - headers (array-like): The header information to display.
-        - data (array-like): The data corresponding to the headers (data from k-space and from image)
+        - data (array-like): The data corresponding to the headers (data from k-space and from image). If None, the
+          data column is left empty.
         - fields (list): List of field names for the headers.
     
         Returns:
@@ -452,7 +381,8 @@ class ToolBarControllerPost(ToolBarWidgetPost):
         for row in range(len(headers)):
             for col in range(len(headers[row])):
                 tableWidget.setItem(row, col, QTableWidgetItem(str(headers[row][col])))
-            tableWidget.setItem(row, len(headers[row]), QTableWidgetItem(str(data[row])))
+            if data is not None:
+                tableWidget.setItem(row, len(headers[row]), QTableWidgetItem(str(data[row])))
     
     def fixImage(self, matrix3d, orientation=None):
         matrix = copy.copy(matrix3d)
@@ -551,8 +481,6 @@ class ToolBarControllerPost(ToolBarWidgetPost):
         
         if sequence_type == 'RARE':
             etl = int(mat['etl'])
-            ind = self.getIndex(etl, nPH, int(mat['sweepMode']))
-            nRep = (nPH // etl) * nSL
             
         axesOrientation = mat['axesOrientation']
         axesOrientation_list = axesOrientation.tolist()
@@ -586,112 +514,18 @@ class ToolBarControllerPost(ToolBarWidgetPost):
         dset.write_xml_header(self.header.toXML()) # Write the header to the dataset
         addRdPoints = int(mat['addRdPoints'])       
         
+        # kSpace3D is already sorted, so the acquisitions are written in k-space order and without averages
         if sequence_type == 'RARE':
-            new_data = np.zeros((nPH * nSL, nRD)) 
-            new_data = np.reshape(mat['kSpace3D'], (nSL, nPH, nRD))
-        
-            counter=0  
-            
-            for slice_idx in range(nSL):
-                for phase_idx in range(nPH):
-                    
-                    line = new_data[slice_idx, phase_idx, :]
-                    line2d = np.reshape(line, (1, nRD))
-                    acq = ismrmrd.Acquisition.from_array(line2d, None)
-                    
-                    index_in_repetition = phase_idx % etl
-                    current_repetition = (phase_idx // etl) + (slice_idx * (nPH // etl))
-                    
-                    acq.clearAllFlags()
-                    
-                    if index_in_repetition == 0: 
-                        acq.setFlag(ismrmrd.ACQ_FIRST_IN_CONTRAST)
-                    elif index_in_repetition == etl - 1:
-                        acq.setFlag(ismrmrd.ACQ_LAST_IN_CONTRAST)
-                    
-                    if phase_idx== 0:
-                        acq.setFlag(ismrmrd.ACQ_FIRST_IN_PHASE)
-                    elif phase_idx == nPH - 1:
-                        acq.setFlag(ismrmrd.ACQ_LAST_IN_PHASE)
-                    
-                    if slice_idx == 0:
-                        acq.setFlag(ismrmrd.ACQ_FIRST_IN_SLICE)
-                    elif slice_idx == nSL - 1:
-                        acq.setFlag(ismrmrd.ACQ_LAST_IN_SLICE)
-                        
-                    if int(current_repetition) == 0:
-                        acq.setFlag(ismrmrd.ACQ_FIRST_IN_REPETITION)
-                    elif int(current_repetition) == nRep - 1:
-                        acq.setFlag(ismrmrd.ACQ_LAST_IN_REPETITION)
-                    
-                    
-                    counter += 1 
-                    
-                    # +1 to start at 1 instead of 0
-                    acq.idx.repetition = int(current_repetition + 1)
-                    acq.idx.kspace_encode_step_1 = phase_idx+1 # phase
-                    acq.idx.slice = slice_idx + 1
-                    acq.idx.contrast = index_in_repetition + 1
-                    
-                    acq.scan_counter = counter
-                    # acq.discard_pre = addRdPoints
-                    # acq.discard_post = addRdPoints #######""
-                    acq.sample_time_us = 1/bw
-                    acq.position=(ctypes.c_float * 3)(*mat['dfov']) 
-                    
-                    acq.read_dir = (ctypes.c_float * 3)(*read_dir)
-                    acq.phase_dir = (ctypes.c_float * 3)(*phase_dir)
-                    acq.slice_dir = (ctypes.c_float * 3)(*slice_dir)
-                    
-                    dset.append_acquisition(acq) # Append the acquisition to the dataset   
-                
+            header = get_rare_header(1, nSL, nPH, etl, averages=False)
         elif sequence_type == 'GRE3D':
-            new_data = np.reshape(mat['kSpace3D'], (nSL, nPH, nRD)) 
-            counter = 0
-        
-            for slice_idx in range(nSL):
-                for phase_idx in range(nPH):
-                        line = new_data[slice_idx, phase_idx, :]
-                        line2d = np.reshape(line, (1, nRD))
-                        acq = ismrmrd.Acquisition.from_array(line2d, None)
-                        
-                        counter += 1
-                    
-                        acq.idx.repetition = counter
-                        acq.idx.kspace_encode_step_1 = phase_idx + 1
-                        acq.idx.slice = slice_idx + 1
-                
-                        
-                        acq.clearAllFlags()
-                        
-                        if phase_idx == 0:
-                            acq.setFlag(ismrmrd.ACQ_FIRST_IN_PHASE)
-                        elif phase_idx == nPH - 1:
-                            acq.setFlag(ismrmrd.ACQ_LAST_IN_PHASE)
-                        
-                        if slice_idx == 0:
-                            acq.setFlag(ismrmrd.ACQ_FIRST_IN_SLICE)
-                        elif slice_idx == nSL - 1:
-                            acq.setFlag(ismrmrd.ACQ_LAST_IN_SLICE)
-                        
-                        if counter == 1:
-                            acq.setFlag(ismrmrd.ACQ_FIRST_IN_AVERAGE)
-                        elif counter == nPH*nSL:
-                            acq.setFlag(ismrmrd.ACQ_LAST_IN_AVERAGE)
-                        
-                        
-                        acq.scan_counter = counter
-                        # acq.discard_pre = hw.addRdPoints
-                        # acq.discard_post = hw.addRdPoints
-                        acq.sample_time_us = 1/bw
-                        acq.position=(ctypes.c_float * 3)(*mat['dfov'])  
-                        acq.read_dir = (ctypes.c_float * 3)(*read_dir) 
-                        acq.phase_dir = (ctypes.c_float * 3)(*phase_dir)
-                        acq.slice_dir = (ctypes.c_float * 3)(*slice_dir)
-                        
-                        
-                        # Ajouter l'acquisition au dataset
-                        dset.append_acquisition(acq)
+            header = get_gre_header(1, nSL, nPH, averages=False)
+        if sequence_type in ['RARE', 'GRE3D']:
+            header.update(sample_time_us=1/bw,
+                          position=mat['dfov'],
+                          read_dir=read_dir,
+                          phase_dir=phase_dir,
+                          slice_dir=slice_dir)
+            append_acquisitions(dset, np.reshape(mat['kSpace3D'], (nSL * nPH, nRD)), header)
         
         image=mat['image3D']
         image_reshaped = np.reshape(image, (nSL, nPH, nRD))
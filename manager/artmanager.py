@@ -0,0 +1,154 @@
+"""
+@author: J.M. Algarín, MRILab, i3M, CSIC, Valencia
+@email: josalggui@i3m.upv.es
+@Summary: block algebraic reconstruction (block-Kaczmarz ART and SIRT) of non-Cartesian k-space data on the CPU
+"""
+
+import numpy as np
+import scipy.linalg as linalg
+
+
+class EncodingBlock:
+    """
+    Encoding matrix of a block of k-space samples over a Cartesian grid of voxels.
+
+    The encoding matrix exp(-2*pi*i*k*r) is never built. As the voxels are in a Cartesian grid, each row is the outer
+    product of three 1D exponentials, so the products with the matrix are done axis by axis with matrix products. The
+    memory scales with block_size * (nz * ny) instead of block_size * (nz * ny * nx), and only
+    block_size * (nx + ny + nz) exponentials are evaluated per block.
+    """
+
+    def __init__(self, k, x, y, z):
+        """
+        Initialize the block.
+
+        Args:
+            k (np.ndarray): k-space points of the block with shape (n_samples, 3) in 1/m.
+            x (np.ndarray): x coordinates of the grid in m.
+            y (np.ndarray): y coordinates of the grid in m.
+            z (np.ndarray): z coordinates of the grid in m.
+        """
+        self.ex = np.exp(-2j * np.pi * np.outer(k[:, 0], x))
+        self.ey = np.exp(-2j * np.pi * np.outer(k[:, 1], y))
+        self.ez = np.exp(-2j * np.pi * np.outer(k[:, 2], z))
+        self.shape = (len(z), len(y), len(x))
+
+    def forward(self, rho):
+        """
+        Get the signal of the block samples for the image rho.
+
+        Args:
+            rho (np.ndarray): Image with shape (nz, ny, nx).
+
+        Returns:
+            np.ndarray: Signal of each sample of the block.
+        """
+        nz, ny, nx = self.shape
+        t1 = np.reshape(np.reshape(rho, (nz * ny, nx)) @ self.ex.T, (nz, ny, -1))
+        t2 = np.einsum('zyj,jy->zj', t1, self.ey)
+        return np.einsum('zj,jz->j', t2, self.ez)
+
+    def adjoint(self, r):
+        """
+        Get the product of the conjugate transpose of the encoding matrix with a vector.
+
+        Args:
+            r (np.ndarray): Value for each sample of the block.
+
+        Returns:
+            np.ndarray: Image with shape (nz, ny, nx).
+        """
+        nz, ny, nx = self.shape
+        w = np.conj(self.ez)[:, :, None] * np.conj(self.ey)[:, None, :] * np.reshape(r, (-1, 1, 1))
+        return np.reshape(np.reshape(w, (-1, nz * ny)).T @ np.conj(self.ex), self.shape)
+
+    def gram(self):
+        """
+        Get the Gram matrix A * A^H of the block, obtained as the product of the Gram matrices of each axis.
+
+        Returns:
+            np.ndarray: Gram matrix with shape (n_samples, n_samples).
+        """
+        return (self.ex @ np.conj(self.ex.T)) * (self.ey @ np.conj(self.ey.T)) * (self.ez @ np.conj(self.ez.T))
+
+
+def art_reconstruction(k, s, x, y, z, lbda=1.0, n_iter=1, block_size=256, method='kaczmarz', regularization=1e-3,
+                       rho=None):
+    """
+    Reconstruct an image from non-Cartesian k-space data with block ART.
+
+    The samples are shuffled in each iteration and processed in blocks of block_size samples:
+        - 'kaczmarz': block-Kaczmarz, each block is projected onto its solution set through the Gram matrix of the
+          block. With block_size=1 and regularization=0 it is the sample by sample ART.
+        - 'sirt': the corrections of all the blocks are accumulated and applied once per iteration, with step
+          lbda / ||A||^2. The norm of the encoding matrix is estimated with a few power iterations.
+    The heavy operations are matrix products, so numpy uses all the cores of the CPU.
+
+    Args:
+        k (np.ndarray): k-space points with shape (n_samples, 3) in 1/m.
+        s (np.ndarray): Signal of each k-space point.
+        x (np.ndarray): x coordinates of the grid in m.
+        y (np.ndarray): y coordinates of the grid in m.
+        z (np.ndarray): z coordinates of the grid in m.
+        lbda (float): Relaxation parameter.
+        n_iter (int): Number of iterations.
+        block_size (int): Number of samples per block. It bounds the memory used per update.
+        method (str): 'kaczmarz' or 'sirt'.
+        regularization (float): Tikhonov regularization of the Gram matrix, relative to the number of voxels.
+        rho (np.ndarray, optional): Initial image with shape (nz, ny, nx).
+
+    Returns:
+        np.ndarray: Reconstructed image with shape (nz, ny, nx).
+    """
+    k = np.asarray(k, dtype=float)
+    s = np.reshape(s, -1)
+    n_samples = len(s)
+    n_voxels = len(x) * len(y) * len(z)
+    if rho is None:
+        rho = np.zeros((len(z), len(y), len(x)), dtype=complex)
+    else:
+        rho = np.array(np.reshape(rho, (len(z), len(y), len(x))), dtype=complex)
+
+    index = np.arange(n_samples)
+    n_blocks = int(np.ceil(n_samples / block_size))
+    if method == 'sirt':
+        step = lbda / _get_norm2(k, x, y, z, block_size)
+    for iteration in range(n_iter):
+        np.random.shuffle(index)
+        d_rho = np.zeros_like(rho) if method == 'sirt' else None
+        m = 0
+        for block_idx in range(n_blocks):
+            samples = index[block_idx * block_size:(block_idx + 1) * block_size]
+            block = EncodingBlock(k[samples, :], x, y, z)
+            residual = block.forward(rho) - s[samples]
+            if method == 'sirt':
+                d_rho += block.adjoint(residual)
+            else:
+                gram = block.gram()
+                gram[np.diag_indices_from(gram)] += regularization * n_voxels
+                rho -= lbda * block.adjoint(linalg.solve(gram, residual, assume_a='her'))
+
+            # Show progress every 10 %
+            if int(10 * (block_idx + 1) / n_blocks) > m:
+                m = int(10 * (block_idx + 1) / n_blocks)
+                print("ART iteration %i: %i %%" % (iteration + 1, 10 * m))
+
+        if method == 'sirt':
+            rho -= step * d_rho
+
+    return rho
+
+
+def _get_norm2(k, x, y, z, block_size, n_power=5):
+    # Estimate the squared spectral norm of the encoding matrix with power iterations of A^H * A
+    v = np.random.randn(len(z), len(y), len(x)) + 1j * np.random.randn(len(z), len(y), len(x))
+    norm2 = 1.0
+    for ii in range(n_power):
+        v /= np.linalg.norm(v)
+        w = np.zeros_like(v)
+        for start in range(0, k.shape[0], block_size):
+            block = EncodingBlock(k[start:start + block_size, :], x, y, z)
+            w += block.adjoint(block.forward(v))
+        norm2 = np.real(np.vdot(v, w))
+        v = w
+    return norm2
@@ -0,0 +1,126 @@
+"""
+@author: J.M. Algarín, MRILab, i3M, CSIC, Valencia
+@email: josalggui@i3m.upv.es
+@Summary: tiled BM4D denoising in a pool of workers and estimation of the image noise from the acquired noise data
+"""
+
+import os
+import numpy as np
+import scipy.signal as sig
+import bm4d
+import configs.hw_config as hw
+from manager.poolmanager import get_executor
+
+
+def estimate_noise_std(noise_data, n_points, n_scans=1, factor=None):
+    """
+    Estimate the standard deviation of the noise of the image reconstructed with the inverse FFT of the k-space.
+
+    The noise data is decimated as the k-space data, so that it has the same bandwidth, and the standard deviation of
+    the real and imaginary parts is scaled by the averages of the scans and by the normalization of the inverse FFT
+    (1 / n_points, so the noise of the image is std / sqrt(n_points)).
+
+    Args:
+        noise_data (np.ndarray): Noise acquired without excitation, oversampled by `factor` (e.g. noiseData of RARE).
+        n_points (int): Number of points of the k-space.
+        n_scans (int): Number of scans averaged in the k-space.
+        factor (int, optional): Oversampling factor of the noise data. If None, hw.oversamplingFactor. Use 1 if the
+            noise is already decimated.
+
+    Returns:
+        float: Standard deviation of the noise of each component of the image.
+    """
+    if factor is None:
+        factor = hw.oversamplingFactor
+    noise = np.ravel(noise_data)
+    if factor > 1:
+        noise = sig.decimate(noise, factor, ftype='fir', zero_phase=True)
+
+    # Skip the edges of the filter
+    n_edge = min(10, noise.size // 4)
+    noise = noise[n_edge:noise.size - n_edge]
+    std = np.sqrt((np.var(np.real(noise)) + np.var(np.imag(noise))) / 2)
+
+    return std / np.sqrt(n_scans * n_points)
+
+
+def bm4d_filter(image, sigma_psd, fast=False, tile_size=64, overlap=12, n_workers=None, processes=False):
+    """
+    Denoise a 3D image with BM4D, splitting it into overlapping tiles processed in parallel.
+
+    Each axis larger than tile_size is split into tiles of up to tile_size points that overlap by `overlap` points.
+    The tiles are denoised in a pool of threads, as the bm4d core releases the GIL, and blended back with linear ramps
+    in the overlaps, so there are no seams.
+    The overlap should be larger than the block matching search window, so that the tiles see the same neighbours as
+    the full volume. In fast mode only the hard thresholding stage is run, skipping the Wiener filtering.
+
+    Args:
+        image (np.ndarray): Real 3D image.
+        sigma_psd (float): Standard deviation of the noise, in the units of the image.
+        fast (bool): If True, only the hard thresholding stage is run.
+        tile_size (int): Number of points of the tiles along each axis.
+        overlap (int): Number of points shared by neighbouring tiles.
+        n_workers (int, optional): Number of workers. If None, the number of cores of the CPU.
+        processes (bool): If True, the workers are forked processes instead of threads (see poolmanager.get_executor).
+
+    Returns:
+        np.ndarray: Denoised image.
+    """
+    image = np.asarray(image, dtype=float)
+    stage_arg = bm4d.BM4DStages.HARD_THRESHOLDING if fast else bm4d.BM4DStages.ALL_STAGES
+    tiles = _get_tiles(image.shape, tile_size, overlap)
+    if n_workers is None:
+        n_workers = os.cpu_count()
+    n_workers = max(min(n_workers, len(tiles)), 1)
+
+    # Denoise the tiles
+    jobs = [(image[tile], sigma_psd, stage_arg) for tile in tiles]
+    if n_workers == 1:
+        results = [_denoise_tile(job) for job in jobs]
+    else:
+        with get_executor(n_workers, processes=processes) or get_executor(n_workers) as executor:
+            results = list(executor.map(_denoise_tile, jobs))
+
+    # Blend the tiles
+    if len(tiles) == 1:
+        return results[0]
+    denoised = np.zeros(image.shape)
+    weights = np.zeros(image.shape)
+    for tile, result in zip(tiles, results):
+        weight = _get_tile_weights(tile, image.shape, overlap)
+        denoised[tile] += result * weight
+        weights[tile] += weight
+    return denoised / weights
+
+
+def _denoise_tile(job):
+    tile, sigma_psd, stage_arg = job
+    return bm4d.bm4d(tile, sigma_psd=sigma_psd, profile=bm4d.BM4DProfile(), stage_arg=stage_arg,
+                     blockmatches=(False, False))
+
+
+def _get_tiles(shape, tile_size, overlap):
+    # Slices of the tiles. Each axis is split into the minimum number of tiles of up to tile_size points overlapping by
+    # at least `overlap` points, with the same length, so that the extra work of the overlaps is the minimum
+    axis_slices = []
+    for n in shape:
+        n_tiles = max(int(np.ceil((n - overlap) / (tile_size - overlap))), 1)
+        length = int(np.ceil((n + (n_tiles - 1) * overlap) / n_tiles))
+        starts = np.round(np.linspace(0, n - length, n_tiles)).astype(int)
+        axis_slices.append([slice(start, start + length) for start in starts])
+    return [(sz, sy, sx) for sz in axis_slices[0] for sy in axis_slices[1] for sx in axis_slices[2]]
+
+
+def _get_tile_weights(tile, shape, overlap):
+    # Linear ramps at the edges of the tile that are inside the volume, so that the weights of neighbouring tiles sum
+    # to one in the overlaps
+    weights = np.ones([s.stop - s.start for s in tile])
+    ramp = (np.arange(overlap) + 0.5) / overlap
+    for axis, s in enumerate(tile):
+        w = np.ones(s.stop - s.start)
+        if s.start > 0:
+            w[0:overlap] = ramp
+        if s.stop < shape[axis]:
+            w[-overlap::] = np.minimum(w[-overlap::], ramp[::-1])
+        weights = weights * np.reshape(w, [-1 if ii == axis else 1 for ii in range(3)])
+    return weights
@@ -0,0 +1,159 @@
+"""
+@author: J.M. Algarín, MRILab, i3M, CSIC, Valencia
+@email: josalggui@i3m.upv.es
+@Summary: in-memory LRU cache of the compiled waveforms of the sequences, so that repeated acquisitions with the same
+inputs do not need to create and interpret the sequence again
+"""
+
+import hashlib
+import types
+from collections import OrderedDict
+
+import numpy as np
+import configs.hw_config as hw
+
+
+class WaveformCache:
+    """
+    Least recently used cache of compiled waveforms.
+
+    The cache key is a hash of the sequence class, the input parameters of the sequence (mapVals of the mapKeys) and
+    the hw_config values, so the compiled waveforms are reused only if nothing that could change them has changed.
+    When the cache is full, the least recently used waveforms are removed.
+
+    Attributes:
+        max_bytes (int): Maximum size in bytes of the stored arrays.
+        max_items (int): Maximum number of stored items.
+        hits (int): Number of times that the waveforms were found in the cache.
+        misses (int): Number of times that the waveforms had to be compiled.
+    """
+
+    def __init__(self, max_bytes=512 * 2**20, max_items=32):
+        """
+        Initialize an empty cache.
+
+        Args:
+            max_bytes (int): Maximum size in bytes of the stored arrays.
+            max_items (int): Maximum number of stored items.
+        """
+        self.max_bytes = max_bytes
+        self.max_items = max_items
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._n_bytes = {}
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __repr__(self):
+        return "WaveformCache(items=%i, MB=%0.1f, hits=%i, misses=%i)" % \
+               (len(self), self.n_bytes / 2**20, self.hits, self.misses)
+
+    @property
+    def n_bytes(self):
+        return sum(self._n_bytes.values())
+
+    def get_key(self, sequence, name='', *args):
+        """
+        Get the key of the compiled waveforms of a sequence.
+
+        Args:
+            sequence (MRIBLANKSEQ): Sequence with the input parameters in mapVals.
+            name (str): Name of the function that compiles the waveforms.
+            *args: Additional arguments given to the function that compiles the waveforms.
+
+        Returns:
+            str: Hexadecimal hash of the inputs.
+        """
+        key = hashlib.sha1()
+        _update_hash(key, type(sequence).__name__)
+        _update_hash(key, name)
+        _update_hash(key, args)
+        _update_hash(key, {k: sequence.mapVals[k] for k in sequence.mapKeys if k in sequence.mapVals})
+        _update_hash(key, {k: v for k, v in vars(hw).items() if not k.startswith('_') and
+                           not isinstance(v, (types.ModuleType, types.FunctionType, type))})
+        return key.hexdigest()
+
+    def get(self, key):
+        """
+        Get the waveforms saved with the given key and update the hit and miss counters.
+
+        Args:
+            key (str): Key given by get_key().
+
+        Returns:
+            object: Saved waveforms, or None if the key is not in the cache.
+        """
+        if key in self._items:
+            self.hits += 1
+            self._items.move_to_end(key)
+            return self._items[key]
+        else:
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        """
+        Save the waveforms into the cache, removing the least recently used ones if the cache is full.
+
+        Args:
+            key (str): Key given by get_key().
+            value (object): Compiled waveforms. Usually a tuple with dictionaries of numpy arrays.
+        """
+        n_bytes = _get_n_bytes(value)
+        if n_bytes > self.max_bytes:
+            return
+        self._items[key] = value
+        self._n_bytes[key] = n_bytes
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_items or self.n_bytes > self.max_bytes:
+            old_key, _ = self._items.popitem(last=False)
+            self._n_bytes.pop(old_key)
+
+    def clear(self):
+        """
+        Remove all the waveforms and reset the counters.
+        """
+        self._items.clear()
+        self._n_bytes.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+def _update_hash(key, value):
+    # Add a canonical representation of the value to the hash, independent of the dictionary order
+    if isinstance(value, np.ndarray):
+        key.update(b'ndarray')
+        key.update(str((value.dtype.str, value.shape)).encode())
+        key.update(np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, dict):
+        key.update(b'dict')
+        for k in sorted(value, key=str):
+            _update_hash(key, k)
+            _update_hash(key, value[k])
+    elif isinstance(value, (list, tuple)):
+        key.update(b'list')
+        for item in value:
+            _update_hash(key, item)
+    else:
+        key.update(repr(value).encode())
+
+
+def _get_n_bytes(value):
+    # Size of the numpy arrays contained in the value
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    elif isinstance(value, dict):
+        return sum(_get_n_bytes(item) for item in value.values())
+    elif isinstance(value, (list, tuple)):
+        return sum(_get_n_bytes(item) for item in value)
+    else:
+        return 0
+
+
+# Cache shared by all the sequences
+waveform_cache = WaveformCache()
@@ -0,0 +1,252 @@
+"""
+@author: J.M. Algarín, MRILab, i3M, CSIC, Valencia
+@email: josalggui@i3m.upv.es
+@Summary: compressed sensing reconstruction (L1-wavelet with FISTA and total variation with ADMM) of undersampled
+Cartesian k-space data, and variable density undersampling masks
+"""
+
+import numpy as np
+import scipy.fft as fft
+from manager.fftmanager import fft_service
+
+
+def cs_reconstruction(k_space, mask=None, method='tv', lam=0.01, n_iter=50, threshold=1e-4, rho=0.5, levels=3,
+                      single=False):
+    """
+    Reconstruct undersampled Cartesian k-space data with compressed sensing.
+
+    The image x minimizes 1/2 * ||M F x - y||^2 + lambda * R(x), where M is the sampling mask, F the FFT and y the
+    acquired data. With method='wavelet', R is the L1 norm of the orthonormal Haar wavelet coefficients and the problem
+    is solved with FISTA. With method='tv', R is the isotropic total variation and the problem is solved with ADMM,
+    where the image update is solved exactly in k-space, as the FFT diagonalizes both the mask and the circular finite
+    differences.
+
+    The FFTs are unitary and run without shifts during the iterations, and leading axes of k_space (e.g. scans or
+    echoes) are reconstructed as a batch. lam is relative to the maximum of the zero-filled image, so it does not
+    depend on the units of the data.
+
+    Args:
+        k_space (np.ndarray): k-space data with shape (..., nz, ny, nx) and the center of k-space in the middle.
+        mask (np.ndarray, optional): Boolean mask of the acquired points, broadcastable to k_space. If None, the points
+            different from zero are the acquired points.
+        method (str): 'tv' or 'wavelet'.
+        lam (float): Regularization weight relative to the maximum of the zero-filled image.
+        n_iter (int): Maximum number of iterations.
+        threshold (float): Relative change of the image between iterations to stop.
+        rho (float): Penalty parameter of ADMM. Only used with method='tv'.
+        levels (int): Number of levels of the wavelet transform. Only used with method='wavelet'.
+        single (bool): If True, the reconstruction is done in complex64.
+
+    Returns:
+        np.ndarray: Complex image with the same shape and scale as ifftnc(k_space).
+    """
+    axes = (-3, -2, -1)
+    dtype = np.complex64 if single else complex
+    k_space = np.asarray(k_space)
+    if mask is None:
+        mask = k_space != 0
+    mask = np.broadcast_to(np.asarray(mask, dtype=bool), k_space.shape)
+    n_points = np.prod(k_space.shape[-3:])
+
+    # Acquired data and mask without shifts
+    y = np.fft.ifftshift(np.where(mask, k_space, 0), axes=axes).astype(dtype)
+    m = np.fft.ifftshift(mask, axes=axes)
+
+    # Zero-filled image
+    x = fft.ifftn(y, axes=axes, norm='ortho', workers=fft_service.workers)
+    reference = np.max(np.abs(x))
+    if reference > 0:
+        if method == 'wavelet':
+            x = _fista_wavelet(y, m, x, lam * reference, n_iter, threshold, levels)
+        elif method == 'tv':
+            x = _admm_tv(y, m, x, lam * reference, rho, n_iter, threshold)
+        else:
+            print("ERROR: Unknown compressed sensing method '%s'. Zero-filled image is used." % method)
+
+    return np.fft.ifftshift(x, axes=axes) / np.sqrt(n_points)
+
+
+def get_variable_density_mask(distance, factor, center=0.2, power=2, seed=0):
+    """
+    Get a random undersampling mask with the density decreasing from the center of k-space.
+
+    Points with normalized distance to the center below `center` are always acquired. The probability of the other
+    points is proportional to (1 - distance)^power, scaled to acquire 1/factor of the points inside the unit sphere.
+    The seed makes the mask reproducible, so the sequence and the reconstruction use the same mask.
+
+    Args:
+        distance (np.ndarray): Normalized distance of each point to the center of k-space, with 1 the edge.
+        factor (float): Undersampling factor. With factor <= 1 all the points inside the unit sphere are acquired.
+        center (float): Normalized radius of the fully sampled center.
+        power (float): Power of the decay of the density.
+        seed (int): Seed of the random generator.
+
+    Returns:
+        np.ndarray: Boolean mask with the same shape as distance.
+    """
+    inside = distance <= 1
+    if factor <= 1:
+        return inside
+
+    # Scale of the density to get the number of points, by bisection
+    n_target = np.sum(inside) / factor
+    density = np.where(inside, (1 - np.minimum(distance, 1)) ** power, 0.0)
+    density[distance <= center] = np.inf
+    low, high = 0.0, 1.0
+    while np.sum(np.minimum(high * density, 1)) < n_target and high < 1e12:
+        high *= 2
+    for _ in range(50):
+        scale = (low + high) / 2
+        if np.sum(np.minimum(scale * density, 1)) < n_target:
+            low = scale
+        else:
+            high = scale
+    probability = np.minimum(high * density, 1)
+
+    rng = np.random.default_rng(seed)
+    return rng.random(np.shape(distance)) < probability
+
+
+def _fista_wavelet(y, m, x, lam, n_iter, threshold, levels):
+    # FISTA with step 1, as the FFT is unitary and the mask is a projection
+    axes = (-3, -2, -1)
+    plan, low_shape = _get_haar_plan(y.shape[-3:], levels)
+    low_pass = (Ellipsis,) + tuple(slice(0, n) for n in low_shape)
+    z = x.copy()
+    t = 1.0
+    for iteration in range(n_iter):
+        # Gradient step: restore the acquired points in k-space
+        k = fft.fftn(z, axes=axes, norm='ortho', workers=fft_service.workers)
+        np.copyto(k, y, where=m)
+        r = fft.ifftn(k, axes=axes, norm='ortho', workers=fft_service.workers, overwrite_x=True)
+
+        # Soft thresholding of the wavelet coefficients, except the low pass band
+        coefficients = _haar_forward(r, plan)
+        approximation = coefficients[low_pass].copy()
+        _soft_threshold(coefficients, lam)
+        coefficients[low_pass] = approximation
+        x_new = _haar_inverse(coefficients, plan)
+
+        # Momentum
+        t_new = (1 + np.sqrt(1 + 4 * t ** 2)) / 2
+        change = np.linalg.norm(x_new - x) / max(np.linalg.norm(x_new), np.finfo(float).tiny)
+        z = x_new + ((t - 1) / t_new) * (x_new - x)
+        x, t = x_new, t_new
+        print("Iteration: %i, Convergence: %0.2e" % (iteration, change))
+        if change <= threshold:
+            break
+
+    return x
+
+
+def _admm_tv(y, m, x, lam, rho, n_iter, threshold):
+    # ADMM with the splitting z = D x, being D the circular finite differences along the last three axes
+    axes = (-3, -2, -1)
+    shape = y.shape[-3:]
+    real = y.real.dtype
+
+    # Eigenvalues of D^T D in k-space without shifts
+    laplacian = np.zeros(shape, dtype=real)
+    for axis, n in enumerate(shape):
+        eigenvalues = 2 - 2 * np.cos(2 * np.pi * np.arange(n) / n)
+        laplacian = laplacian + np.reshape(eigenvalues.astype(real), [-1 if ii == axis else 1 for ii in range(3)])
+    denominator = m + rho * laplacian
+    denominator[denominator == 0] = 1
+
+    z = _gradient(x)
+    u = np.zeros_like(z)
+    for iteration in range(n_iter):
+        # Image update, solved in k-space
+        k = fft.fftn(rho * _gradient_adjoint(z - u), axes=axes, norm='ortho', workers=fft_service.workers,
+                     overwrite_x=True)
+        k += y
+        k /= denominator
+        x_new = fft.ifftn(k, axes=axes, norm='ortho', workers=fft_service.workers, overwrite_x=True)
+
+        # Shrinkage of the gradient and update of the dual variable
+        d = _gradient(x_new)
+        z = d + u
+        _shrink(z, lam / rho)
+        u += d - z
+
+        # The first update gives the zero-filled image again, as z starts at its gradient
+        change = np.linalg.norm(x_new - x) / max(np.linalg.norm(x_new), np.finfo(float).tiny)
+        x = x_new
+        print("Iteration: %i, Convergence: %0.2e" % (iteration, change))
+        if iteration > 0 and change <= threshold:
+            break
+
+    return x
+
+
+def _gradient(x):
+    # Forward circular differences along the last three axes, stacked in the first axis
+    return np.stack([np.roll(x, -1, axis=axis) - x for axis in (-3, -2, -1)])
+
+
+def _gradient_adjoint(g):
+    # Adjoint of _gradient
+    return sum(np.roll(g[ii], 1, axis=axis) - g[ii] for ii, axis in enumerate((-3, -2, -1)))
+
+
+def _shrink(g, t):
+    # Isotropic shrinkage of the gradient in place
+    norm = np.sqrt(np.sum(np.abs(g) ** 2, axis=0))
+    g *= np.maximum(1 - t / np.maximum(norm, np.finfo(norm.dtype).tiny), 0)
+
+
+def _soft_threshold(c, t):
+    # Complex soft thresholding in place
+    magnitude = np.abs(c)
+    c *= np.maximum(1 - t / np.maximum(magnitude, np.finfo(magnitude.dtype).tiny), 0)
+
+
+def _get_haar_plan(shape, levels):
+    # Shape of the block transformed at each level and its axes with an even number of points, that are split, and
+    # shape of the final low pass band
+    plan = []
+    shape = list(shape)
+    for level in range(levels):
+        axes = [axis for axis, n in enumerate(shape) if n >= 2 and n % 2 == 0]
+        if len(axes) == 0:
+            break
+        plan.append((tuple(shape), axes))
+        shape = [n // 2 if axis in axes else n for axis, n in enumerate(shape)]
+    return plan, tuple(shape)
+
+
+def _haar_forward(x, plan):
+    # Orthonormal Haar transform along the last three axes, with the low pass band at the beginning of each axis
+    c = np.array(x, copy=True)
+    for block, axes in plan:
+        index = (Ellipsis,) + tuple(slice(0, n) for n in block)
+        data = c[index]
+        for axis in axes:
+            even = data[_axis_slice(axis, slice(0, None, 2))]
+            odd = data[_axis_slice(axis, slice(1, None, 2))]
+            data = np.concatenate(((even + odd) / np.sqrt(2), (even - odd) / np.sqrt(2)), axis=axis - 3)
+        c[index] = data
+    return c
+
+
+def _haar_inverse(c, plan):
+    # Inverse of _haar_forward
+    x = np.array(c, copy=True)
+    for block, axes in reversed(plan):
+        index = (Ellipsis,) + tuple(slice(0, n) for n in block)
+        data = x[index]
+        for axis in reversed(axes):
+            half = block[axis] // 2
+            low_band = data[_axis_slice(axis, slice(0, half))]
+            high_band = data[_axis_slice(axis, slice(half, None))]
+            result = np.empty_like(data)
+            result[_axis_slice(axis, slice(0, None, 2))] = (low_band + high_band) / np.sqrt(2)
+            result[_axis_slice(axis, slice(1, None, 2))] = (low_band - high_band) / np.sqrt(2)
+            data = result
+        x[index] = data
+    return x
+
+
+def _axis_slice(axis, s):
+    # Index applying the slice s to one of the last three axes
+    return (Ellipsis,) + tuple(s if ii == axis else slice(None) for ii in range(3))
@@ -0,0 +1,119 @@
+"""
+@author: J.M. Algarín, MRILab, i3M, CSIC, Valencia
+@email: josalggui@i3m.upv.es
+@Summary: streaming decimation of the oversampled data, so that the data can be decimated as the scans arrive
+"""
+
+import numpy as np
+import scipy.signal as sig
+import configs.hw_config as hw
+from manager.rxmanager import RxBuffer
+
+
+class StreamDecimator:
+    """
+    Streaming equivalent of sig.decimate(data, factor, ftype='fir', zero_phase=True).
+
+    The oversampled data is given in consecutive chunks (e.g. one scan of a batch) with feed(), and each chunk is
+    filtered as soon as the samples required by the FIR filter are available. Only the last samples of the previous
+    chunks are kept to filter across the chunk boundaries, so the result is the same than decimating the full array at
+    the end. Oversampled and decimated data are written into preallocated RxBuffer.
+
+    Attributes:
+        factor (int): Decimation factor.
+        data_decimated (np.ndarray): View of the decimated data available up to now.
+        data_over (np.ndarray): View of the oversampled data fed up to now, only if keep_input is True.
+    """
+
+    def __init__(self, n_points=None, factor=None, offset=0, keep_input=False, dtype=complex):
+        """
+        Initialize the decimator.
+
+        Args:
+            n_points (int, optional): Expected number of oversampled points, used to preallocate the buffers. If None,
+                the buffers grow as needed.
+            factor (int, optional): Decimation factor. If None, hw.oversamplingFactor.
+            offset (int): Number of oversampled points to skip at the beginning of the data.
+            keep_input (bool): If True, the oversampled data is also kept in a preallocated buffer.
+            dtype (type): Data type of the buffers (complex or np.complex64).
+        """
+        if factor is None:
+            factor = hw.oversamplingFactor
+        self.factor = factor
+        self._half_len = 10 * factor
+        self._filter = sig.firwin(2 * self._half_len + 1, 1. / factor, window='hamming')
+        self._offset = offset
+        self._dtype = dtype
+
+        # Samples of the input waiting for the next chunk, starting with the zero padding of the filter
+        self._buffer = np.zeros(self._half_len, dtype=dtype)
+        self._n_input = 0  # Number of input samples after the offset
+        self._n_output = 0  # Number of decimated samples
+
+        # Preallocated buffers
+        if n_points is None:
+            n_points = 1024 * factor
+        self._output = RxBuffer(n_points=-(-max(n_points - offset, 0) // factor), dtype=dtype)
+        self._input = RxBuffer(n_points=n_points, dtype=dtype) if keep_input else None
+        self._n_fed = 0  # Number of input samples including the offset
+
+    @property
+    def data_decimated(self):
+        return self._output.data
+
+    @property
+    def data_over(self):
+        if self._input is None:
+            return None
+        return self._input.data
+
+    def feed(self, data):
+        """
+        Add a new chunk of oversampled data and decimate it.
+
+        Args:
+            data (np.ndarray): Oversampled data, in acquisition order.
+
+        Returns:
+            np.ndarray: View of the decimated data obtained from this chunk.
+        """
+        if self._input is not None:
+            data = self._input.write(data)
+        else:
+            data = np.ravel(data)
+
+        # Skip the offset
+        skip = min(max(self._offset - self._n_fed, 0), data.size)
+        self._n_fed += data.size
+        data = data[skip::]
+        self._n_input += data.size
+        self._buffer = np.concatenate((self._buffer, data))
+
+        # Decimate the samples with all the filter taps available
+        n_ready = (self._n_input - 1 - self._half_len) // self.factor + 1 - self._n_output
+        return self._decimate(n_ready)
+
+    def finish(self):
+        """
+        Decimate the last samples, using zero padding at the end of the data as sig.decimate does.
+
+        Returns:
+            np.ndarray: Decimated data.
+        """
+        self._buffer = np.concatenate((self._buffer, np.zeros(self._half_len, dtype=self._dtype)))
+        n_ready = -(-self._n_input // self.factor) - self._n_output
+        self._decimate(n_ready)
+        return self.data_decimated
+
+    def _decimate(self, n_ready):
+        # Filter and decimate the next n_ready output samples. The buffer starts at the first input sample required
+        # by the next output sample, i.e. factor * n_output - half_len
+        if n_ready <= 0:
+            return self._output.data[self._n_output:self._n_output]
+        n_used = self.factor * (n_ready - 1) + 2 * self._half_len + 1
+        filtered = sig.upfirdn(self._filter, self._buffer[0:n_used], up=1, down=self.factor)
+        first = 2 * self._half_len // self.factor
+        self._buffer = self._buffer[self.factor * n_ready::]
+        self._n_output += n_ready
+        return self._output.write(filtered[first:first + n_ready])
+
@@ -0,0 +1,191 @@
+"""
+@author: J.M. Algarín, MRILab, i3M, CSIC, Valencia
+@email: josalggui@i3m.upv.es
+@Summary: FFT service used by the sequences and the reconstruction tools, with a multithreaded backend, cached shift
+factors and optional single precision
+"""
+
+import os
+import functools
+import numpy as np
+
+
+class FftService:
+    """
+    Centered FFTs of the k-space data and images.
+
+    ifftn() and fftn() give the same result as np.fft.ifftshift(np.fft.ifftn(np.fft.ifftshift(x))) and
+    np.fft.fftshift(np.fft.fftn(np.fft.fftshift(x))). For axes with an even number of points the shifts are fused
+    into the transform: shifting by n/2 points is a modulation by (-1)^index in the other domain, so the data is
+    multiplied by a +-1 mask before the FFT and after it, in place, instead of copying the array twice with each shift.
+    The masks are cached for the shapes already used, and the backend caches the FFT plans.
+
+    The backend is 'scipy' (scipy.fft, multithreaded with `workers`), 'pyfftw' (pyfftw.interfaces.scipy_fft) or
+    'numpy'. With single=True the transforms are done in complex64, halving the memory and the time.
+    """
+
+    def __init__(self, backend='scipy', workers=None, single=False):
+        """
+        Initialize the service.
+
+        Args:
+            backend (str): 'scipy', 'pyfftw' or 'numpy'.
+            workers (int, optional): Number of threads of the FFT. If None, all the cores of the CPU are used.
+            single (bool): If True, the transforms are done in complex64.
+        """
+        self.backend = None
+        self.module = None
+        self.workers = os.cpu_count() if workers is None else workers
+        self.single = single
+        self.set_backend(backend)
+
+    @property
+    def dtype(self):
+        return np.complex64 if self.single else complex
+
+    def set_backend(self, backend):
+        """
+        Select the module used for the FFTs.
+
+        Args:
+            backend (str): 'scipy', 'pyfftw' or 'numpy'. If the module is not installed, scipy is used.
+        """
+        if backend == 'pyfftw':
+            try:
+                import pyfftw.interfaces.scipy_fft as module
+                import pyfftw.interfaces.cache
+                pyfftw.interfaces.cache.enable()
+            except ImportError:
+                print("WARNING: pyfftw is not installed. Using scipy FFT.")
+                backend = 'scipy'
+        if backend == 'numpy':
+            module = np.fft
+        elif backend != 'pyfftw':
+            import scipy.fft as module
+            backend = 'scipy'
+        self.backend = backend
+        self.module = module
+
+    def ifftn(self, k_space, axes=None):
+        """
+        Get the image from the k-space, with the k-space center and the image center in the middle of the arrays.
+
+        Args:
+            k_space (np.ndarray): The k-space data.
+            axes (list, optional): Axes to be transformed. If None, all the axes are transformed.
+
+        Returns:
+            np.ndarray: The image.
+        """
+        return self._run(k_space, axes, inverse=True)
+
+    def fftn(self, image, axes=None):
+        """
+        Get the k-space from the image, with the k-space center and the image center in the middle of the arrays.
+
+        Args:
+            image (np.ndarray): The image.
+            axes (list, optional): Axes to be transformed. If None, all the axes are transformed.
+
+        Returns:
+            np.ndarray: The k-space data.
+        """
+        return self._run(image, axes, inverse=False)
+
+    def _run(self, data, axes, inverse):
+        data = np.asarray(data)
+        if axes is None:
+            axes = tuple(range(data.ndim))
+        else:
+            axes = tuple(axis % data.ndim for axis in np.atleast_1d(axes))
+        if len(axes) == 0:
+            return data.astype(self.dtype)
+        even = tuple(axis for axis in axes if data.shape[axis] % 2 == 0)
+        odd = tuple(axis for axis in axes if data.shape[axis] % 2 == 1 and data.shape[axis] > 1)
+
+        # Shifts of the axes with an odd number of points, that can not be fused
+        if len(odd) > 0:
+            data = np.fft.ifftshift(data, axes=odd) if inverse else np.fft.fftshift(data, axes=odd)
+
+        # Modulation for the axes with an even number of points, always giving a copy of the input
+        if len(even) > 0:
+            mask_in, mask_out = _get_masks(tuple(data.shape[axis] if axis in even else 1 for axis in range(data.ndim)))
+            data = np.multiply(data, mask_in, dtype=self.dtype)
+        else:
+            data = np.array(data, dtype=self.dtype)
+
+        # FFT
+        transform = self.module.ifftn if inverse else self.module.fftn
+        if self.backend == 'numpy':
+            data = transform(data, axes=axes)
+        else:
+            data = transform(data, axes=axes, workers=self.workers, overwrite_x=True)
+        if len(even) > 0:
+            data *= mask_out
+
+        if len(odd) > 0:
+            data = np.fft.ifftshift(data, axes=odd) if inverse else np.fft.fftshift(data, axes=odd)
+
+        return data
+
+
+@functools.lru_cache(maxsize=16)
+def _get_masks(shape):
+    # (-1)^index along each axis with more than one point, applied before the FFT, and the same times (-1)^(n/2), the
+    # phase due to the shift of the other domain, applied after it. Read-only, as they are shared
+    mask = np.ones(shape)
+    phase = 1.0
+    for axis, n in enumerate(shape):
+        if n > 1:
+            mask = mask * np.reshape((-1.0) ** np.arange(n), [-1 if ii == axis else 1 for ii in range(len(shape))])
+            phase *= (-1.0) ** (n // 2)
+    mask_out = mask * phase
+    mask.setflags(write=False)
+    mask_out.setflags(write=False)
+    return mask, mask_out
+
+
+# Default service of the application
+fft_service = FftService()
+
+
+def set_fft_backend(backend='scipy', workers=None, single=False):
+    """
+    Configure the default FFT service.
+
+    Args:
+        backend (str): 'scipy', 'pyfftw' or 'numpy'.
+        workers (int, optional): Number of threads of the FFT. If None, all the cores of the CPU are used.
+        single (bool): If True, the transforms are done in complex64.
+    """
+    fft_service.workers = os.cpu_count() if workers is None else workers
+    fft_service.single = single
+    fft_service.set_backend(backend)
+
+
+def ifftnc(k_space, axes=None):
+    """
+    Centered inverse FFT with the default service, as np.fft.ifftshift(np.fft.ifftn(np.fft.ifftshift(k_space))).
+
+    Args:
+        k_space (np.ndarray): The k-space data.
+        axes (list, optional): Axes to be transformed. If None, all the axes are transformed.
+
+    Returns:
+        np.ndarray: The image.
+    """
+    return fft_service.ifftn(k_space, axes=axes)
+
+
+def fftnc(image, axes=None):
+    """
+    Centered direct FFT with the default service, as np.fft.fftshift(np.fft.fftn(np.fft.fftshift(image))).
+
+    Args:
+        image (np.ndarray): The image.
+        axes (list, optional): Axes to be transformed. If None, all the axes are transformed.
+
+    Returns:
+        np.ndarray: The k-space data.
+    """
+    return fft_service.fftn(image, axes=axes)
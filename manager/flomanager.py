@@ -0,0 +1,361 @@
+"""
+@author: J.M. Algarín, MRILab, i3M, CSIC, Valencia
+@email: josalggui@i3m.upv.es
+@Summary: growable buffers to store the flo instructions (time, amplitude) of the sequence channels and estimation
+of the instructions and readout points of a batch
+"""
+
+import numpy as np
+
+
+class FloChannel:
+    """
+    Growable buffer with the instructions of a single flo channel.
+
+    Times and amplitudes are stored into preallocated arrays whose capacity is doubled when they get full, so appending
+    new events has an amortized constant cost instead of reallocating the full arrays on every event. The buffer keeps
+    the old list-like interface used by the flo_dict: channel[0] returns the times and channel[1] the amplitudes.
+
+    Attributes:
+        times (np.ndarray): View of the stored instruction times in microseconds.
+        amps (np.ndarray): View of the stored instruction amplitudes.
+    """
+
+    def __init__(self, dtype=float, capacity=256):
+        """
+        Initialize an empty channel.
+
+        Args:
+            dtype (type): Data type of the amplitudes (float for gradients, rx and ttl, complex for tx).
+            capacity (int): Initial number of instructions that can be stored without reallocation.
+        """
+        self._times = np.empty(capacity, dtype=float)
+        self._amps = np.empty(capacity, dtype=dtype)
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        yield self.times
+        yield self.amps
+
+    def __getitem__(self, index):
+        if index == 0:
+            return self.times
+        elif index == 1:
+            return self.amps
+        raise IndexError("flo channel index must be 0 (times) or 1 (amplitudes)")
+
+    def __setitem__(self, index, value):
+        value = np.ravel(value)
+        if value.size != self._size:
+            raise ValueError("the new flo channel values must have the same length than the stored ones, use set()")
+        if index == 0:
+            self._times[0:self._size] = value
+        elif index == 1:
+            self._amps[0:self._size] = value
+        else:
+            raise IndexError("flo channel index must be 0 (times) or 1 (amplitudes)")
+
+    @property
+    def times(self):
+        return self._times[0:self._size]
+
+    @property
+    def amps(self):
+        return self._amps[0:self._size]
+
+    def reserve(self, n):
+        """
+        Make sure that n more instructions can be appended without reallocating the arrays.
+
+        Args:
+            n (int): Number of instructions to be appended.
+        """
+        required = self._size + n
+        capacity = self._times.shape[0]
+        if required <= capacity:
+            return
+        while capacity < required:
+            capacity *= 2
+        times = np.empty(capacity, dtype=float)
+        amps = np.empty(capacity, dtype=self._amps.dtype)
+        times[0:self._size] = self._times[0:self._size]
+        amps[0:self._size] = self._amps[0:self._size]
+        self._times = times
+        self._amps = amps
+
+    def append(self, times, amps):
+        """
+        Append new instructions at the end of the channel.
+
+        Args:
+            times (array_like): Times of the new instructions in microseconds.
+            amps (array_like): Amplitudes of the new instructions. A single value is used for all the times.
+        """
+        times = np.ravel(times)
+        amps = np.ravel(amps)
+        n = times.size
+        self.reserve(n)
+        self._times[self._size:self._size + n] = times
+        self._amps[self._size:self._size + n] = amps
+        self._size += n
+
+    def set(self, times, amps):
+        """
+        Replace the content of the channel by the given instructions.
+
+        Args:
+            times (array_like): Times of the instructions in microseconds.
+            amps (array_like): Amplitudes of the instructions.
+        """
+        self._size = 0
+        self.append(times, amps)
+
+    def clear(self):
+        """
+        Remove all the instructions, keeping the allocated memory for the next sequence.
+        """
+        self._size = 0
+
+
+class FloDict(dict):
+    """
+    Dictionary with the flo channels of a sequence: 'g0', 'g1', 'g2', 'rx0', 'rx1', 'tx0', 'tx1', 'ttl0' and 'ttl1'.
+
+    Each value is a FloChannel, so it can be read as before with flo_dict[key][0] (times) and flo_dict[key][1]
+    (amplitudes).
+    """
+
+    channels = {'g0': float,
+                'g1': float,
+                'g2': float,
+                'rx0': float,
+                'rx1': float,
+                'tx0': complex,
+                'tx1': complex,
+                'ttl0': float,
+                'ttl1': float,
+                }
+
+    def __init__(self, channel_class=FloChannel):
+        """
+        Initialize the dictionary with empty channels.
+
+        Args:
+            channel_class (type): Class used to store the instructions of each channel.
+        """
+        super(FloDict, self).__init__()
+        for key, dtype in self.channels.items():
+            self[key] = channel_class(dtype=dtype)
+
+    def clear_channels(self):
+        """
+        Remove the instructions of all the channels.
+        """
+        for channel in self.values():
+            channel.clear()
+
+    def to_dict(self):
+        """
+        Get a copy of the instructions as a plain dictionary.
+
+        Returns:
+            dict: Dictionary with [times, amplitudes] arrays for each channel.
+        """
+        return {key: [np.copy(channel[0]), np.copy(channel[1])] for key, channel in self.items()}
+
+
+class FloBudget:
+    """
+    Estimation of the number of instructions and readout points that a batch sends to the Red Pitaya.
+
+    The budget is obtained from a flo_dict or from a list of PyPulseq blocks without compiling the sequence, so that
+    sequences can be split into the fewest batches that fit into hw.maxOrders and hw.maxRdPoints. The estimation of
+    PyPulseq blocks is an upper bound, the interpreter may merge some of the instructions.
+
+    Attributes:
+        orders (dict): Number of instructions per flo channel.
+        rd_points (dict): Number of readout points per rx channel.
+    """
+
+    def __init__(self, orders=None, rd_points=None):
+        """
+        Initialize the budget.
+
+        Args:
+            orders (dict, optional): Number of instructions per flo channel.
+            rd_points (dict, optional): Number of readout points per rx channel.
+        """
+        self.orders = dict.fromkeys(FloDict.channels, 0)
+        self.rd_points = {'rx0': 0, 'rx1': 0}
+        if orders is not None:
+            self.orders.update(orders)
+        if rd_points is not None:
+            self.rd_points.update(rd_points)
+
+    def __repr__(self):
+        return "FloBudget(n_orders=%i, n_rd_points=%i)" % (self.n_orders, self.n_rd_points)
+
+    def __add__(self, other):
+        return FloBudget({key: self.orders[key] + other.orders[key] for key in self.orders},
+                         {key: self.rd_points[key] + other.rd_points[key] for key in self.rd_points})
+
+    def __sub__(self, other):
+        return FloBudget({key: self.orders[key] - other.orders[key] for key in self.orders},
+                         {key: self.rd_points[key] - other.rd_points[key] for key in self.rd_points})
+
+    @property
+    def n_orders(self):
+        return sum(self.orders.values())
+
+    @property
+    def n_rd_points(self):
+        return sum(self.rd_points.values())
+
+    def fits(self, max_orders, max_rd_points):
+        """
+        Check if the budget fits into the hardware limits.
+
+        Args:
+            max_orders (int): Maximum number of instructions, usually hw.maxOrders.
+            max_rd_points (int): Maximum number of readout points, usually hw.maxRdPoints.
+
+        Returns:
+            bool: True if both the instructions and the readout points are within the limits.
+        """
+        return self.n_orders <= max_orders and self.n_rd_points <= max_rd_points
+
+    def get_repetitions(self, step, max_orders, max_rd_points, n_max=None):
+        """
+        Get how many repetitions fit into the hardware limits.
+
+        The current budget is taken as the cost of a batch with a single repetition and `step` as the cost of each
+        additional repetition.
+
+        Args:
+            step (FloBudget): Budget of one additional repetition.
+            max_orders (int): Maximum number of instructions, usually hw.maxOrders.
+            max_rd_points (int): Maximum number of readout points, usually hw.maxRdPoints.
+            n_max (int, optional): Maximum number of repetitions to return.
+
+        Returns:
+            int: Number of repetitions, 0 if a single repetition does not fit.
+        """
+        if not self.fits(max_orders, max_rd_points):
+            return 0
+        n_repetitions = np.inf if n_max is None else n_max
+        if step.n_orders > 0:
+            n_repetitions = min(n_repetitions, 1 + (max_orders - self.n_orders) // step.n_orders)
+        if step.n_rd_points > 0:
+            n_repetitions = min(n_repetitions, 1 + (max_rd_points - self.n_rd_points) // step.n_rd_points)
+        return int(n_repetitions)
+
+    def plan_batches(self, steps, max_orders, max_rd_points):
+        """
+        Split a list of items (e.g. echo trains) into consecutive batches that fit into the hardware limits.
+
+        The current budget is taken as the cost of an empty batch (dummy pulses, noise acquisition...). A new batch is
+        started when the next item does not fit into the current one. Each batch contains at least one item.
+
+        Args:
+            steps (list): Budget (FloBudget) of each item, in acquisition order.
+            max_orders (int): Maximum number of instructions, usually hw.maxOrders.
+            max_rd_points (int): Maximum number of readout points, usually hw.maxRdPoints.
+
+        Returns:
+            list: (start, stop) index ranges of the items of each batch.
+        """
+        ranges = []
+        start = 0
+        budget = self
+        for idx, step in enumerate(steps):
+            if idx > start and not (budget + step).fits(max_orders, max_rd_points):
+                ranges.append((start, idx))
+                start = idx
+                budget = self
+            budget = budget + step
+        if len(steps) > start:
+            ranges.append((start, len(steps)))
+        return ranges
+
+    @classmethod
+    def from_flo_dict(cls, flo_dict, sampling_period=None):
+        """
+        Get the budget of a flo_dict.
+
+        Args:
+            flo_dict (dict): Dictionary with [times, amplitudes] for each flo channel.
+            sampling_period (float, optional): Readout sampling period in microseconds. If None, the readout points
+                are not counted.
+
+        Returns:
+            FloBudget: Instructions per channel and readout points per rx channel.
+        """
+        budget = cls({key: len(flo_dict[key][0]) for key in flo_dict})
+        if sampling_period is not None:
+            for key in budget.rd_points:
+                times = np.asarray(flo_dict[key][0])
+                amps = np.asarray(flo_dict[key][1])
+                gates = (times[1::] - times[0:-1])[amps[0:-1] != 0]
+                budget.rd_points[key] = int(np.sum(np.round(gates / sampling_period)))
+        return budget
+
+    @classmethod
+    def from_blocks(cls, blocks, grad_raster_time, oversampling_factor=1):
+        """
+        Get the budget of a list of PyPulseq blocks.
+
+        Args:
+            blocks (pp.Sequence or list): PyPulseq sequence, or list of blocks where each block is the output of
+                Sequence.get_block() or the tuple of events given to Sequence.add_block().
+            grad_raster_time (float): Gradient raster time of the interpreter in seconds.
+            oversampling_factor (int): Oversampling factor of the adc events, so that the readout points are counted
+                after decimation, as hw.maxRdPoints. Use 1 if the adc events already have the decimated samples.
+
+        Returns:
+            FloBudget: Instructions per channel and readout points per rx channel.
+        """
+        if hasattr(blocks, 'block_events'):
+            blocks = [blocks.get_block(block) for block in blocks.block_events]
+        budget = cls()
+        for block in blocks:
+            if isinstance(block, (list, tuple)):
+                events = block
+            else:
+                events = [getattr(block, key, None) for key in ['rf', 'gx', 'gy', 'gz', 'adc']]
+            for event in events:
+                if event is None:
+                    continue
+                if event.type == 'rf':
+                    budget.orders['tx0'] += len(event.signal) + 1
+                    budget.orders['ttl0'] += 2
+                elif event.type == 'trap':
+                    budget.orders['g%i' % 'xyz'.index(event.channel)] += \
+                        int(np.ceil(event.rise_time / grad_raster_time)) + \
+                        int(np.ceil(event.fall_time / grad_raster_time)) + 1
+                elif event.type == 'grad':
+                    budget.orders['g%i' % 'xyz'.index(event.channel)] += \
+                        cls._get_grad_orders(event, grad_raster_time) + 1
+                elif event.type == 'adc':
+                    budget.orders['rx0'] += 2
+                    budget.rd_points['rx0'] += int(event.num_samples // oversampling_factor)
+        return budget
+
+    @staticmethod
+    def _get_grad_orders(event, grad_raster_time):
+        """
+        Get the number of instructions of an arbitrary or extended trapezoid gradient.
+
+        Arbitrary gradients are sampled at the center of each raster cell and give one instruction per sample.
+        Extended trapezoids start at time zero and each segment is linearly interpolated by the interpreter at the
+        gradient raster time. Flat segments are compressed into a single instruction by the interpreter.
+        """
+        tt = getattr(event, 'tt', None)
+        if tt is None or len(tt) < 2 or tt[0] > 0:
+            return len(event.waveform)
+        delta_t = np.round(np.diff(tt) * 1e6).astype(int)  # us
+        n_steps = (delta_t / (grad_raster_time * 1e6)).astype(int)
+        ramp = (delta_t > 1) & (np.diff(event.waveform) != 0)
+        return int(np.sum(np.where(ramp, n_steps, 1)))
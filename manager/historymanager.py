@@ -0,0 +1,154 @@
+"""
+@author: J.M. Algarín, MRILab, i3M, CSIC, Valencia
+@email: josalggui@i3m.upv.es
+@Summary: history of images with a RAM budget, where the least recently used images are moved to .npy files
+"""
+
+import os
+import weakref
+from collections import OrderedDict
+from collections.abc import MutableMapping
+import numpy as np
+
+import configs.hw_config as hw
+
+# Default RAM budget of the history if hw_config has no history_ram_budget, in bytes
+RAM_BUDGET = 2 * 1024 ** 3
+
+
+class ImageHistory(MutableMapping):
+    """
+    Dictionary of images with a RAM budget.
+
+    The images are kept in RAM in order of use. When the images in RAM exceed the budget, the least recently used images
+    are written to .npy files in `directory` and removed from RAM. When they are used again they are read back fully
+    into RAM (not as memory maps, as the viewer needs the whole image), and their files are deleted. The last used
+    image is always kept in RAM, even if it exceeds the budget by itself. The files left are deleted by clear(), when
+    the history is garbage collected, or when the application exits.
+    """
+
+    def __init__(self, directory=None, ram_budget=None):
+        """
+        Initialize the history.
+
+        Args:
+            directory (str, optional): Folder for the files of the images moved out of RAM. If None, a 'history' folder
+                in the current directory is used.
+            ram_budget (int, optional): Maximum number of bytes of the images in RAM. If None, hw.history_ram_budget
+                (in GB).
+        """
+        self.directory = directory
+        self._ram = OrderedDict()  # Images in RAM, from the least to the most recently used
+        self._disk = {}  # Files of the images moved out of RAM
+        self._n_files = 0
+        if ram_budget is None:
+            ram_budget = int(getattr(hw, 'history_ram_budget', RAM_BUDGET / 1024 ** 3) * 1024 ** 3)
+        self._ram_budget = ram_budget
+        weakref.finalize(self, _remove_files, self._disk)
+
+    @property
+    def ram_budget(self):
+        return self._ram_budget
+
+    @ram_budget.setter
+    def ram_budget(self, value):
+        self._ram_budget = value
+        self._evict()
+
+    def __getitem__(self, key):
+        if key in self._ram:
+            self._ram.move_to_end(key)
+        elif key in self._disk:
+            # Read the image back into RAM
+            file_name = self._disk.pop(key)
+            self._ram[key] = np.array(np.load(file_name, mmap_mode='r'))
+            os.remove(file_name)
+            self._evict()
+        else:
+            raise KeyError(key)
+        return self._ram[key]
+
+    def __setitem__(self, key, image):
+        self._remove(key)
+        self._ram[key] = image
+        self._evict()
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._remove(key)
+
+    def __contains__(self, key):
+        return key in self._ram or key in self._disk
+
+    def __iter__(self):
+        return iter(list(self._ram) + list(self._disk))
+
+    def __len__(self):
+        return len(self._ram) + len(self._disk)
+
+    def get_usage(self, key):
+        """
+        Get the memory used by an image.
+
+        Args:
+            key (str): Key of the image.
+
+        Returns:
+            tuple: Number of bytes of the image in RAM and on disk.
+        """
+        if key in self._ram:
+            return np.asarray(self._ram[key]).nbytes, 0
+        elif key in self._disk:
+            return 0, os.path.getsize(self._disk[key])
+        else:
+            return 0, 0
+
+    def get_total_usage(self):
+        """
+        Get the memory used by all the images.
+
+        Returns:
+            tuple: Number of bytes of the images in RAM and on disk.
+        """
+        usage = np.array([self.get_usage(key) for key in self], dtype=np.int64).reshape(-1, 2)
+        return tuple(int(n) for n in np.sum(usage, axis=0))
+
+    def clear(self):
+        for key in list(self):
+            self._remove(key)
+
+    def _remove(self, key):
+        self._ram.pop(key, None)
+        file_name = self._disk.pop(key, None)
+        if file_name is not None and os.path.exists(file_name):
+            os.remove(file_name)
+
+    def _evict(self):
+        # Move the least recently used images to disk until the images in RAM fit in the budget
+        ram = sum(np.asarray(image).nbytes for image in self._ram.values())
+        while ram > self._ram_budget and len(self._ram) > 1:
+            key, image = self._ram.popitem(last=False)
+            image = np.asarray(image)
+            ram -= image.nbytes
+
+            # Write the image into a memory-mapped .npy file
+            directory = self.directory if self.directory is not None else 'history'
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            file_name = os.path.join(directory, "image_%i_%i.npy" % (os.getpid(), self._n_files))
+            self._n_files += 1
+            file = np.lib.format.open_memmap(file_name, mode='w+', dtype=image.dtype, shape=image.shape)
+            file[...] = image
+            file.flush()
+            del file
+            self._disk[key] = file_name
+
+
+def _remove_files(files):
+    # Delete the files of the images on disk. It gets the dictionary of files and not the history, so that the
+    # finalizer does not keep the history alive
+    for file_name in list(files.values()):
+        if os.path.exists(file_name):
+            os.remove(file_name)
+    files.clear()
@@ -0,0 +1,102 @@
+"""
+@author: J.M. Algarín, MRILab, i3M, CSIC, Valencia
+@email: josalggui@i3m.upv.es
+@Summary: selective reading of the .mat files of the acquisitions, with small variables cached for the session and
+large arrays loaded on first access
+"""
+
+import os
+from collections.abc import Mapping
+import numpy as np
+from scipy.io import loadmat, whosmat
+
+# Variables with more elements than this are loaded on first access
+MAX_METADATA_SIZE = 1024
+
+# Metadata of the files read in the session, by (path, modification time, size)
+_metadata_cache = {}
+
+
+class MatReader(Mapping):
+    """
+    Read-only dictionary with the variables of a .mat file.
+
+    When the file is opened only the list of variables is read. Small variables (parameters of the sequence, strings,
+    etc.) are read at once with a single pass and cached for the session, so opening the same file again does not read
+    it. Large arrays (e.g. dataFull, overData or imgFull) and structures are lazy: they are read with
+    loadmat(variable_names=[name]) the first time they are used and then kept in the reader.
+
+    Attributes:
+        file_path (str): Path to the .mat file.
+        shapes (dict): Shape of each variable in the file.
+    """
+
+    def __init__(self, file_path, variable_names=None):
+        """
+        Open a .mat file and read its small variables.
+
+        Args:
+            file_path (str): Path to the .mat file.
+            variable_names (list, optional): Large variables to read now instead of on first access.
+        """
+        self.file_path = file_path
+        status = os.stat(file_path)
+        key = (os.path.abspath(file_path), status.st_mtime_ns, status.st_size)
+
+        if key not in _metadata_cache:
+            variables = whosmat(file_path)
+            shapes = {name: shape for name, shape, _ in variables}
+            small = [name for name, shape, mat_class in variables
+                     if np.prod(shape) <= MAX_METADATA_SIZE and mat_class not in ('struct', 'cell', 'object')]
+            metadata = _load(file_path, small) if small else {}
+            _metadata_cache[key] = (shapes, metadata)
+        self.shapes, metadata = _metadata_cache[key]
+        self._data = dict(metadata)
+
+        if variable_names is not None:
+            self.load([name for name in variable_names if name in self.shapes])
+
+    def __getitem__(self, name):
+        if name not in self._data:
+            if name not in self.shapes:
+                raise KeyError(name)
+            self.load([name])
+        return self._data[name]
+
+    def __contains__(self, name):
+        return name in self.shapes
+
+    def __iter__(self):
+        return iter(self.shapes)
+
+    def __len__(self):
+        return len(self.shapes)
+
+    def load(self, variable_names):
+        """
+        Read several large variables with a single pass over the file.
+
+        Args:
+            variable_names (list): Names of the variables.
+        """
+        names = [name for name in variable_names if name not in self._data]
+        if names:
+            self._data.update(_load(self.file_path, names))
+
+    def is_loaded(self, name):
+        """
+        Check if a variable is already in memory.
+
+        Args:
+            name (str): Name of the variable.
+
+        Returns:
+            bool: True if the variable was already read.
+        """
+        return name in self._data
+
+
+def _load(file_path, variable_names):
+    # Read the variables without the header entries added by loadmat
+    data = loadmat(file_path, variable_names=variable_names)
+    return {name: value for name, value in data.items() if not name.startswith('__')}
@@ -0,0 +1,267 @@
+"""
+@author: J.M. Algarín, MRILab, i3M, CSIC, Valencia
+@email: josalggui@i3m.upv.es
+@Summary: reading of ISMRMRD raw data with vectorized headers and lazy selection of acquisitions, slices and averages,
+and writing of the acquisitions in blocks
+"""
+
+import h5py
+import numpy as np
+import ismrmrd
+from ismrmrd.hdf5 import acquisition_dtype, acquisition_header_dtype, encoding_counters_dtype
+
+
+class MrdReader:
+    """
+    Reader of the acquisitions of an ISMRMRD file.
+
+    Only the headers are read when the file is opened. They are kept as a structured array, so the phase, slice and
+    average of all the acquisitions are taken from its fields at once. The data of the acquisitions are read on demand,
+    only for the requested rows, slices or averages, and the interleaved real and imaginary parts are viewed as complex
+    numbers without copies.
+    """
+
+    def __init__(self, file_name, group='dataset'):
+        """
+        Open the file and read the headers of the acquisitions.
+
+        Args:
+            file_name (str): Path to the .h5 file.
+            group (str): Group of the ISMRMRD dataset in the file.
+        """
+        self.file = h5py.File(file_name, 'r')
+        self.acquisitions = self.file[group]['data']
+        self.header = self.acquisitions.fields('head')[()]
+        idx = self.header['idx']
+
+        # Indexes of each acquisition, starting at 0
+        self.phase = _zero_based(idx['kspace_encode_step_1'])
+        self.slice = _zero_based(idx['slice'])
+        self.average = _zero_based(idx['average'])
+        self.n_phases = int(np.max(self.phase)) + 1
+        self.n_slices = int(np.max(self.slice)) + 1
+        self.n_averages = int(np.max(self.average)) + 1
+
+        # Rows sorted as k-space, (average, slice, phase)
+        self.order = np.lexsort((self.phase, self.slice, self.average))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.file.close()
+
+    def read_lines(self, rows):
+        """
+        Read the data of some acquisitions.
+
+        Args:
+            rows (list): Rows of the acquisitions in the file.
+
+        Returns:
+            np.ndarray: Complex data with shape (len(rows), active_channels * number_of_samples).
+        """
+        rows = np.asarray(rows, dtype=int)
+        if rows.size == 0:
+            return np.zeros((0, 0), dtype=np.complex64)
+
+        # h5py reads rows in increasing order
+        unique, inverse = np.unique(rows, return_inverse=True)
+        lines = np.stack(self.acquisitions.fields('data')[unique])
+        return lines.view(np.complex64)[inverse]
+
+    def read(self, slices=None, averages=None, discard=True):
+        """
+        Read the k-space of the selected slices and averages.
+
+        Only the acquisitions of the selected slices and averages are read, and they are placed in k-space at once
+        with the indexes of their headers. Missing acquisitions are zero.
+
+        Args:
+            slices (list, optional): Slices to read. If None, all the slices.
+            averages (list, optional): Averages to read. If None, all the averages.
+            discard (bool): If True, the discard_pre and discard_post points of each readout are removed.
+
+        Returns:
+            np.ndarray: k-space with shape (len(averages), len(slices), n_phases, n_readout) of the first channel.
+        """
+        slices = np.arange(self.n_slices) if slices is None else np.atleast_1d(slices)
+        averages = np.arange(self.n_averages) if averages is None else np.atleast_1d(averages)
+        rows = np.flatnonzero(np.isin(self.slice, slices) & np.isin(self.average, averages))
+
+        # Data of the first channel
+        n_samples = int(np.max(self.header['number_of_samples']))
+        lines = self.read_lines(rows)
+        lines = np.reshape(lines, (rows.size, -1, n_samples))[:, 0, :]
+        if discard and rows.size > 0:
+            pre = int(self.header['discard_pre'][rows[0]])
+            post = int(self.header['discard_post'][rows[0]])
+            lines = lines[:, pre:n_samples - post]
+
+        # Position of each acquisition in the output
+        slice_position = np.zeros(self.n_slices, dtype=int)
+        slice_position[slices] = np.arange(slices.size)
+        average_position = np.zeros(self.n_averages, dtype=int)
+        average_position[averages] = np.arange(averages.size)
+
+        k_space = np.zeros((averages.size, slices.size, self.n_phases, lines.shape[-1]), dtype=lines.dtype)
+        k_space[average_position[self.average[rows]], slice_position[self.slice[rows]], self.phase[rows]] = lines
+        return k_space
+
+    def read_mean(self, slices=None, discard=True):
+        """
+        Read the k-space averaged over the averages, reading one average at a time to bound the memory.
+
+        Args:
+            slices (list, optional): Slices to read. If None, all the slices.
+            discard (bool): If True, the discard_pre and discard_post points of each readout are removed.
+
+        Returns:
+            np.ndarray: Mean k-space with shape (len(slices), n_phases, n_readout).
+        """
+        k_space = self.read(slices=slices, averages=[0], discard=discard)[0]
+        for average in range(1, self.n_averages):
+            k_space += self.read(slices=slices, averages=[average], discard=discard)[0]
+        return k_space / self.n_averages
+
+
+def append_acquisitions(dset, data, header, block_size=4096):
+    """
+    Append many single channel acquisitions to an ISMRMRD dataset.
+
+    The headers are built at once as a structured array with the ISMRMRD layout, and the headers and data are written
+    in blocks of acquisitions, so the file has the same content as appending an ismrmrd.Acquisition for each readout
+    with dset.append_acquisition.
+
+    Args:
+        dset (ismrmrd.Dataset): Dataset open for writing.
+        data (np.ndarray): Complex data with shape (n_acquisitions, n_samples), in acquisition order.
+        header (dict): Values of the header fields, with a scalar or an array with one value per acquisition. The fields
+            of the encoding counters (e.g. slice or kspace_encode_step_1) are given by name too.
+        block_size (int): Number of acquisitions written at once.
+    """
+    data = np.asarray(data, dtype=np.complex64)
+    n_acquisitions, n_samples = data.shape
+
+    # Headers, with the defaults of ismrmrd.Acquisition.from_array
+    head = np.zeros(n_acquisitions, dtype=acquisition_header_dtype)
+    head['version'] = 1
+    head['number_of_samples'] = n_samples
+    head['active_channels'] = 1
+    head['available_channels'] = 1
+    for field, value in header.items():
+        if field in encoding_counters_dtype.names:
+            head['idx'][field] = value
+        else:
+            head[field] = value
+
+    # Dataset of the acquisitions, created as in dset.append_acquisition
+    group = dset._file.require_group(dset._dataset_name)
+    if 'data' not in group:
+        group.create_dataset("data", (0,), maxshape=(None,), dtype=acquisition_dtype)
+    acquisitions = group['data']
+    n_previous = acquisitions.shape[0]
+    acquisitions.resize(n_previous + n_acquisitions, axis=0)
+
+    # Write the blocks, the data is saved as interleaved real and imaginary parts
+    for start in range(0, n_acquisitions, block_size):
+        stop = min(start + block_size, n_acquisitions)
+        lines = np.empty(stop - start, dtype=object)
+        lines[:] = list(data[start:stop].view(np.float32))
+        trajectories = np.empty(stop - start, dtype=object)
+        trajectories[:] = [np.zeros(0, dtype=np.float32)] * (stop - start)
+        block = np.empty(stop - start, dtype=acquisition_dtype)
+        block['head'] = head[start:stop]
+        block['traj'] = trajectories
+        block['data'] = lines
+        acquisitions[n_previous + start:n_previous + stop] = block
+
+
+def get_rare_header(n_scans, n_sl, n_ph, etl, ind=None, averages=True):
+    """
+    Get the encoding counters and flags of the acquisitions of a RARE sequence.
+
+    The acquisitions are sorted by scan, slice and phase, and the phase lines of each slice are acquired in echo trains
+    of etl echoes. The counters start at 1.
+
+    Args:
+        n_scans (int): Number of scans.
+        n_sl (int): Number of slices.
+        n_ph (int): Number of phases.
+        etl (int): Echo train length.
+        ind (np.ndarray, optional): Phase line of each echo, from getIndex. If None, the lines are sorted.
+        averages (bool): If False, the average counter and the average flags are not set, as in the files converted
+            from .mat.
+
+    Returns:
+        dict: Header fields with one value per acquisition.
+    """
+    scan, slice_idx, phase_idx = [np.ravel(a) for a in np.meshgrid(np.arange(n_scans), np.arange(n_sl),
+                                                                   np.arange(n_ph), indexing='ij')]
+    line = phase_idx if ind is None else np.asarray(ind, dtype=int)[phase_idx]
+    index_in_repetition = phase_idx % etl
+    current_repetition = phase_idx // etl + slice_idx * (n_ph // etl)
+    n_rep = (n_ph // etl) * n_sl
+
+    flags = _get_flags(index_in_repetition, etl - 1, ismrmrd.ACQ_FIRST_IN_CONTRAST, ismrmrd.ACQ_LAST_IN_CONTRAST)
+    flags |= _get_flags(line, n_ph - 1, ismrmrd.ACQ_FIRST_IN_PHASE, ismrmrd.ACQ_LAST_IN_PHASE)
+    flags |= _get_flags(slice_idx, n_sl - 1, ismrmrd.ACQ_FIRST_IN_SLICE, ismrmrd.ACQ_LAST_IN_SLICE)
+    flags |= _get_flags(current_repetition, n_rep - 1, ismrmrd.ACQ_FIRST_IN_REPETITION, ismrmrd.ACQ_LAST_IN_REPETITION)
+    header = {'flags': flags,
+              'scan_counter': np.arange(1, scan.size + 1),
+              'repetition': current_repetition + 1,
+              'kspace_encode_step_1': line + 1,
+              'slice': slice_idx + 1,
+              'contrast': index_in_repetition + 1}
+    if averages:
+        header['flags'] |= _get_flags(scan, n_scans - 1, ismrmrd.ACQ_FIRST_IN_AVERAGE, ismrmrd.ACQ_LAST_IN_AVERAGE)
+        header['average'] = scan + 1
+    return header
+
+
+def get_gre_header(n_scans, n_sl, n_ph, averages=True):
+    """
+    Get the encoding counters and flags of the acquisitions of a 3D gradient echo sequence.
+
+    The acquisitions are sorted by scan, slice and phase, and each acquisition is a repetition of the scan. The
+    counters start at 1.
+
+    Args:
+        n_scans (int): Number of scans.
+        n_sl (int): Number of slices.
+        n_ph (int): Number of phases.
+        averages (bool): If False, the average counter is not set, as in the files converted from .mat.
+
+    Returns:
+        dict: Header fields with one value per acquisition.
+    """
+    scan, slice_idx, phase_idx = [np.ravel(a) for a in np.meshgrid(np.arange(n_scans), np.arange(n_sl),
+                                                                   np.arange(n_ph), indexing='ij')]
+    repetition = slice_idx * n_ph + phase_idx
+
+    flags = _get_flags(phase_idx, n_ph - 1, ismrmrd.ACQ_FIRST_IN_PHASE, ismrmrd.ACQ_LAST_IN_PHASE)
+    flags |= _get_flags(slice_idx, n_sl - 1, ismrmrd.ACQ_FIRST_IN_SLICE, ismrmrd.ACQ_LAST_IN_SLICE)
+    flags |= _get_flags(repetition, n_ph * n_sl - 1, ismrmrd.ACQ_FIRST_IN_AVERAGE, ismrmrd.ACQ_LAST_IN_AVERAGE)
+    header = {'flags': flags,
+              'scan_counter': np.arange(1, scan.size + 1),
+              'repetition': repetition + 1,
+              'kspace_encode_step_1': phase_idx + 1,
+              'slice': slice_idx + 1}
+    if averages:
+        header['average'] = scan + 1
+    return header
+
+
+def _get_flags(index, last, first_flag, last_flag):
+    # first_flag where index is 0, else last_flag where index is last, as bits of the ISMRMRD flags
+    return np.where(index == 0, np.uint64(1) << np.uint64(first_flag - 1),
+                    np.where(index == last, np.uint64(1) << np.uint64(last_flag - 1), np.uint64(0))).astype(np.uint64)
+
+
+def _zero_based(index):
+    # ISMRMRD indexes written by MaRGE start at 1, but other writers start at 0
+    index = index.astype(int)
+    return index - min(np.min(index), 1) if index.size > 0 else index
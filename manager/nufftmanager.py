@@ -0,0 +1,402 @@
+"""
+@author: J.M. Algarín, MRILab, i3M, CSIC, Valencia
+@email: josalggui@i3m.upv.es
+@Summary: NUFFT gridding of non-Cartesian k-space data (e.g. PETRA) into a Cartesian k-space grid with a Kaiser-Bessel
+kernel, an oversampled grid and density compensation
+"""
+
+import os
+import time
+import hashlib
+import numpy as np
+import scipy.sparse as sparse
+from scipy.special import i0
+
+# Cache of the gridders in the MaRGE folder, whatever the working directory is
+CACHE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'calibration', 'nufft')
+MAX_CACHE_SIZE = 2 * 1024 ** 3  # bytes
+MAX_CACHE_AGE = 30 * 24 * 3600  # s
+
+
+class NufftGridder:
+    """
+    Gridding of non-Cartesian k-space samples into the Cartesian grid of the reconstruction.
+
+    The samples are weighted with the density compensation, convolved with a Kaiser-Bessel kernel into a grid
+    oversampled by `oversampling` in each axis, and taken to the image domain with the FFT. There the apodization of
+    the kernel is corrected and the image is cropped to the field of view, and a last FFT gives the k-space at the
+    Cartesian points. The convolution is a sparse matrix built once per trajectory, so gridding new data with the same
+    trajectory only costs a sparse product and a few FFTs.
+
+    The Cartesian grid is given as in PETRA: k_cartesian has the (kx, ky, kz) points of a grid with shape (nz, ny, nx)
+    flattened in (z, y, x) order. Axes that are not gridded (not in `axes` or with a single point) take the gridded
+    values of the other axes.
+
+    Attributes:
+        matrix (scipy.sparse.csr_matrix): Convolution of the samples into the oversampled grid.
+        dcf (np.ndarray): Density compensation weight of each sample.
+    """
+
+    def __init__(self, k, k_cartesian, n_points, axes=(0, 1, 2), oversampling=2.0, width=4, n_dcf_iter=20,
+                 matrix=None, dcf=None):
+        """
+        Initialize the gridder, building the convolution matrix and the density compensation.
+
+        Args:
+            k (np.ndarray): k-space points of the samples with shape (n_samples, 3) in 1/m.
+            k_cartesian (np.ndarray): Cartesian k-space points with shape (nx * ny * nz, 3) in 1/m.
+            n_points (list): Number of points [nx, ny, nz] of the Cartesian grid.
+            axes (tuple): Axes (0 for x, 1 for y, 2 for z) to be gridded.
+            oversampling (float): Oversampling factor of the grid.
+            width (int): Width of the Kaiser-Bessel kernel in points of the oversampled grid.
+            n_dcf_iter (int): Number of iterations of the density compensation.
+            matrix (scipy.sparse.csr_matrix, optional): Precomputed convolution matrix for the same inputs.
+            dcf (np.ndarray, optional): Precomputed density compensation for the same inputs.
+        """
+        k = np.real(np.asarray(k))[:, 0:3]
+        k_cartesian = np.real(np.asarray(k_cartesian))
+        self.n_points = [int(n) for n in n_points]
+        self.width = width
+        self.beta = np.pi * np.sqrt((width / oversampling) ** 2 * (oversampling - 0.5) ** 2 - 0.8)
+
+        # Grid of each axis: first point, step and number of points of the oversampled grid
+        self.gridded = [axis in axes and self.n_points[axis] > 1 for axis in range(3)]
+        self.k0 = np.zeros(3)
+        self.dk = np.ones(3)
+        self.n_os = [1, 1, 1]
+        for axis in range(3):
+            if self.gridded[axis]:
+                self.k0[axis] = np.min(k_cartesian[:, axis])
+                self.dk[axis] = (np.max(k_cartesian[:, axis]) - self.k0[axis]) / (self.n_points[axis] - 1)
+                self.n_os[axis] = int(np.ceil(oversampling * self.n_points[axis]))
+
+        # Convolution matrix and kernel apodization
+        self.matrix = self.get_matrix(k) if matrix is None else matrix
+        self.deapodization = [self._get_apodization(axis) for axis in range(3)]
+
+        # Density compensation (Pipe and Menon), convolving the weights with the kernel through the grid
+        if dcf is None:
+            dcf = np.ones(k.shape[0])
+            for ii in range(n_dcf_iter):
+                density = self.matrix.T @ (self.matrix @ dcf)
+                dcf /= np.where(density > 0, density, 1)
+            dcf *= self._get_dcf_scale()
+        self.dcf = dcf
+
+    def get_matrix(self, k):
+        """
+        Build the sparse matrix that convolves the samples with the kernel into the oversampled grid.
+
+        Args:
+            k (np.ndarray): k-space points of the samples with shape (n_samples, 3) in 1/m.
+
+        Returns:
+            scipy.sparse.csr_matrix: Matrix with shape (n_grid, n_samples), with the grid flattened in (z, y, x) order.
+        """
+        n_samples = k.shape[0]
+        index = np.zeros((n_samples, 1), dtype=np.int64)
+        value = np.ones((n_samples, 1))
+        for axis in [2, 1, 0]:
+            axis_index, axis_value = self._get_axis_weights(axis, k[:, axis])
+            index = np.reshape(index[:, :, None] * self.n_os[axis] + axis_index[:, None, :], (n_samples, -1))
+            value = np.reshape(value[:, :, None] * axis_value[:, None, :], (n_samples, -1))
+        columns = np.repeat(np.arange(n_samples), index.shape[1])
+        matrix = sparse.csr_matrix((np.reshape(value, -1), (np.reshape(index, -1), columns)),
+                                   shape=(int(np.prod(self.n_os)), n_samples))
+        matrix.sum_duplicates()
+        return matrix
+
+    def grid(self, s):
+        """
+        Get the Cartesian k-space from the signal of the samples.
+
+        Args:
+            s (np.ndarray): Signal of each sample.
+
+        Returns:
+            np.ndarray: Cartesian k-space with shape (nz, ny, nx).
+        """
+        return self.image2kspace(self.samples2image(np.reshape(s, -1) * self.dcf))
+
+    def samples2image(self, s):
+        """
+        Adjoint NUFFT: convolve the samples into the oversampled grid and get the apodization corrected image of the
+        field of view.
+
+        Args:
+            s (np.ndarray): Value of each sample (already weighted with the density compensation if needed).
+
+        Returns:
+            np.ndarray: Image with shape (nz, ny, nx), with the center of the field of view at index 0 of each axis.
+        """
+        grid = np.reshape(self.matrix @ np.reshape(s, -1), self.n_os[::-1])
+        image = np.fft.ifftn(grid, axes=[axis for axis in range(3) if self.gridded[2 - axis]])
+        for axis in range(3):
+            if self.gridded[axis]:
+                image = np.take(image, self._get_fov_index(axis), axis=2 - axis)
+                image = image / np.reshape(self.deapodization[axis], [-1 if ii == 2 - axis else 1 for ii in range(3)])
+        return image
+
+    def image2samples(self, image):
+        """
+        Forward NUFFT: get the value of the samples from an image, as the adjoint of samples2image.
+
+        Args:
+            image (np.ndarray): Image with shape (nz, ny, nx), with the center of the field of view at index 0.
+
+        Returns:
+            np.ndarray: Value of each sample.
+        """
+        image = np.reshape(image, [self.n_points[2 - ii] if self.gridded[2 - ii] else 1 for ii in range(3)])
+        for axis in range(3):
+            if self.gridded[axis]:
+                image = image / np.reshape(self.deapodization[axis], [-1 if ii == 2 - axis else 1 for ii in range(3)])
+                shape = list(image.shape)
+                shape[2 - axis] = self.n_os[axis]
+                padded = np.zeros(shape, dtype=complex)
+                index = [slice(None)] * 3
+                index[2 - axis] = self._get_fov_index(axis)
+                padded[tuple(index)] = image
+                image = padded / self.n_os[axis]
+        grid = np.fft.fftn(image, axes=[axis for axis in range(3) if self.gridded[2 - axis]])
+        return self.matrix.T @ np.reshape(grid, -1)
+
+    def image2kspace(self, image):
+        """
+        Get the Cartesian k-space of an image given by samples2image.
+
+        Args:
+            image (np.ndarray): Image with shape (nz, ny, nx).
+
+        Returns:
+            np.ndarray: Cartesian k-space with shape (nz, ny, nx).
+        """
+        axes = [axis for axis in range(3) if self.gridded[2 - axis]]
+        k_space = np.fft.fftn(image, axes=axes) if len(axes) > 0 else image
+        for axis in range(3):
+            if self.gridded[axis]:
+                k_space = k_space * self.n_os[axis] / self.n_points[axis]
+        return np.broadcast_to(k_space, tuple(self.n_points[::-1])).copy()
+
+    def _get_fov_index(self, axis):
+        # Index in the oversampled image of each point of the field of view, with the center at index 0
+        n = self.n_points[axis]
+        positions = np.arange(-(n // 2), n - n // 2)
+        return (positions % self.n_os[axis])[np.argsort(positions % n)]
+
+    def _get_axis_weights(self, axis, k):
+        # Closest points of the oversampled grid to the samples along one axis and kernel value for each of them
+        if not self.gridded[axis]:
+            return np.zeros((k.shape[0], 1), dtype=np.int64), np.ones((k.shape[0], 1))
+        u = (k - self.k0[axis]) / self.dk[axis] * self.n_os[axis] / self.n_points[axis]
+        first = np.ceil(u - self.width / 2).astype(np.int64)
+        points = first[:, None] + np.arange(self.width)[None, :]
+        return points % self.n_os[axis], self._kernel(points - u[:, None])
+
+    def _kernel(self, d):
+        # Kaiser-Bessel kernel at distance d, in points of the oversampled grid
+        arg = 1 - (2 * d / self.width) ** 2
+        return np.where(arg >= 0, i0(self.beta * np.sqrt(np.clip(arg, 0, None))), 0) / self.width
+
+    def _get_apodization(self, axis):
+        # Fourier transform of the kernel at the image positions of the field of view, in the order of samples2image
+        if not self.gridded[axis]:
+            return np.ones(1)
+        n = self.n_points[axis]
+        positions = np.arange(-(n // 2), n - n // 2)
+        positions = positions[np.argsort(positions % n)]
+        d = np.linspace(-self.width / 2, self.width / 2, 20 * self.width + 1)
+        kernel = self._kernel(d) * (d[1] - d[0])
+        return np.real(np.exp(2j * np.pi * np.outer(positions / self.n_os[axis], d)) @ kernel)
+
+    def _get_dcf_scale(self):
+        # The density compensation makes the convolution of the weights with the autocorrelation of the kernel equal to
+        # one, i.e. weights oversampling / integral(kernel)^2 per axis for a uniform density of samples. Scale them to
+        # one, so that the amplitude of the k-space is kept
+        scale = 1.0
+        for axis in range(3):
+            if self.gridded[axis]:
+                scale *= self.deapodization[axis][0] ** 2 * self.n_points[axis] / self.n_os[axis]
+        return scale
+
+
+def get_gridder(k, k_cartesian, n_points, axes=(0, 1, 2), oversampling=2.0, width=4, n_dcf_iter=20,
+                cache_dir=CACHE_DIR):
+    """
+    Get a NufftGridder, reusing the convolution matrix and the density compensation saved on disk for the same
+    trajectory.
+
+    The convolution matrix and the density compensation only depend on the trajectory and the grid, so they are saved
+    into cache_dir in a .npz file named with a hash of all the inputs. Repeated scans with the same protocol, or the
+    reconstruction of raw data already reconstructed once, load them instead of building them again. The cache is pruned
+    with prune_cache after saving a new file.
+
+    Args:
+        k (np.ndarray): k-space points of the samples with shape (n_samples, 3) in 1/m.
+        k_cartesian (np.ndarray): Cartesian k-space points with shape (nx * ny * nz, 3) in 1/m.
+        n_points (list): Number of points [nx, ny, nz] of the Cartesian grid.
+        axes (tuple): Axes (0 for x, 1 for y, 2 for z) to be gridded.
+        oversampling (float): Oversampling factor of the grid.
+        width (int): Width of the Kaiser-Bessel kernel in points of the oversampled grid.
+        n_dcf_iter (int): Number of iterations of the density compensation.
+        cache_dir (str, optional): Folder of the cache, calibration/nufft in the MaRGE folder by default. If None, the
+            cache is not used.
+
+    Returns:
+        NufftGridder: The gridder.
+    """
+    k = np.ascontiguousarray(np.real(np.asarray(k))[:, 0:3], dtype=np.float64)
+    k_cartesian = np.ascontiguousarray(np.real(np.asarray(k_cartesian)), dtype=np.float64)
+    if cache_dir is None:
+        return NufftGridder(k, k_cartesian, n_points, axes=axes, oversampling=oversampling, width=width,
+                            n_dcf_iter=n_dcf_iter)
+
+    # Key of the cache
+    key = hashlib.sha1()
+    key.update(k.tobytes())
+    key.update(k_cartesian.tobytes())
+    key.update(repr(([int(n) for n in n_points], sorted(int(axis) for axis in axes), float(oversampling),
+                     int(width), int(n_dcf_iter))).encode())
+    file_name = os.path.join(cache_dir, "nufft_%s.npz" % key.hexdigest())
+
+    # Load the matrix and the density compensation
+    if os.path.exists(file_name):
+        try:
+            with np.load(file_name) as data:
+                matrix = sparse.csr_matrix((data['data'], data['indices'], data['indptr']),
+                                           shape=tuple(data['shape']))
+                dcf = data['dcf']
+            gridder = NufftGridder(k, k_cartesian, n_points, axes=axes, oversampling=oversampling, width=width,
+                                   matrix=matrix, dcf=dcf)
+        except (OSError, KeyError, ValueError):
+            print("WARNING: corrupted NUFFT cache file %s. Building it again." % file_name)
+        else:
+            # Keep the files in use when the cache is pruned
+            try:
+                os.utime(file_name)
+            except OSError:
+                pass
+            return gridder
+
+    # Build the gridder and save it. The file is renamed at the end so that it is never read half written
+    gridder = NufftGridder(k, k_cartesian, n_points, axes=axes, oversampling=oversampling, width=width,
+                           n_dcf_iter=n_dcf_iter)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        temp_name = file_name[0:-4] + "_%i.tmp.npz" % os.getpid()
+        np.savez(temp_name, data=gridder.matrix.data, indices=gridder.matrix.indices, indptr=gridder.matrix.indptr,
+                 shape=np.array(gridder.matrix.shape), dcf=gridder.dcf)
+        os.replace(temp_name, file_name)
+    except OSError:
+        print("WARNING: NUFFT cache could not be saved into %s." % cache_dir)
+    prune_cache(cache_dir, keep=file_name)
+    return gridder
+
+
+def prune_cache(cache_dir=CACHE_DIR, max_size=MAX_CACHE_SIZE, max_age=MAX_CACHE_AGE, keep=None):
+    """
+    Remove the files of the NUFFT cache not used for longer than max_age, and the least recently used ones until the
+    cache takes at most max_size.
+
+    Args:
+        cache_dir (str): Folder of the cache.
+        max_size (int): Maximum size of the cache in bytes.
+        max_age (float): Maximum time in seconds since the last use of a file.
+        keep (str, optional): File that is never removed, e.g. the one just saved.
+
+    Returns:
+        list: Removed files.
+    """
+    try:
+        file_names = [os.path.join(cache_dir, name) for name in os.listdir(cache_dir)
+                      if name.startswith('nufft_') and name.endswith('.npz') and not name.endswith('.tmp.npz')]
+    except OSError:
+        return []
+
+    # Files from the most recently used to the oldest one, after the file to keep
+    files = []
+    for file_name in file_names:
+        try:
+            stat = os.stat(file_name)
+        except OSError:
+            continue
+        files.append((file_name == keep, stat.st_mtime, stat.st_size, file_name))
+    files.sort(reverse=True)
+
+    removed = []
+    size = 0
+    now = time.time()
+    for kept, mtime, file_size, file_name in files:
+        size += file_size
+        if not kept and (now - mtime > max_age or size > max_size):
+            try:
+                os.remove(file_name)
+                removed.append(file_name)
+                size -= file_size
+            except OSError:
+                print("WARNING: NUFFT cache file %s could not be removed." % file_name)
+    return removed
+
+
+def cg_reconstruction(gridder, s, lbda=0.0, n_iter=20, tol=1e-4, weighted=True, x0=None):
+    """
+    Least-squares reconstruction of non-Cartesian data with the conjugate gradient method.
+
+    Solves (A^H W A + lbda * ||A^H W A|| * I) x = A^H W s, where A is the forward NUFFT of the gridder and W the density
+    compensation (if weighted) that improves the convergence as in CG-SENSE. The iterations stop when the relative
+    residual is below tol.
+
+    Args:
+        gridder (NufftGridder): Gridder of the trajectory.
+        s (np.ndarray): Signal of each sample.
+        lbda (float): Tikhonov regularization, relative to the norm of A^H W A.
+        n_iter (int): Maximum number of iterations.
+        tol (float): Relative residual to stop the iterations.
+        weighted (bool): Use the density compensation to weight the samples.
+        x0 (np.ndarray, optional): Initial image with shape (nz, ny, nx). If None, the gridded image is used.
+
+    Returns:
+        np.ndarray: Image with shape (nz, ny, nx), with the center of the field of view at index 0 of each axis.
+    """
+    s = np.reshape(s, -1)
+    weights = gridder.dcf if weighted else np.ones_like(gridder.dcf)
+
+    # Scale of the forward NUFFT for images with the amplitude of the gridded image
+    scale = np.prod([gridder.n_os[axis] ** 2 / gridder.n_points[axis] for axis in range(3) if gridder.gridded[axis]])
+
+    def normal(x):
+        return scale ** 2 * gridder.samples2image(weights * gridder.image2samples(x))
+
+    # Regularization relative to the largest eigenvalue of the normal operator, estimated with power iterations
+    b = scale * gridder.samples2image(weights * s)
+    mu = 0.0
+    if lbda > 0:
+        v = b / np.linalg.norm(b)
+        for ii in range(5):
+            w = normal(v)
+            mu = np.linalg.norm(w)
+            v = w / mu
+        mu *= lbda
+
+    # Warm start from the gridded image
+    if x0 is None:
+        x0 = gridder.samples2image(gridder.dcf * s)
+    x = np.array(np.reshape(x0, b.shape), dtype=complex)
+
+    r = b - normal(x) - mu * x
+    p = r.copy()
+    rr = np.real(np.vdot(r, r))
+    b_norm = np.linalg.norm(b)
+    for iteration in range(n_iter):
+        ap = normal(p) + mu * p
+        alpha = rr / np.real(np.vdot(p, ap))
+        x += alpha * p
+        r -= alpha * ap
+        rr_new = np.real(np.vdot(r, r))
+        print("CG iteration %i: residual %0.2e" % (iteration + 1, np.sqrt(rr_new) / b_norm))
+        if np.sqrt(rr_new) / b_norm < tol:
+            break
+        p = r + rr_new / rr * p
+        rr = rr_new
+
+    return x
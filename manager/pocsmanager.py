@@ -0,0 +1,152 @@
+"""
+@author: J.M. Algarín, MRILab, i3M, CSIC, Valencia
+@email: josalggui@i3m.upv.es
+@Summary: partial Fourier reconstruction (POCS and homodyne) of 3D k-space data
+"""
+
+import numpy as np
+import scipy.fft as fft
+from manager.fftmanager import fft_service
+
+
+def pocs_reconstruction(k_space, mm, m, nb_point=2, threshold=1e-3, max_iter=100, single=False):
+    """
+    Reconstruct partial Fourier data with POCS (projection onto convex sets).
+
+    The acquired points are the first mm points of each axis, and the 2*m points around the k-space center give the
+    phase of the image. Starting from the image of the acquired data with a Hanning filter at the edge, the magnitude
+    is combined with the phase, the acquired points are restored in k-space, and the process is repeated until the
+    relative change of the magnitude is below the threshold.
+
+    The data is kept in k-space order without shifts during the iterations (the phase is applied point by point, so it
+    does not depend on the shift), and all the operations are done in place in buffers allocated before the loop.
+    Leading axes of k_space (e.g. scans or echoes) are reconstructed as a batch.
+
+    Args:
+        k_space (np.ndarray): k-space data with shape (..., nz, ny, nx) and the center of k-space in the middle.
+        mm (list): Number of acquired points of each of the last three axes.
+        m (list): Number of points past the center of k-space of each of the last three axes.
+        nb_point (int): Number of points of the Hanning filter at the edge of the acquired data.
+        threshold (float): Relative change of the magnitude between iterations to stop.
+        max_iter (int): Maximum number of iterations.
+        single (bool): If True, the reconstruction is done in complex64.
+
+    Returns:
+        np.ndarray: Magnitude image with the same shape as k_space.
+    """
+    axes = (-3, -2, -1)
+    dtype = np.complex64 if single else complex
+    k_ref = np.fft.ifftshift(np.asarray(k_space), axes=axes).astype(dtype)
+    shape = k_ref.shape[-3:]
+
+    # Phase of the image from the center of k-space
+    weights = _get_weights(shape, _center_window, m, dtype=k_ref.real.dtype)
+    phase = fft.ifftn(k_ref * weights, axes=axes, workers=fft_service.workers, overwrite_x=True)
+    magnitude = np.abs(phase)
+    np.divide(phase, magnitude, out=phase, where=magnitude > 0)
+
+    # Initial image from the acquired data with the Hanning filter
+    weights = _get_weights(shape, _hanning_window, mm, [nb_point] * 3, dtype=k_ref.real.dtype)
+    buffer = fft.ifftn(k_ref * weights, axes=axes, workers=fft_service.workers, overwrite_x=True)
+    np.abs(buffer, out=magnitude)
+    previous = np.empty_like(magnitude)
+    acquired = _get_weights(shape, _acquired_window, mm) > 0
+
+    for iteration in range(max_iter + 1):
+        # Combine the magnitude with the phase and restore the acquired points
+        np.multiply(magnitude, phase, out=buffer)
+        buffer = fft.fftn(buffer, axes=axes, workers=fft_service.workers, overwrite_x=True)
+        np.copyto(buffer, k_ref, where=acquired)
+        buffer = fft.ifftn(buffer, axes=axes, workers=fft_service.workers, overwrite_x=True)
+
+        # New magnitude and relative change respect to the previous one
+        magnitude, previous = previous, magnitude
+        np.abs(buffer, out=magnitude)
+        np.subtract(previous, magnitude, out=previous)
+        change = np.einsum('...ijk,...ijk->...', previous, previous)
+        norm = np.einsum('...ijk,...ijk->...', magnitude, magnitude)
+        convergence = np.max(np.sqrt(change / np.where(norm > 0, norm, 1)))
+        print("Iteration: %i, Convergence: %0.2e" % (iteration, convergence))
+        if convergence <= threshold:
+            break
+
+    return np.fft.ifftshift(magnitude, axes=axes)
+
+
+def homodyne_reconstruction(k_space, mm, m, single=False):
+    """
+    Reconstruct partial Fourier data with the homodyne method, without iterations.
+
+    The acquired points past the symmetric center of k-space are weighted by 2, the symmetric center by a ramp from 2
+    to 0, and the image is demodulated with the phase of the center of k-space. The real part of the result is the
+    image. If more than one axis is partial, the weights of the axes are multiplied.
+
+    Args:
+        k_space (np.ndarray): k-space data with shape (..., nz, ny, nx) and the center of k-space in the middle.
+        mm (list): Number of acquired points of each of the last three axes.
+        m (list): Number of points past the center of k-space of each of the last three axes.
+        single (bool): If True, the reconstruction is done in complex64.
+
+    Returns:
+        np.ndarray: Real image with the same shape as k_space.
+    """
+    axes = (-3, -2, -1)
+    dtype = np.complex64 if single else complex
+    k_ref = np.fft.ifftshift(np.asarray(k_space), axes=axes).astype(dtype)
+    shape = k_ref.shape[-3:]
+
+    # Phase of the image from the center of k-space
+    weights = _get_weights(shape, _center_window, m, dtype=k_ref.real.dtype)
+    phase = fft.ifftn(k_ref * weights, axes=axes, workers=fft_service.workers, overwrite_x=True)
+    phase = np.conj(phase, out=phase)
+    np.divide(phase, np.abs(phase), out=phase, where=phase != 0)
+
+    # Weighted image demodulated with the phase
+    weights = _get_weights(shape, _homodyne_window, mm, m, dtype=k_ref.real.dtype)
+    image = fft.ifftn(k_ref * weights, axes=axes, workers=fft_service.workers, overwrite_x=True)
+    image *= phase
+
+    return np.fft.ifftshift(np.real(image), axes=axes)
+
+
+def _get_weights(shape, window, *parameters, dtype=float):
+    # Product of the 1D windows of the three axes, in k-space order without shifts. Each parameter has one value per
+    # axis
+    weights = np.ones(shape, dtype=dtype)
+    for axis, n in enumerate(shape):
+        w = np.fft.ifftshift(window(n, *[int(parameter[axis]) for parameter in parameters]))
+        weights = weights * np.reshape(w.astype(dtype), [-1 if ii == axis else 1 for ii in range(3)])
+    return weights
+
+
+def _acquired_window(n, mm):
+    # Ones for the first mm points
+    w = np.zeros(n)
+    w[0:mm] = 1.0
+    return w
+
+
+def _center_window(n, m):
+    # Ones for the 2*m points around the center
+    w = np.zeros(n)
+    w[max(n // 2 - m, 0):n // 2 + m] = 1.0
+    return w
+
+
+def _hanning_window(n, mm, nb_point):
+    # Ones for the first mm points, with the last nb_point points going to zero with half a Hanning window
+    w = _acquired_window(n, mm)
+    if mm < n:
+        w[mm - nb_point + 1:mm + 1] *= np.hanning(nb_point * 2)[nb_point::]
+    return w
+
+
+def _homodyne_window(n, mm, m):
+    # 2 for the acquired points before the symmetric center, a ramp from 2 to 0 in the symmetric center and 0 for the
+    # points not acquired. Ones if the axis is fully acquired
+    if mm >= n or m <= 0:
+        return np.ones(n)
+    w = np.zeros(n)
+    w[0:n // 2 - m] = 2.0
+    w[n // 2 - m:mm] = 1.0 - (np.arange(n // 2 - m, mm) - n // 2) / m
+    return w
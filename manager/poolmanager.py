@@ -0,0 +1,44 @@
+"""
+@author: J.M. Algarín, MRILab, i3M, CSIC, Valencia
+@email: josalggui@i3m.upv.es
+@Summary: choice of the pool of workers used to parallelize the managers from the GUI
+"""
+
+import multiprocessing
+import concurrent.futures
+
+
+def can_fork():
+    """
+    Check if the worker processes can be forked from the current process.
+
+    Returns:
+        bool: True if the 'fork' start method is available (i.e. not on Windows).
+    """
+    return 'fork' in multiprocessing.get_all_start_methods()
+
+
+def get_executor(n_workers, processes=False):
+    """
+    Get the executor of a pool of workers.
+
+    Threads are used by default. Forking processes from the GUI is only safe when no other thread holds a lock at
+    that moment (Qt, the server communication or the acquisition threads), so processes must be requested explicitly,
+    for code that is limited by the GIL and is not run while the GUI is busy. They are forked, and not spawned, so the
+    jobs can be nested functions of the sequences and the processes do not import the GUI again.
+
+    Args:
+        n_workers (int): Number of workers.
+        processes (bool): If True, the workers are forked processes instead of threads.
+
+    Returns:
+        concurrent.futures.Executor: Executor with n_workers workers, or None if processes were requested but they can
+        not be forked.
+    """
+    if not processes:
+        return concurrent.futures.ThreadPoolExecutor(max_workers=n_workers)
+    elif can_fork():
+        return concurrent.futures.ProcessPoolExecutor(max_workers=n_workers,
+                                                      mp_context=multiprocessing.get_context('fork'))
+    else:
+        return None
@@ -0,0 +1,322 @@
+"""
+@author: J.M. Algarín, MRILab, i3M, CSIC, Valencia
+@email: josalggui@i3m.upv.es
+@Summary: interpretation of PyPulseq sequences without batch files, parallel compilation of the batches, asynchronous
+archiving of the .seq files and streaming reading of external .seq files
+"""
+
+import os
+import pickle
+import tempfile
+import threading
+from concurrent.futures.process import BrokenProcessPool
+from importlib.metadata import version, PackageNotFoundError
+
+import numpy as np
+from marga_pulseq.interpreter import PSInterpreter
+
+import configs.hw_config as hw
+from manager.flomanager import FloBudget
+from manager.poolmanager import get_executor, can_fork
+
+# Versions of marga_pulseq whose private event tables and methods are used by SequenceInterpreter.interpret_chunks
+SUPPORTED_VERSIONS = ('0.2.2',)
+
+# Maximum number of processes compiling the batches when hw.batch_workers is None
+MAX_BATCH_WORKERS = 8
+
+# Folder of the temporary .seq files, in RAM when the system has a tmpfs at /dev/shm
+TEMP_DIR = '/dev/shm' if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK) else None
+
+
+def _get_marga_pulseq_version():
+    try:
+        return version('marga_pulseq')
+    except PackageNotFoundError:
+        return None
+
+
+class SequenceInterpreter(PSInterpreter):
+    """
+    PSInterpreter that interprets PyPulseq sequences without .seq files in the working directory.
+
+    Sequences are written into temporary .seq files, in RAM when possible, and interpreted with the public interpret()
+    method, so the waveforms are the same than the ones obtained from the batch files.
+
+    Long .seq files can also be interpreted in chunks that fit into the hardware limits. This relies on the private
+    event tables and methods of PSInterpreter, so it is only done with the versions of marga_pulseq in
+    SUPPORTED_VERSIONS. With other versions the file is interpreted in a single chunk.
+
+    Attributes:
+        supports_chunks (bool): True if the installed marga_pulseq supports the interpretation in chunks.
+    """
+
+    supports_chunks = _get_marga_pulseq_version() in SUPPORTED_VERSIONS
+
+    def interpret_sequence(self, seq):
+        """
+        Interpret a PyPulseq sequence through a temporary .seq file.
+
+        Args:
+            seq (pp.Sequence): PyPulseq sequence to interpret.
+
+        Returns:
+            dict: tuple of numpy.ndarray time and update arrays, with variable name keys
+            dict: parameter dictionary containing raster times, readout numbers, and any sequence definitions
+        """
+        file, file_name = tempfile.mkstemp(suffix='.seq', dir=TEMP_DIR)
+        os.close(file)
+        try:
+            seq.write(file_name)
+            return self.interpret(file_name)
+        finally:
+            os.remove(file_name)
+
+    def interpret_chunks(self, pulseq_file, max_orders, max_rd_points):
+        """
+        Interpret a .seq file in consecutive chunks of blocks that fit into the hardware limits.
+
+        The file is read once, then the blocks are split at block boundaries according to the number of instructions
+        and readout points estimated for each block, and each chunk is interpreted independently. Each chunk starts at
+        time zero, so there is a dead time between chunks when they are executed one after another.
+
+        Args:
+            pulseq_file (str): Path to the .seq file.
+            max_orders (int): Maximum number of instructions, usually hw.maxOrders.
+            max_rd_points (int): Maximum number of readout points, usually hw.maxRdPoints.
+
+        Yields:
+            tuple: (waveforms, param_dict) of each chunk, as given by interpret().
+        """
+        if not self.supports_chunks:
+            print("WARNING: marga_pulseq %s does not support chunks, the file is interpreted at once."
+                  % _get_marga_pulseq_version())
+            waveforms, param_dict = self.interpret(pulseq_file)
+            param_dict['n_chunks'] = 1
+            yield waveforms, param_dict
+            return
+        if self.is_assembled:
+            self._reset()
+        self._read_pulseq(pulseq_file)
+        self._compile_tx_data()
+        self._compile_grad_data()
+        self.is_assembled = True
+
+        # Split the blocks into chunks
+        blocks = self._blocks
+        block_ids = list(blocks.keys())
+        steps = [self._get_block_budget(blocks[block_id]) for block_id in block_ids]
+        ranges = FloBudget().plan_batches(steps, max_orders, max_rd_points)
+
+        try:
+            for start, stop in ranges:
+                self._blocks = {block_id: blocks[block_id] for block_id in block_ids[start:stop]}
+                self.out_data, self.readout_number = self._stream_all_blocks()
+                param_dict = {'readout_number': self.readout_number, 'tx_t': self._tx_t, 'rx_t': self._rx_t,
+                              'grad_t': self._grad_t, 'n_chunks': len(ranges)}
+                param_dict.update(self._definitions)
+                yield self.out_data, param_dict
+        finally:
+            self._blocks = blocks
+
+    def _reset(self):
+        """
+        Clear the event tables of the previous sequence, keeping the system parameters, as interpret() does.
+        """
+        self.__init__(
+            rf_center=self._rf_center, rf_amp_max=self._rf_amp_max,
+            gx_max=self._grad_max['gx'], gy_max=self._grad_max['gy'], gz_max=self._grad_max['gz'],
+            clk_t=self._clk_t, tx_t=self._tx_t, grad_t=self._grad_t,
+            tx_warmup=self._tx_warmup, tx_zero_end=self._tx_zero_end, grad_zero_end=self._grad_zero_end,
+            log_file='ps_interpreter', log_level=20,
+        )
+
+    def _get_block_budget(self, block):
+        """
+        Estimate the instructions and readout points of a block of the event tables, as FloBudget.from_blocks does for
+        PyPulseq blocks.
+
+        Args:
+            block (dict): Block of the interpreter event tables.
+
+        Returns:
+            FloBudget: Instructions per channel and readout points per rx channel.
+        """
+        budget = FloBudget()
+        if block['rf'] != 0:
+            budget.orders['tx0'] += len(self._shapes[self._rf_events[block['rf']]['mag_id']]) + 1
+            budget.orders['ttl0'] += 2
+        for idx, key in enumerate(['gx', 'gy', 'gz']):
+            if block[key] == 0:
+                continue
+            grad = self._grad_events[block[key]]
+            if grad['is_trap']:
+                budget.orders['g%i' % idx] += int(np.ceil(grad['rise'] / self._grad_t)) + \
+                                              int(np.ceil(grad['fall'] / self._grad_t)) + 1
+            else:
+                budget.orders['g%i' % idx] += len(self._shapes[grad['shape_id']]) + 1
+        if block['adc'] != 0:
+            budget.orders['rx0'] += 2
+            budget.rd_points['rx0'] += self._adc_events[block['adc']]['num']
+        return budget
+
+
+def read_seq_header(file_path):
+    """
+    Read the version, definitions and readout information of a .seq file without loading the full file.
+
+    The file is read line by line and only the [VERSION], [DEFINITIONS] and [ADC] sections are stored. The lines of the
+    [BLOCKS] section are only used to count the blocks and the ADC windows.
+
+    Args:
+        file_path (str): Path to the .seq file.
+
+    Returns:
+        dict: Dictionary with 'version', 'definitions', 'n_blocks', 'n_adc' (number of ADC windows), 'n_readouts'
+        (points per ADC window of the last ADC event), 'dwell' (ns, of the last ADC event) and 'n_rd_points' (total
+        number of readout points).
+    """
+    version = {}
+    definitions = {}
+    adc_events = {}
+    adc_count = {}  # Number of blocks using each ADC event
+    n_blocks = 0
+    section = None
+    with open(file_path, 'r') as file:
+        for line in file:
+            line = line.split('#')[0].strip()
+            if line == '':
+                continue
+            if line.startswith('['):
+                section = line
+                continue
+            components = line.split()
+            if section == '[VERSION]' and len(components) == 2:
+                version[components[0]] = int(components[1])
+            elif section == '[DEFINITIONS]' and len(components) >= 2:
+                try:
+                    definitions[components[0]] = float(components[1]) if len(components) == 2 else \
+                        [float(value) for value in components[1::]]
+                except ValueError:
+                    definitions[components[0]] = ' '.join(components[1::])
+            elif section == '[BLOCKS]' and len(components) >= 7:
+                n_blocks += 1
+                adc_id = int(components[6])
+                if adc_id != 0:
+                    adc_count[adc_id] = adc_count.get(adc_id, 0) + 1
+            elif section == '[ADC]' and len(components) >= 4:
+                adc_events[int(components[0])] = (int(components[1]), int(float(components[2])))
+
+    n_readouts, dwell = list(adc_events.values())[-1] if len(adc_events) > 0 else (0, None)
+    return {'version': version,
+            'definitions': definitions,
+            'n_blocks': n_blocks,
+            'n_adc': sum(adc_count.values()),
+            'n_readouts': n_readouts,
+            'dwell': dwell,
+            'n_rd_points': sum(adc_events[adc_id][0] * count for adc_id, count in adc_count.items()),
+            }
+
+
+# Batch builder inherited by the worker processes of compile_batches
+_batch_builder = None
+
+
+def _compile_batch(args):
+    # Create and interpret a single batch in a worker process
+    create_batch, interpreter = _batch_builder
+    batch = create_batch(*args)
+    waveforms, param_dict = interpreter.interpret_sequence(batch)
+    return batch, waveforms
+
+
+def get_batch_workers():
+    """
+    Get the number of processes used to compile the batches of the PyPulseq sequences.
+
+    The number is given by hw.batch_workers. If it is None, or it is missing in hw_config.py (configuration files older
+    than this setting), the number of CPUs is used, up to MAX_BATCH_WORKERS. Where the processes can not be forked
+    (e.g. on Windows), the batches are compiled sequentially.
+
+    Returns:
+        int: Number of processes, 1 to compile the batches sequentially.
+    """
+    if not can_fork():
+        return 1
+    n_workers = getattr(hw, 'batch_workers', None)
+    if n_workers is None:
+        n_workers = min(os.cpu_count() or 1, MAX_BATCH_WORKERS)
+    return max(int(n_workers), 1)
+
+
+def compile_batches(interpreter, create_batch, batch_args, n_workers=1):
+    """
+    Create and interpret the batches of a sequence, optionally in a pool of processes.
+
+    The batches must be independent, i.e. create_batch builds a complete batch from its arguments. By default the
+    batches are compiled one after another in the current process. With n_workers > 1 the worker processes are forked
+    from the current process (see poolmanager.get_executor), so create_batch can be a nested function of the sequence.
+    If fork is not available (e.g. on Windows), or if the pool breaks or the results can not be pickled, the batches
+    are compiled sequentially. Errors raised by create_batch or by the interpreter are propagated.
+
+    Args:
+        interpreter (SequenceInterpreter): Interpreter of the sequence.
+        create_batch (function): Function that returns the pp.Sequence of a batch.
+        batch_args (list): Arguments of create_batch for each batch.
+        n_workers (int, optional): Number of processes. If None, the number of CPUs is used.
+
+    Returns:
+        list: (batch, waveforms) tuples in the same order than batch_args.
+    """
+    global _batch_builder
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    n_workers = min(n_workers, len(batch_args))
+
+    pool = get_executor(n_workers, processes=True) if n_workers > 1 else None
+    if pool is not None:
+        _batch_builder = (create_batch, interpreter)
+        try:
+            with pool:
+                return list(pool.map(_compile_batch, batch_args))
+        except (BrokenProcessPool, pickle.PicklingError) as error:
+            print("WARNING: parallel compilation of the batches failed (%s), compiling them sequentially." % error)
+        finally:
+            _batch_builder = None
+
+    results = []
+    for args in batch_args:
+        batch = create_batch(*args)
+        waveforms, param_dict = interpreter.interpret_sequence(batch)
+        results.append((batch, waveforms))
+    return results
+
+
+def save_seq_files(batches, folder, file_name):
+    """
+    Write the PyPulseq batches of a sequence into .seq files in a separate thread.
+
+    Files are saved into folder/seq as file_name_X.seq, where X is the last field of the batch name (e.g. batch_X).
+    Errors while writing the files are printed, as they can not be raised to the caller.
+
+    Args:
+        batches (dict): PyPulseq sequences with the batch names as keys.
+        folder (str): Destination folder, usually the session directory.
+        file_name (str): Prefix of the .seq files.
+
+    Returns:
+        threading.Thread: Thread writing the files.
+    """
+    batches = dict(batches)
+
+    def write():
+        try:
+            os.makedirs(os.path.join(folder, 'seq'), exist_ok=True)
+            for name, batch in batches.items():
+                batch.write(os.path.join(folder, 'seq', "%s_%s.seq" % (file_name, name.split('_')[-1])))
+        except Exception as error:
+            print("ERROR: .seq files of %s not saved (%s)" % (file_name, error))
+
+    thread = threading.Thread(target=write)
+    thread.start()
+    return thread
@@ -0,0 +1,238 @@
+"""
+@author: J.M. Algarín, MRILab, i3M, CSIC, Valencia
+@email: josalggui@i3m.upv.es
+@Summary: HDF5 container of the raw data of the acquisitions, written incrementally during the acquisition and read
+partially in post-processing, and its conversion to .mat
+"""
+
+from collections.abc import Mapping
+import h5py
+import numpy as np
+from scipy.io import savemat
+
+# Arrays with more elements than this are saved as datasets, smaller values as attributes
+MAX_ATTRIBUTE_SIZE = 1024
+
+# Number of elements of the chunks of the data appended during the acquisition
+CHUNK_SIZE = 2 ** 16
+
+
+class RawDataWriter:
+    """
+    Writer of the HDF5 raw data file of an acquisition.
+
+    The parameters and other small values are saved as attributes and the arrays as chunked datasets compressed with
+    gzip. The acquired data is appended to resizable datasets as it arrives, and the file is flushed after each append,
+    so the data acquired up to a crash can be recovered. The attribute 'complete' is False until the file is closed
+    after the analysis.
+    """
+
+    def __init__(self, file_name):
+        """
+        Create the file.
+
+        Args:
+            file_name (str): Path to the .h5 file.
+        """
+        self.file_name = file_name
+        self.file = h5py.File(file_name, 'w')
+        self.file.attrs['complete'] = False
+        self._appended = set()  # Datasets written with append, not overwritten by write
+
+    def __contains__(self, name):
+        return name in self.file
+
+    def append(self, name, data):
+        """
+        Append data to a resizable dataset along the first axis and flush the file.
+
+        Args:
+            name (str): Name of the dataset. It is created in the first call.
+            data (np.ndarray): Data to append.
+        """
+        data = np.asarray(data)
+        if data.ndim == 0:
+            data = np.reshape(data, 1)
+        if name not in self.file:
+            chunks = (max(CHUNK_SIZE // max(int(np.prod(data.shape[1:])), 1), 1),) + data.shape[1:]
+            self.file.create_dataset(name, shape=(0,) + data.shape[1:], maxshape=(None,) + data.shape[1:],
+                                     dtype=data.dtype, chunks=chunks, compression='gzip', compression_opts=1,
+                                     shuffle=True)
+            self._appended.add(name)
+        dataset = self.file[name]
+        n = dataset.shape[0]
+        dataset.resize(n + data.shape[0], axis=0)
+        dataset[n:] = data
+        self.file.flush()
+
+    def write(self, name, value, group=None):
+        """
+        Write a value, replacing the previous one with the same name.
+
+        Args:
+            name (str): Name of the value.
+            value: Value to write. Dictionaries are saved as groups and None is skipped.
+            group (h5py.Group, optional): Group where the value is saved. If None, the root of the file.
+        """
+        if value is None or (group is None and name in self._appended):
+            return
+        group = self.file if group is None else group
+        if name in group:
+            del group[name]
+        if name in group.attrs:
+            del group.attrs[name]
+
+        if isinstance(value, dict):
+            sub_group = group.create_group(name)
+            for key, val in value.items():
+                self.write(str(key), val, group=sub_group)
+            return
+
+        try:
+            array = np.asarray(value)
+        except ValueError:
+            array = np.asarray(str(value))
+        if array.dtype.kind == 'O':
+            array = np.asarray(str(value))
+
+        if array.dtype.kind == 'U':
+            group.attrs.create(name, array.astype(object), dtype=h5py.string_dtype())
+        elif array.size > MAX_ATTRIBUTE_SIZE:
+            group.create_dataset(name, data=array, chunks=True, compression='gzip', compression_opts=1, shuffle=True)
+        else:
+            group.attrs[name] = array
+
+    def write_dict(self, values):
+        """
+        Write all the values of a dictionary, e.g. the mapVals of a sequence.
+
+        Args:
+            values (dict): Values to write. The datasets written with append are not replaced.
+        """
+        for key, value in values.items():
+            self.write(key, value)
+        self.file.flush()
+
+    def set_attributes(self, **kwargs):
+        """
+        Set attributes of the file and flush it, e.g. the progress of the acquisition.
+        """
+        for key, value in kwargs.items():
+            self.file.attrs[key] = value
+        self.file.flush()
+
+    def close(self, complete=True):
+        """
+        Close the file.
+
+        Args:
+            complete (bool): True if the acquisition and the analysis finished.
+        """
+        if self.file:
+            self.file.attrs['complete'] = complete
+            self.file.close()
+
+
+class RawDataReader(Mapping):
+    """
+    Read-only dictionary with the values of an HDF5 raw data file.
+
+    The values are given in the format of loadmat, so the post-processing code works with .mat and .h5 files: numbers
+    and arrays saved as attributes are at least 2D and strings are 1-element arrays. Datasets are given as h5py
+    datasets, so that slicing them reads only the selected data from the file, unless they are read into memory with
+    load. Files of acquisitions that did not finish can be read too, with the data acquired up to the last scan.
+
+    Attributes:
+        file_name (str): Path to the .h5 file.
+        complete (bool): False if the acquisition or the analysis did not finish.
+    """
+
+    def __init__(self, file_name):
+        """
+        Open the file.
+
+        Args:
+            file_name (str): Path to the .h5 file.
+        """
+        self.file_name = file_name
+        self.file = h5py.File(file_name, 'r')
+        self.complete = bool(self.file.attrs.get('complete', False))
+        self._data = {}
+        self._names = [name for name in self.file.attrs] + [name for name in self.file]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __getitem__(self, name):
+        if name not in self._data:
+            if name in self.file:
+                self._data[name] = _get_value(self.file[name])
+            elif name in self.file.attrs:
+                self._data[name] = _as_mat(self.file.attrs[name])
+            else:
+                raise KeyError(name)
+        return self._data[name]
+
+    def __iter__(self):
+        return iter(self._names)
+
+    def __len__(self):
+        return len(self._names)
+
+    def load(self, variable_names):
+        """
+        Read several datasets into memory.
+
+        Args:
+            variable_names (list): Names of the datasets.
+        """
+        for name in variable_names:
+            value = self[name]
+            if isinstance(value, h5py.Dataset):
+                self._data[name] = value[()]
+
+    def close(self):
+        self.file.close()
+
+
+def raw_to_mat(file_name, mat_file_name=None):
+    """
+    Convert an HDF5 raw data file into a .mat file with the same content as the .mat files saved by saveRawData.
+
+    Args:
+        file_name (str): Path to the .h5 file.
+        mat_file_name (str, optional): Path to the .mat file. If None, the extension of file_name is replaced by .mat.
+
+    Returns:
+        str: Path to the .mat file.
+    """
+    if mat_file_name is None:
+        mat_file_name = file_name[0:-3] + '.mat' if file_name.endswith('.h5') else file_name + '.mat'
+    with RawDataReader(file_name) as reader:
+        reader.load([name for name in reader.file])
+        values = {name: reader[name] for name in reader if name != 'complete'}
+        savemat(mat_file_name, values)
+    return mat_file_name
+
+
+def _get_value(item):
+    # Datasets are kept in the file, groups are read as dictionaries
+    if isinstance(item, h5py.Dataset):
+        return item
+    values = {name: _as_mat(value) for name, value in item.attrs.items()}
+    values.update({name: _get_value(value)[()] if isinstance(value, h5py.Dataset) else _get_value(value)
+                   for name, value in item.items()})
+    return values
+
+
+def _as_mat(value):
+    # Format of the values given by loadmat
+    if isinstance(value, (str, bytes)):
+        return np.array([value if isinstance(value, str) else value.decode()])
+    value = np.asarray(value)
+    if value.dtype.kind == 'O':
+        return np.array([v.decode() if isinstance(v, bytes) else v for v in value.ravel()]).reshape(value.shape)
+    return np.atleast_2d(value)
@@ -0,0 +1,142 @@
+"""
+@author: J.M. Algarín, MRILab, i3M, CSIC, Valencia
+@email: josalggui@i3m.upv.es
+@Summary: preallocated buffers to store the data acquired by the Red Pitaya during the scans
+"""
+
+import numpy as np
+
+
+class RxBuffer:
+    """
+    Preallocated buffer for the samples of an rx channel.
+
+    The buffer is sized up front for the full acquisition, and the samples of each run are written into the next free
+    positions, so the acquired data is copied only once instead of concatenating the arrays scan after scan. If more
+    samples than expected arrive, the capacity is doubled. Samples can be stored as complex64 to halve the memory.
+
+    Attributes:
+        data (np.ndarray): View of the samples written up to now.
+    """
+
+    def __init__(self, n_points=1024, dtype=complex):
+        """
+        Initialize an empty buffer.
+
+        Args:
+            n_points (int): Expected number of samples.
+            dtype (type): Data type of the samples (complex or np.complex64).
+        """
+        self._data = np.empty(max(int(n_points), 1), dtype=dtype)
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def dtype(self):
+        return self._data.dtype
+
+    @property
+    def data(self):
+        return self._data[0:self._size]
+
+    def reserve(self, n):
+        """
+        Make sure that n more samples can be written without reallocating the buffer.
+
+        Args:
+            n (int): Number of samples to be written.
+        """
+        required = self._size + n
+        capacity = self._data.shape[0]
+        if required <= capacity:
+            return
+        while capacity < required:
+            capacity *= 2
+        data = np.empty(capacity, dtype=self._data.dtype)
+        data[0:self._size] = self._data[0:self._size]
+        self._data = data
+
+    def write(self, data):
+        """
+        Write new samples at the end of the buffer.
+
+        Args:
+            data (np.ndarray): Acquired samples, e.g. rxd['rx0'] or a slice of it.
+
+        Returns:
+            np.ndarray: View of the buffer with the written samples.
+        """
+        data = np.ravel(data)
+        n = data.size
+        self.reserve(n)
+        self._data[self._size:self._size + n] = data
+        self._size += n
+        return self._data[self._size - n:self._size]
+
+    def clear(self):
+        """
+        Remove all the samples, keeping the allocated memory.
+        """
+        self._size = 0
+
+
+class RxBufferPool(dict):
+    """
+    Dictionary of RxBuffer with the different kinds of data of an acquisition (e.g. 'noise', 'dummy', 'over').
+
+    All the buffers of the pool share the same data type.
+    """
+
+    def __init__(self, dtype=complex, **n_points):
+        """
+        Initialize the pool.
+
+        Args:
+            dtype (type): Data type of the samples (complex or np.complex64).
+            **n_points: Expected number of samples of each buffer, with the buffer names as keys.
+        """
+        super(RxBufferPool, self).__init__()
+        self.dtype = dtype
+        for name, n in n_points.items():
+            self.allocate(name, n)
+
+    def allocate(self, name, n_points):
+        """
+        Add a new empty buffer to the pool.
+
+        Args:
+            name (str): Name of the buffer.
+            n_points (int): Expected number of samples.
+
+        Returns:
+            RxBuffer: The new buffer.
+        """
+        self[name] = RxBuffer(n_points=n_points, dtype=self.dtype)
+        return self[name]
+
+    def write(self, name, data):
+        """
+        Write new samples at the end of a buffer.
+
+        Args:
+            name (str): Name of the buffer.
+            data (np.ndarray): Acquired samples.
+
+        Returns:
+            np.ndarray: View of the buffer with the written samples.
+        """
+        return self[name].write(data)
+
+    def get_data(self, name):
+        """
+        Get the samples written into a buffer.
+
+        Args:
+            name (str): Name of the buffer.
+
+        Returns:
+            np.ndarray: View of the written samples.
+        """
+        return self[name].data
@@ -10,6 +10,7 @@ import seq.mriBlankSeq as blankSeq  # Import the mriBlankSequence for any new se
 import scipy.signal as sig
 import configs.hw_config as hw
 import pyqtgraph as pg
+from manager.fftmanager import ifftnc
 
 class FIDandNoise(blankSeq.MRIBLANKSEQ):
     def __init__(self):
@@ -124,7 +125,7 @@ class FIDandNoise(blankSeq.MRIBLANKSEQ):
 
             # Noise
             tVector = np.linspace(0, acqTime, nPoints) * 1e-3  # ms
-            spectrumnoise = np.fft.ifftshift(np.fft.ifftn(np.fft.ifftshift(noisetemp)))
+            spectrumnoise = ifftnc(noisetemp)
             fVector = np.linspace(-bw / 2, bw / 2, nPoints) * 1e3  # kHz
             self.dataTime = [tVector, noisetemp]
             self.dataSpec = [fVector, spectrumnoise]
@@ -144,7 +145,7 @@ class FIDandNoise(blankSeq.MRIBLANKSEQ):
 
         tVector = np.linspace(rfExTime/2+deadTime+0.5/bw, rfExTime/2+deadTime+acqTime-0.5/bw, nPoints)
         fVector = np.linspace(-bw/2, bw/2, nPoints)
-        spectrum = np.abs(np.fft.ifftshift(np.fft.ifftn(np.fft.ifftshift(signal))))
+        spectrum = np.abs(ifftnc(signal))
         spectrum = np.reshape(spectrum, -1)
 
         noise = np.abs(self.dataTime[1])
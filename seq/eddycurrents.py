@@ -20,6 +20,7 @@ import numpy as np
 import seq.mriBlankSeq as blankSeq  # Import the mriBlankSequence for any new sequence.
 import configs.hw_config as hw
 import configs.units as units
+from manager.fftmanager import ifftnc
 
 class EDDYCURRENTS(blankSeq.MRIBLANKSEQ):
     def __init__(self):
@@ -229,7 +230,7 @@ class EDDYCURRENTS(blankSeq.MRIBLANKSEQ):
             for delay_idx in range(self.nDelays):
                 for rx_idx in range(3):
                     data_prov = data[delay_idx, rx_idx, :]
-                    spectrums[delay_idx, rx_idx, :] = np.fft.ifftshift(np.fft.ifftn(np.fft.ifftshift(data_prov)))
+                    spectrums[delay_idx, rx_idx, :] = ifftnc(data_prov)
             self.mapVals['spectrums'] = spectrums
 
             # Data to sweep sequence
@@ -25,6 +25,7 @@ import seq.mriBlankSeq as blankSeq
 import scipy.signal as sig
 import configs.hw_config as hw
 import configs.units as units
+from manager.fftmanager import ifftnc
 
 class FID(blankSeq.MRIBLANKSEQ):
     def __init__(self):
@@ -154,7 +155,7 @@ class FID(blankSeq.MRIBLANKSEQ):
         rfExTime = self.mapVals['rfExTime']*1e-3 # ms
         tVector = np.linspace(rfExTime/2 + deadTime + 0.5/bw, rfExTime/2 + deadTime + (nPoints-0.5)/bw, nPoints)
         fVector = np.linspace(-bw/2, bw/2, nPoints)
-        spectrum = np.abs(np.fft.ifftshift(np.fft.ifftn(np.fft.ifftshift(signal))))
+        spectrum = np.abs(ifftnc(signal))
         fitedLarmor=self.mapVals['larmorFreq'] + fVector[np.argmax(np.abs(spectrum))] * 1e-3  #MHz
         hw.larmorFreq=fitedLarmor
         fwhm=getFHWM(spectrum, fVector, bw)
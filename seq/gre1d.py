@@ -26,6 +26,7 @@ import numpy as np
 import seq.mriBlankSeq as blankSeq  # Import the mriBlankSequence for any new sequence.
 import configs.hw_config as hw
 import configs.units as units
+from manager.fftmanager import ifftnc
 
 
 class GRE1D(blankSeq.MRIBLANKSEQ):
@@ -209,7 +210,7 @@ class GRE1D(blankSeq.MRIBLANKSEQ):
         # Get images
         s0 = self.mapVals['data']
         s1 = s0[int(self.n_rd / 2 - self.nPoints / 2):int(self.n_rd / 2 + self.nPoints / 2)]
-        img = np.fft.ifftshift(np.fft.ifftn(np.fft.ifftshift(s1)))
+        img = ifftnc(s1)
         t_vector = np.linspace(-self.rxTime / 2, self.rxTime / 2, self.n_rd) * 1e-3  # ms
         x_vector = np.linspace(-self.fov_1d / 2, self.fov_1d / 2, self.nPoints) * 1e2  # cm
 
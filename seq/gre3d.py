@@ -26,6 +26,8 @@ import experiment as ex
 import scipy.signal as sig
 import configs.hw_config as hw # Import the scanner hardware config
 import seq.mriBlankSeq as blankSeq  # Import the mriBlankSequence for any new sequence.
+from manager.decimationmanager import StreamDecimator
+from manager.rxmanager import RxBuffer
 import pyqtgraph as pg              
 import configs.units as units
 
@@ -38,6 +40,8 @@ import ctypes
 import matplotlib
 import xml.etree.ElementTree as ET
 from scipy.io import loadmat
+from manager.fftmanager import ifftnc
+from manager.mrdmanager import append_acquisitions, get_gre_header
 
 class GRE3D(blankSeq.MRIBLANKSEQ):
     def __init__(self):
@@ -206,114 +210,92 @@ class GRE3D(blankSeq.MRIBLANKSEQ):
 
         # Create sequence instructions
         def createSequence(ph_index=0, sl_index=0, ln_index=0, repe_index_global=0):
-            repe_index = 0
-            acq_points = 0
-            orders = 0
-
             # check in case of dummy pulse filling the cache
             if(self.dummy_pulses>0 and n_rd*2>hw.maxRdPoints) or (self.dummy_pulses==0 and n_rd>hw.maxRdPoints):
                 print('ERROR: Too many acquired points.')
                 return 0
 
-            # Set shimming
-            self.iniSequence(20, self.shimming)
+            def add_repetitions(repe_index):
+                # Timing of the batch: one row per repetition
+                repetitions = np.reshape(np.arange(repe_index), (-1, 1))
+                acquire = repetitions>=self.dummy_pulses
+                t_ex = 20e3+self.repetition_time*repetitions
+
+                def batch_array(*columns):
+                    # Join the events of each repetition to keep them sorted in time
+                    columns = [np.broadcast_to(column, (repe_index, np.shape(column)[-1])) for column in columns]
+                    return np.concatenate(columns, axis=1)
 
-            # Run sequence batch
-            while acq_points+n_rd<=hw.maxRdPoints and orders<=hw.maxOrders and repe_index_global<n_repetitions:
-                # Initialize time
-                t_ex = 20e3+self.repetition_time*repe_index
+                # Phase and slice gradients of the acquired lines
+                lines = sl_index*n_ph+ph_index+np.arange(np.sum(acquire))
+                ph_sl_amp = np.zeros((3, repe_index, 1))
+                ph_sl_amp[:, acquire[:, 0], 0] = np.outer(rot[:, self.axesOrientation[1]], ph_gradients[lines % n_ph]) + \
+                                                 np.outer(rot[:, self.axesOrientation[2]], sl_gradients[lines // n_ph])
 
-                # First I do a noise measurement
-                if repe_index==0:
-                    t0 = t_ex-4*self.acq_time
-                    self.rxGate(t0, self.acq_time+2*hw.addRdPoints/bw)
-                    acq_points += n_rd
+                # Set shimming
+                self.iniSequence(20, self.shimming)
 
-                # Excitation pulse
-                t0 = t_ex-hw.blkTime-self.rfExTime/2
+                # Excitation pulses
                 if self.mode==1 or self.mode==3: # rf spoiling
-                    self.rfRecPulse(t0, self.rfExTime, rfExAmp * np.exp(1j * 117 * np.pi / 180 * repe_index))
+                    rf_amp = rfExAmp * np.exp(1j * 117 * np.pi / 180 * repetitions)
                 elif self.mode==4: # balanced
-                    self.rfRecPulse(t0, self.rfExTime, rfExAmp * np.exp(1j * np.pi/2 * (1 + (-1) ** repe_index)))
+                    rf_amp = rfExAmp * np.exp(1j * np.pi/2 * (1 + (-1) ** repetitions))
                 elif self.mode==0 or self.mode==2:
-                    self.rfRecPulse(t0, self.rfExTime, rfExAmp)
-
-                # Dephasing gradient
-                if repe_index>=self.dummy_pulses:
-                    grad_amp_deph = np.array([0.0, 0.0, 0.0])
-                    grad_amp_deph[self.axesOrientation[0]] = rd_deph_amplitude
-                    grad_amp_deph[self.axesOrientation[1]] = ph_gradients[ph_index]
-                    grad_amp_deph[self.axesOrientation[2]] = sl_gradients[sl_index]
-                    grad_amp_deph = np.dot(rot, np.reshape(grad_amp_deph, (3, 1)))
-                    t0 = t_ex+self.rfExTime/2-hw.gradDelay
-                    self.gradTrap(t0, grad_rise_time, self.dephGradTime, grad_amp_deph[0], hw.grad_steps, 0, self.shimming)
-                    self.gradTrap(t0, grad_rise_time, self.dephGradTime, grad_amp_deph[1], hw.grad_steps, 1, self.shimming)
-                    self.gradTrap(t0, grad_rise_time, self.dephGradTime, grad_amp_deph[2], hw.grad_steps, 2, self.shimming)
-                    orders = orders+hw.grad_steps*6
-                    # get k-point
-                    k_ph_sl_xyz[:, self.nPoints[0] * ln_index:self.nPoints[0] * (ln_index + 1)] = \
-                        np.diag(np.reshape(grad_amp_deph, -1)) @ \
-                        k_ph_sl_xyz[:, self.nPoints[0] * ln_index:self.nPoints[0] * (ln_index + 1)]
-
-                # Rephasing readout gradient
-                if repe_index>=self.dummy_pulses:
-                    grad_amp_reph = np.array([0.0, 0.0, 0.0])
-                    grad_amp_reph[self.axesOrientation[0]] = rd_grad_amplitude
-                    grad_amp_reph = np.dot(rot, np.reshape(grad_amp_reph, (3, 1)))
-                    t0 = t_ex + self.echo_time - self.rdGradTime / 2 - grad_rise_time - hw.gradDelay
-                    orders = orders + hw.grad_steps * 6
-                    if self.mode==0 or self.mode==1 or self.mode==4: # normal, only rf spoiler, or balanced
-                        rd_grad_time = self.rdGradTime
-                    elif self.mode==2 or self.mode==3: # gradient spoiler
-                        rd_grad_time = 0.5*(self.rdGradTime-grad_rise_time)+self.acq_time*self.spoiler_order
-                    self.gradTrap(t0, grad_rise_time, rd_grad_time, grad_amp_reph[0], hw.grad_steps, 0,
-                                  self.shimming)
-                    self.gradTrap(t0, grad_rise_time, rd_grad_time, grad_amp_reph[1], hw.grad_steps, 1,
-                                  self.shimming)
-                    self.gradTrap(t0, grad_rise_time, rd_grad_time, grad_amp_reph[2], hw.grad_steps, 2,
-                                  self.shimming)
-
-                # Rx gate
-                if repe_index>=self.dummy_pulses:
-                    t0 = t_ex+self.echo_time-self.acq_time/2-hw.addRdPoints/bw
-                    self.rxGate(t0, self.acq_time+2*hw.addRdPoints/bw)
-                    acq_points += n_rd
-                    # get k-point
-                    k_rd_xyz[:, self.nPoints[0] * ln_index:self.nPoints[0] * (ln_index + 1)] = \
-                        np.diag(np.reshape(gradAmp, -1)) @ \
-                        k_rd_xyz[:, self.nPoints[0] * ln_index:self.nPoints[0] * (ln_index + 1)] @ \
-                        np.diag(self.time_vector)
-                
-                # gradient balance
-                if repe_index>=self.dummy_pulses and (self.mode==2 or self.mode==3 or self.mode==4):
-                    grad_amp_bala = np.array([0.0, 0.0, 0.0])
-                    if self.mode==4: # bSSFP
-                        grad_amp_bala[self.axesOrientation[0]] = rd_deph_amplitude
-                    grad_amp_bala[self.axesOrientation[1]] = -ph_gradients[ph_index]
-                    grad_amp_bala[self.axesOrientation[2]] = -sl_gradients[sl_index]
-                    grad_amp_bala = np.dot(rot, np.reshape(grad_amp_bala, (3, 1)))
-                    t0 = t_ex + self.echo_time - self.rdGradTime / 2 + rd_grad_time + grad_rise_time - hw.gradDelay
-                    self.gradTrap(t0, grad_rise_time, self.dephGradTime, grad_amp_bala[0], hw.grad_steps, 0,
-                                  self.shimming)
-                    self.gradTrap(t0, grad_rise_time, self.dephGradTime, grad_amp_bala[1], hw.grad_steps, 1,
-                                  self.shimming)
-                    self.gradTrap(t0, grad_rise_time, self.dephGradTime, grad_amp_bala[2], hw.grad_steps, 2,
-                                  self.shimming)
-
-                # Update the phase and slice gradient
-                if repe_index>=self.dummy_pulses:
-                    ln_index += 1
-                    if ph_index == n_ph-1:
-                        ph_index = 0
-                        sl_index += 1
-                    else:
-                        ph_index += 1
+                    rf_amp = rfExAmp * np.ones((repe_index, 1))
+                self.rfRecPulseTrain(t_ex-hw.blkTime-self.rfExTime/2, self.rfExTime, rf_amp)
+
+                # Gradients: dephasing, rephasing readout and balance
+                g_time = batch_array(t_ex+self.rfExTime/2-hw.gradDelay,
+                                     t_ex+self.echo_time-self.rdGradTime/2-grad_rise_time-hw.gradDelay,
+                                     t_ex+self.echo_time-self.rdGradTime/2+rd_grad_time+grad_rise_time-hw.gradDelay)
+                g_flat = batch_array([self.dephGradTime, rd_grad_time, self.dephGradTime])
+                g_mask = batch_array(acquire, acquire, acquire & (self.mode==2 or self.mode==3 or self.mode==4))
+                for axis in range(3):
+                    g_amp = batch_array(rd_vector[axis]*rd_deph_amplitude+ph_sl_amp[axis],
+                                        [rd_vector[axis]*rd_grad_amplitude],
+                                        rd_vector[axis]*rd_deph_amplitude*(self.mode==4)-ph_sl_amp[axis])
+                    self.gradTrapTrain(g_time[g_mask], grad_rise_time, g_flat[g_mask], g_amp[g_mask], hw.grad_steps,
+                                       axis, self.shimming)
+
+                # Rx gates: noise measurement and readouts
+                self.rxGate(t_ex[0, 0]-4*self.acq_time, self.acq_time+2*hw.addRdPoints/bw)
+                t_rx = t_ex+self.echo_time-self.acq_time/2-hw.addRdPoints/bw
+                self.rxGateTrain(t_rx[acquire], self.acq_time+2*hw.addRdPoints/bw)
+
+                # Turn off the gradients after the end of the batch
+                self.endSequence(repe_index*self.repetition_time)
+
+                return ph_sl_amp[:, acquire[:, 0], :]
+
+            # Readout gradient time
+            if self.mode==0 or self.mode==1 or self.mode==4: # normal, only rf spoiler, or balanced
+                rd_grad_time = self.rdGradTime
+            elif self.mode==2 or self.mode==3: # gradient spoiler
+                rd_grad_time = 0.5*(self.rdGradTime-grad_rise_time)+self.acq_time*self.spoiler_order
+            rd_vector = rot[:, self.axesOrientation[0]]
+
+            # Get the number of repetitions that fit into the batch
+            n_acquired = self.getBatchSize(lambda n: add_repetitions(self.dummy_pulses+n),
+                                           n_repetitions-repe_index_global, 1/bw)
+            if n_acquired==0:
+                print('ERROR: Too many instructions in a single repetition.')
+                return 0
+
+            # Create the batch
+            ph_sl_amp = add_repetitions(self.dummy_pulses+n_acquired)
+            acq_points = n_rd*(1+n_acquired)
+            repe_index_global += n_acquired
 
-                if repe_index>=self.dummy_pulses: repe_index_global += 1 # Update the global repe_index
-                repe_index+=1 # Update the repe_index after the ETL
+            # Get k-points
+            k_ph_sl = np.reshape(k_ph_sl_xyz, (3, -1, self.nPoints[0]))
+            k_ph_sl[:, ln_index:ln_index+n_acquired, :] *= np.reshape(rd_vector*rd_deph_amplitude, (3, 1, 1)) + \
+                                                             ph_sl_amp
+            k_rd = np.reshape(k_rd_xyz, (3, -1, self.nPoints[0]))
+            k_rd[:, ln_index:ln_index+n_acquired, :] *= np.reshape(gradAmp, (3, 1, 1))*self.time_vector
 
-            # Turn off the gradients after the end of the batch
-            self.endSequence(repe_index*self.repetition_time)
+            # Update the phase and slice indexes
+            ln_index += n_acquired
+            ph_index, sl_index = (sl_index*n_ph+ph_index+n_acquired) % n_ph, (sl_index*n_ph+ph_index+n_acquired) // n_ph
 
             # Return the output variables
             return(ph_index, sl_index, ln_index, repe_index_global, acq_points)
@@ -326,8 +308,10 @@ class GRE3D(blankSeq.MRIBLANKSEQ):
 
         # Initialize the experiment
         data_full = []
-        over_data = []
-        noise = []
+        # Preallocated buffers for the noise and oversampled data, decimated as the scans arrive
+        decimator = StreamDecimator(n_points=n_rd * n_ph * n_sl * hw.oversamplingFactor * self.nScans,
+                                    keep_input=True, dtype=self.rx_dtype)
+        noise = RxBuffer(n_points=n_rd * hw.oversamplingFactor * self.nScans, dtype=self.rx_dtype)
         n_batches = 0
         repe_index_array = np.array([0])
         repe_index_global = repe_index_array[0]
@@ -374,7 +358,7 @@ class GRE3D(blankSeq.MRIBLANKSEQ):
                         acq_points = 0
                         while acq_points != (aa * hw.oversamplingFactor):
                             rxd, msgs = self.expt.run()
-                            rxd['rx0'] = rxd['rx0'] * hw.adcFactor  # Here I normalize to get the result in mV
+                            rxd['rx0'] *= hw.adcFactor  # Here I normalize to get the result in mV
                             acq_points = np.size(rxd['rx0'])
                             print("Acquired points = %i" % acq_points)
                             print("Expected points = %i" % (aa * hw.oversamplingFactor))
@@ -385,80 +369,40 @@ class GRE3D(blankSeq.MRIBLANKSEQ):
                             aa * hw.oversamplingFactor)
                         print("Batch %i, scan %i ready!" % (n_batches, ii + 1))
                     # Get noise data
-                    noise = np.concatenate((noise, rxd['rx0'][0:n_rd * hw.oversamplingFactor]), axis=0)
+                    noise.write(rxd['rx0'][0:n_rd * hw.oversamplingFactor])
                     rxd['rx0'] = rxd['rx0'][n_rd * hw.oversamplingFactor::]
                     # Get data
-                    over_data = np.concatenate((over_data, rxd['rx0']), axis=0)
+                    decimator.feed(rxd['rx0'])
             if not demo: self.expt.__del__()
         del aa
 
         if not plotSeq:
             acq_points_per_batch = (acq_points_per_batch-n_rd)*self.nScans
-            self.mapVals['noise_data'] = noise
+            self.mapVals['noise_data'] = noise.data
+            over_data = decimator.data_over
             self.mapVals['over_data'] = over_data
 
             # Generate data_full
-            data_full = sig.decimate(over_data, hw.oversamplingFactor, ftype='fir', zero_phase=True) ##size 4800 = 60*(60+2*addrdpoints)
-            if n_batches>1:
-                data_full_a = data_full[0:sum(acq_points_per_batch[0:-1])]
-                data_full_b = data_full[sum(acq_points_per_batch[0:-1])::]
-                
-                        
-            # Subtract phase in case of rf spoling or balanced
-            if n_batches>1:
-                if self.mode==1 or self.mode==3:  # rf spoiling
-                    data_full_a = np.reshape(data_full_a, ((n_batches - 1) * self.nScans, -1, n_rd))
-                    for repe_index in range(np.size(data_full_a, 1)):
-                        data_full_a[:, repe_index, :] *= np.exp(-1j * 117 * np.pi / 180 * repe_index)
-                    data_full_a = np.reshape(data_full_a, -1)
-                    data_full_b = np.reshape(data_full_b, (self.nScans, -1, n_rd))
-                    for repe_index in range(np.size(data_full_b, 1)):
-                        data_full_b[:, repe_index, :] *= np.exp(-1j * 117 * np.pi / 180 * repe_index)
-                    data_full_b = np.reshape(data_full_b, -1)
-                if self.mode==4:
-                    data_full_a = np.reshape(data_full_a, ((n_batches - 1) * self.nScans, -1, n_rd))
-                    for repe_index in range(np.size(data_full_a, 1)):
-                        data_full_a[:, repe_index, :] *= np.exp(-1j * np.pi / 2 *(1 + (-1) ** repe_index))
-                    data_full_a = np.reshape(data_full_a, -1)
-                    data_full_b = np.reshape(data_full_b, ((n_batches - 1) * self.nScans, -1, n_rd))
-                    for repe_index in range(np.size(data_full_b, 1)):
-                        data_full_b[:, repe_index, :] *= np.exp(-1j * np.pi / 2 * (1 + (-1) ** repe_index))
-                    data_full_b = np.reshape(data_full_b, -1)
-            else:
-                if self.mode==1 or self.mode==3:  # rf spoiling
-                    data_full = np.reshape(data_full, (n_batches * self.nScans, -1, n_rd))
-                    for repe_index in range(np.size(data_full, 1)):
-                        data_full[:, repe_index, :] *= np.exp(-1j * 117 * np.pi / 180 * repe_index)
-                    data_full = np.reshape(data_full, -1)
-                if self.mode==4:
-                    data_full = np.reshape(data_full, (n_batches * self.nScans, -1, n_rd))
-                    for repe_index in range(np.size(data_full, 1)):
-                        data_full[:, repe_index, :] *= np.exp(-1j * np.pi / 2 * (1 + (-1) ** repe_index))
-                    data_full = np.reshape(data_full, -1)
-
-            # Reorganize data_full
-            data_prov = np.zeros([self.nScans,n_sl*n_ph*n_rd], dtype=complex)
-            if n_batches>1:
-                data_full_a = np.reshape(data_full_a, (n_batches-1, self.nScans, -1, n_rd))
-                data_full_b = np.reshape(data_full_b, (1, self.nScans, -1, n_rd))
-            else:
-                data_full = np.reshape(data_full, (n_batches, self.nScans, -1, n_rd))
-            for scan in range(self.nScans):
-                if n_batches>1:
-                    data_prov[scan, :] = np.concatenate((np.reshape(data_full_a[:,ii,:,:],-1), np.reshape(data_full_b[:,ii,:,:],-1)), axis=0)
-                else:
-                    data_prov[scan, :] = np.reshape(data_full[:,scan,:,:],-1)
-                    
+            data_full = decimator.finish() ##size 4800 = 60*(60+2*addrdpoints)
+            readouts_per_batch = np.array(acq_points_per_batch) // (self.nScans * n_rd)
+            k_map = self.getKSpaceMap(readouts_per_batch, self.nScans)
+
+            # Subtract phase in case of rf spoling or balanced, according to the repetition of each readout in its batch
+            data_full = np.reshape(data_full, (-1, n_rd))
+            if self.mode==1 or self.mode==3:  # rf spoiling
+                data_full *= np.exp(-1j * 117 * np.pi / 180 * k_map['repetition'])[:, np.newaxis]
+            if self.mode==4:
+                data_full *= np.exp(-1j * np.pi / 2 * (1 + (-1) ** k_map['repetition']))[:, np.newaxis]
+
+            # Reorganize data_full. The lines are acquired in k-space order
+            data_full = self.assembleKSpace(data_full, k_map, n_rd)
+
             # Save data_full to save it in .h5
-            self.data_full_mat=data_full
-            
-            
-            data_full = np.reshape(data_prov,-1)
+            self.data_full_mat = np.reshape(data_full, -1)
 
             # Get index for krd = 0
             # Average data
-            data_prov = np.reshape(data_full, (self.nScans, n_rd*n_ph*n_sl))
-            data_prov = np.average(data_prov, axis=0)
+            data_prov = np.average(data_full, axis=0)
             data_prov = np.reshape(data_prov, (n_sl, n_ph, n_rd))
             # Check where is krd = 0
             data_prov = data_prov[int(self.nPoints[2]/2), int(n_ph/2), :]
@@ -469,11 +413,8 @@ class GRE3D(blankSeq.MRIBLANKSEQ):
             # Get individual images
             data_full = np.reshape(data_full, (self.nScans, n_sl, n_ph, n_rd))
             data_full = data_full[:, :, :, indkrd0-int(self.nPoints[0]/2):indkrd0+int(self.nPoints[0]/2)]
-            img_full = data_full*0
-            for scan in range(self.nScans):
-                img_full[scan, :, :, :] = np.fft.ifftshift(np.fft.ifftn(np.fft.ifftshift(data_full[scan, :, :, :])))
             self.mapVals['data_full'] = data_full
-            self.mapVals['img_full'] = img_full
+            self.setLazyVal('img_full', lambda: ifftnc(data_full, axes=(1, 2, 3)))
 
             # Average data
             data = np.average(data_full, axis=0)
@@ -501,7 +442,7 @@ class GRE3D(blankSeq.MRIBLANKSEQ):
             d_phase = np.exp(-2*np.pi*1j*(self.dfov[0]*k_rd+self.dfov[1]*k_ph+self.dfov[2]*k_sl))
             data = np.reshape(data*d_phase, (self.nPoints[2], self.nPoints[1], self.nPoints[0]))
             self.mapVals['kSpace3D'] = data
-            img=np.fft.ifftshift(np.fft.ifftn(np.fft.ifftshift(data)))
+            img=ifftnc(data)
             self.mapVals['image3D'] = img
             data = np.reshape(data, (1, self.nPoints[0]*self.nPoints[1]*self.nPoints[2]))
 
@@ -536,7 +477,7 @@ class GRE3D(blankSeq.MRIBLANKSEQ):
             t_vector = np.linspace(-self.acq_time/2, self.acq_time/2, self.nPoints[0])*1e-3 # ms
             s_vector = self.mapVals['sampled'][:, 3]
             f_vector = np.linspace(-bw/2, bw/2, self.nPoints[0])
-            i_vector = np.fft.ifftshift(np.fft.ifftn(np.fft.ifftshift(s_vector)))
+            i_vector = ifftnc(s_vector)
             result1 = {'widget': 'curve',
                        'xData': t_vector,
                        'yData': [np.abs(s_vector), np.real(s_vector), np.imag(s_vector)],
@@ -826,58 +767,18 @@ class GRE3D(blankSeq.MRIBLANKSEQ):
         dset.write_xml_header(self.header.toXML()) 
                 
         
-        self.data_full_mat = np.reshape(self.data_full_mat, (nScans, nSL, nPH, nRD + 2 * addRdPoints))
-        counter = 0
-        for average in range(nScans):
-            repetition=0  
-            for slice_idx in range(nSL):
-                for phase_idx in range(nPH):
-                        # Extraire la ligne correspondante
-                        line = self.data_full_mat[average, slice_idx, phase_idx, :]
-                                                
-                        # Préparer les données complexes
-                        line2d = np.reshape(line, (1, nRD+2*addRdPoints))
-                        acq = ismrmrd.Acquisition.from_array(line2d, None)
-                        
-                        counter += 1
-                        repetition += 1 ##verifier
-                    
-                        acq.idx.repetition = repetition
-                        acq.idx.kspace_encode_step_1 = phase_idx + 1
-                        acq.idx.slice = slice_idx + 1
-                        acq.idx.average = average + 1
-                        
-                        acq.clearAllFlags()
-                        
-                        if phase_idx == 0:
-                            acq.setFlag(ismrmrd.ACQ_FIRST_IN_PHASE)
-                        elif phase_idx == nPH - 1:
-                            acq.setFlag(ismrmrd.ACQ_LAST_IN_PHASE)
-                        
-                        if slice_idx == 0:
-                            acq.setFlag(ismrmrd.ACQ_FIRST_IN_SLICE)
-                        elif slice_idx == nSL - 1:
-                            acq.setFlag(ismrmrd.ACQ_LAST_IN_SLICE)
-                        
-                        if repetition == 1: 
-                            acq.setFlag(ismrmrd.ACQ_FIRST_IN_AVERAGE)
-                        elif repetition == nPH*nSL:
-                            acq.setFlag(ismrmrd.ACQ_LAST_IN_AVERAGE)
-                        
-                        
-                        acq.scan_counter = counter
-                        acq.discard_pre = hw.addRdPoints
-                        acq.discard_post = hw.addRdPoints
-                        acq.sample_time_us = 1/bw
-                        self.dfov = np.array(self.dfov)
-                        acq.position = (ctypes.c_float * 3)(*self.dfov.flatten())
-                        acq.read_dir = (ctypes.c_float * 3)(*read_dir) 
-                        acq.phase_dir = (ctypes.c_float * 3)(*phase_dir)
-                        acq.slice_dir = (ctypes.c_float * 3)(*slice_dir)
-                        
-                        
-                        # Ajouter l'acquisition au dataset
-                        dset.append_acquisition(acq)
+        # Acquisitions sorted by average, slice and phase, written in blocks
+        self.dfov = np.array(self.dfov)
+        header = get_gre_header(nScans, nSL, nPH)
+        header.update(discard_pre=hw.addRdPoints,
+                      discard_post=hw.addRdPoints,
+                      sample_time_us=1/bw,
+                      position=self.dfov.flatten(),
+                      read_dir=read_dir,
+                      phase_dir=phase_dir,
+                      slice_dir=slice_dir)
+        lines = np.reshape(self.data_full_mat, (nScans * nSL * nPH, nRD + 2 * addRdPoints))
+        append_acquisitions(dset, lines, header)
                         
                         
         image=self.mapVals['image3D']
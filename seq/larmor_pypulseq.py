@@ -27,8 +27,9 @@ import scipy.signal as sig
 import configs.hw_config as hw
 import configs.units as units
 import experiment as ex
-from marga_pulseq.interpreter import PSInterpreter
+from manager.pulseqmanager import SequenceInterpreter
 import pypulseq as pp
+from manager.fftmanager import ifftnc
 
 
 class LarmorPyPulseq(blankSeq.MRIBLANKSEQ):
@@ -77,7 +78,7 @@ class LarmorPyPulseq(blankSeq.MRIBLANKSEQ):
         self.demo = demo
 
         # Define the interpreter. It should be updated on calibration
-        self.flo_interpreter = PSInterpreter(tx_warmup=hw.blkTime,  # us
+        self.flo_interpreter = SequenceInterpreter(tx_warmup=hw.blkTime,  # us
                                              rf_center=hw.larmorFreq * 1e6,  # Hz
                                              rf_amp_max=hw.b1Efficiency / (2 * np.pi) * 1e6,  # Hz
                                              gx_max=hw.gFactor[0] * hw.gammaB,  # Hz/m
@@ -152,6 +153,12 @@ class LarmorPyPulseq(blankSeq.MRIBLANKSEQ):
                                 delay=delay_adc,  # s
                                 system=self.system)
 
+        def interpretSequence():
+            # Run the interpreter to get the waveforms
+            waveforms, param_dict = self.interpretBatch(self.flo_interpreter, self.seq, 'sequence')
+
+            return waveforms
+
         # Create the sequence here
         def createSequence():  # Here I will test pypulseq
             rd_points = 0
@@ -169,11 +176,8 @@ class LarmorPyPulseq(blankSeq.MRIBLANKSEQ):
             self.seq.add_block(event_adc)
             rd_points += n_points
 
-            # Create the sequence file
-            self.seq.write('sequence.seq')
-
-            # Run the interpreter to get the waveforms
-            waveforms, param_dict = self.flo_interpreter.interpret('sequence.seq')
+            # Get the waveforms from the cache or interpret the sequence
+            waveforms = self.getCachedBatches(interpretSequence)
 
             # Convert waveform to mriBlankSeq tools (just do it)
             self.pypulseq2mriblankseq(waveforms=waveforms, shimming=self.shimming)
@@ -234,7 +238,7 @@ class LarmorPyPulseq(blankSeq.MRIBLANKSEQ):
         # Generate time and frequency vectors and calcualte the signal spectrum
         tVector = np.linspace(-acq_time / 2, acq_time / 2, n_points)
         fVector = np.linspace(-self.bw / 2, self.bw / 2, n_points) * 1e3  # kHz
-        spectrum = np.fft.ifftshift(np.fft.ifftn(np.fft.ifftshift(signal)))
+        spectrum = ifftnc(signal)
 
         # Get the central frequency
         idf = np.argmax(np.abs(spectrum))
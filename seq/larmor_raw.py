@@ -26,6 +26,7 @@ import numpy as np
 import seq.mriBlankSeq as blankSeq  # Import the mriBlankSequence for any new sequence.
 import configs.hw_config as hw
 import configs.units as units
+from manager.fftmanager import ifftnc
 
 class LarmorRaw(blankSeq.MRIBLANKSEQ):
     def __init__(self):
@@ -187,7 +188,7 @@ class LarmorRaw(blankSeq.MRIBLANKSEQ):
         # Generate time and frequency vectors and calcualte the signal spectrum
         tVector = np.linspace(-acq_time / 2, acq_time / 2, n_points)
         fVector = np.linspace(-self.bw / 2, self.bw / 2, n_points) * 1e3  # kHz
-        spectrum = np.fft.ifftshift(np.fft.ifftn(np.fft.ifftshift(signal)))
+        spectrum = ifftnc(signal)
 
         # Get the central frequency
         idf = np.argmax(np.abs(spectrum))
@@ -6,8 +6,8 @@ Created on Thu June 2 2022
 """
 
 import os
+from concurrent.futures import ThreadPoolExecutor, Future
 
-import bm4d
 import numpy as np
 import configs.hw_config as hw
 from datetime import date, datetime
@@ -22,7 +22,14 @@ from skimage.measure import shannon_entropy
 
 # Import dicom saver
 from manager.dicommanager import DICOMImage
-import shutil
+from manager.flomanager import FloDict, FloBudget
+from manager.cachemanager import waveform_cache
+from manager.pulseqmanager import save_seq_files, compile_batches, get_batch_workers
+from manager.decimationmanager import StreamDecimator
+from manager.fftmanager import ifftnc, fftnc
+from manager.bm4dmanager import bm4d_filter, estimate_noise_std
+from manager.csmanager import cs_reconstruction
+from manager.rawmanager import RawDataWriter
 
 class MRIBLANKSEQ:
     """
@@ -46,7 +53,7 @@ class MRIBLANKSEQ:
         session (dict): Session information.
         demo (bool): Demo information.
         mode (string): Mode information for 'Standalone' execution.
-        flo_dict (dict): Dictionary containing sequence waveforms.
+        flo_dict (FloDict): Dictionary containing sequence waveforms.
 
     """
 
@@ -72,15 +79,16 @@ class MRIBLANKSEQ:
         self.mode = None
         self.output=[]
         self.raw_data_name="raw_data"
-        self.flo_dict = {'g0': [[],[]],
-                         'g1': [[],[]],
-                         'g2': [[],[]],
-                         'rx0': [[],[]],
-                         'rx1': [[],[]],
-                         'tx0': [[],[]],
-                         'tx1': [[],[]],
-                         'ttl0': [[],[]],
-                         'ttl1': [[],[]],}
+        self.flo_dict = FloDict()
+        self.seq_batches = {}  # PyPulseq batches of the last run, saved as .seq files by saveRawData
+        self.save_seq = True  # Set to False to skip saving the .seq files of the PyPulseq batches
+        self.seq_thread = None  # Thread of save_seq_files writing the .seq files of the last acquisition
+        self.batch_workers = get_batch_workers()  # Processes forked to compile the PyPulseq batches
+        self.rx_dtype = complex  # Data type of the acquired data, np.complex64 halves the memory
+        self.lazy_vals = {}  # Outputs computed only when requested with getLazyVal, e.g. the images of each scan
+        self.export_lazy_vals = True  # Compute the lazy outputs when the raw data is saved, False to skip them
+        self.raw_data_file = None  # HDF5 file where runBatches writes the raw data of the current acquisition
+        self.save_mat = True  # The outputs are saved into the .h5 and .mat files, False to save only the .h5 file
 
 
     # *********************************************************************************
@@ -211,87 +219,216 @@ class MRIBLANKSEQ:
         - In demo mode, simulated random data replaces hardware acquisition.
         - Oversampled data is stored in `self.mapVals['data_over']`.
         - Decimated data is stored in `self.mapVals['data_decimated']`.
+        - Both are also appended scan by scan to the HDF5 raw data file, so they can be recovered after a crash.
         - Handles data loss by repeating batches until the expected points are acquired.
         """
         self.mapVals['n_readouts'] = list(n_readouts.values())
         self.mapVals['n_batches'] = len(n_readouts.values())
 
-        # Initialize a list to hold oversampled data
-        data_over = []
-
-        # Iterate through each batch of waveforms
-        for seq_num in waveforms.keys():
-            # Initialize the experiment if not in demo mode
-            if not self.demo:
-                self.expt = ex.Experiment(
-                    lo_freq=frequency,  # Larmor frequency in MHz
-                    rx_t=1 / bandwidth,  # Sampling time in us
-                    init_gpa=False,  # Whether to initialize GPA board (False for now)
-                    gpa_fhdo_offset_time=(1 / 0.2 / 3.1),  # GPA offset time calculation
-                    auto_leds=True  # Automatic control of LEDs
-                )
-
-            # Convert the PyPulseq waveform to the Red Pitaya compatible format
-            self.pypulseq2mriblankseq(waveforms=waveforms[seq_num],
-                                      shimming=self.shimming,
-                                      sampling_period=1/bandwidth,
-                                      hardware=hardware,
-                                      )
-
-            # Load the waveforms into Red Pitaya
-            if not self.floDict2Exp():
-                print("ERROR: Sequence waveforms out of hardware bounds")
-                return False
+        # Decimate the oversampled data as the scans arrive, the oversampled data is kept in a preallocated buffer
+        decimator = StreamDecimator(n_points=sum(n_readouts.values()) * hw.oversamplingFactor * self.nScans,
+                                    offset=int((hw.oversamplingFactor - 1) / 2),
+                                    keep_input=True,
+                                    dtype=self.rx_dtype)
+
+        # Prepare the waveforms of the next batch in a worker thread while the current batch is running. It is not
+        # done when plotting the sequence, as the plot uses the flo_dict of the current batch.
+        batch_names = list(waveforms.keys())
+        executor = None if self.plotSeq else ThreadPoolExecutor(max_workers=1)
+
+        # Write the data into the raw data file as it arrives
+        suffix = '' if output == '' else f'_{output}'
+        raw_file = None if self.plotSeq else self.openRawDataFile(f'data_over{suffix}')
+        n_decimated = 0
+
+        def prepare(seq_num):
+            return self.prepareBatch(waveforms=waveforms[seq_num],
+                                     sampling_period=1 / bandwidth,
+                                     hardware=hardware)
+
+        def submit(seq_num):
+            if executor is None:
+                future = Future()
+                future.set_result(prepare(seq_num))
+                return future
             else:
+                return executor.submit(prepare, seq_num)
+
+        try:
+            next_batch = submit(batch_names[0])
+
+            # Iterate through each batch of waveforms
+            for batch_idx, seq_num in enumerate(batch_names):
+                # Get the converted and validated waveforms of the batch
+                flo_dict = next_batch.result()
+                if flo_dict is None:
+                    print("ERROR: Sequence waveforms out of hardware bounds")
+                    return False
+                if batch_idx + 1 < len(batch_names):
+                    next_batch = submit(batch_names[batch_idx + 1])
+
+                # Get the experiment if not in demo mode, the connection is kept for batches with the same lo_freq
+                # and rx_t, and the instructions of the previous batch are replaced
+                if not self.demo:
+                    rewrite = self.getExperiment(lo_freq=frequency, rx_t=1 / bandwidth)
+                    self.uploadFloDict(flo_dict, rewrite=rewrite)
                 print("Sequence waveforms loaded successfully")
 
-            # If not plotting the sequence, start scanning
+                # If not plotting the sequence, start scanning
+                if not self.plotSeq:
+                    for scan in range(self.nScans):
+                        print(f"Scan {scan + 1}, batch {seq_num.split('_')[-1]}/{len(n_readouts)} running...")
+                        acquired_points = 0
+                        expected_points = n_readouts[seq_num] * hw.oversamplingFactor  # Expected number of points
+
+                        # Continue acquiring points until we reach the expected number
+                        while acquired_points != expected_points:
+                            if not self.demo:
+                                rxd, msgs = self.expt.run()  # Run the experiment and collect data
+                            else:
+                                # In demo mode, generate random data as a placeholder
+                                rxd = {'rx0': np.random.randn(expected_points) + 1j * np.random.randn(expected_points)}
+
+                            # Update acquired points
+                            acquired_points = np.size(rxd['rx0'])
+
+                            # Check if acquired points coincide with expected points
+                            if acquired_points != expected_points:
+                                print("WARNING: data apoints lost!")
+                                print("Repeating batch...")
+
+                        # Add acquired data to the oversampled data and decimate it
+                        data_decimated = decimator.feed(rxd['rx0'])
+                        raw_file.append(f'data_over{suffix}', np.asarray(rxd['rx0'], dtype=self.rx_dtype))
+                        raw_file.append(f'data_decimated{suffix}', data_decimated)
+                        raw_file.set_attributes(**{f'acquired_batches{suffix}': batch_idx,
+                                                   f'acquired_scans{suffix}': scan + 1})
+                        n_decimated += data_decimated.size
+                        print(f"Acquired points = {acquired_points}, Expected points = {expected_points}")
+                        print(f"Scan {scan + 1}, batch {seq_num[-1]}/{len(n_readouts)} ready!")
+
+                elif self.plotSeq and self.standalone:
+                    # Plot the sequence if requested and return immediately
+                    self.sequencePlot(standalone=self.standalone)
+
+            # Store the oversampled and decimated data
             if not self.plotSeq:
-                for scan in range(self.nScans):
-                    print(f"Scan {scan + 1}, batch {seq_num.split('_')[-1]}/{len(n_readouts)} running...")
-                    acquired_points = 0
-                    expected_points = n_readouts[seq_num] * hw.oversamplingFactor  # Expected number of points
-
-                    # Continue acquiring points until we reach the expected number
-                    while acquired_points != expected_points:
-                        if not self.demo:
-                            rxd, msgs = self.expt.run()  # Run the experiment and collect data
-                        else:
-                            # In demo mode, generate random data as a placeholder
-                            rxd = {'rx0': np.random.randn(expected_points) + 1j * np.random.randn(expected_points)}
-
-                        # Update acquired points
-                        acquired_points = np.size(rxd['rx0'])
-
-                        # Check if acquired points coincide with expected points
-                        if acquired_points != expected_points:
-                            print("WARNING: data apoints lost!")
-                            print("Repeating batch...")
-
-                    # Concatenate acquired data into the oversampled data array
-                    data_over = np.concatenate((data_over, rxd['rx0']), axis=0)
-                    print(f"Acquired points = {acquired_points}, Expected points = {expected_points}")
-                    print(f"Scan {scan + 1}, batch {seq_num[-1]}/{len(n_readouts)} ready!")
-
-                # Decimate the oversampled data and store it
                 if output=='':
-                    self.mapVals[f'data_over'] = data_over
-                    data = self.decimate(data_over, n_adc=n_adc, option='Normal', remove=False)
-                    self.mapVals[f'data_decimated'] = data
+                    self.mapVals[f'data_over'] = decimator.data_over
+                    self.mapVals[f'data_decimated'] = decimator.finish()
                 else:
-                    self.mapVals[f'data_over_{output}'] = data_over
-                    data = self.decimate(data_over, n_adc=n_adc, option='Normal', remove=False)
-                    self.mapVals[f'data_decimated_{output}'] = data
+                    self.mapVals[f'data_over_{output}'] = decimator.data_over
+                    self.mapVals[f'data_decimated_{output}'] = decimator.finish()
+                raw_file.append(f'data_decimated{suffix}', decimator.data_decimated[n_decimated:])
+                raw_file.set_attributes(**{f'acquired_batches{suffix}': len(batch_names)})
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=True)
+            if not self.demo:
+                self.closeExperiment()
 
-            elif self.plotSeq and self.standalone:
-                # Plot the sequence if requested and return immediately
-                self.sequencePlot(standalone=self.standalone)
+        return True
 
-            if not self.demo:
-                self.expt.__del__()
+    def openRawDataFile(self, name=''):
+        """
+        Get the HDF5 raw data file of the current acquisition, creating it with the input parameters if needed.
+
+        The file is closed by saveRawData. If the file already contains the dataset `name`, it belongs to a previous
+        acquisition that was not saved, so it is closed as incomplete and a new file is created.
+
+        Args:
+            name (str, optional): Name of the dataset that will be written into the file.
+
+        Returns:
+            RawDataWriter: Writer of the raw data file.
+        """
+        if self.raw_data_file is not None and name in self.raw_data_file:
+            self.raw_data_file.close(complete=False)
+            self.raw_data_file = None
+
+        if self.raw_data_file is None:
+            directory_raw = self.getDataDirectory() + '/raw'
+            if not os.path.exists(directory_raw):
+                os.makedirs(directory_raw)
+            self.mapVals['name_string'] = datetime.now().strftime("%Y.%m.%d.%H.%M.%S.%f")[:-3]
+            file_name = "%s.%s" % (self.raw_data_name, self.mapVals['name_string'])
+            self.raw_data_file = RawDataWriter("%s/%s.h5" % (directory_raw, file_name))
+            self.raw_data_file.write_dict({key: self.mapVals[key] for key in self.mapKeys if key in self.mapVals})
+
+        return self.raw_data_file
+
+    def getDataDirectory(self):
+        """
+        Get the directory of the session where the data is saved.
+
+        Returns:
+            str: Session directory, or a folder with the date of today if there is no session.
+        """
+        if 'directory' in self.session.keys():
+            directory = self.session['directory']
+        else:
+            dt2 = date.today()
+            date_string = dt2.strftime("%Y.%m.%d")
+            directory = 'experiments/acquisitions/%s' % (date_string)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        return directory
+
+    def prepareBatch(self, waveforms, sampling_period, hardware=True):
+        """
+        Convert the PyPulseq waveforms of a batch into the flo_dict and check them for errors.
+
+        Nothing is sent to the Red Pitaya, so the next batch can be prepared while the current one is running.
+
+        Args:
+            waveforms (dict): Waveforms given by the PyPulseq interpreter.
+            sampling_period (float): Sampling period in us.
+            hardware (bool, optional): Take into account gradient and ADC delay.
+
+        Returns:
+            dict: Copy of the flo_dict ready to be uploaded with uploadFloDict, or None if there are errors.
+        """
+        self.pypulseq2mriblankseq(waveforms=waveforms,
+                                  shimming=self.shimming,
+                                  sampling_period=sampling_period,
+                                  hardware=hardware,
+                                  )
+        if not self.checkFloDict():
+            return None
+        return self.flo_dict.to_dict()
 
+    def getExperiment(self, lo_freq, rx_t):
+        """
+        Get the experiment connected to the Red Pitaya, reusing the current one if it has the same lo_freq and rx_t.
+
+        Args:
+            lo_freq (float): Larmor frequency in MHz.
+            rx_t (float): Sampling period in us.
+
+        Returns:
+            bool: True if a new experiment was created, False if the current one is reused.
+        """
+        if getattr(self, 'expt', None) is not None and getattr(self, 'expt_key', None) == (lo_freq, rx_t):
+            return False
+        self.closeExperiment()
+        self.expt = ex.Experiment(
+            lo_freq=lo_freq,  # Larmor frequency in MHz
+            rx_t=rx_t,  # Sampling time in us
+            init_gpa=False,  # Whether to initialize GPA board (False for now)
+            gpa_fhdo_offset_time=(1 / 0.2 / 3.1),  # GPA offset time calculation
+            auto_leds=True  # Automatic control of LEDs
+        )
+        self.expt_key = (lo_freq, rx_t)
         return True
 
+    def closeExperiment(self):
+        """
+        Close the connection of the experiment created by getExperiment, if any.
+        """
+        if getattr(self, 'expt_key', None) is not None:
+            self.expt.__del__()
+            self.expt_key = None
+
     def sequenceInfo(self):
         print("sequenceInfo method is empty."
               "It is recommended to overide this method into your sequence.")
@@ -362,59 +499,32 @@ class MRIBLANKSEQ:
 
         """
         # Reset flo dictionary
-        self.flo_dict = {'g0': [[], []],
-                         'g1': [[], []],
-                         'g2': [[], []],
-                         'rx0': [[], []],
-                         'rx1': [[], []],
-                         'tx0': [[], []],
-                         'tx1': [[], []],
-                         'ttl0': [[], []],
-                         'ttl1': [[], []], }
+        self.flo_dict.clear_channels()
 
         # Fill dictionary
+        keys = {'tx0': 'tx0',
+                'tx1': 'tx1',
+                'rx0_en': 'rx0',
+                'rx1_en': 'rx1',
+                'tx_gate': 'ttl0',
+                'rx_gate': 'ttl1',
+                'grad_vx': 'g0',
+                'grad_vy': 'g1',
+                'grad_vz': 'g2',
+                }
         for key in waveforms.keys():
-            if key == 'tx0':
-                self.flo_dict['tx0'][0] = np.concatenate((self.flo_dict['tx0'][0], waveforms['tx0'][0][0:-1]), axis=0)
-                self.flo_dict['tx0'][1] = np.concatenate((self.flo_dict['tx0'][1], waveforms['tx0'][1][0:-1]), axis=0)
-            elif key == 'tx1':
-                self.flo_dict['tx1'][0] = np.concatenate((self.flo_dict['tx1'][0], waveforms['tx1'][0][0:-1]), axis=0)
-                self.flo_dict['tx1'][1] = np.concatenate((self.flo_dict['tx1'][1], waveforms['tx1'][1][0:-1]), axis=0)
-            elif key == 'rx0_en':
-                self.flo_dict['rx0'][0] = np.concatenate((self.flo_dict['rx0'][0], waveforms['rx0_en'][0][0:-1]), axis=0)
-                self.flo_dict['rx0'][1] = np.concatenate((self.flo_dict['rx0'][1], waveforms['rx0_en'][1][0:-1]), axis=0)
-            elif key == 'rx1_en':
-                self.flo_dict['rx1'][0] = np.concatenate((self.flo_dict['rx1'][0], waveforms['rx1_en'][0][0:-1]), axis=0)
-                self.flo_dict['rx1'][1] = np.concatenate((self.flo_dict['rx1'][1], waveforms['rx1_en'][1][0:-1]), axis=0)
-            elif key == 'tx_gate':
-                self.flo_dict['ttl0'][0] = np.concatenate((self.flo_dict['ttl0'][0], waveforms['tx_gate'][0][0:-1]), axis=0)
-                self.flo_dict['ttl0'][1] = np.concatenate((self.flo_dict['ttl0'][1], waveforms['tx_gate'][1][0:-1]), axis=0)
-            elif key == 'rx_gate':
-                self.flo_dict['ttl1'][0] = np.concatenate((self.flo_dict['ttl1'][0], waveforms['rx_gate'][0][0:-1]), axis=0)
-                self.flo_dict['ttl1'][1] = np.concatenate((self.flo_dict['ttl1'][1], waveforms['rx_gate'][1][0:-1]), axis=0)
-            elif key == 'grad_vx':
-                self.flo_dict['g0'][0] = np.concatenate((self.flo_dict['g0'][0], waveforms['grad_vx'][0][0:-1]), axis=0)
-                self.flo_dict['g0'][1] = np.concatenate((self.flo_dict['g0'][1], waveforms['grad_vx'][1][0:-1]), axis=0)
-            elif key == 'grad_vy':
-                self.flo_dict['g1'][0] = np.concatenate((self.flo_dict['g1'][0], waveforms['grad_vy'][0][0:-1]), axis=0)
-                self.flo_dict['g1'][1] = np.concatenate((self.flo_dict['g1'][1], waveforms['grad_vy'][1][0:-1]), axis=0)
-            elif key == 'grad_vz':
-                self.flo_dict['g2'][0] = np.concatenate((self.flo_dict['g2'][0], waveforms['grad_vz'][0][0:-1]), axis=0)
-                self.flo_dict['g2'][1] = np.concatenate((self.flo_dict['g2'][1], waveforms['grad_vz'][1][0:-1]), axis=0)
+            if key in keys:
+                self.flo_dict[keys[key]].append(waveforms[key][0][0:-1], waveforms[key][1][0:-1])
 
         # Fill missing keys
         for key in self.flo_dict.keys():
-            try:
-                is_unfilled = all(not sublist for sublist in self.flo_dict[key])
-            except:
-                is_unfilled = False
-            if is_unfilled:
-                self.flo_dict[key] = [np.array([0]), np.array([0])]
+            if len(self.flo_dict[key]) == 0:
+                self.flo_dict[key].set(np.array([0]), np.array([0]))
 
         # Add shimming
-        self.flo_dict['g0'][1] = self.flo_dict['g0'][1] + shimming[0]
-        self.flo_dict['g1'][1] = self.flo_dict['g1'][1] + shimming[1]
-        self.flo_dict['g2'][1] = self.flo_dict['g2'][1] + shimming[2]
+        self.flo_dict['g0'][1] += shimming[0]
+        self.flo_dict['g1'][1] += shimming[1]
+        self.flo_dict['g2'][1] += shimming[2]
 
         # Set everything to zero
         last_times = np.array([value[0][-1] for value in self.flo_dict.values()])
@@ -955,6 +1065,68 @@ class MRIBLANKSEQ:
 
         return np.int32(ind)
 
+    @staticmethod
+    def getKSpaceMap(readouts_per_batch, n_scans=1, lines=None, n_lines=None):
+        """
+        Get the map from the readouts of the decimated data stream to the k-space lines.
+
+        The decimated data is acquired batch by batch, and each batch repeats its readouts n_scans times, so the stream
+        is ordered as (batch, scan, readout). The readouts of the batches one after the other give the acquisition
+        order of a scan, and `lines` gives the k-space line of each of them (e.g. from getIndex or from a sampling
+        mask). The map only depends on the sequence parameters, so it can be computed once and reused.
+
+        Args:
+            readouts_per_batch (list): Number of readouts of each batch for a single scan.
+            n_scans (int): Number of scans.
+            lines (np.ndarray, optional): k-space line of each readout in acquisition order. If None, the k-space lines
+                are in acquisition order.
+            n_lines (int, optional): Number of k-space lines. If None, the maximum line plus one.
+
+        Returns:
+            dict: Map with the keys:
+                - 'index': position of each readout of the stream in the array (n_scans, n_lines) flattened.
+                - 'scan': scan of each readout of the stream.
+                - 'repetition': index of each readout of the stream inside its batch and scan.
+                - 'acquisition': index of each readout of the stream in the acquisition order of a scan.
+                - 'shape': shape (n_scans, n_lines).
+
+        """
+        readouts_per_batch = np.array(readouts_per_batch, dtype=int)
+        first = np.concatenate(([0], np.cumsum(readouts_per_batch)[0:-1]))
+        repetition = np.concatenate([np.tile(np.arange(n), n_scans) for n in readouts_per_batch])
+        scan = np.concatenate([np.repeat(np.arange(n_scans), n) for n in readouts_per_batch])
+        acquisition = np.repeat(first, readouts_per_batch * n_scans) + repetition
+        if lines is None:
+            lines = np.arange(np.sum(readouts_per_batch))
+        lines = np.asarray(lines, dtype=int)
+        if n_lines is None:
+            n_lines = int(np.max(lines)) + 1
+
+        return {'index': scan * n_lines + lines[acquisition],
+                'scan': scan,
+                'repetition': repetition,
+                'acquisition': acquisition,
+                'shape': (n_scans, n_lines)}
+
+    @staticmethod
+    def assembleKSpace(data, k_map, n_rd):
+        """
+        Scatter the readouts of the decimated data stream into k-space in a single pass.
+
+        Args:
+            data (np.ndarray): Decimated data, with n_rd points per readout, ordered as (batch, scan, readout).
+            k_map (dict): Map given by getKSpaceMap.
+            n_rd (int): Number of points per readout.
+
+        Returns:
+            np.ndarray: k-space with shape (n_scans, n_lines, n_rd). Lines that are not sampled are zero.
+
+        """
+        data = np.reshape(data, (-1, n_rd))
+        k_space = np.zeros((k_map['shape'][0] * k_map['shape'][1], n_rd), dtype=data.dtype)
+        k_space[k_map['index']] = data
+        return np.reshape(k_space, k_map['shape'] + (n_rd,))
+
     def fixEchoPosition(self, echoes, data0):
         """
         Adjust the position of k=0 in the echo data to the center of the acquisition window.
@@ -1079,10 +1251,8 @@ class MRIBLANKSEQ:
         txAmp = rfAmplitude * np.exp(1j * rfPhase) * hanning * np.abs(np.sinc(tx))
         txGateTime = np.array([tStart, tStart + hw.blkTime + rfTime])
         txGateAmp = np.array([1, 0])
-        self.flo_dict['tx%i' % channel][0] = np.concatenate((self.flo_dict['tx%i' % channel][0], txTime), axis=0)
-        self.flo_dict['tx%i' % channel][1] = np.concatenate((self.flo_dict['tx%i' % channel][1], txAmp), axis=0)
-        self.flo_dict['ttl0'][0] = np.concatenate((self.flo_dict['ttl0'][0], txGateTime), axis=0)
-        self.flo_dict['ttl0'][1] = np.concatenate((self.flo_dict['ttl0'][1], txGateAmp), axis=0)
+        self.flo_dict['tx%i' % channel].append(txTime, txAmp)
+        self.flo_dict['ttl0'].append(txGateTime, txGateAmp)
 
     def rfRawSincPulse(self, tStart, rfTime, rfAmplitude, rfPhase=0, nLobes=7, channel=0, rewrite=True):
         """
@@ -1106,8 +1276,7 @@ class MRIBLANKSEQ:
         txAmp = rfAmplitude * np.exp(1j * rfPhase) * hanning * np.abs(np.sinc(tx))
         txGateTime = np.array([tStart, tStart + hw.blkTime + rfTime])
         txGateAmp = np.array([1, 0])
-        self.flo_dict['tx%i' % channel][0] = np.concatenate((self.flo_dict['tx%i' % channel][0], txTime), axis=0)
-        self.flo_dict['tx%i' % channel][1] = np.concatenate((self.flo_dict['tx%i' % channel][1], txAmp), axis=0)
+        self.flo_dict['tx%i' % channel].append(txTime, txAmp)
 
     def rfRecPulse(self, tStart, rfTime, rfAmplitude, rfPhase=0, channel=0):
         """
@@ -1125,10 +1294,32 @@ class MRIBLANKSEQ:
         txAmp = np.array([rfAmplitude * np.exp(1j * rfPhase), 0.])
         txGateTime = np.array([tStart, tStart + hw.blkTime + rfTime])
         txGateAmp = np.array([1, 0])
-        self.flo_dict['tx%i' % channel][0] = np.concatenate((self.flo_dict['tx%i' % channel][0], txTime), axis=0)
-        self.flo_dict['tx%i' % channel][1] = np.concatenate((self.flo_dict['tx%i' % channel][1], txAmp), axis=0)
-        self.flo_dict['ttl0'][0] = np.concatenate((self.flo_dict['ttl0'][0], txGateTime), axis=0)
-        self.flo_dict['ttl0'][1] = np.concatenate((self.flo_dict['ttl0'][1], txGateAmp), axis=0)
+        self.flo_dict['tx%i' % channel].append(txTime, txAmp)
+        self.flo_dict['ttl0'].append(txGateTime, txGateAmp)
+
+    def rfRecPulseTrain(self, tStart, rfTime, rfAmplitude, rfPhase=0, channel=0):
+        """
+        Generate a train of RF pulses with rectangular shape and the corresponding deblanking signals in a single call.
+
+        All the inputs can be scalars or arrays with the same length than tStart, so that each pulse of the train can
+        have its own duration, amplitude and phase. Pulses are added in the given order, so tStart must be sorted.
+
+        Args:
+            tStart (array_like): Start times of the RF pulses.
+            rfTime (float or array_like): Duration of the RF pulses.
+            rfAmplitude (float, complex or array_like): Amplitude of the RF pulses.
+            rfPhase (float or array_like): Phase of the RF pulses in radians. Default is 0.
+            channel (int): Channel index for the RF pulses. Default is 0.
+
+        """
+        tStart, rfTime, rfAmplitude, rfPhase = np.broadcast_arrays(np.ravel(tStart), np.ravel(rfTime),
+                                                                   np.ravel(rfAmplitude), np.ravel(rfPhase))
+        txTime = np.stack((tStart + hw.blkTime, tStart + hw.blkTime + rfTime), axis=1)
+        txAmp = np.stack((rfAmplitude * np.exp(1j * rfPhase), np.zeros(tStart.shape)), axis=1)
+        txGateTime = np.stack((tStart, tStart + hw.blkTime + rfTime), axis=1)
+        txGateAmp = np.tile(np.array([1, 0]), tStart.shape[0])
+        self.flo_dict['tx%i' % channel].append(txTime, txAmp)
+        self.flo_dict['ttl0'].append(txGateTime, txGateAmp)
 
     def rfRawPulse(self, tStart, rfTime, rfAmplitude, rfPhase=0, channel=0):
         """
@@ -1144,8 +1335,7 @@ class MRIBLANKSEQ:
         """
         txTime = np.array([tStart, tStart + rfTime])
         txAmp = np.array([rfAmplitude * np.exp(1j * rfPhase), 0.])
-        self.flo_dict['tx%i' % channel][0] = np.concatenate((self.flo_dict['tx%i' % channel][0], txTime), axis=0)
-        self.flo_dict['tx%i' % channel][1] = np.concatenate((self.flo_dict['tx%i' % channel][1], txAmp), axis=0)
+        self.flo_dict['tx%i' % channel].append(txTime, txAmp)
 
     def rxGate(self, tStart, gateTime, channel=0):
         """
@@ -1157,10 +1347,22 @@ class MRIBLANKSEQ:
             channel (int): Channel index for the receiver gate. Default is 0.
 
         """
-        self.flo_dict['rx%i' % channel][0] = \
-            np.concatenate((self.flo_dict['rx%i' % channel][0], np.array([tStart, tStart + gateTime])), axis=0)
-        self.flo_dict['rx%i' % channel][1] = \
-            np.concatenate((self.flo_dict['rx%i' % channel][1], np.array([1, 0])), axis=0)
+        self.flo_dict['rx%i' % channel].append(np.array([tStart, tStart + gateTime]), np.array([1, 0]))
+
+    def rxGateTrain(self, tStart, gateTime, channel=0):
+        """
+        Open the receiver gate several times for a specified channel in a single call.
+
+        Args:
+            tStart (array_like): Start times of the receiver gates, sorted.
+            gateTime (float or array_like): Duration of the receiver gates.
+            channel (int): Channel index for the receiver gates. Default is 0.
+
+        """
+        tStart, gateTime = np.broadcast_arrays(np.ravel(tStart), np.ravel(gateTime))
+        rxTime = np.stack((tStart, tStart + gateTime), axis=1)
+        rxAmp = np.tile(np.array([1, 0]), tStart.shape[0])
+        self.flo_dict['rx%i' % channel].append(rxTime, rxAmp)
 
     def rxGateSync(self, tStart, gateTime, channel=0):
         """
@@ -1183,10 +1385,7 @@ class MRIBLANKSEQ:
             samplingRate = self.mapVals['samplingPeriod'] / hw.oversamplingFactor
         t0 = tStart - (hw.addRdPoints * hw.oversamplingFactor - hw.cic_delay_points) * samplingRate  # us
         t1 = tStart + (hw.addRdPoints * hw.oversamplingFactor + hw.cic_delay_points) * samplingRate + gateTime  # us
-        self.flo_dict['rx%i' % channel][0] = \
-            np.concatenate((self.flo_dict['rx%i' % channel][0], np.array([t0, t1])), axis=0)
-        self.flo_dict['rx%i' % channel][1] = \
-            np.concatenate((self.flo_dict['rx%i' % channel][1], np.array([1, 0])), axis=0)
+        self.flo_dict['rx%i' % channel].append(np.array([t0, t1]), np.array([1, 0]))
 
     def ttl(self, tStart, ttlTime, channel=0):
         """
@@ -1198,10 +1397,7 @@ class MRIBLANKSEQ:
             channel (int): Channel index for the TTL signal. Default is 0.
 
         """
-        self.flo_dict['ttl%i' % channel][0] = \
-            np.concatenate((self.flo_dict['ttl%i' % channel][0], np.array([tStart, tStart + ttlTime])), axis=0)
-        self.flo_dict['ttl%i' % channel][1] = \
-            np.concatenate((self.flo_dict['ttl%i' % channel][1], np.array([1, 0])), axis=0)
+        self.flo_dict['ttl%i' % channel].append(np.array([tStart, tStart + ttlTime]), np.array([1, 0]))
 
     def gradTrap(self, tStart, gRiseTime, gFlattopTime, gAmp, gSteps, gAxis, shimming):
         """
@@ -1234,8 +1430,43 @@ class MRIBLANKSEQ:
         aDown = np.linspace(gAmp - dAmp, 0, num=gSteps)
         a = np.squeeze(np.concatenate((aUp, aDown), axis=0)) / hw.gFactor[gAxis] + shimming[gAxis]
 
-        self.flo_dict['g%i' % gAxis][0] = np.concatenate((self.flo_dict['g%i' % gAxis][0], t), axis=0)
-        self.flo_dict['g%i' % gAxis][1] = np.concatenate((self.flo_dict['g%i' % gAxis][1], a), axis=0)
+        self.flo_dict['g%i' % gAxis].append(t, a)
+
+    def gradTrapTrain(self, tStart, gRiseTime, gFlattopTime, gAmp, gSteps, gAxis, shimming):
+        """
+        Generate a train of trapezoidal gradient pulses on a given axis in a single call.
+
+        This is the vectorized version of gradTrap. tStart, gFlattopTime and gAmp can be scalars or arrays with the
+        same length, and the pulses are added in the given order, so they must not overlap.
+
+        Args:
+            tStart (array_like): Start times of the gradient pulses.
+            gRiseTime (float): Rise time of the gradient pulses in microseconds.
+            gFlattopTime (float or array_like): Flattop time of the gradient pulses in microseconds.
+            gAmp (float or array_like): Amplitude of the gradient pulses in T/m.
+            gSteps (int): Number of steps for the gradient ramps.
+            gAxis (int): Axis index for the gradient pulses.
+            shimming (list): List of shimming values for each axis in arbitrary units from marcos.
+
+        Notes:
+            - Time inputs are in microseconds.
+            - Amplitude inputs are in T/m.
+            - shimming is in arbitrary units
+
+        """
+        tStart, gFlattopTime, gAmp = np.broadcast_arrays(np.ravel(tStart), np.ravel(gFlattopTime), np.ravel(gAmp))
+        steps = np.arange(gSteps)
+
+        tUp = np.reshape(tStart, (-1, 1)) + gRiseTime * steps / gSteps
+        tDown = tUp + gRiseTime + np.reshape(gFlattopTime, (-1, 1))
+        t = np.concatenate((tUp, tDown), axis=1)
+
+        gAmp = np.reshape(gAmp, (-1, 1))
+        aUp = gAmp * (steps + 1) / gSteps
+        aDown = gAmp * (gSteps - 1 - steps) / gSteps
+        a = np.concatenate((aUp, aDown), axis=1) / hw.gFactor[gAxis] + shimming[gAxis]
+
+        self.flo_dict['g%i' % gAxis].append(t, a)
 
     def gradTrapMomentum(self, tStart, kMax, gTotalTime, gAxis, shimming, rewrite=True):
         """
@@ -1309,13 +1540,10 @@ class MRIBLANKSEQ:
             - shimming is in arbitrary units
 
         """
-        for kk in range(nStepsGradRise):
-            tRamp = tStart + gradRiseTime * kk / nStepsGradRise
-            gAmp = (g0 + ((gf - g0) * (kk + 1) / nStepsGradRise)) / hw.gFactor[gAxis] + shimming[gAxis]
-            self.flo_dict['g%i' % gAxis][0] = np.concatenate((self.flo_dict['g%i' % gAxis][0], np.array([tRamp])),
-                                                             axis=0)
-            self.flo_dict['g%i' % gAxis][1] = np.concatenate((self.flo_dict['g%i' % gAxis][1], np.array([gAmp])),
-                                                             axis=0)
+        kk = np.arange(nStepsGradRise)
+        tRamp = tStart + gradRiseTime * kk / nStepsGradRise
+        gAmp = (g0 + ((gf - g0) * (kk + 1) / nStepsGradRise)) / hw.gFactor[gAxis] + shimming[gAxis]
+        self.flo_dict['g%i' % gAxis].append(tRamp, gAmp)
 
     def gradTrapAmplitude(self, tStart, gAmplitude, gTotalTime, gAxis, shimming, orders, rewrite=True):
         """
@@ -1371,24 +1599,8 @@ class MRIBLANKSEQ:
             tEnd (float): End time of the sequence in microseconds.
 
         """
-        self.flo_dict['g0'][0] = np.concatenate((self.flo_dict['g0'][0], np.array([tEnd])), axis=0)
-        self.flo_dict['g0'][1] = np.concatenate((self.flo_dict['g0'][1], np.array([0])), axis=0)
-        self.flo_dict['g1'][0] = np.concatenate((self.flo_dict['g1'][0], np.array([tEnd])), axis=0)
-        self.flo_dict['g1'][1] = np.concatenate((self.flo_dict['g1'][1], np.array([0])), axis=0)
-        self.flo_dict['g2'][0] = np.concatenate((self.flo_dict['g2'][0], np.array([tEnd])), axis=0)
-        self.flo_dict['g2'][1] = np.concatenate((self.flo_dict['g2'][1], np.array([0])), axis=0)
-        self.flo_dict['rx0'][0] = np.concatenate((self.flo_dict['rx0'][0], np.array([tEnd])), axis=0)
-        self.flo_dict['rx0'][1] = np.concatenate((self.flo_dict['rx0'][1], np.array([0])), axis=0)
-        self.flo_dict['rx1'][0] = np.concatenate((self.flo_dict['rx1'][0], np.array([tEnd])), axis=0)
-        self.flo_dict['rx1'][1] = np.concatenate((self.flo_dict['rx1'][1], np.array([0])), axis=0)
-        self.flo_dict['tx0'][0] = np.concatenate((self.flo_dict['tx0'][0], np.array([tEnd])), axis=0)
-        self.flo_dict['tx0'][1] = np.concatenate((self.flo_dict['tx0'][1], np.array([0])), axis=0)
-        self.flo_dict['tx1'][0] = np.concatenate((self.flo_dict['tx1'][0], np.array([tEnd])), axis=0)
-        self.flo_dict['tx1'][1] = np.concatenate((self.flo_dict['tx1'][1], np.array([0])), axis=0)
-        self.flo_dict['ttl0'][0] = np.concatenate((self.flo_dict['ttl0'][0], np.array([tEnd])), axis=0)
-        self.flo_dict['ttl0'][1] = np.concatenate((self.flo_dict['ttl0'][1], np.array([0])), axis=0)
-        self.flo_dict['ttl1'][0] = np.concatenate((self.flo_dict['ttl1'][0], np.array([tEnd])), axis=0)
-        self.flo_dict['ttl1'][1] = np.concatenate((self.flo_dict['ttl1'][1], np.array([0])), axis=0)
+        for channel in self.flo_dict.values():
+            channel.append(np.array([tEnd]), np.array([0]))
 
     def iniSequence(self, t0, shimming):
         """
@@ -1400,24 +1612,11 @@ class MRIBLANKSEQ:
             shimming (list): List of shimming values for each axis in arbitrary units.
 
         """
-        self.flo_dict['g0'][0] = np.array([t0])
-        self.flo_dict['g0'][1] = np.array([shimming[0]])
-        self.flo_dict['g1'][0] = np.array([t0])
-        self.flo_dict['g1'][1] = np.array([shimming[1]])
-        self.flo_dict['g2'][0] = np.array([t0])
-        self.flo_dict['g2'][1] = np.array([shimming[2]])
-        self.flo_dict['rx0'][0] = np.array([t0])
-        self.flo_dict['rx0'][1] = np.array([0])
-        self.flo_dict['rx1'][0] = np.array([t0])
-        self.flo_dict['rx1'][1] = np.array([0])
-        self.flo_dict['tx0'][0] = np.array([t0])
-        self.flo_dict['tx0'][1] = np.array([0])
-        self.flo_dict['tx1'][0] = np.array([t0])
-        self.flo_dict['tx1'][1] = np.array([0])
-        self.flo_dict['ttl0'][0] = np.array([t0])
-        self.flo_dict['ttl0'][1] = np.array([0])
-        self.flo_dict['ttl1'][0] = np.array([t0])
-        self.flo_dict['ttl1'][1] = np.array([0])
+        for key, channel in self.flo_dict.items():
+            if key[0] == 'g':
+                channel.set(np.array([t0]), np.array([shimming[int(key[1])]]))
+            else:
+                channel.set(np.array([t0]), np.array([0]))
 
     def setGradient(self, t0, gAmp, gAxis, rewrite=True):
         """
@@ -1430,8 +1629,7 @@ class MRIBLANKSEQ:
             rewrite (bool, optional): Whether to overwrite existing values. Defaults to True.
 
         """
-        self.flo_dict['g%i' % gAxis][0] = np.concatenate((self.flo_dict['g%i' % gAxis][0], np.array([t0])), axis=0)
-        self.flo_dict['g%i' % gAxis][1] = np.concatenate((self.flo_dict['g%i' % gAxis][1], np.array([gAmp])), axis=0)
+        self.flo_dict['g%i' % gAxis].append(np.array([t0]), np.array([gAmp]))
 
     def floDict2Exp(self, rewrite=True, demo=False):
         """
@@ -1446,6 +1644,21 @@ class MRIBLANKSEQ:
 
         """
         # Check errors:
+        if not self.checkFloDict():
+            return False
+
+        # Add instructions to server (copy the buffers, they are reused by the next batch)
+        if not self.demo:
+            self.uploadFloDict(self.flo_dict.to_dict(), rewrite)
+        return True
+
+    def checkFloDict(self):
+        """
+        Check the timing and amplitude of the instructions in the flo_dict.
+
+        Returns:
+            bool: True if no errors were found; False otherwise.
+        """
         for key in self.flo_dict.keys():
             item = self.flo_dict[key]
             dt = item[0][1::] - item[0][0:-1]
@@ -1455,21 +1668,126 @@ class MRIBLANKSEQ:
             if (item[1] > 1).any() or (item[1] < -1).any():
                 print("ERROR: %s amplitude error" % key)
                 return False
-
-        # Add instructions to server
-        if not self.demo:
-            self.expt.add_flodict({'grad_vx': (self.flo_dict['g0'][0], self.flo_dict['g0'][1]),
-                                   'grad_vy': (self.flo_dict['g1'][0], self.flo_dict['g1'][1]),
-                                   'grad_vz': (self.flo_dict['g2'][0], self.flo_dict['g2'][1]),
-                                   'rx0_en': (self.flo_dict['rx0'][0], self.flo_dict['rx0'][1]),
-                                   'rx1_en': (self.flo_dict['rx1'][0], self.flo_dict['rx1'][1]),
-                                   'tx0': (self.flo_dict['tx0'][0], self.flo_dict['tx0'][1]),
-                                   'tx1': (self.flo_dict['tx1'][0], self.flo_dict['tx1'][1]),
-                                   'tx_gate': (self.flo_dict['ttl0'][0], self.flo_dict['ttl0'][1]),
-                                   'rx_gate': (self.flo_dict['ttl1'][0], self.flo_dict['ttl1'][1]),
-                                   }, rewrite)
         return True
 
+    def uploadFloDict(self, flo_dict, rewrite=True):
+        """
+        Add the instructions of a flo_dict to the experiment.
+
+        Args:
+            flo_dict (dict): Dictionary with [times, amplitudes] for each flo channel, e.g. given by FloDict.to_dict().
+            rewrite (bool, optional): Argument passed to Experiment.add_flodict. Use False to replace the instructions
+                of a previous batch in a reused experiment.
+        """
+        self.expt.add_flodict({'grad_vx': (flo_dict['g0'][0], flo_dict['g0'][1]),
+                               'grad_vy': (flo_dict['g1'][0], flo_dict['g1'][1]),
+                               'grad_vz': (flo_dict['g2'][0], flo_dict['g2'][1]),
+                               'rx0_en': (flo_dict['rx0'][0], flo_dict['rx0'][1]),
+                               'rx1_en': (flo_dict['rx1'][0], flo_dict['rx1'][1]),
+                               'tx0': (flo_dict['tx0'][0], flo_dict['tx0'][1]),
+                               'tx1': (flo_dict['tx1'][0], flo_dict['tx1'][1]),
+                               'tx_gate': (flo_dict['ttl0'][0], flo_dict['ttl0'][1]),
+                               'rx_gate': (flo_dict['ttl1'][0], flo_dict['ttl1'][1]),
+                               }, rewrite)
+
+    def getBatchSize(self, createBatch, nMax, samplingPeriod):
+        """
+        Get the number of repetitions that fit into a batch according to hw.maxOrders and hw.maxRdPoints.
+
+        The batch is not run nor uploaded. createBatch is called with one and two repetitions to estimate the
+        instructions and readout points of the batch and of each additional repetition.
+
+        Args:
+            createBatch (function): Function that fills the flo_dict with a batch of n repetitions, createBatch(n).
+            nMax (int): Maximum number of repetitions.
+            samplingPeriod (float): Readout sampling period in microseconds.
+
+        Returns:
+            int: Number of repetitions of the batch, 0 if a single repetition does not fit into the hardware.
+
+        """
+        createBatch(1)
+        budget = FloBudget.from_flo_dict(self.flo_dict, samplingPeriod)
+        if nMax == 1 or not budget.fits(hw.maxOrders, hw.maxRdPoints):
+            return int(budget.fits(hw.maxOrders, hw.maxRdPoints))
+        createBatch(2)
+        step = FloBudget.from_flo_dict(self.flo_dict, samplingPeriod) - budget
+        return budget.get_repetitions(step, hw.maxOrders, hw.maxRdPoints, nMax)
+
+    def getCachedBatches(self, createBatches, *args):
+        """
+        Get the compiled waveforms of the sequence from the waveform cache.
+
+        If the sequence was already compiled with the same input parameters and hardware configuration, the saved
+        output of createBatches is returned. Otherwise, createBatches is called and its output is saved into the cache.
+        The PyPulseq batches interpreted by createBatches are saved together with the waveforms, so they can be
+        archived by saveRawData also when the waveforms come from the cache.
+
+        Args:
+            createBatches (function): Function that creates and interprets the batches of the sequence.
+            *args: Arguments given to createBatches.
+
+        Returns:
+            object: Output of createBatches(*args).
+        """
+        key = waveform_cache.get_key(self, createBatches.__name__, *args)
+        cached = waveform_cache.get(key)
+        if cached is None:
+            seq_batches = self.seq_batches
+            self.seq_batches = {}
+            output = createBatches(*args)
+            waveform_cache.put(key, (output, self.seq_batches))
+            self.seq_batches = {**seq_batches, **self.seq_batches}
+        else:
+            output, seq_batches = cached
+            self.seq_batches.update(seq_batches)
+            print("Waveforms loaded from cache (%i hits, %i misses)" % (waveform_cache.hits, waveform_cache.misses))
+        return output
+
+    def interpretBatch(self, interpreter, batch, name):
+        """
+        Interpret a PyPulseq batch through a temporary .seq file, without batch files in the working directory.
+
+        The batch is kept in self.seq_batches, so that saveRawData can save it later into the session folder.
+
+        Args:
+            interpreter (SequenceInterpreter): Interpreter of the sequence.
+            batch (pp.Sequence): PyPulseq sequence of the batch.
+            name (str): Name of the batch, e.g. 'batch_1'.
+
+        Returns:
+            dict: tuple of numpy.ndarray time and update arrays, with variable name keys
+            dict: parameter dictionary containing raster times, readout numbers, and any sequence definitions
+        """
+        self.seq_batches[name] = batch
+        return interpreter.interpret_sequence(batch)
+
+    def compileBatches(self, interpreter, createBatch, batchArgs):
+        """
+        Create and interpret the batches of a PyPulseq sequence, optionally in a pool of processes.
+
+        The index ranges of each batch must be planned beforehand (see FloBudget.plan_batches), so that createBatch
+        can build any batch independently of the others. The batches are kept in self.seq_batches as in
+        interpretBatch. The number of processes is given by self.batch_workers, taken from hw.batch_workers (see
+        get_batch_workers). Where the processes can not be forked, or with self.batch_workers = 1, the batches are
+        compiled one after another in the GUI process.
+
+        Args:
+            interpreter (SequenceInterpreter): Interpreter of the sequence.
+            createBatch (function): Function that returns the pp.Sequence of a batch.
+            batchArgs (dict): Arguments of createBatch for each batch, with the batch names as keys.
+
+        Returns:
+            dict: Waveforms of each batch, in the same order than batchArgs.
+        """
+        results = compile_batches(interpreter, createBatch, list(batchArgs.values()), n_workers=self.batch_workers)
+        waveforms = {}
+        for name, (batch, batch_waveforms) in zip(batchArgs, results):
+            self.seq_batches[name] = batch
+            waveforms[name] = batch_waveforms
+            print(f"{name} ready!")
+        return waveforms
+
     def saveRawData(self):
         
         """
@@ -1477,7 +1795,9 @@ class MRIBLANKSEQ:
 
         This method saves the rawData to various formats including .mat, .csv, .dcm and .h5.
 
-        The .mat file contains the rawData.
+        The raw .h5 file contains the rawData. The data acquired with runBatches is already in the file, and the
+        outputs of the analysis are added here.
+        The .mat file contains the rawData. It is skipped if save_mat is False.
         The .csv file contains only the input parameters.
         The .dcm file is the DICOM image.
         The .h5 file is the ISMRMRD format.
@@ -1489,23 +1809,19 @@ class MRIBLANKSEQ:
         """
         
         # Get directory
-        if 'directory' in self.session.keys():
-            directory = self.session['directory']
-        else:
-            dt2 = date.today()
-            date_string = dt2.strftime("%Y.%m.%d")
-            directory = 'experiments/acquisitions/%s' % (date_string)
-        if not os.path.exists(directory):
-            os.makedirs(directory)
+        directory = self.getDataDirectory()
 
         # generate directories for mat, csv and dcm files
         directory_mat = directory + '/mat'
         directory_csv = directory + '/csv'
         directory_dcm = directory + '/dcm'
         directory_ismrmrd = directory + '/ismrmrd'
+        directory_raw = directory + '/raw'
         
         if not os.path.exists(directory + '/mat'):
             os.makedirs(directory_mat)
+        if not os.path.exists(directory_raw):
+            os.makedirs(directory_raw)
         if not os.path.exists(directory + '/csv'):
             os.makedirs(directory_csv)
         if not os.path.exists(directory + '/dcm'):
@@ -1515,10 +1831,13 @@ class MRIBLANKSEQ:
 
         self.directory_rmd=directory_ismrmrd 
         
-        # Generate filename
-        name = datetime.now()
-        name_string = name.strftime("%Y.%m.%d.%H.%M.%S.%f")[:-3]
-        self.mapVals['name_string'] = name_string
+        # Generate filename, the same of the raw data file if it was created during the acquisition
+        if self.raw_data_file is not None:
+            name_string = self.mapVals['name_string']
+        else:
+            name = datetime.now()
+            name_string = name.strftime("%Y.%m.%d.%H.%M.%S.%f")[:-3]
+            self.mapVals['name_string'] = name_string
         if hasattr(self, 'raw_data_name'):
             file_name = "%s.%s" % (self.raw_data_name, name_string)
         else:
@@ -1527,9 +1846,27 @@ class MRIBLANKSEQ:
         self.mapVals['fileName'] = "%s.mat" % file_name
         # Generate filename for ismrmrd
         self.mapVals['fileNameIsmrmrd'] = "%s.h5" % file_name
+        self.mapVals['fileNameRaw'] = "%s.h5" % file_name
         
+        # Compute the lazy outputs to be exported
+        if self.export_lazy_vals:
+            for key in list(self.lazy_vals.keys()):
+                self.getLazyVal(key)
+
+        # Save the outputs into the raw data file and close it
+        if self.raw_data_file is None:
+            self.raw_data_file = RawDataWriter("%s/%s.h5" % (directory_raw, file_name))
+        self.raw_data_file.write_dict(self.mapVals)
+        self.raw_data_file.close(complete=True)
+        self.raw_data_file = None
+
         # Save mat file with the outputs
-        savemat("%s/%s.mat" % (directory_mat, file_name), self.mapVals) # au format savemat(chemin_fichier_mat, {"data" : data}), avec data contient les données brute à sauvegarder
+        if self.save_mat:
+            try:
+                savemat("%s/%s.mat" % (directory_mat, file_name), self.mapVals) # au format savemat(chemin_fichier_mat, {"data" : data}), avec data contient les données brute à sauvegarder
+            except (ValueError, OverflowError) as e:
+                # Variables too large for the v5 format of the .mat files
+                print("WARNING: .mat file not saved (%s). The raw data is in raw/%s.h5" % (e, file_name))
 
         # Save csv with input parameters
         with open('%s/%s.csv' % (directory_csv, file_name), 'w') as csvfile: # ouvrir le fichier csv en mode écriture au format with open(chemin_fichier_csv, 'w', newline='') as csvfile:
@@ -1544,45 +1881,13 @@ class MRIBLANKSEQ:
         if (len(self.output) > 0) and (self.output[0]['widget'] == 'image') and (self.mode is None): ##verify if output is an image
             self.image2Dicom(fileName="%s/%s.dcm" % (directory_dcm, file_name))
 
-        # Move seq files
-        self.move_batch_files(destination_folder=directory, file_name=file_name)
-
-    @staticmethod
-    def move_batch_files(destination_folder, file_name):
-        """
-        Move batch_X.seq files from the current working directory to the specified destination folder.
-
-        The method scans all files in the current directory and identifies files with the extension '.seq'.
-        It extracts the batch number from the file name (in the format 'batch_X.seq', where 'X' is the batch number).
-        Then, it moves these files to a subfolder 'seq' inside the specified destination folder, renaming them based on the provided `file_name` template.
-
-        Args:
-        - destination_folder (str): The path to the destination folder where the 'seq' subfolder will be created, and the files will be moved.
-        - file_name (str): The prefix used for renaming the files. Files will be renamed in the format 'file_name_X.seq', where 'X' is the extracted batch number from the original file name.
-
-        Example:
-            If the file 'batch_1.seq' is found and `file_name='processed'`, it will be moved and renamed to:
-            'destination_folder/seq/processed_1.seq'.
-
-        Side Effects:
-        - Creates a 'seq' subfolder in the destination folder if it doesn't already exist.
-        - Moves and renames the matched '.seq' files from the current directory.
-
-        """
-        # List all files in the source folder
-        for source_file in os.listdir():
-            # Match files with the pattern 'batch_X.seq'
-            file_prov = source_file.split('.')
-            if file_prov[-1]=='seq' and os.path.isfile(source_file):
-                batch_num = file_prov[0].split('_')[-1]
-
-                # Create the destination folder path based on the batch number
-                os.makedirs(os.path.join(destination_folder, 'seq'), exist_ok=True)
-
-                # Move the file to the destination folder
-                destination_file = os.path.join(destination_folder, 'seq', file_name+'_%s.seq' % batch_num)
-                shutil.move(source_file, destination_file)
-                print(f'Moved: {file_name} to {destination_folder}')
+        # Save seq files in the background, after the files of the previous acquisition
+        if self.seq_thread is not None:
+            self.seq_thread.join()
+            self.seq_thread = None
+        if self.save_seq and len(self.seq_batches) > 0:
+            self.seq_thread = save_seq_files(self.seq_batches, folder=directory, file_name=file_name)
+        self.seq_batches = {}
 
     def image2Dicom(self, fileName): 
         """
@@ -1700,6 +2005,8 @@ class MRIBLANKSEQ:
                 setattr(self, key, np.array([element * self.map_units[key] for element in self.mapVals[key]]))
             else:
                 setattr(self, key, self.mapVals[key] * self.map_units[key])
+        self.seq_batches = {}
+        self.lazy_vals = {}  # Do not keep the data of the previous acquisition in the closures of the lazy outputs
 
     def plotResults(self):
         """
@@ -1785,6 +2092,40 @@ class MRIBLANKSEQ:
         self.mapNmspc[key] = string
         self.map_units[key] = unit
 
+    def setLazyVal(self, key, function):
+        """
+        Register an output that is computed only when it is requested.
+
+        The output is removed from mapVals until getLazyVal is called, so outputs that are not displayed (e.g. the
+        images of each scan) are not computed during the analysis. They are computed and saved by saveRawData, unless
+        export_lazy_vals is False.
+
+        Args:
+            key (str): The key of the output in mapVals.
+            function (callable): Function without arguments that returns the output.
+
+        Returns:
+            None
+
+        """
+        self.mapVals.pop(key, None)
+        self.lazy_vals[key] = function
+
+    def getLazyVal(self, key):
+        """
+        Get an output registered with setLazyVal, computing it and keeping it in mapVals the first time.
+
+        Args:
+            key (str): The key of the output in mapVals.
+
+        Returns:
+            Any: The value of the output.
+
+        """
+        if key in self.lazy_vals:
+            self.mapVals[key] = self.lazy_vals.pop(key)()
+        return self.mapVals[key]
+
     @staticmethod
     def fix_image_orientation(image, axes):
         """
@@ -1885,7 +2226,7 @@ class MRIBLANKSEQ:
             ndarray: The reconstructed image in the spatial domain.
 
         """
-        image = np.fft.ifftshift(np.fft.ifftn(np.fft.ifftshift(k_space)))
+        image = ifftnc(k_space)
         return image
 
     @staticmethod
@@ -1903,20 +2244,23 @@ class MRIBLANKSEQ:
             ndarray: The k-space data.
 
         """
-        k_space = np.fft.fftshift(np.fft.fftn(np.fft.fftshift(image)))
+        k_space = fftnc(image)
         return k_space
 
     @staticmethod
-    def runBm4dFilter(image_data):
+    def runBm4dFilter(image_data, sigma_psd=None, fast=False):
         """
         Apply the BM4D filter to denoise the image.
 
         This method retrieves the image data, rescales it, calculates the standard deviation for the BM4D filter,
         applies the BM4D filter to denoise the rescaled image, and rescales the denoised image back to its original
-        scale.
+        scale. The filter runs in overlapping tiles processed in parallel.
 
         Args:
             image_data (ndarray): The input image data.
+            sigma_psd (float, optional): Standard deviation of the noise of the image, e.g. from estimate_noise_std. If
+                None, 5 % of the maximum of the image is used.
+            fast (bool): If True, only the hard thresholding stage of BM4D is run.
 
         Returns:
             ndarray: The denoised image.
@@ -1926,23 +2270,39 @@ class MRIBLANKSEQ:
         reference = np.max(image_data)
         image_rescaled = image_data / reference * 100
 
-        # Calculate the standard deviation for BM4D filter
-        # (Code to calculate the standard deviation is included here)
-
-        # Create a BM4D profile and set options
-        profile = bm4d.BM4DProfile()
-        stage_arg = bm4d.BM4DStages.ALL_STAGES
-        blockmatches = (False, False)
+        # Standard deviation for BM4D filter in the rescaled units
+        std = 5 if sigma_psd is None else sigma_psd / reference * 100
 
         # Apply the BM4D filter to the rescaled image
-        denoised_rescaled = bm4d.bm4d(image_rescaled, sigma_psd=5, profile=profile, stage_arg=stage_arg,
-                                      blockmatches=blockmatches)
+        denoised_rescaled = bm4d_filter(image_rescaled, std, fast=fast)
 
         # Rescale the denoised image back to its original dimensions
         denoised_image = denoised_rescaled / 100 * reference
 
         return denoised_image
 
+    @staticmethod
+    def runCSReconstruction(k_space, mask=None, method='tv', lam=0.01, n_iter=50):
+        """
+        Reconstruct undersampled k-space data with compressed sensing.
+
+        The missing points are recovered by minimizing the total variation (method='tv', solved with ADMM) or the L1
+        norm of the wavelet coefficients (method='wavelet', solved with FISTA) of the image, keeping the acquired points.
+
+        Args:
+            k_space (ndarray): The k-space data. Leading axes, e.g. two acquisitions, are reconstructed as a batch.
+            mask (ndarray, optional): Boolean mask of the acquired points. If None, the points different from zero.
+            method (str): 'tv' or 'wavelet'.
+            lam (float): Regularization weight relative to the maximum of the zero-filled image.
+            n_iter (int): Maximum number of iterations.
+
+        Returns:
+            ndarray: The reconstructed complex image.
+
+        """
+        image = cs_reconstruction(k_space, mask=mask, method=method, lam=lam, n_iter=n_iter)
+        return image
+
     @staticmethod
     def runCosbellFilter(sampled, data, cosbell_order):
         """
@@ -2057,8 +2417,12 @@ class MRIBLANKSEQ:
         # Perform inverse FFT to reconstruct the image in the spatial domain
         image = self.runIFFT(k_space)
 
-        # Apply the BM4D filter to denoise the image
-        image = self.runBm4dFilter(np.abs(image))
+        # Apply the BM4D filter to denoise the image, with the noise level from the noise acquired by the sequence
+        noise = self.mapVals.get('noiseData', self.mapVals.get('noise_data'))
+        sigma_psd = None
+        if noise is not None and np.size(noise) > 0:
+            sigma_psd = estimate_noise_std(noise, np.size(k_space), n_scans=self.mapVals.get('nScans', 1))
+        image = self.runBm4dFilter(np.abs(image), sigma_psd=sigma_psd)
 
         # Perform direct FFT to transform the denoised image back to k-space
         k_sp = self.runDFFT(image)
@@ -30,6 +30,7 @@ import configs.hw_config as hw # Import the scanner hardware config
 import configs.units as units
 import seq.mriBlankSeq as blankSeq  # Import the mriBlankSequence for any new sequence.
 from scipy.optimize import curve_fit
+from manager.fftmanager import ifftnc, fftnc
 
 #*********************************************************************************
 #*********************************************************************************
@@ -215,164 +216,115 @@ class MSE(blankSeq.MRIBLANKSEQ):
         k_rd_xyz = np.ones((3, self.nPoints[0]*self.nPoints[1]*nSL))*hw.gammaB
 
         def createSequence(phIndex=0, slIndex=0, lnIndex=0, repeIndexGlobal=0):
-            repeIndex = 0
-            acqPoints = 0
-            orders = 0
-
             # Check in case of dummy pulse fill the cache
             if (self.dummyPulses>0 and self.etl*nRD*2>hw.maxRdPoints) or (self.dummyPulses==0 and self.etl*nRD>hw.maxRdPoints):
                 print('ERROR: Too many acquired points.')
                 return 0
 
-            # Set shimming
-            self.iniSequence(20, self.shimming)
-            while acqPoints+self.etl*nRD<=hw.maxRdPoints and orders<=hw.maxOrders and repeIndexGlobal<nRepetitions:
-            # while repeIndexGlobal<nRepetitions:
-                # Initialize time
-                tEx = 20e3+self.repetitionTime*repeIndex+self.inversionTime+self.preExTime
-
-                # First I do a noise measurement.
-                if repeIndex==0:
-                    t0 = tEx-self.preExTime-self.inversionTime-self.acqTime-2*addRdPoints/BW-self.rfExTime/2-hw.blkTime
-                    self.rxGate(t0, self.acqTime+2*addRdPoints/BW)
-                    acqPoints += nRD
-
-                # Pre-excitation pulse
-                if repeIndex>=self.dummyPulses and self.preExTime!=0:
-                    t0 = tEx-self.preExTime-self.inversionTime-self.rfExTime/2-hw.blkTime
-                    self.rfRecPulse(t0, self.rfExTime, rfExAmp, 0)
-                    self.gradTrap(t0 + hw.blkTime + self.rfReTime, gradRiseTime, self.preExTime * 0.5, -0.005, gSteps,
-                                  self.axesOrientation[0], self.shimming)
-                    self.gradTrap(t0 + hw.blkTime + self.rfReTime, gradRiseTime, self.preExTime * 0.5, -0.005, gSteps,
-                                  self.axesOrientation[1], self.shimming)
-                    self.gradTrap(t0 + hw.blkTime + self.rfReTime, gradRiseTime, self.preExTime * 0.5, -0.005, gSteps,
-                                  self.axesOrientation[2], self.shimming)
-                orders = orders+gSteps*6
-
-                # Inversion pulse
-                if repeIndex>=self.dummyPulses and self.inversionTime!=0:
-                    t0 = tEx-self.inversionTime-self.rfReTime/2-hw.blkTime
-                    self.rfRecPulse(t0, self.rfReTime, rfReAmp, 0)
-                    self.gradTrap(t0 + hw.blkTime + self.rfReTime, gradRiseTime, self.inversionTime * 0.5, 0.005,
-                                  gSteps, self.axesOrientation[0], self.shimming)
-                    self.gradTrap(t0 + hw.blkTime + self.rfReTime, gradRiseTime, self.inversionTime * 0.5, 0.005,
-                                  gSteps, self.axesOrientation[1], self.shimming)
-                    self.gradTrap(t0 + hw.blkTime + self.rfReTime, gradRiseTime, self.inversionTime * 0.5, 0.005,
-                                  gSteps, self.axesOrientation[2], self.shimming)
-                orders = orders+gSteps*6
-
-                # Excitation pulse
-                t0 = tEx-hw.blkTime-self.rfExTime/2
-                self.rfRecPulse(t0,self.rfExTime,rfExAmp,0)
-
-                # Dephasing readout
-                gradAmp = np.array([0.0, 0.0, 0.0])
-                gradAmp[self.axesOrientation[0]] = rdDephAmplitude
-                gradAmp = np.dot(rot, np.reshape(gradAmp, (3, 1)))
-                if repeIndex==(self.dummyPulses-1) or repeIndex>=self.dummyPulses:
-                    t0 = tEx+self.rfExTime/2-hw.gradDelay
-                    self.gradTrap(t0, gradRiseTime, self.rdDephTime, gradAmp[0] * self.rdPreemphasis, gSteps,
-                                  0, self.shimming)
-                    self.gradTrap(t0, gradRiseTime, self.rdDephTime, gradAmp[1] * self.rdPreemphasis, gSteps,
-                                  1, self.shimming)
-                    self.gradTrap(t0, gradRiseTime, self.rdDephTime, gradAmp[2] * self.rdPreemphasis, gSteps,
-                                  2, self.shimming)
-                    orders = orders+gSteps*6
-
-                # Echo train
-                for echoIndex in range(self.etl):
-                    tEcho = tEx+self.echoSpacing*(echoIndex+1)
-
-                    # Refocusing pulse
-                    t0 = tEcho-self.echoSpacing/2-self.rfReTime/2-hw.blkTime
-                    if self.rfMode == 0: # CPMG
-                        self.rfRecPulse(t0, self.rfReTime, rfReAmp, np.pi/2+self.rfPhase*np.pi/180)
-                    elif self.rfMode == 1: # 
-                        if echoIndex%2 == 0:
-                            self.rfRecPulse(t0, self.rfReTime, rfReAmp*1j, np.pi/2+self.rfPhase*np.pi/180)
-                        else:
-                            self.rfRecPulse(t0, self.rfReTime, -rfReAmp*1j, np.pi/2+self.rfPhase*np.pi/180)
-                    elif self.rfMode == 2:
-                        if echoIndex%2 == 0:
-                            self.rfRecPulse(t0, self.rfReTime, rfReAmp, np.pi/2+self.rfPhase*np.pi/180)
-                        else:
-                            self.rfRecPulse(t0, self.rfReTime, -rfReAmp, np.pi/2+self.rfPhase*np.pi/180)
-                    elif self.rfMode == 3:
-                        self.rfRecPulse(t0, self.rfReTime, -rfReAmp*1j, np.pi/2+self.rfPhase*np.pi/180)
-
-                    # Dephasing phase and slice gradients
-                    gradAmp = np.array([0.0, 0.0, 0.0])
-                    gradAmp[self.axesOrientation[1]] = phGradients[phIndex]
-                    gradAmp[self.axesOrientation[2]] = slGradients[slIndex]
-                    gradAmp = np.dot(rot, np.reshape(gradAmp, (3, 1)))
-                    if repeIndex>=self.dummyPulses:         # This is to account for dummy pulses
-                        t0 = tEcho-self.echoSpacing/2+self.rfReTime/2-hw.gradDelay
-                        self.gradTrap(t0, gradRiseTime, self.phGradTime, gradAmp[0], gSteps, 0, self.shimming)
-                        self.gradTrap(t0, gradRiseTime, self.phGradTime, gradAmp[1], gSteps, 1, self.shimming)
-                        self.gradTrap(t0, gradRiseTime, self.phGradTime, gradAmp[2], gSteps, 2, self.shimming)
-                        orders = orders+gSteps*6
-                        if echoIndex == 0:
-                        # get k-point
-                            k_ph_sl_xyz[:, self.nPoints[0]*lnIndex:self.nPoints[0]*(lnIndex+1)] = \
-                                np.diag(np.reshape(gradAmp, -1)) @ \
-                                k_ph_sl_xyz[:, self.nPoints[0] * lnIndex:self.nPoints[0] * (lnIndex + 1)]
-
-                    # Readout gradient
-                    gradAmp = np.array([0.0, 0.0, 0.0])
-                    gradAmp[self.axesOrientation[0]] = rdGradAmplitude
-                    gradAmp = np.dot(rot, np.reshape(gradAmp, (3, 1)))
-                    if repeIndex==(self.dummyPulses-1) or repeIndex>=self.dummyPulses:         # This is to account for dummy pulses
-                        t0 = tEcho-self.rdGradTime/2-gradRiseTime-hw.gradDelay+self.echo_shift
-                        self.gradTrap(t0, gradRiseTime, self.rdGradTime, gradAmp[0], gSteps, 0, self.shimming)
-                        self.gradTrap(t0, gradRiseTime, self.rdGradTime, gradAmp[1], gSteps, 1, self.shimming)
-                        self.gradTrap(t0, gradRiseTime, self.rdGradTime, gradAmp[2], gSteps, 2, self.shimming)
-                        orders = orders+gSteps*6
-
-                    # Rx gate
-                    if repeIndex==(self.dummyPulses-1) or repeIndex>=self.dummyPulses:
-                        t0 = tEcho-self.acqTime/2-addRdPoints/BW+self.echo_shift
-                        self.rxGate(t0, self.acqTime+2*addRdPoints/BW)
-                        acqPoints += nRD
-
-                    if repeIndex>=self.dummyPulses and echoIndex == 0:
-                        k_rd_xyz[:, self.nPoints[0] * lnIndex:self.nPoints[0] * (lnIndex + 1)] = \
-                            np.diag(np.reshape(gradAmp, -1)) @ \
-                            k_rd_xyz[:, self.nPoints[0] * lnIndex:self.nPoints[0] * (lnIndex + 1)]  @ \
-                            np.diag(self.time_vector)
-
-                    # Rephasing phase and slice gradients
-                    gradAmp = np.array([0.0, 0.0, 0.0])
-                    gradAmp[self.axesOrientation[1]] = phGradients[phIndex]
-                    gradAmp[self.axesOrientation[2]] = slGradients[slIndex]
-                    gradAmp = np.dot(rot, np.reshape(gradAmp, (3, 1)))
-                    t0 = tEcho+self.rdGradTime/2+gradRiseTime-hw.gradDelay+self.echo_shift
-                    if (echoIndex<self.etl-1 and repeIndex>=self.dummyPulses):
-                        self.gradTrap(t0, gradRiseTime, self.phGradTime, -gradAmp[0], gSteps, 0, self.shimming)
-                        self.gradTrap(t0, gradRiseTime, self.phGradTime, -gradAmp[1], gSteps, 1, self.shimming)
-                        self.gradTrap(t0, gradRiseTime, self.phGradTime, -gradAmp[2], gSteps, 2, self.shimming)
-                        orders = orders+gSteps*6
-                    elif(echoIndex==self.etl-1 and repeIndex>=self.dummyPulses):
-                        self.gradTrap(t0, gradRiseTime, self.phGradTime, gradAmp[0], gSteps, 0, self.shimming)
-                        self.gradTrap(t0, gradRiseTime, self.phGradTime, gradAmp[1], gSteps, 1, self.shimming)
-                        self.gradTrap(t0, gradRiseTime, self.phGradTime, gradAmp[2], gSteps, 2, self.shimming)
-                        orders = orders+gSteps*6
-                    # Update the phase and slice gradient
-                    if repeIndex>=self.dummyPulses:
-                        # lnIndex +=1
-                        if echoIndex == self.etl-1:
-                            if phIndex == nPH-1:
-                                phIndex = 0
-                                slIndex += 1
-                            else:
-                                phIndex += 1
-                        elif echoIndex == 0:
-                            lnIndex +=1
-                if repeIndex>=self.dummyPulses: 
-                    repeIndexGlobal += 1 # Update the global repeIndex
-                repeIndex+=1 # Update the repeIndex after the ETL
-
-            # Turn off the gradients after the end of the batch
-            self.endSequence((repeIndex+1)*self.repetitionTime)
+            def addRepetitions(repeIndex):
+                # Timing of the batch: one row per repetition and one column per echo
+                repetitions = np.reshape(np.arange(repeIndex), (-1, 1))
+                acquire = repetitions>=self.dummyPulses
+                readout = acquire | (repetitions==(self.dummyPulses-1))
+                tEx = 20e3+self.repetitionTime*repetitions+self.inversionTime+self.preExTime
+                tEcho = tEx+self.echoSpacing*(np.arange(self.etl)+1)
+                tPreEx = tEx-self.preExTime-self.inversionTime-self.rfExTime/2-hw.blkTime
+                tInv = tEx-self.inversionTime-self.rfReTime/2-hw.blkTime
+
+                def echoTrain(*events):
+                    # Interleave the events of each echo to keep them sorted in time
+                    events = np.broadcast_arrays(tEcho, *events)[1::]
+                    return np.reshape(np.stack(events, axis=2), (repeIndex, -1))
+
+                def batchArray(*columns):
+                    # Join the events of each repetition to keep them sorted in time
+                    columns = [np.broadcast_to(column, (repeIndex, np.shape(column)[-1])) for column in columns]
+                    return np.concatenate(columns, axis=1)
+
+                # Phase and slice gradients of the acquired lines (one line per repetition)
+                lines = slIndex*nPH+phIndex+np.arange(np.sum(acquire))
+                phSlAmp = np.zeros((3, repeIndex, 1))
+                phSlAmp[:, acquire[:, 0], 0] = np.outer(rot[:, self.axesOrientation[1]], phGradients[lines%nPH]) + \
+                                               np.outer(rot[:, self.axesOrientation[2]], slGradients[lines//nPH])
+                phSlSign = -np.ones(self.etl)
+                phSlSign[-1] = 1
+
+                # Set shimming
+                self.iniSequence(20, self.shimming)
+
+                # Rf pulses: pre-excitation, inversion, excitation and refocusing pulses
+                rfTime = batchArray(tPreEx, tInv, tEx-hw.blkTime-self.rfExTime/2,
+                                    tEcho-self.echoSpacing/2-self.rfReTime/2-hw.blkTime)
+                rfDuration = batchArray([self.rfExTime, self.rfReTime, self.rfExTime], [self.rfReTime]*self.etl)
+                rfAmp = batchArray([rfExAmp, rfReAmp, rfExAmp], rfReAmps)
+                rfPhase = batchArray([0, 0, 0], [np.pi/2+self.rfPhase*np.pi/180]*self.etl)
+                rfMask = batchArray(acquire & (self.preExTime!=0), acquire & (self.inversionTime!=0), [True],
+                                    [self.rfMode in [0, 1, 2, 3]]*self.etl)
+                self.rfRecPulseTrain(rfTime[rfMask], rfDuration[rfMask], rfAmp[rfMask], rfPhase[rfMask])
+
+                # Gradients: pre-excitation, inversion, readout dephasing and echoes (dephasing, readout and rephasing)
+                gTime = batchArray(tPreEx+hw.blkTime+self.rfReTime, tInv+hw.blkTime+self.rfReTime,
+                                   tEx+self.rfExTime/2-hw.gradDelay,
+                                   echoTrain(tEcho-self.echoSpacing/2+self.rfReTime/2-hw.gradDelay,
+                                             tEcho-self.rdGradTime/2-gradRiseTime-hw.gradDelay+self.echo_shift,
+                                             tEcho+self.rdGradTime/2+gradRiseTime-hw.gradDelay+self.echo_shift))
+                gFlat = batchArray([self.preExTime*0.5, self.inversionTime*0.5, self.rdDephTime],
+                                   [self.phGradTime, self.rdGradTime, self.phGradTime]*self.etl)
+                gMask = batchArray(acquire & (self.preExTime!=0), acquire & (self.inversionTime!=0), readout,
+                                   echoTrain(acquire, readout, acquire))
+                for axis in range(3):
+                    gAmp = batchArray([-0.005, 0.005, rdVector[axis]*rdDephAmplitude*self.rdPreemphasis],
+                                      echoTrain(phSlAmp[axis], rdVector[axis]*rdGradAmplitude, phSlSign*phSlAmp[axis]))
+                    self.gradTrapTrain(gTime[gMask], gradRiseTime, gFlat[gMask], gAmp[gMask], gSteps, axis,
+                                       self.shimming)
+
+                # Rx gates: noise measurement and echoes
+                t0 = tEx[0, 0]-self.preExTime-self.inversionTime-self.acqTime-2*addRdPoints/BW-self.rfExTime/2-hw.blkTime
+                self.rxGate(t0, self.acqTime+2*addRdPoints/BW)
+                tRx = tEcho-self.acqTime/2-addRdPoints/BW+self.echo_shift
+                self.rxGateTrain(tRx[readout[:, 0], :], self.acqTime+2*addRdPoints/BW)
+
+                # Turn off the gradients after the end of the batch
+                self.endSequence((repeIndex+1)*self.repetitionTime)
+
+                return phSlAmp[:, acquire[:, 0], :], np.sum(readout)
+
+            # Refocusing pulses amplitude according to the rf mode
+            echoSign = (-1)**np.arange(self.etl)
+            if self.rfMode == 0: # CPMG
+                rfReAmps = rfReAmp*np.ones(self.etl)
+            elif self.rfMode == 1:
+                rfReAmps = rfReAmp*1j*echoSign
+            elif self.rfMode == 2:
+                rfReAmps = rfReAmp*echoSign
+            elif self.rfMode == 3:
+                rfReAmps = -rfReAmp*1j*np.ones(self.etl)
+            else:
+                rfReAmps = np.zeros(self.etl)
+
+            # Get the number of repetitions that fit into the batch
+            rdVector = rot[:, self.axesOrientation[0]]
+            nAcquired = self.getBatchSize(lambda n: addRepetitions(self.dummyPulses+n), nRepetitions-repeIndexGlobal,
+                                          1/BW)
+            if nAcquired==0:
+                print('ERROR: Too many instructions in a single repetition.')
+                return 0
+
+            # Create the batch
+            phSlAmp, nReadouts = addRepetitions(self.dummyPulses+nAcquired)
+            acqPoints = nRD+nReadouts*self.etl*nRD
+            repeIndexGlobal += nAcquired
+            nLines = nAcquired
+
+            # Get k-points
+            k_ph_sl = np.reshape(k_ph_sl_xyz, (3, -1, self.nPoints[0]))
+            k_ph_sl[:, lnIndex:lnIndex+nLines, :] *= phSlAmp
+            k_rd = np.reshape(k_rd_xyz, (3, -1, self.nPoints[0]))
+            k_rd[:, lnIndex:lnIndex+nLines, :] *= np.reshape(rdVector*rdGradAmplitude, (3, 1, 1))*self.time_vector
+
+            # Update the phase and slice indexes
+            lnIndex += nLines
+            phIndex, slIndex = (slIndex*nPH+phIndex+nLines)%nPH, (slIndex*nPH+phIndex+nLines)//nPH
 
             # Return the output variables
             return(phIndex, slIndex, lnIndex, repeIndexGlobal, acqPoints)
@@ -486,24 +438,10 @@ class MSE(blankSeq.MRIBLANKSEQ):
 
             # Generate dataFull
             dataFull = sig.decimate(overData, hw.oversamplingFactor, ftype='fir', zero_phase=True)
-            if nBatches>1:
-                dataFullA = dataFull[0:sum(acqPointsPerBatch[0:-1])]
-                dataFullB = dataFull[sum(acqPointsPerBatch[0:-1])::]
-
-            # Reorganize dataFull
-            dataProv = np.zeros([self.nScans,nSL*nPH*nRD*nETL])
-            dataProv = dataProv+1j*dataProv
-            if nBatches>1:
-                dataFullA = np.reshape(dataFullA, (nBatches-1, self.nScans, -1, nRD*nETL))
-                dataFullB = np.reshape(dataFullB, (1, self.nScans, -1, nRD*nETL))
-            else:
-                dataFull = np.reshape(dataFull, (nBatches, self.nScans, -1, nRD*nETL))
-            for scan in range(self.nScans):
-                if nBatches>1:
-                    dataProv[scan, :] = np.concatenate((np.reshape(dataFullA[:,scan,:,:],-1), np.reshape(dataFullB[:,scan,:,:],-1)), axis=0)
-                else:
-                    dataProv[scan, :] = np.reshape(dataFull[:,scan,:,:],-1)
-            dataFull = np.reshape(dataProv,-1)
+
+            # Reorganize dataFull. Each echo train is a k-space line and the lines are acquired in k-space order
+            kMap = self.getKSpaceMap(np.array(acqPointsPerBatch) // (self.nScans*nRD*nETL), self.nScans)
+            dataFull = np.reshape(self.assembleKSpace(dataFull, kMap, nRD*nETL), -1)
 
             # Get index for krd = 0
             # Average data
@@ -519,21 +457,13 @@ class MSE(blankSeq.MRIBLANKSEQ):
             # Get individual images
             dataFull = np.reshape(dataFull, (self.nScans, nSL, nPH, nETL, nRD))
             dataFull = dataFull[:, :, :, :, indkrd0-int(self.nPoints[0]/2):indkrd0+int(self.nPoints[0]/2)]
-            imgFull = dataFull*0
-            for jj in range(nETL):
-                for ii in range(self.nScans):
-                    imgFull[ii, :, :, jj, :] = np.fft.ifftshift(np.fft.ifftn(np.fft.ifftshift(dataFull[ii, :, :, jj, :])))
             self.mapVals['dataFull'] = dataFull
-            self.mapVals['imgFull'] = imgFull
+            self.setLazyVal('imgFull', lambda: ifftnc(dataFull, axes=(1, 2, 4)))
 
             # Average data
             dataMSE = np.average(dataFull, axis=0)
             # self.mapVals['kSpace3D_MSE'] = dataMSE
 
-            imgMSE = dataMSE*0
-            for jj in range(nETL):
-                imgMSE[:,:,jj,:]=np.fft.ifftshift(np.fft.ifftn(np.fft.ifftshift(dataMSE[:,:,jj,:])))
-
             # Do zero padding
             dataAllAcq= np.zeros((nETL,self.nPoints[0]*self.nPoints[1]*self.nPoints[2]), dtype=complex)
             for jj in range(nETL):
@@ -557,12 +487,11 @@ class MSE(blankSeq.MRIBLANKSEQ):
             kSL = np.reshape(kSL, (1, self.nPoints[0]*self.nPoints[1]*self.nPoints[2]))
             dPhase = np.exp(-2*np.pi*1j*(self.dfov[0]*kRD+self.dfov[1]*kPH+self.dfov[2]*kSL))
             kSpaceAll = np.zeros((self.nPoints[2], self.nPoints[1], nETL, self.nPoints[0]),dtype=complex)
-            imageAll = np.zeros((self.nPoints[2], self.nPoints[1], nETL, self.nPoints[0]),dtype=complex)
             for jj in range(nETL):
                 dataAllAcq[jj,:] = dataAllAcq[jj,:]*dPhase
                 dataAux = np.reshape(dataAllAcq[jj,:], (self.nPoints[2], self.nPoints[1], self.nPoints[0]))
                 kSpaceAll[:,:,jj,:] = dataAux
-                imageAll[:,:,jj,:] = np.fft.ifftshift(np.fft.ifftn(np.fft.ifftshift(dataAux)))
+            imageAll = ifftnc(kSpaceAll, axes=(0, 1, 3))
 
             self.mapVals['kSpace3D_MSE'] = kSpaceAll
             self.mapVals['image3D_MSE'] = imageAll
@@ -624,7 +553,7 @@ class MSE(blankSeq.MRIBLANKSEQ):
             tVector = np.linspace(-acqTime/2, acqTime/2, nPoints[0])
             sVector = self.mapVals['sampled'][:, 3]
             fVector = np.linspace(-bw/2, bw/2, nPoints[0])
-            iVector = np.fft.ifftshift(np.fft.ifftn(np.fft.ifftshift(sVector)))
+            iVector = ifftnc(sVector)
 
             # Plots to show into the GUI
             result1 = {}
@@ -833,7 +762,7 @@ class MSE(blankSeq.MRIBLANKSEQ):
         image_3d = np.reshape(image[3, :], self.nPoints[-1::-1])
         
         # Generate k-space
-        kspace_3d = np.fft.fftshift(np.fft.fftn(np.fft.fftshift(image_3d)))
+        kspace_3d = fftnc(image_3d)
         
         kspace = np.reshape(kspace_3d, (1, -1))
         
@@ -857,8 +786,8 @@ class MSE(blankSeq.MRIBLANKSEQ):
         dummy2 = dummy_pulses[1, 10:-10]
 
         # Calculate 1d projections from odd and even echoes
-        proj1 = np.fft.ifftshift(np.fft.ifftn(np.fft.ifftshift(dummy1)))
-        proj2 = np.fft.ifftshift(np.fft.ifftn(np.fft.ifftshift(dummy2)))
+        proj1 = ifftnc(dummy1)
+        proj2 = ifftnc(dummy2)
         proj1 = proj1 / np.max(np.abs(proj1))
         proj2 = proj2 / np.max(np.abs(proj2))
         proj1[np.abs(proj1) < 0.1] = 0
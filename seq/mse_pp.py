@@ -34,7 +34,9 @@ import experiment as ex
 import configs.hw_config as hw
 import configs.units as units
 import seq.mriBlankSeq as blankSeq
-from marga_pulseq.interpreter import PSInterpreter
+from manager.flomanager import FloBudget
+from manager.pulseqmanager import SequenceInterpreter
+from manager.fftmanager import ifftnc
 
 
 #*********************************************************************************
@@ -174,7 +176,7 @@ class MSE(blankSeq.MRIBLANKSEQ):
         self.demo = demo
 
         # Define the interpreter. It should be updated on calibration
-        self.flo_interpreter = PSInterpreter(
+        self.flo_interpreter = SequenceInterpreter(
             tx_warmup=hw.blkTime,  # Transmit chain warm-up time (us)
             rf_center=hw.larmorFreq * 1e6,  # Larmor frequency (Hz)
             rf_amp_max=hw.b1Efficiency / (2 * np.pi) * 1e6,  # Maximum RF amplitude (Hz)
@@ -221,7 +223,6 @@ class MSE(blankSeq.MRIBLANKSEQ):
         nRD_post = hw.addRdPoints
         self.mapVals['nRD_pre'] = hw.addRdPoints
         self.mapVals['nRD_post'] = hw.addRdPoints
-        n_rd_points_per_train = n_echo * (nRD + nRD_post + nRD_pre)
         os = hw.oversamplingFactor
         self.mapVals['oversamplingFactor'] = os
         t_ex = self.rfExTime
@@ -420,6 +421,48 @@ class MSE(blankSeq.MRIBLANKSEQ):
                 # Add repetition delay
                 batches[name].add_block(delay_TR)
 
+        def createBatch(name, first, last):
+            """
+            Create a batch with the echo trains from `first` to `last` (excluded) of the slice and phase sweeps.
+
+            Parameters:
+            ----------
+            name : str
+                The name of the batch.
+            first, last : int
+                Range of echo trains, where the echo train index is Cz * nPH + Cy.
+
+            Returns:
+            --------
+            pp.Sequence
+                The batch with its dummy pulses and echo trains.
+            """
+            initializeBatch(name)
+            for train in range(first, last):
+                Cz, Cy = divmod(train, nPH)
+
+                # Fix the phase and slice amplitude
+                sl_scale = (Cz - nSL / 2) / nSL * 2
+                pe_scale = (Cy - nPH / 2) / nPH * 2
+                gs = pp.scale_grad(gs_max, sl_scale)
+                gp = pp.scale_grad(gp_max, pe_scale)
+
+                # Add excitation pulse and readout de-phasing gradient
+                batches[name].add_block(rf_ex, d_ex)
+                batches[name].add_block(pp.scale_grad(gr_preph, self.preemphasis), delay_preph)
+
+                # Add the echo train
+                for k_echo in range(n_echo):
+                    # Add refocusing pulse
+                    batches[name].add_block(rf_ref, d_ref)
+                    # Add slice, phase and readout gradients
+                    batches[name].add_block(gs, gp, gr, adc)
+
+                # Add time delay to next repetition
+                batches[name].add_block(delay_TR)
+
+            return batches[name]
+
         def createBatches():
             """
             Create MRI pulse sequence based on slice and phase sweeps, manage readout points,
@@ -429,15 +472,16 @@ class MSE(blankSeq.MRIBLANKSEQ):
             gradients, adding excitation, refocusing pulses, and gradient blocks. It dynamically
             divides the readout points between batches and ensures that no one exceeds
             the maximum allowable readout points. The batches are checked for timing errors,
-            and the finalized batches are written to files.
+            and the finalized batches are interpreted.
 
             Workflow:
             ---------
-            1. Loop over slice positions (`Cz`) and phase positions (`Cy`) to generate batches.
-            2. Initialize a new sequence when needed based on the readout points limit.
-            3. Add excitation, refocusing pulses, gradients (slice, phase, readout), and ADC blocks.
-            4. Ensure correct timing of the final sequence and generate a timing error report if needed.
-            5. Write each sequence to a file and interpret the sequence to generate waveforms.
+            1. Split the echo trains of the slice (`Cz`) and phase (`Cy`) sweeps into batches, so that each batch
+               fits into the hardware limits.
+            2. Create each batch with `createBatch`, adding excitation, refocusing pulses, gradients (slice, phase,
+               readout), and ADC blocks.
+            3. Interpret the batches to generate waveforms. Batches are independent, so they are created and
+               interpreted in a pool of processes.
 
             Returns:
             --------
@@ -454,8 +498,8 @@ class MSE(blankSeq.MRIBLANKSEQ):
 
             - `nSL`: number of slices.
             - `nPH`: number of phase encoding steps.
-            - `n_rd_points_per_train`: number of readout points per echo train.
-            - `hw.maxRdPoints`: hardware maximum allowable readout points.
+            - `train_budget`: instructions and readout points per echo train, estimated with `FloBudget`.
+            - `hw.maxOrders`, `hw.maxRdPoints`: hardware maximum allowable instructions and readout points.
             - `rf_ex`, `d_ex`: RF excitation pulse and corresponding duration.
             - `rf_ref`, `d_ref`: RF refocusing pulse and corresponding duration.
             - `gr_preph`: pre-phasing gradient block.
@@ -473,76 +517,37 @@ class MSE(blankSeq.MRIBLANKSEQ):
 
             File Output:
             ------------
-            The sequence files are saved with the `.seq` extension, and the waveforms are
-            interpreted using the `flo_interpreter`.
+            The batches are interpreted using the `flo_interpreter` without batch files and kept in `self.seq_batches`,
+            so they are saved as `.seq` files into the session folder by `saveRawData`.
             """
 
-            n_rd_points = 0
+            # Instructions and readout points of a single echo train
+            train_blocks = [(rf_ex, d_ex), (gr_preph, delay_preph)]
+            train_blocks += [(rf_ref, d_ref), (gs_max, gp_max, gr, adc)] * n_echo
+            train_blocks.append((delay_TR,))
+            train_budget = FloBudget.from_blocks(train_blocks, hw.grad_raster_time, hw.oversamplingFactor)
+
+            # Split the echo trains of the slice and phase sweeps into batches
+            initializeBatch("batch_0")
+            batch_budget = FloBudget.from_blocks(batches.pop("batch_0"), hw.grad_raster_time, hw.oversamplingFactor)
+            ranges = batch_budget.plan_batches([train_budget] * (nSL * nPH), hw.maxOrders, hw.maxRdPoints)
+            batch_args = {}
             n_rd_points_dict = {}
-            seq_idx = 0
-            seq_num = "batch_0"
-            waveforms = {}
-
-            # Slice sweep
-            for Cz in range(nSL):
-
-                # Get slice gradient amplitude
-                Nph_range = range(nPH)
-
-                # Phase sweep
-                for Cy in Nph_range:
-                    # Initialize new sequence with corresponding dummy pulses
-                    if seq_idx == 0 or n_rd_points + n_rd_points_per_train > hw.maxRdPoints:
-                        # Write seq file
-                        if seq_idx > 0:
-                            batches[seq_num].write(seq_num + ".seq")
-                            waveforms[seq_num], param_dict = self.flo_interpreter.interpret(seq_num + ".seq")
-                            print(seq_num + ".seq ready!")
-
-                        # Create new batch
-                        seq_idx += 1
-                        n_rd_points_dict[seq_num] = n_rd_points
-                        seq_num = "batch_%i" % seq_idx
-                        initializeBatch(seq_num)
-                        n_rd_points = 0
-                        print("Creating " + seq_num + ".seq...")
-
-                    # Fix the phase and slice amplitude
-                    sl_scale = (Cz - nSL / 2) / nSL * 2
-                    pe_scale = (Cy - nPH / 2) / nPH * 2
-                    gs = pp.scale_grad(gs_max, sl_scale)
-                    gp = pp.scale_grad(gp_max, pe_scale)
-
-                    # Add excitation pulse and readout de-phasing gradient
-                    batches[seq_num].add_block(rf_ex, d_ex)
-                    batches[seq_num].add_block(pp.scale_grad(gr_preph, self.preemphasis), delay_preph)
-
-                    # Add the echo train
-                    for k_echo in range(n_echo):
-                        # Add refocusing pulse
-                        batches[seq_num].add_block(rf_ref, d_ref)
-                        # Add slice, phase and readout gradients
-                        batches[seq_num].add_block(gs, gp, gr, adc)
-                        n_rd_points += nRD + nRD_post + nRD_pre
-
-                    # Add time delay to next repetition
-                    batches[seq_num].add_block(delay_TR)
-
-            # Get the rd point list
-            n_rd_points_dict.pop('batch_0')
-            n_rd_points_dict[seq_num] = n_rd_points
-
-            # Write the sequence files
-            batches[seq_num].write(seq_num + ".seq")
-            waveforms[seq_num], param_dict = self.flo_interpreter.interpret(seq_num + ".seq")
-            print(seq_num + ".seq ready!")
-            print("%i batches created." % len(batches))
+            for seq_idx, (first, last) in enumerate(ranges):
+                seq_num = "batch_%i" % (seq_idx + 1)
+                batch_args[seq_num] = (seq_num, first, last)
+                n_rd_points_dict[seq_num] = (last - first) * n_echo * (nRD + nRD_post + nRD_pre)
+            print("Creating %i batches..." % len(batch_args))
+
+            # Create and interpret the batches
+            waveforms = self.compileBatches(self.flo_interpreter, createBatch, batch_args)
+            print("%i batches created." % len(batch_args))
             print("Sequence ready!")
 
             return waveforms, n_rd_points_dict
 
         # Create the batches
-        waveforms, n_readouts = createBatches()
+        waveforms, n_readouts = self.getCachedBatches(createBatches)
         self.mapVals['n_readouts'] = list(n_readouts.values())
         self.mapVals['n_batches'] = len(n_readouts.values())
         scan_time = (nPH * nSL + self.mapVals['n_batches'] * self.dummyPulses) * self.repetitionTime * self.nScans
@@ -627,23 +632,9 @@ class MSE(blankSeq.MRIBLANKSEQ):
         nRD = nRD + 2 * hw.addRdPoints
         n_batches = self.mapVals['n_batches']
 
-        # Reorganize data_full
-        data_prov = np.zeros([self.nScans, nRD * nPH * nSL * self.etl], dtype=complex)
-        if n_batches > 1:
-            n_rds = self.mapVals['n_readouts']
-            data_full_a = data_full[0:sum(n_rds[0:-1]) * self.nScans]
-            data_full_b = data_full[sum(n_rds[0:-1]) * self.nScans:]
-            data_full_a = np.reshape(data_full_a, newshape=(n_batches - 1, self.nScans, -1, nRD))
-            data_full_b = np.reshape(data_full_b, newshape=(1, self.nScans, -1, nRD))
-            for scan in range(self.nScans):
-                data_scan_a = np.reshape(data_full_a[:, scan, :, :], -1)
-                data_scan_b = np.reshape(data_full_b[:, scan, :, :], -1)
-                data_prov[scan, :] = np.concatenate((data_scan_a, data_scan_b), axis=0)
-        else:
-            data_full = np.reshape(data_full, (1, self.nScans, -1, nRD))
-            for scan in range(self.nScans):
-                data_prov[scan, :] = np.reshape(data_full[:, scan, :, :], -1)
-        data_full = np.reshape(data_prov, -1)
+        # Reorganize data_full. The readouts are acquired in k-space order
+        k_map = self.getKSpaceMap(np.array(self.mapVals['n_readouts']) // nRD, self.nScans)
+        data_full = np.reshape(self.assembleKSpace(data_full, k_map, nRD), -1)
 
         # Average data
         data_full = np.reshape(data_full, newshape=(self.nScans, -1))
@@ -661,9 +652,7 @@ class MSE(blankSeq.MRIBLANKSEQ):
         self.mapVals['kSpace'] = data_ind
 
         # Get images
-        image_ind = np.zeros_like(data_ind)
-        for echo in range(self.etl):
-            image_ind[echo] = np.fft.ifftshift(np.fft.ifftn(np.fft.ifftshift(data_ind[echo])))
+        image_ind = ifftnc(data_ind, axes=(1, 2, 3))
         self.mapVals['iSpace'] = image_ind
 
         # Prepare data to plot (plot central slice)
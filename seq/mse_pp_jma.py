@@ -28,8 +28,9 @@ import configs.hw_config as hw # Import the scanner hardware config
 import configs.units as units
 import seq.mriBlankSeq as blankSeq  # Import the mriBlankSequence for any new sequence.
 from scipy.optimize import curve_fit
-from marga_pulseq.interpreter import PSInterpreter
+from manager.pulseqmanager import SequenceInterpreter
 import pypulseq as pp
+from manager.fftmanager import ifftnc
 
 #*********************************************************************************
 #*********************************************************************************
@@ -134,7 +135,7 @@ class MSE(blankSeq.MRIBLANKSEQ):
         # Step 1: Define the interpreter for FloSeq/PSInterpreter.
         # The interpreter is responsible for converting the high-level pulse sequence description into low-level
         # instructions for the scanner hardware. You will typically update the interpreter during scanner calibration.
-        self.flo_interpreter = PSInterpreter(
+        self.flo_interpreter = SequenceInterpreter(
             tx_warmup=hw.blkTime,  # Transmit chain warm-up time (us)
             rf_center=hw.larmorFreq * 1e6,  # Larmor frequency (Hz)
             rf_amp_max=hw.b1Efficiency / (2 * np.pi) * 1e6,  # Maximum RF amplitude (Hz)
@@ -450,16 +451,15 @@ class MSE(blankSeq.MRIBLANKSEQ):
                 print("Timing check failed. Error listing follows:")
                 [print(e) for e in error_report]
 
-            # Write the sequence files
+            # Interpret the last batch
             waveforms = {}
             for seq_num in batches.keys():
-                batches[seq_num].write(seq_num + ".seq")
-                waveforms[seq_num], param_dict = self.flo_interpreter.interpret(seq_num + ".seq")
+                waveforms[seq_num], param_dict = self.interpretBatch(self.flo_interpreter, batches[seq_num], seq_num)
 
             return waveforms, n_rd_points_dict
 
         # Create the batches
-        waveforms, n_readouts = createBatches()
+        waveforms, n_readouts = self.getCachedBatches(createBatches)
         self.mapVals['n_readouts'] = list(n_readouts.values())
         self.mapVals['n_batches'] = len(n_readouts.values())
         scan_time = (nPH * nSL + self.mapVals['n_batches'] * self.dummyPulses) * self.repetitionTime * self.nScans
@@ -544,23 +544,9 @@ class MSE(blankSeq.MRIBLANKSEQ):
         nRD = nRD + 2 * hw.addRdPoints
         n_batches = self.mapVals['n_batches']
 
-        # Reorganize data_full
-        data_prov = np.zeros([self.nScans, nRD * nPH * nSL * self.etl], dtype=complex)
-        if n_batches > 1:
-            n_rds = self.mapVals['n_readouts']
-            data_full_a = data_full[0:sum(n_rds[0:-1]) * self.nScans]
-            data_full_b = data_full[sum(n_rds[0:-1]) * self.nScans:]
-            data_full_a = np.reshape(data_full_a, newshape=(n_batches - 1, self.nScans, -1, nRD))
-            data_full_b = np.reshape(data_full_b, newshape=(1, self.nScans, -1, nRD))
-            for scan in range(self.nScans):
-                data_scan_a = np.reshape(data_full_a[:, scan, :, :], -1)
-                data_scan_b = np.reshape(data_full_b[:, scan, :, :], -1)
-                data_prov[scan, :] = np.concatenate((data_scan_a, data_scan_b), axis=0)
-        else:
-            data_full = np.reshape(data_full, (1, self.nScans, -1, nRD))
-            for scan in range(self.nScans):
-                data_prov[scan, :] = np.reshape(data_full[:, scan, :, :], -1)
-        data_full = np.reshape(data_prov, -1)
+        # Reorganize data_full. The readouts are acquired in k-space order
+        k_map = self.getKSpaceMap(np.array(self.mapVals['n_readouts']) // nRD, self.nScans)
+        data_full = np.reshape(self.assembleKSpace(data_full, k_map, nRD), -1)
 
         # Average data
         data_full = np.reshape(data_full, newshape=(self.nScans, -1))
@@ -580,7 +566,7 @@ class MSE(blankSeq.MRIBLANKSEQ):
         # Get images
         image_ind = np.zeros_like(data_ind)
         for echo in range(self.etl):
-            image_ind[echo] = np.fft.ifftshift(np.fft.ifftn(np.fft.ifftshift(data_ind[echo])))
+            image_ind[echo] = ifftnc(data_ind[echo])
         self.mapVals['iSpace'] = image_ind
 
         # Prepare data to plot (plot central slice)
@@ -26,6 +26,7 @@ import numpy as np
 import seq.mriBlankSeq as blankSeq  # Import the mriBlankSequence for any new sequence.
 import configs.hw_config as hw
 import configs.units as units
+from manager.fftmanager import ifftnc
 
 class Noise(blankSeq.MRIBLANKSEQ):
     def __init__(self):
@@ -73,7 +74,7 @@ class Noise(blankSeq.MRIBLANKSEQ):
             data = self.decimate(data_over=data, n_adc=1, option='Normal')
             acqTime = self.nPoints/self.bw
             tVector = np.linspace(0, acqTime, num=self.nPoints) * 1e-3  # ms
-            spectrum = np.fft.ifftshift(np.fft.ifftn(np.fft.ifftshift(data)))
+            spectrum = ifftnc(data)
             fVector = np.linspace(-self.bw / 2, self.bw / 2, num=self.nPoints) * 1e3  # kHz
             self.dataTime = [tVector, data]
             self.dataSpec = [fVector, spectrum]
@@ -112,7 +113,7 @@ class Noise(blankSeq.MRIBLANKSEQ):
                 data = self.decimate(rxd['rx%i' % self.rxChannel], 1, option='Normal')
                 self.mapVals['data'] = data
                 tVector = np.linspace(0, acqTime, num=self.nPoints) * 1e-3  # ms
-                spectrum = np.fft.ifftshift(np.fft.ifftn(np.fft.ifftshift(data)))
+                spectrum = ifftnc(data)
                 fVector = np.linspace(-self.bw / 2, self.bw / 2, num=self.nPoints) * 1e3  # kHz
                 self.dataTime = [tVector, data]
                 self.dataSpec = [fVector, spectrum]
@@ -9,7 +9,8 @@ import numpy as np
 import controller.experiment_gui as ex
 import configs.hw_config as hw # Import the scanner hardware config
 import seq.mriBlankSeq as blankSeq  # Import the mriBlankSequence for any new sequence.
-from scipy.interpolate import griddata
+from manager.nufftmanager import get_gridder, cg_reconstruction
+from manager.fftmanager import ifftnc
 
 
 #*********************************************************************************
@@ -44,7 +45,9 @@ class PETRA(blankSeq.MRIBLANKSEQ):
         self.addParameter(key='txChannel', string='Tx channel', val=0, field='RF')
         self.addParameter(key='rxChannel', string='Rx channel', val=0, field='RF')
         self.addParameter(key='NyquistOS', string='Radial oversampling', val=1, field='SEQ')
-        self.addParameter(key='reco', string='ART->0,  FFT->1', val=1, field='IM')
+        self.addParameter(key='reco', string='CG->0,  FFT->1', val=1, field='IM')
+        self.addParameter(key='cgIter', string='CG iterations', val=20, field='IM')
+        self.addParameter(key='cgLambda', string='CG Tikhonov lambda', val=0.0, field='IM')
         self.addParameter(key='boolGrid', string='Bool regridding', val=1, field='OTH')
 
     def sequenceInfo(self):
@@ -414,16 +417,10 @@ class PETRA(blankSeq.MRIBLANKSEQ):
                 self.mapVals['kSpaceRaw'] = kSpace
 
                 if nCir > 1:
-                    kxOriginal = np.reshape(np.real(kSpace[:, 0]), -1)
-                    kyOriginal = np.reshape(np.real(kSpace[:, 1]), -1)
-                    kzOriginal = np.reshape(np.real(kSpace[:, 2]), -1)
-                    kxTarget = np.reshape(kCartesian[:, 0], -1)
-                    kyTarget = np.reshape(kCartesian[:, 1], -1)
-                    kzTarget = np.reshape(kCartesian[:, 2], -1)
                     if boolGrid == 0:
                         valCartesian = 1
                     else:
-                        valCartesian = griddata((kxOriginal, kyOriginal, kzOriginal), np.reshape(kSpace[:, 3], -1),(kxTarget, kyTarget, kzTarget), method='linear', fill_value=0, rescale=False)
+                        valCartesian = get_gridder(kSpace[:, 0:3], kCartesian, nPoints, axes=(0, 1, 2)).grid(kSpace[:, 3]).reshape(-1)
                     DELX = dfov[0]
                     DELY = dfov[1]
                     DELZ = dfov[2]
@@ -431,23 +428,17 @@ class PETRA(blankSeq.MRIBLANKSEQ):
                     valCartesian = valCartesian * phase
 
                 if (nCir == 1) and (nLPC > 2):
-                    kxOriginal = np.reshape(np.real(kSpace[:, 0]), -1)
-                    kyOriginal = np.reshape(np.real(kSpace[:, 1]), -1)
-                    kxTarget = np.reshape(kCartesian[:, 0], -1)
-                    kyTarget = np.reshape(kCartesian[:, 1], -1)
                     if boolGrid == 0:
                         valCartesian = 1
                     else:
-                        valCartesian = griddata((kxOriginal, kyOriginal), np.reshape(kSpace[:, 3], -1),(kxTarget, kyTarget), method='linear', fill_value=0, rescale=False)
+                        valCartesian = get_gridder(kSpace[:, 0:3], kCartesian, nPoints, axes=(0, 1)).grid(kSpace[:, 3]).reshape(-1)
                     DELX = dfov[0]
                     DELY = dfov[1]
                     phase = np.exp(-2 * np.pi * 1j * (DELX * kCartesian[:, 0] + DELY * kCartesian[:, 1]))
                     valCartesian = valCartesian * phase
 
                 if (nCir == 1) and (nLPC == 2):
-                    kxOriginal = np.reshape(np.real(kSpace[:, 0]), -1)
-                    kxTarget = np.reshape(kCartesian[:, 0], -1)
-                    valCartesian = griddata((kxOriginal), np.reshape(kSpace[:, 3], -1), (kxTarget), method='linear',fill_value=0, rescale=False)
+                    valCartesian = get_gridder(kSpace[:, 0:3], kCartesian, nPoints, axes=(0,)).grid(kSpace[:, 3]).reshape(-1)
                     self.valCartesian = valCartesian
                     DELX = dfov[0]
                     DELY = dfov[1]
@@ -464,7 +455,7 @@ class PETRA(blankSeq.MRIBLANKSEQ):
                 kSpaceCartesian[:, 4] = valCartesian.real
                 kSpaceCartesian[:, 5] = valCartesian.imag
                 kSpaceArray = np.reshape(valCartesian, (nPoints[2], nPoints[1], nPoints[0]))
-                ImageFFT = np.fft.ifftshift(np.fft.ifftn(np.fft.ifftshift(kSpaceArray)))
+                ImageFFT = ifftnc(kSpaceArray)
                 self.mapVals['kSpaceCartesian'] = kSpaceCartesian
                 self.mapVals['kSpaceArray'] = kSpaceArray
                 self.mapVals['ImageFFT'] = ImageFFT
@@ -480,46 +471,23 @@ class PETRA(blankSeq.MRIBLANKSEQ):
         reco = self.mapVals['reco']
 
         if reco == 0:
-            niter = 1
-            update = 1
-            fov = self.mapVals['fov']/ 100
             nPoints = self.mapVals['nPoints']
+            dfov = np.array(self.mapVals['dfov']) * 1e-3  # m
             sampled_Kspace = self.mapVals['kSpaceRaw']
             kS = np.array(sampled_Kspace[:, 0:3].real)
             signal = sampled_Kspace[:, 3]
-            tSTEPS = signal.shape[0]
-            FoVx = fov[0]
-            FoVy = fov[1]
-            FoVz = fov[2]
-            NX = nPoints[0]
-            NY = nPoints[1]
-            NZ = nPoints[2]
-            dx2 = FoVx / NX
-            dy2 = FoVy / NY
-            dz2 = FoVz / NZ
-            nn = NX * NY * NZ
-            RHO = np.zeros((1, nn))
-            kk = np.arange(NZ)
-            jj = np.arange(NY)
-            ii = np.arange(NX)
-            count = 1
-
-            for n in range(niter):
-                for tt in range(tSTEPS):
-                    Mtk = np.reshape(np.array(np.exp(-1*1j * (2 * np.pi * kS[tt, 2] * (-(NZ - 1) / 2 + kk) * dz2))), [1, NZ])
-                    Mtj = np.reshape(np.array(np.exp(-1*1j * (2 * np.pi * kS[tt, 1] * (-(NY - 1) / 2 + jj) * dy2))), [NY, 1])
-                    Mtjk = np.reshape(np.matmul(Mtj, Mtk), [1, NY*NZ])
-                    aux = np.reshape(np.exp(-1*1j * (2 * np.pi * kS[tt, 0] * (-(NX - 1) / 2 + ii) * dx2)), [NX, 1])
-                    Mt = np.reshape(np.matmul(aux, Mtjk), [1, NX*NY*NZ])
-                    delta_t = (signal[tt] - np.sum(np.matmul(np.reshape(Mt, [NX*NY*NZ, 1]), RHO))) / np.dot(np.squeeze(np.asarray(Mt)), np.squeeze(np.asarray(Mt)))
-                    RHO = (RHO + update * delta_t * np.conj(Mt))
-                    count = count + 1
-                    print(tt, "/", tSTEPS, " ART")
-
-            if NZ == 1:
-                image = np.reshape(RHO, [NX, NY])
-            if NZ > 1:
-                image = np.reshape(RHO, [NX, NY, NZ])
+            kCartesian = self.mapVals['kCartesian']
+
+            # Iterative least-squares reconstruction with the nufft operator, starting from the gridded image
+            gridder = get_gridder(kS, kCartesian, nPoints, axes=tuple(np.where(np.ptp(kS, axis=0) > 0)[0]))
+            rho = cg_reconstruction(gridder, signal, lbda=self.mapVals['cgLambda'], n_iter=self.mapVals['cgIter'])
+
+            # Get the image with the same layout than the FFT reconstruction
+            phase = np.exp(-2 * np.pi * 1j * (kCartesian @ dfov))
+            kSpace = gridder.image2kspace(rho) * np.reshape(phase, (nPoints[2], nPoints[1], nPoints[0]))
+            image = ifftnc(kSpace)
+            self.mapVals['kSpaceArray'] = kSpace
+            self.mapVals['ImageART'] = image
 
         if axes[0] == 0 and axes[1] == 2:
             axislegend = ['Z', 'X']
@@ -555,7 +523,7 @@ class PETRA(blankSeq.MRIBLANKSEQ):
             result2 = {}
             result2['widget'] = 'curve'
             result2['xData'] = pos
-            result2['yData'] = [np.abs(np.fft.ifftshift(np.fft.ifftn(np.fft.ifftshift(self.valCartesian))))]
+            result2['yData'] = [np.abs(ifftnc(self.valCartesian))]
             result2['xLabel'] = 'Position (cm)'
             result2['yLabel'] = "Amplitude (a.u.)"
             result2['title'] = "Spectrum"
@@ -27,7 +27,8 @@ import configs.units as units
 import scipy.signal as sig
 import experiment as ex
 import configs.hw_config as hw
-from marga_pulseq.interpreter import PSInterpreter
+from manager.pulseqmanager import SequenceInterpreter, read_seq_header
+from manager.rxmanager import RxBuffer
 
 
 class PulseqReader(blankSeq.MRIBLANKSEQ):
@@ -65,13 +66,13 @@ class PulseqReader(blankSeq.MRIBLANKSEQ):
         self.files = [s.strip() for s in self.files]
 
     def sequenceRun(self, plotSeq=0, demo=False, standalone=False):
-        init_gpa = False
         self.demo = demo
 
         # Step 1: Define the interpreter for FloSeq/PSInterpreter.
         # The interpreter is responsible for converting the high-level pulse sequence description into low-level
         # instructions for the scanner hardware. You will typically update the interpreter during scanner calibration.
-        self.flo_interpreter = PSInterpreter(
+        # Large files are interpreted in chunks of blocks that fit into the hardware limits.
+        self.flo_interpreter = SequenceInterpreter(
             tx_warmup=hw.blkTime,  # Transmit chain warm-up time (us)
             rf_center=hw.larmorFreq * 1e6,  # Larmor frequency (Hz)
             rf_amp_max=hw.b1Efficiency / (2 * np.pi) * 1e6,  # Maximum RF amplitude (Hz)
@@ -82,90 +83,63 @@ class PulseqReader(blankSeq.MRIBLANKSEQ):
             grad_t=100,  # Gradient raster time (us)
         )
 
-        # Function to get the dwell time
-        def get_seq_info(file_path):
-            dwell_time = None
-            with open(file_path, 'r') as file:
-                lines = file.readlines()
-                adc_section = False
+        # Get the dwell time and readout points of the files without loading them
+        headers = [read_seq_header(file) for file in self.files]
+        data_over = RxBuffer(n_points=sum(header['n_rd_points'] for header in headers) * self.nScans,
+                             dtype=self.rx_dtype)  # To save oversampled data
 
-                for line in lines:
-                    if line.strip() == '[ADC]':
-                        adc_section = True
-                        continue
+        try:
+            for file, header in zip(self.files, headers):
+                print("Running " + file + "...")
+                dwell = header['dwell']  # ns
 
-                    if adc_section:
-                        # If we reach another section, stop processing ADC section
-                        if line.startswith('\n'):
-                            break
-
-                        # Split the line into components
-                        components = line.split()
-
-                        # Check if the line contains the ADC event data
-                        if len(components) >= 4:
-                            n_readouts = int(components[1])  # Extract the number of acquired points per Rx window
-                            dwell_time = int(components[2])  # Extract the dwell time (3rd component)
-
-            return n_readouts, dwell_time
-
-        data_over = []  # To save oversampled data
-        for file in self.files:
-            print("Running " + file + "...")
-            # Get the dwell time and n_readouts
-            n_readouts, dwell = get_seq_info(file)  # dwell is in ns
-
-            # Create experiment
-            if not self.demo:
-                self.expt = ex.Experiment(lo_freq=self.larmorFreq * 1e-6,  # MHz
-                                          rx_t=dwell * 1e-3,  # us
-                                          init_gpa=init_gpa,
-                                          gpa_fhdo_offset_time=(1 / 0.2 / 3.1),
-                                          )
-                dwell = self.expt.get_rx_ts()[0]
-            bw = 1/dwell * 1e9  # Hz
-            self.mapVals['samplingPeriod'] = dwell * 1e-9  # s
-            self.mapVals['bw'] = bw  # Hz
-
-            # Run the interpreter to get the waveforms
-            waveforms, param_dict = self.flo_interpreter.interpret(file)
-
-            # Get number of Rx windows
-            n_rx_windows = int(np.sum(waveforms['rx0_en'][1][:]))
-
-            # Convert waveform to mriBlankSeq tools (just do it)
-            self.pypulseq2mriblankseq(waveforms=waveforms, shimming=self.shimming)
-
-            if not self.demo:
-                if self.floDict2Exp():
-                    print("Sequence waveforms loaded successfully")
-                    pass
-                else:
-                    print("ERROR: sequence waveforms out of hardware bounds")
-                    return False
-
-            # Run the experiment
-            if not plotSeq:
-                for scan in range(self.nScans):
-                    print("Scan %i running..." % (scan + 1))
+                # Interpret and run the file chunk by chunk
+                chunks = self.flo_interpreter.interpret_chunks(file, hw.maxOrders, hw.maxRdPoints)
+                for chunk, (waveforms, param_dict) in enumerate(chunks):
+                    # Create experiment, the connection is kept for all the chunks of the file
+                    if not self.demo:
+                        rewrite = self.getExperiment(lo_freq=self.larmorFreq * 1e-6,  # MHz
+                                                     rx_t=header['dwell'] * 1e-3)  # us
+                        dwell = self.expt.get_rx_ts()[0] * 1e3  # ns
+                    bw = 1/dwell * 1e9  # Hz
+                    self.mapVals['samplingPeriod'] = dwell * 1e-9  # s
+                    self.mapVals['bw'] = bw  # Hz
+
+                    # Get number of Rx windows
+                    n_rx_windows = int(np.sum(waveforms['rx0_en'][1][:]))
+
+                    # Convert waveform to mriBlankSeq tools (just do it)
+                    self.pypulseq2mriblankseq(waveforms=waveforms, shimming=self.shimming)
+
+                    if not self.checkFloDict():
+                        print("ERROR: sequence waveforms out of hardware bounds")
+                        return False
                     if not self.demo:
-                        rxd, msgs = self.expt.run()
-                        rxd['rx0'] = hw.adcFactor * (np.real(rxd['rx0']) - 1j * np.imag(rxd['rx0']))
-                    else:
-                        rxd = {'rx0': np.random.randn(n_readouts * n_rx_windows) +
-                                      1j * np.random.randn(n_readouts * n_rx_windows)}
-                    data_over = np.concatenate((data_over, rxd['rx0']), axis=0)
-                    print("Acquired points = %i" % np.size([rxd['rx0']]))
-                    print("Expected points = %i" % n_readouts * n_rx_windows)
-                    print("Scan %i ready!" % (scan + 1))
-                    self.mapVals['data_over'] = data_over
-            elif plotSeq and standalone:
-                self.sequencePlot(standalone=standalone)
-                return True
+                        self.uploadFloDict(self.flo_dict, rewrite=rewrite)
+                    print("Sequence waveforms loaded successfully")
 
+                    # Run the experiment
+                    if not plotSeq:
+                        for scan in range(self.nScans):
+                            print("Chunk %i/%i, scan %i running..." % (chunk + 1, param_dict['n_chunks'], scan + 1))
+                            if not self.demo:
+                                rxd, msgs = self.expt.run()
+                                rxd['rx0'] = hw.adcFactor * np.conj(rxd['rx0'])
+                            else:
+                                rxd = {'rx0': np.random.randn(header['n_readouts'] * n_rx_windows) +
+                                              1j * np.random.randn(header['n_readouts'] * n_rx_windows)}
+                            data_over.write(rxd['rx0'])
+                            print("Acquired points = %i" % np.size([rxd['rx0']]))
+                            print("Expected points = %i" % (header['n_readouts'] * n_rx_windows))
+                            print("Scan %i ready!" % (scan + 1))
+                            self.mapVals['data_over'] = data_over.data
+                    elif plotSeq and standalone:
+                        self.sequencePlot(standalone=standalone)
+                        return True
+        finally:
             # Close the experiment
             if not self.demo:
-                self.expt.__del__()
+                self.closeExperiment()
 
         return True
 
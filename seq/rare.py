@@ -28,6 +28,8 @@ from scipy.stats import linregress
 import configs.hw_config as hw # Import the scanner hardware config
 import configs.units as units
 import seq.mriBlankSeq as blankSeq  # Import the mriBlankSequence for any new sequence.
+from manager.decimationmanager import StreamDecimator
+from manager.rxmanager import RxBufferPool
 
 from datetime import date
 from datetime import datetime
@@ -38,6 +40,8 @@ import ctypes
 import matplotlib
 import xml.etree.ElementTree as ET
 from scipy.io import loadmat
+from manager.fftmanager import ifftnc, fftnc
+from manager.mrdmanager import append_acquisitions, get_rare_header
 
 #*********************************************************************************
 #*********************************************************************************
@@ -240,147 +244,101 @@ class RARE(blankSeq.MRIBLANKSEQ):
         k_rd_xyz = np.ones((3, self.nPoints[0]*self.nPoints[1]*nSL))*hw.gammaB
 
         def createSequence(phIndex=0, slIndex=0, lnIndex=0, repeIndexGlobal=0):
-            repeIndex = 0
-            acqPoints = 0
-            orders = 0
-
             # Check in case of dummy pulse fill the cache
             if (self.dummyPulses>0 and self.etl*nRD*2>hw.maxRdPoints) or (self.dummyPulses==0 and self.etl*nRD>hw.maxRdPoints):
                 print('ERROR: Too many acquired points.')
                 return 0
 
-            # Set shimming
-            self.iniSequence(20, self.shimming)
-            while acqPoints+self.etl*nRD<=hw.maxRdPoints and orders<=hw.maxOrders and repeIndexGlobal<nRepetitions:
-                # Initialize time
-                tEx = self.repetitionTime+self.repetitionTime*repeIndex+self.inversionTime+self.preExTime
-
-                # First I do a noise measurement.
-                if repeIndex==0:
-                    t0 = 40
-                    self.rxGate(t0, self.acqTime+2*addRdPoints/BW)
-                    acqPoints += nRD
-
-                # Pre-excitation pulse
-                if repeIndex>=self.dummyPulses and self.preExTime!=0:
-                    t0 = tEx-self.preExTime-self.inversionTime-self.rfExTime/2-hw.blkTime
-                    self.rfRecPulse(t0, self.rfExTime, rfExAmp, 0)
-                    self.gradTrap(t0 + hw.blkTime + self.rfReTime, gradRiseTime, self.preExTime * 0.5, -0.005, gSteps,
-                                  self.axesOrientation[0], self.shimming)
-                    self.gradTrap(t0 + hw.blkTime + self.rfReTime, gradRiseTime, self.preExTime * 0.5, -0.005, gSteps,
-                                  self.axesOrientation[1], self.shimming)
-                    self.gradTrap(t0 + hw.blkTime + self.rfReTime, gradRiseTime, self.preExTime * 0.5, -0.005, gSteps,
-                                  self.axesOrientation[2], self.shimming)
-                orders = orders+gSteps*6
-
-                # Inversion pulse
-                if repeIndex>=self.dummyPulses and self.inversionTime!=0:
-                    t0 = tEx-self.inversionTime-self.rfReTime/2-hw.blkTime
-                    self.rfRecPulse(t0, self.rfReTime, rfReAmp, 0)
-                    self.gradTrap(t0 + hw.blkTime + self.rfReTime, gradRiseTime, self.inversionTime * 0.5, 0.005,
-                                  gSteps, self.axesOrientation[0], self.shimming)
-                    self.gradTrap(t0 + hw.blkTime + self.rfReTime, gradRiseTime, self.inversionTime * 0.5, 0.005,
-                                  gSteps, self.axesOrientation[1], self.shimming)
-                    self.gradTrap(t0 + hw.blkTime + self.rfReTime, gradRiseTime, self.inversionTime * 0.5, 0.005,
-                                  gSteps, self.axesOrientation[2], self.shimming)
-                orders = orders+gSteps*6
-
-                # Excitation pulse
-                t0 = tEx-hw.blkTime-self.rfExTime/2
-                self.rfRecPulse(t0,self.rfExTime,rfExAmp,0)
-
-                # Dephasing readout
-                gradAmp = np.array([0.0, 0.0, 0.0])
-                gradAmp[self.axesOrientation[0]] = rdDephAmplitude
-                gradAmp = np.dot(rot, np.reshape(gradAmp, (3, 1)))
-                if repeIndex==(self.dummyPulses-1) or repeIndex>=self.dummyPulses:
-                    t0 = tEx+self.rfExTime/2-hw.gradDelay
-                    self.gradTrap(t0, gradRiseTime, self.rdDephTime, gradAmp[0] * self.rdPreemphasis, gSteps,
-                                  0, self.shimming)
-                    self.gradTrap(t0, gradRiseTime, self.rdDephTime, gradAmp[1] * self.rdPreemphasis, gSteps,
-                                  1, self.shimming)
-                    self.gradTrap(t0, gradRiseTime, self.rdDephTime, gradAmp[2] * self.rdPreemphasis, gSteps,
-                                  2, self.shimming)
-                    orders = orders+gSteps*6
-
-                # Echo train
-                for echoIndex in range(self.etl):
-                    tEcho = tEx+self.echoSpacing*(echoIndex+1)
-
-                    # Refocusing pulse
-                    t0 = tEcho-self.echoSpacing/2-self.rfReTime/2-hw.blkTime
-                    self.rfRecPulse(t0, self.rfReTime, rfReAmp, np.pi/2+self.rfPhase*np.pi/180)
-
-                    # Dephasing phase and slice gradients
-                    gradAmp = np.array([0.0, 0.0, 0.0])
-                    gradAmp[self.axesOrientation[1]] = phGradients[phIndex]
-                    gradAmp[self.axesOrientation[2]] = slGradients[slIndex]
-                    gradAmp = np.dot(rot, np.reshape(gradAmp, (3, 1)))
-                    if repeIndex>=self.dummyPulses:         # This is to account for dummy pulses
-                        t0 = tEcho-self.echoSpacing/2+self.rfReTime/2-hw.gradDelay
-                        self.gradTrap(t0, gradRiseTime, self.phGradTime, gradAmp[0], gSteps, 0, self.shimming)
-                        self.gradTrap(t0, gradRiseTime, self.phGradTime, gradAmp[1], gSteps, 1, self.shimming)
-                        self.gradTrap(t0, gradRiseTime, self.phGradTime, gradAmp[2], gSteps, 2, self.shimming)
-                        orders = orders+gSteps*6
-                        # get k-point
-                        k_ph_sl_xyz[:, self.nPoints[0]*lnIndex:self.nPoints[0]*(lnIndex+1)] = \
-                            np.diag(np.reshape(gradAmp, -1)) @ \
-                            k_ph_sl_xyz[:, self.nPoints[0] * lnIndex:self.nPoints[0] * (lnIndex + 1)]
-
-                    # Readout gradient
-                    gradAmp = np.array([0.0, 0.0, 0.0])
-                    gradAmp[self.axesOrientation[0]] = rdGradAmplitude
-                    gradAmp = np.dot(rot, np.reshape(gradAmp, (3, 1)))
-                    if repeIndex==(self.dummyPulses-1) or repeIndex>=self.dummyPulses:         # This is to account for dummy pulses
-                        t0 = tEcho-self.rdGradTime/2-gradRiseTime-hw.gradDelay+self.echo_shift
-                        self.gradTrap(t0, gradRiseTime, self.rdGradTime, gradAmp[0], gSteps, 0, self.shimming)
-                        self.gradTrap(t0, gradRiseTime, self.rdGradTime, gradAmp[1], gSteps, 1, self.shimming)
-                        self.gradTrap(t0, gradRiseTime, self.rdGradTime, gradAmp[2], gSteps, 2, self.shimming)
-                        orders = orders+gSteps*6
-
-                    # Rx gate
-                    if repeIndex==(self.dummyPulses-1) or repeIndex>=self.dummyPulses:
-                        t0 = tEcho-self.acqTime/2-addRdPoints/BW+self.echo_shift
-                        self.rxGate(t0, self.acqTime+2*addRdPoints/BW)
-                        acqPoints += nRD
-
-                    if repeIndex>=self.dummyPulses:
-                        k_rd_xyz[:, self.nPoints[0] * lnIndex:self.nPoints[0] * (lnIndex + 1)] = \
-                            np.diag(np.reshape(gradAmp, -1)) @ \
-                            k_rd_xyz[:, self.nPoints[0] * lnIndex:self.nPoints[0] * (lnIndex + 1)]  @ \
-                            np.diag(self.time_vector)
-
-                    # Rephasing phase and slice gradients
-                    gradAmp = np.array([0.0, 0.0, 0.0])
-                    gradAmp[self.axesOrientation[1]] = phGradients[phIndex]
-                    gradAmp[self.axesOrientation[2]] = slGradients[slIndex]
-                    gradAmp = np.dot(rot, np.reshape(gradAmp, (3, 1)))
-                    t0 = tEcho+self.rdGradTime/2+gradRiseTime-hw.gradDelay+self.echo_shift
-                    if (echoIndex<self.etl-1 and repeIndex>=self.dummyPulses):
-                        self.gradTrap(t0, gradRiseTime, self.phGradTime, -gradAmp[0], gSteps, 0, self.shimming)
-                        self.gradTrap(t0, gradRiseTime, self.phGradTime, -gradAmp[1], gSteps, 1, self.shimming)
-                        self.gradTrap(t0, gradRiseTime, self.phGradTime, -gradAmp[2], gSteps, 2, self.shimming)
-                        orders = orders+gSteps*6
-                    elif(echoIndex==self.etl-1 and repeIndex>=self.dummyPulses):
-                        self.gradTrap(t0, gradRiseTime, self.phGradTime, gradAmp[0], gSteps, 0, self.shimming)
-                        self.gradTrap(t0, gradRiseTime, self.phGradTime, gradAmp[1], gSteps, 1, self.shimming)
-                        self.gradTrap(t0, gradRiseTime, self.phGradTime, gradAmp[2], gSteps, 2, self.shimming)
-                        orders = orders+gSteps*6
-
-                    # Update the phase and slice gradient
-                    if repeIndex>=self.dummyPulses:
-                        lnIndex +=1
-                        if phIndex == nPH-1:
-                            phIndex = 0
-                            slIndex += 1
-                        else:
-                            phIndex += 1
-                if repeIndex>=self.dummyPulses: 
-                    repeIndexGlobal += 1 # Update the global repeIndex
-                repeIndex+=1 # Update the repeIndex after the ETL
-
-            # Turn off the gradients after the end of the batch
-            self.endSequence((repeIndex+1)*self.repetitionTime)
+            def addRepetitions(repeIndex):
+                # Timing of the batch: one row per repetition and one column per echo
+                repetitions = np.reshape(np.arange(repeIndex), (-1, 1))
+                acquire = repetitions>=self.dummyPulses
+                readout = acquire | (repetitions==(self.dummyPulses-1))
+                tEx = self.repetitionTime+self.repetitionTime*repetitions+self.inversionTime+self.preExTime
+                tEcho = tEx+self.echoSpacing*(np.arange(self.etl)+1)
+                tPreEx = tEx-self.preExTime-self.inversionTime-self.rfExTime/2-hw.blkTime
+                tInv = tEx-self.inversionTime-self.rfReTime/2-hw.blkTime
+
+                def echoTrain(*events):
+                    # Interleave the events of each echo to keep them sorted in time
+                    events = np.broadcast_arrays(tEcho, *events)[1::]
+                    return np.reshape(np.stack(events, axis=2), (repeIndex, -1))
+
+                def batchArray(*columns):
+                    # Join the events of each repetition to keep them sorted in time
+                    columns = [np.broadcast_to(column, (repeIndex, np.shape(column)[-1])) for column in columns]
+                    return np.concatenate(columns, axis=1)
+
+                # Phase and slice gradients of the acquired lines
+                lines = slIndex*nPH+phIndex+np.arange(np.sum(acquire)*self.etl)
+                phSlAmp = np.zeros((3, repeIndex, self.etl))
+                phSlAmp[:, acquire[:, 0], :] = np.reshape(np.outer(rot[:, self.axesOrientation[1]], phGradients[lines%nPH]) +
+                                                          np.outer(rot[:, self.axesOrientation[2]], slGradients[lines//nPH]),
+                                                          (3, -1, self.etl))
+                phSlSign = -np.ones(self.etl)
+                phSlSign[-1] = 1
+
+                # Set shimming
+                self.iniSequence(20, self.shimming)
+
+                # Rf pulses: pre-excitation, inversion, excitation and refocusing pulses
+                rfTime = batchArray(tPreEx, tInv, tEx-hw.blkTime-self.rfExTime/2,
+                                    tEcho-self.echoSpacing/2-self.rfReTime/2-hw.blkTime)
+                rfDuration = batchArray([self.rfExTime, self.rfReTime, self.rfExTime], [self.rfReTime]*self.etl)
+                rfAmp = batchArray([rfExAmp, rfReAmp, rfExAmp], [rfReAmp]*self.etl)
+                rfPhase = batchArray([0, 0, 0], [np.pi/2+self.rfPhase*np.pi/180]*self.etl)
+                rfMask = batchArray(acquire & (self.preExTime!=0), acquire & (self.inversionTime!=0), [True]*(self.etl+1))
+                self.rfRecPulseTrain(rfTime[rfMask], rfDuration[rfMask], rfAmp[rfMask], rfPhase[rfMask])
+
+                # Gradients: pre-excitation, inversion, readout dephasing and echoes (dephasing, readout and rephasing)
+                gTime = batchArray(tPreEx+hw.blkTime+self.rfReTime, tInv+hw.blkTime+self.rfReTime,
+                                   tEx+self.rfExTime/2-hw.gradDelay,
+                                   echoTrain(tEcho-self.echoSpacing/2+self.rfReTime/2-hw.gradDelay,
+                                             tEcho-self.rdGradTime/2-gradRiseTime-hw.gradDelay+self.echo_shift,
+                                             tEcho+self.rdGradTime/2+gradRiseTime-hw.gradDelay+self.echo_shift))
+                gFlat = batchArray([self.preExTime*0.5, self.inversionTime*0.5, self.rdDephTime],
+                                   [self.phGradTime, self.rdGradTime, self.phGradTime]*self.etl)
+                gMask = batchArray(acquire & (self.preExTime!=0), acquire & (self.inversionTime!=0), readout,
+                                   echoTrain(acquire, readout, acquire))
+                for axis in range(3):
+                    gAmp = batchArray([-0.005, 0.005, rdVector[axis]*rdDephAmplitude*self.rdPreemphasis],
+                                      echoTrain(phSlAmp[axis], rdVector[axis]*rdGradAmplitude, phSlSign*phSlAmp[axis]))
+                    self.gradTrapTrain(gTime[gMask], gradRiseTime, gFlat[gMask], gAmp[gMask], gSteps, axis,
+                                       self.shimming)
+
+                # Rx gates: noise measurement and echoes
+                self.rxGate(40, self.acqTime+2*addRdPoints/BW)
+                tRx = tEcho-self.acqTime/2-addRdPoints/BW+self.echo_shift
+                self.rxGateTrain(tRx[readout[:, 0], :], self.acqTime+2*addRdPoints/BW)
+
+                # Turn off the gradients after the end of the batch
+                self.endSequence((repeIndex+1)*self.repetitionTime)
+
+                return phSlAmp[:, acquire[:, 0], :], np.sum(readout)
+
+            # Get the number of repetitions that fit into the batch
+            rdVector = rot[:, self.axesOrientation[0]]
+            nAcquired = self.getBatchSize(lambda n: addRepetitions(self.dummyPulses+n), nRepetitions-repeIndexGlobal,
+                                          1/BW)
+            if nAcquired==0:
+                print('ERROR: Too many instructions in a single repetition.')
+                return 0
+
+            # Create the batch
+            phSlAmp, nReadouts = addRepetitions(self.dummyPulses+nAcquired)
+            acqPoints = nRD+nReadouts*self.etl*nRD
+            repeIndexGlobal += nAcquired
+            nLines = nAcquired*self.etl
+
+            # Get k-points
+            k_ph_sl = np.reshape(k_ph_sl_xyz, (3, -1, self.nPoints[0]))
+            k_ph_sl[:, lnIndex:lnIndex+nLines, :] *= np.reshape(phSlAmp, (3, -1, 1))
+            k_rd = np.reshape(k_rd_xyz, (3, -1, self.nPoints[0]))
+            k_rd[:, lnIndex:lnIndex+nLines, :] *= np.reshape(rdVector*rdGradAmplitude, (3, 1, 1))*self.time_vector
+
+            # Update the phase and slice indexes
+            lnIndex += nLines
+            phIndex, slIndex = (slIndex*nPH+phIndex+nLines)%nPH, (slIndex*nPH+phIndex+nLines)//nPH
 
             # Return the output variables
             return(phIndex, slIndex, lnIndex, repeIndexGlobal, acqPoints)
@@ -404,9 +362,12 @@ class RARE(blankSeq.MRIBLANKSEQ):
         # Create full sequence
         # Run the experiment
         dataFull = []
-        dummyData = []
-        overData = []
-        noise = []
+        # Preallocated buffers for the noise, dummy pulses and oversampled data, decimated as the scans arrive
+        rx_buffers = RxBufferPool(dtype=self.rx_dtype,
+                                  noise=nRD*hw.oversamplingFactor*self.nScans,
+                                  dummy=nRD*self.etl*hw.oversamplingFactor*self.nScans*(self.dummyPulses>0))
+        decimator = StreamDecimator(n_points=nRD*nPH*nSL*hw.oversamplingFactor*self.nScans, keep_input=True,
+                                    dtype=self.rx_dtype)
         nBatches = 0
         repeIndexArray = np.array([0])
         repeIndexGlobal = repeIndexArray[0]
@@ -452,7 +413,7 @@ class RARE(blankSeq.MRIBLANKSEQ):
                         acq_points = 0
                         while acq_points != (aa * hw.oversamplingFactor):
                             rxd, msgs = self.expt.run()
-                            rxd['rx0'] = rxd['rx0']*hw.adcFactor   # Here I normalize to get the result in mV
+                            rxd['rx0'] *= hw.adcFactor   # Here I normalize to get the result in mV
                             acq_points = np.size(rxd['rx0'])
                             print("Acquired points = %i" % acq_points)
                             print("Expected points = %i" % (aa * hw.oversamplingFactor))
@@ -464,14 +425,14 @@ class RARE(blankSeq.MRIBLANKSEQ):
                         rxd['rx0'] = np.random.randn(aa*hw.oversamplingFactor) + 1j * np.random.randn(aa*hw.oversamplingFactor)
                         print("Batch %i, scan %i ready!" % (nBatches, ii+1))
                     # Get noise data
-                    noise = np.concatenate((noise, rxd['rx0'][0:nRD*hw.oversamplingFactor]), axis = 0)
+                    rx_buffers.write('noise', rxd['rx0'][0:nRD*hw.oversamplingFactor])
                     rxd['rx0'] = rxd['rx0'][nRD*hw.oversamplingFactor::]
                     # Get data
                     if self.dummyPulses>0:
-                        dummyData = np.concatenate((dummyData, rxd['rx0'][0:nRD*self.etl*hw.oversamplingFactor]), axis = 0)
-                        overData = np.concatenate((overData, rxd['rx0'][nRD*self.etl*hw.oversamplingFactor::]), axis = 0)
+                        rx_buffers.write('dummy', rxd['rx0'][0:nRD*self.etl*hw.oversamplingFactor])
+                        decimator.feed(rxd['rx0'][nRD*self.etl*hw.oversamplingFactor::])
                     else:
-                        overData = np.concatenate((overData, rxd['rx0']), axis = 0)
+                        decimator.feed(rxd['rx0'])
             # elif plotSeq and standalone:
             #     self.plotSequence()
 
@@ -481,12 +442,13 @@ class RARE(blankSeq.MRIBLANKSEQ):
         if not plotSeq:
             acqPointsPerBatch= (np.array(acqPointsPerBatch)-self.etl*nRD*(self.dummyPulses>0)-nRD)*self.nScans
             print('Scans ready!')
-            self.mapVals['noiseData'] = noise
+            self.mapVals['noiseData'] = rx_buffers.get_data('noise')
+            overData = decimator.data_over
             self.mapVals['overData'] = overData
 
             # Fix the echo position using oversampled data
             if self.dummyPulses>0:
-                dummyData = np.reshape(dummyData,  (nBatches*self.nScans, self.etl, nRD*hw.oversamplingFactor))
+                dummyData = np.reshape(rx_buffers.get_data('dummy'),  (nBatches*self.nScans, self.etl, nRD*hw.oversamplingFactor))
                 dummyData = np.average(dummyData, axis=0)
                 self.mapVals['dummyData'] = dummyData
                 overData = np.reshape(overData, (-1, self.etl, nRD*hw.oversamplingFactor))
@@ -496,61 +458,30 @@ class RARE(blankSeq.MRIBLANKSEQ):
                     self.dummyAnalysis()
 
             # Generate dataFull
-            dataFull = sig.decimate(overData, hw.oversamplingFactor, ftype='fir', zero_phase=True)
-        
-            if nBatches>1:
-                dataFullA = dataFull[0:sum(acqPointsPerBatch[0:-1])]
-                dataFullB = dataFull[sum(acqPointsPerBatch[0:-1])::]
-                
-            
-            # Reorganize dataFull
-            dataProv = np.zeros([self.nScans,nSL*nPH*nRD])
-            dataProv = dataProv+1j*dataProv
-            if nBatches>1:
-                dataFullA = np.reshape(dataFullA, (nBatches-1, self.nScans, -1, nRD))
-                dataFullB = np.reshape(dataFullB, (1, self.nScans, -1, nRD))
-            else:
-                dataFull = np.reshape(dataFull, (nBatches, self.nScans, -1, nRD))
-            for scan in range(self.nScans):
-                if nBatches>1:
-                    dataProv[scan, :] = np.concatenate((np.reshape(dataFullA[:,scan,:,:],-1), np.reshape(dataFullB[:,scan,:,:],-1)), axis=0)
-                else:
-                    dataProv[scan, :] = np.reshape(dataFull[:,scan,:,:],-1)
-            dataFull = np.reshape(dataProv,-1)
-            
+            dataFull = decimator.finish()
+
+            # Assemble the readouts of all the batches and scans in acquisition order and in k-space order
+            readoutsPerBatch = np.array(acqPointsPerBatch) // (self.nScans*nRD)
+            acqMap = self.getKSpaceMap(readoutsPerBatch, self.nScans)
+            lines = np.reshape(np.arange(nSL)[:, np.newaxis]*nPH + ind[np.newaxis, :], -1)
+            kMap = self.getKSpaceMap(readoutsPerBatch, self.nScans, lines=lines, n_lines=nSL*nPH)
+
             # Save dataFull to save it in .h5 ########################################################""
-            self.dataFullmat = dataFull
+            self.dataFullmat = np.reshape(self.assembleKSpace(dataFull, acqMap, nRD), -1)
+            dataFull = np.reshape(self.assembleKSpace(dataFull, kMap, nRD), (self.nScans, nSL, nPH, nRD))
 
             # Get index for krd = 0
             # Average data
-            dataProv = np.reshape(dataFull, (self.nScans, nRD*nPH*nSL))
-            dataProv = np.average(dataProv, axis=0)
-            # Reorganize the data acording to sweep mode
-            dataProv = np.reshape(dataProv, (nSL, nPH, nRD))
-            
-            dataTemp = dataProv*0
-            for ii in range(nPH):
-                dataTemp[:, ind[ii], :] = dataProv[:,  ii, :]
-            dataProv = dataTemp
-           
-
-            dataProv = dataProv[int(self.nPoints[2]/2), int(nPH/2), :] 
+            dataProv = np.average(dataFull, axis=0)
+            dataProv = dataProv[int(self.nPoints[2]/2), int(nPH/2), :]
             indkrd0 = np.argmax(np.abs(dataProv))
             if indkrd0 < nRD/2-addRdPoints or indkrd0 > nRD/2+addRdPoints:
                 indkrd0 = int(nRD/2)
 
             # Get individual images
-            dataFull = np.reshape(dataFull, (self.nScans, nSL, nPH, nRD))
-            dataFull = dataFull[:, :, :, indkrd0-int(self.nPoints[0]/2):indkrd0+int(self.nPoints[0]/2)] 
-            dataTemp = dataFull*0
-            for ii in range(nPH):
-                dataTemp[:, :, ind[ii], :] = dataFull[:, :,  ii, :]
-            dataFull = dataTemp
-            imgFull = dataFull*0
-            for ii in range(self.nScans):
-                imgFull[ii, :, :, :] = np.fft.ifftshift(np.fft.ifftn(np.fft.ifftshift(dataFull[ii, :, :, :])))
-            self.mapVals['dataFull'] = dataFull 
-            self.mapVals['imgFull'] = imgFull 
+            dataFull = dataFull[:, :, :, indkrd0-int(self.nPoints[0]/2):indkrd0+int(self.nPoints[0]/2)]
+            self.mapVals['dataFull'] = dataFull
+            self.setLazyVal('imgFull', lambda: ifftnc(dataFull, axes=(1, 2, 3)))
 
             # Average data
             data = np.average(dataFull, axis=0)
@@ -586,7 +517,7 @@ class RARE(blankSeq.MRIBLANKSEQ):
             dPhase = np.exp(-2*np.pi*1j*(self.dfov[0]*kRD+self.dfov[1]*kPH+self.dfov[2]*kSL))
             data = np.reshape(data*dPhase, (self.nPoints[2], self.nPoints[1], self.nPoints[0]))
             self.mapVals['kSpace3D'] = data
-            img=np.fft.ifftshift(np.fft.ifftn(np.fft.ifftshift(data)))
+            img=ifftnc(data)
             self.mapVals['image3D'] = img
             data = np.reshape(data, (1, self.nPoints[0]*self.nPoints[1]*self.nPoints[2]))
 
@@ -625,7 +556,7 @@ class RARE(blankSeq.MRIBLANKSEQ):
             tVector = np.linspace(-acqTime/2, acqTime/2, nPoints[0])
             sVector = self.mapVals['sampled'][:, 3]
             fVector = np.linspace(-bw/2, bw/2, nPoints[0])
-            iVector = np.fft.ifftshift(np.fft.ifftn(np.fft.ifftshift(sVector)))
+            iVector = ifftnc(sVector)
 
             # Plots to show into the GUI
             result1 = {}
@@ -831,7 +762,7 @@ class RARE(blankSeq.MRIBLANKSEQ):
         image_3d = np.reshape(image[3, :], self.nPoints[-1::-1])
         
         # Generate k-space
-        kspace_3d = np.fft.fftshift(np.fft.fftn(np.fft.fftshift(image_3d)))
+        kspace_3d = fftnc(image_3d)
         
         kspace = np.reshape(kspace_3d, (1, -1))
         
@@ -855,8 +786,8 @@ class RARE(blankSeq.MRIBLANKSEQ):
         dummy2 = dummy_pulses[1, 10:-10]
 
         # Calculate 1d projections from odd and even echoes
-        proj1 = np.fft.ifftshift(np.fft.ifftn(np.fft.ifftshift(dummy1)))
-        proj2 = np.fft.ifftshift(np.fft.ifftn(np.fft.ifftshift(dummy2)))
+        proj1 = ifftnc(dummy1)
+        proj2 = ifftnc(dummy2)
         proj1 = proj1 / np.max(np.abs(proj1))
         proj2 = proj2 / np.max(np.abs(proj2))
         proj1[np.abs(proj1) < 0.1] = 0
@@ -893,11 +824,10 @@ class RARE(blankSeq.MRIBLANKSEQ):
         1. Generate a timestamp-based filename and directory path for the output file.
         2. Initialize the ISMRMRD dataset with the generated path.
         3. Populate the header and write the XML header to the dataset. Informations can be added.
-        4. Reshape the raw data matrix and iterate over scans, slices, and phases to write each acquisition. WARNING : RARE sequence follows ind order to fill the k-space.
-        5. Set acquisition flags and properties.
-        6. Append the acquisition data to the dataset.
-        7. Reshape and save the reconstructed images.
-        8. Close the dataset.
+        4. Build the headers of all the acquisitions (scans, slices and phases) with their flags and properties. WARNING : RARE sequence follows ind order to fill the k-space.
+        5. Append the raw data matrix and the headers to the dataset in blocks.
+        6. Reshape and save the reconstructed images.
+        7. Close the dataset.
 
         Attribute:
         - self.data_full_mat (numpy.array): Full matrix of raw data to be reshaped and saved.
@@ -927,7 +857,6 @@ class RARE(blankSeq.MRIBLANKSEQ):
         nPH = self.nPoints[1]
         nSL = self.nPoints[2]
         ind = self.getIndex(self.etl, nPH, self.sweepMode)
-        nRep = (nPH//etl)*nSL
         bw = self.mapVals['bw']
         
         axesOrientation = self.axesOrientation
@@ -1025,71 +954,18 @@ class RARE(blankSeq.MRIBLANKSEQ):
                 
         
         
-        new_data = np.zeros((nPH * nSL * nScans, nRD + 2*self.addRdPoints))
-        new_data = np.reshape(self.dataFullmat, (nScans, nSL, nPH, nRD+ 2*self.addRdPoints))
-        
-        counter=0  
-        for scan in range(nScans):
-            for slice_idx in range(nSL):
-                for phase_idx in range(nPH):
-                    
-                    line = new_data[scan, slice_idx, phase_idx, :]
-                    line2d = np.reshape(line, (1, nRD+2*self.addRdPoints))
-                    acq = ismrmrd.Acquisition.from_array(line2d, None)
-                    
-                    index_in_repetition = phase_idx % etl
-                    current_repetition = (phase_idx // etl) + (slice_idx * (nPH // etl))
-                    
-                    acq.clearAllFlags()
-                    
-                    if index_in_repetition == 0: 
-                        acq.setFlag(ismrmrd.ACQ_FIRST_IN_CONTRAST)
-                    elif index_in_repetition == etl - 1:
-                        acq.setFlag(ismrmrd.ACQ_LAST_IN_CONTRAST)
-                    
-                    if ind[phase_idx]== 0:
-                        acq.setFlag(ismrmrd.ACQ_FIRST_IN_PHASE)
-                    elif ind[phase_idx] == nPH - 1:
-                        acq.setFlag(ismrmrd.ACQ_LAST_IN_PHASE)
-                    
-                    if slice_idx == 0:
-                        acq.setFlag(ismrmrd.ACQ_FIRST_IN_SLICE)
-                    elif slice_idx == nSL - 1:
-                        acq.setFlag(ismrmrd.ACQ_LAST_IN_SLICE)
-                        
-                    if int(current_repetition) == 0:
-                        acq.setFlag(ismrmrd.ACQ_FIRST_IN_REPETITION)
-                    elif int(current_repetition) == nRep - 1:
-                        acq.setFlag(ismrmrd.ACQ_LAST_IN_REPETITION)
-                        
-                    if scan == 0:
-                        acq.setFlag(ismrmrd.ACQ_FIRST_IN_AVERAGE)
-                    elif scan == nScans-1:
-                        acq.setFlag(ismrmrd.ACQ_LAST_IN_AVERAGE)
-                    
-                    
-                    counter += 1 
-                    
-                    # +1 to start at 1 instead of 0
-                    acq.idx.repetition = int(current_repetition + 1)
-                    acq.idx.kspace_encode_step_1 = ind[phase_idx]+1 # phase
-                    acq.idx.slice = slice_idx + 1
-                    acq.idx.contrast = index_in_repetition + 1
-                    acq.idx.average = scan + 1 # scan
-                    
-                    acq.scan_counter = counter
-                    acq.discard_pre = self.addRdPoints
-                    acq.discard_post = self.addRdPoints
-                    acq.sample_time_us = 1/bw
-                    self.dfov = np.array(self.dfov)
-                    acq.position = (ctypes.c_float * 3)(*self.dfov.flatten())
-
-                    
-                    acq.read_dir = (ctypes.c_float * 3)(*read_dir)
-                    acq.phase_dir = (ctypes.c_float * 3)(*phase_dir)
-                    acq.slice_dir = (ctypes.c_float * 3)(*slice_dir)
-                    
-                    dset.append_acquisition(acq) # Append the acquisition to the dataset
+        # Acquisitions sorted by scan, slice and phase, written in blocks
+        self.dfov = np.array(self.dfov)
+        header = get_rare_header(nScans, nSL, nPH, etl, ind)
+        header.update(discard_pre=self.addRdPoints,
+                      discard_post=self.addRdPoints,
+                      sample_time_us=1/bw,
+                      position=self.dfov.flatten(),
+                      read_dir=read_dir,
+                      phase_dir=phase_dir,
+                      slice_dir=slice_dir)
+        lines = np.reshape(self.dataFullmat, (nScans * nSL * nPH, nRD + 2*self.addRdPoints))
+        append_acquisitions(dset, lines, header)
                         
                         
         image=self.mapVals['image3D']
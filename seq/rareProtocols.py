@@ -28,6 +28,7 @@ import seq.mriBlankSeq as blankSeq  # Import the mriBlankSequence for any new se
 import pyqtgraph as pg
 import time
 from phantominator import shepp_logan
+from manager.fftmanager import ifftnc
 
 
 #*********************************************************************************
@@ -548,7 +549,7 @@ class RAREProtocols(blankSeq.MRIBLANKSEQ):
             dataFull = dataTemp
             imgFull = dataFull*0
             for ii in range(self.nScans):
-                imgFull[ii, :, :, :] = np.fft.ifftshift(np.fft.ifftn(np.fft.ifftshift(dataFull[ii, :, :, :])))
+                imgFull[ii, :, :, :] = ifftnc(dataFull[ii, :, :, :])
             self.mapVals['dataFull'] = dataFull
             self.mapVals['imgFull'] = imgFull
 
@@ -575,7 +576,7 @@ class RAREProtocols(blankSeq.MRIBLANKSEQ):
             dPhase = np.exp(-2*np.pi*1j*(self.dfov[0]*kRD-self.dfov[1]*kPH-self.dfov[2]*kSL))
             data = np.reshape(data*dPhase, (self.nPoints[2], self.nPoints[1], self.nPoints[0]))
             self.mapVals['kSpace3D'] = data
-            img=np.fft.ifftshift(np.fft.ifftn(np.fft.ifftshift(data)))
+            img=ifftnc(data)
             self.mapVals['image3D'] = img
             data = np.reshape(data, (1, self.nPoints[0]*self.nPoints[1]*self.nPoints[2]))
 
@@ -613,7 +614,7 @@ class RAREProtocols(blankSeq.MRIBLANKSEQ):
             tVector = np.linspace(-acqTime/2, acqTime/2, nPoints[0])
             sVector = self.mapVals['sampled'][:, 3]
             fVector = np.linspace(-bw/2, bw/2, nPoints[0])
-            iVector = np.fft.ifftshift(np.fft.ifftn(np.fft.ifftshift(sVector)))
+            iVector = ifftnc(sVector)
 
             # Plots to show into the GUI
             result1 = {}
@@ -28,14 +28,17 @@ from scipy.stats import linregress
 import configs.hw_config as hw # Import the scanner hardware config
 import configs.units as units
 import seq.mriBlankSeq as blankSeq  # Import the mriBlankSequence for any new sequence.
+from manager.flomanager import FloBudget
 
 from datetime import datetime
 import ismrmrd
 import ismrmrd.xsd
 import datetime
 import ctypes
-from marga_pulseq.interpreter import PSInterpreter
+from manager.pulseqmanager import SequenceInterpreter
 import pypulseq as pp
+from manager.fftmanager import ifftnc
+from manager.mrdmanager import append_acquisitions, get_rare_header
 
 #*********************************************************************************
 #*********************************************************************************
@@ -188,7 +191,7 @@ class RarePyPulseq(blankSeq.MRIBLANKSEQ):
         instructions for the scanner hardware.
         '''
 
-        flo_interpreter = PSInterpreter(
+        flo_interpreter = SequenceInterpreter(
             tx_warmup=hw.blkTime,  # Transmit chain warm-up time (us)
             rf_center=hw.larmorFreq * 1e6,  # Larmor frequency (Hz)
             rf_amp_max=hw.b1Efficiency / (2 * np.pi) * 1e6,  # Maximum RF amplitude (Hz)
@@ -261,9 +264,6 @@ class RarePyPulseq(blankSeq.MRIBLANKSEQ):
         if self.etl>n_ph:
             self.etl = n_ph
 
-        # Miscellaneous
-        n_rd_points_per_train = self.etl * n_rd
-
         # par_acq_lines in case par_acq_lines = 0
         par_acq_lines = int(int(self.nPoints[2]*self.parFourierFraction)-self.nPoints[2]/2)
         self.mapVals['partialAcquisition'] = par_acq_lines
@@ -641,12 +641,73 @@ class RarePyPulseq(blankSeq.MRIBLANKSEQ):
 
             return batch, n_rd_points, n_adc
 
+        # Echo trains of the slice and phase sweeps, given by the slice index and the first phase index
+        trains = [(sl_idx, ph_idx) for sl_idx in range(n_sl) for ph_idx in range(0, n_ph, self.etl)]
+
         '''
         Step 7: Define your createBatches method.
         In this step you will populate the batches adding the blocks previously defined in step 4, and accounting for
         number of acquired points to check if a new batch is required.
         '''
 
+        def create_batch(first, last):
+            """
+            Creates a single batch with the echo trains from `first` to `last` (excluded) of `trains`.
+
+            The batch starts with the noise acquisition and dummy pulses given by `initialize_batch()`, followed by the
+            echo trains, each one with its pre-excitation/inversion pulses (optional), excitation pulse, echo train with
+            the phase and slice gradients of the train, and repetition delay.
+
+            Returns:
+            --------
+            pp.Sequence
+                PyPulseq sequence of the batch.
+            """
+            batch, n_rd_points, n_adc = initialize_batch()
+            for sl_idx, ph_idx in trains[first:last]:
+                # Pre-excitation pulse
+                if self.preExTime > 0:
+                    gr_rd_preex = pp.scale_grad(block_gr_rd_preph, scale=+1.0)
+                    batch.add_block(block_rf_pre_excitation,
+                                    gr_rd_preex,
+                                    delay_pre_excitation)
+
+                # Inversion pulse
+                if self.inversionTime > 0:
+                    gr_rd_inv = pp.scale_grad(block_gr_rd_preph, scale=-1.0)
+                    batch.add_block(block_rf_inversion,
+                                    gr_rd_inv,
+                                    delay_inversion)
+
+                # Add excitation pulse and readout de-phasing gradient
+                batch.add_block(block_gr_rd_preph,
+                                block_rf_excitation,
+                                delay_preph)
+
+                # Add echo train
+                for echo in range(self.etl):
+                    # Fix the phase and slice amplitude
+                    gr_ph_deph = pp.scale_grad(block_gr_ph_deph, ph_gradients[ph_idx])
+                    gr_sl_deph = pp.scale_grad(block_gr_sl_deph, sl_gradients[sl_idx])
+                    gr_ph_reph = pp.scale_grad(block_gr_ph_reph, - ph_gradients[ph_idx])
+                    gr_sl_reph = pp.scale_grad(block_gr_sl_reph, - sl_gradients[sl_idx])
+
+                    # Add blocks
+                    batch.add_block(block_rf_refocusing,
+                                    block_gr_rd_reph,
+                                    gr_ph_deph,
+                                    gr_sl_deph,
+                                    block_adc_signal,
+                                    delay_reph)
+                    batch.add_block(gr_ph_reph,
+                                    gr_sl_reph)
+                    ph_idx += 1
+
+                # Add time delay to next repetition
+                batch.add_block(delay_tr)
+
+            return batch
+
         def create_batches():
             """
             Creates and processes multiple batches of MRI sequence blocks for slice and phase encoding sweeps.
@@ -660,31 +721,15 @@ class RarePyPulseq(blankSeq.MRIBLANKSEQ):
 
             Workflow:
             ---------
-            1. **Initialization**:
-                - Initializes dictionaries to store batches (`batches`), waveforms (`waveforms`), and readout points (`n_rd_points_dict`).
-                - Tracks the current readout point count (`n_rd_points`), ADC window count (`n_adc`), and batch index (`seq_idx`).
-
-            2. **Slice and Phase Sweep**:
-                - Iterates over slices (`n_sl`) and phases (`n_ph`) to build and organize sequence blocks:
-                    - **Batch Management**:
-                        - Creates a new batch if no batch exists or the current batch exceeds the hardware limit (`hw.maxRdPoints`).
-                        - Writes the previous batch to disk, interprets it using `flo_interpreter`, and updates dictionaries.
-                        - Initializes the next batch with `initializeBatch()`.
-
-                    - **Pre-Excitation and Inversion Pulses**:
-                        - Optionally adds a pre-excitation pulse (`block_rf_pre_excitation`) and an inversion pulse (`block_rf_inversion`), if respective times (`self.preExTime`, `self.inversionTime`) are greater than zero.
-
-                    - **Excitation and Echo Train**:
-                        - Adds an excitation pulse followed by an echo train for phase and slice gradients:
-                            - Gradients are scaled based on the current slice (`sl_idx`) and phase (`ph_idx`) indices.
-                            - Includes ADC acquisition blocks (`block_adc_signal`) and refocusing pulses for each echo.
-
-                    - **Repetition Time Delay**:
-                        - Adds a delay (`delay_tr`) between repetitions.
+            1. **Planning**:
+                - Lists the echo trains (`trains`) of the slice (`n_sl`) and phase (`n_ph`) sweeps as (slice index,
+                  first phase index) pairs.
+                - Splits the echo trains into the fewest batches that fit into the hardware limits (`hw.maxOrders` and
+                  `hw.maxRdPoints`), estimated with `FloBudget` without building the batches.
 
-            3. **Final Batch Processing**:
-                - Writes and interprets the last batch after completing all slices and phases.
-                - Updates the total readout points for the final batch.
+            2. **Compilation**:
+                - Builds each batch with `create_batch()` and interprets it with `flo_interpreter`. Batches are
+                  independent, so they are compiled in a pool of processes by `compileBatches()`.
 
             Returns:
             --------
@@ -692,88 +737,30 @@ class RarePyPulseq(blankSeq.MRIBLANKSEQ):
             - `n_rd_points_dict`: Maps batch names to the total readout points per batch.
             - `n_adc`: Total number of ADC acquisition windows across all batches.
             """
-            batches = {}  # Dictionary to save batches PyPulseq sequences
-            waveforms = {}  # Dictionary to store generated waveforms per each batch
-            n_rd_points_dict = {}  # Dictionary to track readout points for each batch
-            n_rd_points = 0  # To account for number of acquired rd points
-            seq_idx = 0  # Sequence batch index
-            n_adc = 0  # To account for number of adc windows
-            batch_num = "batch_0"  # Initial batch name
-
-            # Slice sweep
-            for sl_idx in range(n_sl):
-                ph_idx = 0
-                # Phase sweep
-                while ph_idx < n_ph:
-                    # Check if a new batch is needed (either first batch or exceeding readout points limit)
-                    if seq_idx == 0 or n_rd_points + n_rd_points_per_train > hw.maxRdPoints:
-                        # If a previous batch exists, write and interpret it
-                        if seq_idx > 0:
-                            batches[batch_num].write(batch_num + ".seq")
-                            waveforms[batch_num], param_dict = flo_interpreter.interpret(batch_num + ".seq")
-                            print(f"{batch_num}.seq ready!")
-
-                        # Update to the next batch
-                        seq_idx += 1
-                        n_rd_points_dict[batch_num] = n_rd_points  # Save readout points count
-                        n_rd_points = 0
-                        batch_num = f"batch_{seq_idx}"
-                        batches[batch_num], n_rd_points, n_adc_0 = initialize_batch()  # Initialize new batch
-                        n_adc += n_adc_0
-                        print(f"Creating {batch_num}.seq...")
-
-                    # Pre-excitation pulse
-                    if self.preExTime > 0:
-                        gr_rd_preex = pp.scale_grad(block_gr_rd_preph, scale=+1.0)
-                        batches[batch_num].add_block(block_rf_pre_excitation,
-                                                     gr_rd_preex,
-                                                     delay_pre_excitation)
-
-                    # Inversion pulse
-                    if self.inversionTime > 0:
-                        gr_rd_inv = pp.scale_grad(block_gr_rd_preph, scale=-1.0)
-                        batches[batch_num].add_block(block_rf_inversion,
-                                                     gr_rd_inv,
-                                                     delay_inversion)
-
-                    # Add excitation pulse and readout de-phasing gradient
-                    batches[batch_num].add_block(block_gr_rd_preph,
-                                            block_rf_excitation,
-                                            delay_preph)
-
-                    # Add echo train
-                    for echo in range(self.etl):
-                        # Fix the phase and slice amplitude
-                        gr_ph_deph = pp.scale_grad(block_gr_ph_deph, ph_gradients[ph_idx])
-                        gr_sl_deph = pp.scale_grad(block_gr_sl_deph, sl_gradients[sl_idx])
-                        gr_ph_reph = pp.scale_grad(block_gr_ph_reph, - ph_gradients[ph_idx])
-                        gr_sl_reph = pp.scale_grad(block_gr_sl_reph, - sl_gradients[sl_idx])
-
-                        # Add blocks
-                        batches[batch_num].add_block(block_rf_refocusing,
-                                                block_gr_rd_reph,
-                                                gr_ph_deph,
-                                                gr_sl_deph,
-                                                block_adc_signal,
-                                                delay_reph)
-                        batches[batch_num].add_block(gr_ph_reph,
-                                                gr_sl_reph)
-                        n_rd_points += n_rd
-                        n_adc += 1
-                        ph_idx += 1
-
-                    # Add time delay to next repetition
-                    batches[batch_num].add_block(delay_tr)
-
-            # After final repetition, save and interpret the last batch
-            batches[batch_num].write(batch_num + ".seq")
-            waveforms[batch_num], param_dict = flo_interpreter.interpret(batch_num + ".seq")
-            print(f"{batch_num}.seq ready!")
-            print(f"{len(batches)} batches created. Sequence ready!")
-
-            # Update the number of acquired points in the last batch
-            n_rd_points_dict.pop('batch_0')
-            n_rd_points_dict[batch_num] = n_rd_points
+            # Instructions and readout points of a single echo train
+            train_blocks = [(block_gr_rd_preph, block_rf_excitation, delay_preph)]
+            if self.preExTime > 0:
+                train_blocks.append((block_rf_pre_excitation, block_gr_rd_preph, delay_pre_excitation))
+            if self.inversionTime > 0:
+                train_blocks.append((block_rf_inversion, block_gr_rd_preph, delay_inversion))
+            train_blocks += [(block_rf_refocusing, block_gr_rd_reph, block_gr_ph_deph, block_gr_sl_deph,
+                              block_adc_signal, delay_reph),
+                             (block_gr_ph_reph, block_gr_sl_reph)] * self.etl
+            train_budget = FloBudget.from_blocks(train_blocks, hw.grad_raster_time)
+
+            # Split the echo trains into batches
+            batch, n_rd_points_0, n_adc_0 = initialize_batch()
+            ranges = FloBudget.from_blocks(batch, hw.grad_raster_time).plan_batches([train_budget] * len(trains),
+                                                                                   hw.maxOrders, hw.maxRdPoints)
+            batch_args = {f"batch_{idx + 1}": batch_range for idx, batch_range in enumerate(ranges)}
+            n_rd_points_dict = {name: n_rd_points_0 + (last - first) * self.etl * n_rd
+                                for name, (first, last) in batch_args.items()}
+            n_adc = len(ranges) * n_adc_0 + len(trains) * self.etl
+            print(f"Creating {len(batch_args)} batches...")
+
+            # Create and interpret the batches
+            waveforms = self.compileBatches(flo_interpreter, create_batch, batch_args)
+            print(f"{len(batch_args)} batches created. Sequence ready!")
 
             return waveforms, n_rd_points_dict, n_adc
 
@@ -783,7 +770,7 @@ class RarePyPulseq(blankSeq.MRIBLANKSEQ):
         Oversampled data will be available in self.mapVals['data_over']
         Decimated data will be available in self.mapVals['data_decimated']
         '''
-        waveforms, n_readouts, n_adc = create_batches()
+        waveforms, n_readouts, n_adc = self.getCachedBatches(create_batches)
         return self.runBatches(waveforms=waveforms,
                                n_readouts=n_readouts,
                                n_adc=n_adc,
@@ -864,36 +851,19 @@ class RarePyPulseq(blankSeq.MRIBLANKSEQ):
         # Decimate data to get signal in desired bandwidth
         data_full = data_signal
 
-        # Reorganize data_full
-        data_prov = np.zeros(shape=[self.nScans, n_sl * n_ph * n_rd], dtype=complex)
-        if n_batches > 1:
-            data_full_a = data_full[0:sum(n_readouts[0:-1]) * self.nScans]
-            data_full_b = data_full[sum(n_readouts[0:-1]) * self.nScans:]
-            data_full_a = np.reshape(data_full_a, newshape=(n_batches - 1, self.nScans, -1, n_rd))
-            data_full_b = np.reshape(data_full_b, newshape=(1, self.nScans, -1, n_rd))
-            for scan in range(self.nScans):
-                data_scan_a = np.reshape(data_full_a[:, scan, :, :], -1)
-                data_scan_b = np.reshape(data_full_b[:, scan, :, :], -1)
-                data_prov[scan, :] = np.concatenate((data_scan_a, data_scan_b), axis=0)
-        else:
-            data_full = np.reshape(data_full, newshape=(1, self.nScans, -1, n_rd))
-            for scan in range(self.nScans):
-                data_prov[scan, :] = np.reshape(data_full[:, scan, :, :], -1)
-        data_full = np.reshape(data_prov, -1)
+        # Assemble the readouts of all the batches and scans in acquisition order and in k-space order
+        readouts_per_batch = np.array(n_readouts) // n_rd
+        acq_map = self.getKSpaceMap(readouts_per_batch, self.nScans)
+        lines = np.reshape(np.arange(n_sl)[:, np.newaxis] * n_ph + np.array(ind)[np.newaxis, :], -1)
+        k_map = self.getKSpaceMap(readouts_per_batch, self.nScans, lines=lines, n_lines=n_sl * n_ph)
 
         # Save data_full to save it in .h5
-        self.data_fullmat = data_full
+        self.data_fullmat = np.reshape(self.assembleKSpace(data_full, acq_map, n_rd), -1)
+        data_full = np.reshape(self.assembleKSpace(data_full, k_map, n_rd), newshape=(self.nScans, n_sl, n_ph, n_rd))
 
         # Get index for krd = 0
         # Average data
-        data_prov = np.reshape(data_full, newshape=(self.nScans, n_rd * n_ph * n_sl))
-        data_prov = np.average(data_prov, axis=0)
-        # Reorganize the data according to sweep mode
-        data_prov = np.reshape(data_prov, newshape=(n_sl, n_ph, n_rd))
-        data_temp = np.zeros_like(data_prov)
-        for ii in range(n_ph):
-            data_temp[:, ind[ii], :] = data_prov[:, ii, :]
-        data_prov = data_temp
+        data_prov = np.average(data_full, axis=0)
         # Get central line
         data_prov = data_prov[int(self.nPoints[2] / 2), int(n_ph / 2), :]
         ind_krd_0 = np.argmax(np.abs(data_prov))
@@ -901,12 +871,7 @@ class RarePyPulseq(blankSeq.MRIBLANKSEQ):
             ind_krd_0 = int(n_rd / 2)
 
         # Get individual images
-        data_full = np.reshape(data_full, newshape=(self.nScans, n_sl, n_ph, n_rd))
         data_full = data_full[:, :, :, ind_krd_0 - int(self.nPoints[0] / 2):ind_krd_0 + int(self.nPoints[0] / 2)]
-        data_temp = np.zeros_like(data_full)
-        for ii in range(n_ph):
-            data_temp[:, :, ind[ii], :] = data_full[:, :, ii, :]
-        data_full = data_temp
         self.mapVals['data_full'] = data_full
 
         # Average data
@@ -932,7 +897,7 @@ class RarePyPulseq(blankSeq.MRIBLANKSEQ):
         dPhase = np.exp(-2 * np.pi * 1j * (self.dfov[0] * kRD + self.dfov[1] * kPH + self.dfov[2] * kSL))
         data = np.reshape(data * dPhase, newshape=(self.nPoints[2], self.nPoints[1], self.nPoints[0]))
         self.mapVals['kSpace3D'] = data
-        img = np.fft.ifftshift(np.fft.ifftn(np.fft.ifftshift(data)))
+        img = ifftnc(data)
         self.mapVals['image3D'] = img
         data = np.reshape(data, newshape=(1, self.nPoints[0] * self.nPoints[1] * self.nPoints[2]))
 
@@ -966,7 +931,7 @@ class RarePyPulseq(blankSeq.MRIBLANKSEQ):
             tVector = np.linspace(-acqTime/2, acqTime/2, self.nPoints[0])
             sVector = self.mapVals['sampled'][:, 3]
             fVector = np.linspace(-bw/2, bw/2, self.nPoints[0])
-            iVector = np.fft.ifftshift(np.fft.ifftn(np.fft.ifftshift(sVector)))
+            iVector = ifftnc(sVector)
 
             # Plots to show into the GUI
             result1 = {}
@@ -1096,11 +1061,10 @@ class RarePyPulseq(blankSeq.MRIBLANKSEQ):
         1. Generate a timestamp-based filename and directory path for the output file.
         2. Initialize the ISMRMRD dataset with the generated path.
         3. Populate the header and write the XML header to the dataset. Informations can be added.
-        4. Reshape the raw data matrix and iterate over scans, slices, and phases to write each acquisition. WARNING : RARE sequence follows ind order to fill the k-space.
-        5. Set acquisition flags and properties.
-        6. Append the acquisition data to the dataset.
-        7. Reshape and save the reconstructed images.
-        8. Close the dataset.
+        4. Build the headers of all the acquisitions (scans, slices and phases) with their flags and properties. WARNING : RARE sequence follows ind order to fill the k-space.
+        5. Append the raw data matrix and the headers to the dataset in blocks.
+        6. Reshape and save the reconstructed images.
+        7. Close the dataset.
 
         Attribute:
         - self.data_full_mat (numpy.array): Full matrix of raw data to be reshaped and saved.
@@ -1128,7 +1092,6 @@ class RarePyPulseq(blankSeq.MRIBLANKSEQ):
         n_ph = self.nPoints[1]
         n_sl = self.nPoints[2]
         ind = self.getIndex(self.etl, n_ph, self.sweepMode)
-        nRep = (n_ph//etl)*n_sl
         bw = self.mapVals['bw_MHz']
         
         axesOrientation = self.axesOrientation
@@ -1164,71 +1127,18 @@ class RarePyPulseq(blankSeq.MRIBLANKSEQ):
                 
         
         
-        new_data = np.zeros((n_ph * n_sl * self.nScans, n_rd + 2*hw.addRdPoints))
-        new_data = np.reshape(self.data_fullmat, (self.nScans, n_sl, n_ph, n_rd+ 2*hw.addRdPoints))
-        
-        counter=0  
-        for scan in range(self.nScans):
-            for slice_idx in range(n_sl):
-                for phase_idx in range(n_ph):
-                    
-                    line = new_data[scan, slice_idx, phase_idx, :]
-                    line2d = np.reshape(line, (1, n_rd+2*hw.addRdPoints))
-                    acq = ismrmrd.Acquisition.from_array(line2d, None)
-                    
-                    index_in_repetition = phase_idx % etl
-                    current_repetition = (phase_idx // etl) + (slice_idx * (n_ph // etl))
-                    
-                    acq.clearAllFlags()
-                    
-                    if index_in_repetition == 0: 
-                        acq.setFlag(ismrmrd.ACQ_FIRST_IN_CONTRAST)
-                    elif index_in_repetition == etl - 1:
-                        acq.setFlag(ismrmrd.ACQ_LAST_IN_CONTRAST)
-                    
-                    if ind[phase_idx]== 0:
-                        acq.setFlag(ismrmrd.ACQ_FIRST_IN_PHASE)
-                    elif ind[phase_idx] == n_ph - 1:
-                        acq.setFlag(ismrmrd.ACQ_LAST_IN_PHASE)
-                    
-                    if slice_idx == 0:
-                        acq.setFlag(ismrmrd.ACQ_FIRST_IN_SLICE)
-                    elif slice_idx == n_sl - 1:
-                        acq.setFlag(ismrmrd.ACQ_LAST_IN_SLICE)
-                        
-                    if int(current_repetition) == 0:
-                        acq.setFlag(ismrmrd.ACQ_FIRST_IN_REPETITION)
-                    elif int(current_repetition) == nRep - 1:
-                        acq.setFlag(ismrmrd.ACQ_LAST_IN_REPETITION)
-                        
-                    if scan == 0:
-                        acq.setFlag(ismrmrd.ACQ_FIRST_IN_AVERAGE)
-                    elif scan == self.nScans-1:
-                        acq.setFlag(ismrmrd.ACQ_LAST_IN_AVERAGE)
-                    
-                    
-                    counter += 1 
-                    
-                    # +1 to start at 1 instead of 0
-                    acq.idx.repetition = int(current_repetition + 1)
-                    acq.idx.kspace_encode_step_1 = ind[phase_idx]+1 # phase
-                    acq.idx.slice = slice_idx + 1
-                    acq.idx.contrast = index_in_repetition + 1
-                    acq.idx.average = scan + 1 # scan
-                    
-                    acq.scan_counter = counter
-                    acq.discard_pre = hw.addRdPoints
-                    acq.discard_post = hw.addRdPoints
-                    acq.sample_time_us = 1/bw
-                    self.dfov = np.array(self.dfov)
-                    acq.position = (ctypes.c_float * 3)(*self.dfov.flatten())
-
-                    
-                    acq.read_dir = (ctypes.c_float * 3)(*read_dir)
-                    acq.phase_dir = (ctypes.c_float * 3)(*phase_dir)
-                    acq.slice_dir = (ctypes.c_float * 3)(*slice_dir)
-                    
-                    dset.append_acquisition(acq) # Append the acquisition to the dataset
+        # Acquisitions sorted by scan, slice and phase, written in blocks
+        self.dfov = np.array(self.dfov)
+        header = get_rare_header(self.nScans, n_sl, n_ph, etl, ind)
+        header.update(discard_pre=hw.addRdPoints,
+                      discard_post=hw.addRdPoints,
+                      sample_time_us=1/bw,
+                      position=self.dfov.flatten(),
+                      read_dir=read_dir,
+                      phase_dir=phase_dir,
+                      slice_dir=slice_dir)
+        lines = np.reshape(self.data_fullmat, (self.nScans * n_sl * n_ph, n_rd + 2*hw.addRdPoints))
+        append_acquisitions(dset, lines, header)
                         
                         
         image=self.mapVals['image3D']
@@ -33,8 +33,11 @@ import ismrmrd
 import ismrmrd.xsd
 import datetime
 import ctypes
-from marga_pulseq.interpreter import PSInterpreter
+from manager.pulseqmanager import SequenceInterpreter
+from manager.flomanager import FloBudget
 import pypulseq as pp
+from manager.fftmanager import ifftnc, fftnc
+from manager.mrdmanager import append_acquisitions, get_rare_header
 
 #*********************************************************************************
 #*********************************************************************************
@@ -165,7 +168,7 @@ class RARE_T2prep_pp(blankSeq.MRIBLANKSEQ):
         instructions for the scanner hardware. You will typically update the interpreter during scanner calibration.
         '''
 
-        self.flo_interpreter = PSInterpreter(
+        self.flo_interpreter = SequenceInterpreter(
             tx_warmup=hw.blkTime,  # Transmit chain warm-up time (us)
             rf_center=hw.larmorFreq * 1e6,  # Larmor frequency (Hz)
             rf_amp_max=hw.b1Efficiency / (2 * np.pi) * 1e6,  # Maximum RF amplitude (Hz)
@@ -605,88 +608,90 @@ class RARE_T2prep_pp(blankSeq.MRIBLANKSEQ):
         number of acquired points to check if a new batch is required.
         '''
 
-        def createBatches():
-            seq_idx = 0  # Sequence batch index
-            batch_num = "batch_0"  # Initial batch name
-            waveforms = {}  # Dictionary to store generated waveforms
-
-            # Slice sweep
-            for sl_idx in range(nSL):
-                ph_idx = 0
-                # Phase sweep
-                while ph_idx < nPH:
-                    # Check if a new batch is needed (either first batch or exceeding readout points limit)
-                    if seq_idx == 0 or self.n_rd_points + n_rd_points_per_train > hw.maxRdPoints:
-                        # If a previous batch exists, write and interpret it
-                        if seq_idx > 0:
-                            batches[batch_num].write(batch_num + ".seq")
-                            waveforms[batch_num], param_dict = self.flo_interpreter.interpret(batch_num + ".seq")
-                            print(f"{batch_num}.seq ready!")
-
-                        # Update to the next batch
-                        seq_idx += 1
-                        n_rd_points_dict[batch_num] = self.n_rd_points  # Save readout points count
-                        batch_num = f"batch_{seq_idx}"
-                        initializeBatch(batch_num)  # Initialize new batch
-                        print(f"Creating {batch_num}.seq...")
-
-                    # Add preparation pulses
-                    batches[batch_num].add_block(block_rf_plus_x_pi2,
-                                            delay_rf_plus_x_pi2)
-                    batches[batch_num].add_block(block_rf_plus_y_pi,
-                                            delay_rf_plus_y_pi)
-                    batches[batch_num].add_block(block_rf_minus_x_pi2)
-                    batches[batch_num].add_block(block_gr_x_spoiler,
-                                            block_gr_y_spoiler,
-                                            block_gr_z_spoiler,
-                                            delay_prep)
-
-                    # Add excitation pulse and readout de-phasing gradient
-                    batches[batch_num].add_block(block_gr_rd_preph,
-                                            block_rf_excitation,
-                                            delay_preph)
-
-                    # Add echo train
-                    for echo in range(self.etl):
-                        # Fix the phase and slice amplitude
-                        gr_ph_deph = pp.scale_grad(block_gr_ph_deph, phGradients[ph_idx])
-                        gr_sl_deph = pp.scale_grad(block_gr_sl_deph, slGradients[sl_idx])
-                        gr_ph_reph = pp.scale_grad(block_gr_ph_reph, - phGradients[ph_idx])
-                        gr_sl_reph = pp.scale_grad(block_gr_sl_reph, - slGradients[sl_idx])
-
-                        # Add blocks
-                        batches[batch_num].add_block(block_rf_refocusing,
-                                                block_gr_rd_reph,
-                                                gr_ph_deph,
-                                                gr_sl_deph,
-                                                block_adc_signal,
-                                                delay_reph)
-                        batches[batch_num].add_block(gr_ph_reph,
-                                                gr_sl_reph)
-                        self.n_rd_points += nRD
-                        ph_idx += 1
+        # Echo trains of the slice and phase sweeps, given by the slice index and the first phase index
+        trains = [(sl_idx, ph_idx) for sl_idx in range(nSL) for ph_idx in range(0, nPH, self.etl)]
 
-                    # Add time delay to next repetition
-                    batches[batch_num].add_block(delay_tr)
+        def createBatch(name, first, last):
+            # Create a batch with the echo trains from first to last (excluded)
+            initializeBatch(name)
+            for sl_idx, ph_idx in trains[first:last]:
+                # Add preparation pulses
+                batches[name].add_block(block_rf_plus_x_pi2,
+                                        delay_rf_plus_x_pi2)
+                batches[name].add_block(block_rf_plus_y_pi,
+                                        delay_rf_plus_y_pi)
+                batches[name].add_block(block_rf_minus_x_pi2)
+                batches[name].add_block(block_gr_x_spoiler,
+                                        block_gr_y_spoiler,
+                                        block_gr_z_spoiler,
+                                        delay_prep)
 
-            # After final repetition, save and interpret the last batch
-            batches[batch_num].write(batch_num + ".seq")
-            waveforms[batch_num], param_dict = self.flo_interpreter.interpret(batch_num + ".seq")
-            print(f"{batch_num}.seq ready!")
-            print(f"{len(batches)} batches created. Sequence ready!")
+                # Add excitation pulse and readout de-phasing gradient
+                batches[name].add_block(block_gr_rd_preph,
+                                        block_rf_excitation,
+                                        delay_preph)
 
-            # Update the number of acquired ponits in the last batch
-            n_rd_points_dict.pop('batch_0')
-            n_rd_points_dict[batch_num] = self.n_rd_points
+                # Add echo train
+                for echo in range(self.etl):
+                    # Fix the phase and slice amplitude
+                    gr_ph_deph = pp.scale_grad(block_gr_ph_deph, phGradients[ph_idx])
+                    gr_sl_deph = pp.scale_grad(block_gr_sl_deph, slGradients[sl_idx])
+                    gr_ph_reph = pp.scale_grad(block_gr_ph_reph, - phGradients[ph_idx])
+                    gr_sl_reph = pp.scale_grad(block_gr_sl_reph, - slGradients[sl_idx])
+
+                    # Add blocks
+                    batches[name].add_block(block_rf_refocusing,
+                                            block_gr_rd_reph,
+                                            gr_ph_deph,
+                                            gr_sl_deph,
+                                            block_adc_signal,
+                                            delay_reph)
+                    batches[name].add_block(gr_ph_reph,
+                                            gr_sl_reph)
+                    ph_idx += 1
+
+                # Add time delay to next repetition
+                batches[name].add_block(delay_tr)
 
-            return waveforms, n_rd_points_dict
+            return batches[name]
+
+        def createBatches():
+            # Instructions and readout points of a single echo train
+            train_blocks = [(block_rf_plus_x_pi2, delay_rf_plus_x_pi2),
+                            (block_rf_plus_y_pi, delay_rf_plus_y_pi),
+                            (block_rf_minus_x_pi2,),
+                            (block_gr_x_spoiler, block_gr_y_spoiler, block_gr_z_spoiler, delay_prep),
+                            (block_gr_rd_preph, block_rf_excitation, delay_preph)]
+            train_blocks += [(block_rf_refocusing, block_gr_rd_reph, block_gr_ph_deph, block_gr_sl_deph,
+                              block_adc_signal, delay_reph),
+                             (block_gr_ph_reph, block_gr_sl_reph)] * self.etl
+            train_blocks.append((delay_tr,))
+            train_budget = FloBudget.from_blocks(train_blocks, hw.grad_raster_time, hw.oversamplingFactor)
+
+            # Split the echo trains into batches according to the instructions and readout points limits
+            initializeBatch("batch_0")
+            batch_budget = FloBudget.from_blocks(batches.pop("batch_0"), hw.grad_raster_time, hw.oversamplingFactor)
+            ranges = batch_budget.plan_batches([train_budget] * len(trains), hw.maxOrders, hw.maxRdPoints)
+            batch_args = {}
+            n_rd_points_dict.clear()
+            for seq_idx, (first, last) in enumerate(ranges):
+                batch_num = f"batch_{seq_idx + 1}"
+                batch_args[batch_num] = (batch_num, first, last)
+                n_rd_points_dict[batch_num] = batch_budget.n_rd_points + (last - first) * n_rd_points_per_train
+            print(f"Creating {len(batch_args)} batches...")
+
+            # Create and interpret the batches
+            waveforms = self.compileBatches(self.flo_interpreter, createBatch, batch_args)
+            print(f"{len(batch_args)} batches created. Sequence ready!")
+
+            return waveforms, dict(n_rd_points_dict)
 
         ''' 
         Step 8: Run the batches
         This step will handle the different batches, run it and get the resulting data. This should not be modified.
         Oversampled data will be available in self.mapVals['data_over']
         '''
-        waveforms, n_readouts = createBatches()
+        waveforms, n_readouts = self.getCachedBatches(createBatches)
         return self.runBatches(waveforms,
                                n_readouts,
                                frequency=hw.larmorFreq + self.freqOffset * 1e-6,  # MHz
@@ -730,36 +735,19 @@ class RARE_T2prep_pp(blankSeq.MRIBLANKSEQ):
         # Decimate data to get signal in desired bandwidth
         data_full = sig.decimate(data_signal, hw.oversamplingFactor, ftype='fir', zero_phase=True)
 
-        # Reorganize data_full
-        data_prov = np.zeros(shape=[self.nScans, nSL * nPH * nRD], dtype=complex)
-        if n_batches > 1:
-            data_full_a = data_full[0:sum(n_readouts[0:-1]) * self.nScans]
-            data_full_b = data_full[sum(n_readouts[0:-1]) * self.nScans:]
-            data_full_a = np.reshape(data_full_a, newshape=(n_batches - 1, self.nScans, -1, nRD))
-            data_full_b = np.reshape(data_full_b, newshape=(1, self.nScans, -1, nRD))
-            for scan in range(self.nScans):
-                data_scan_a = np.reshape(data_full_a[:, scan, :, :], -1)
-                data_scan_b = np.reshape(data_full_b[:, scan, :, :], -1)
-                data_prov[scan, :] = np.concatenate((data_scan_a, data_scan_b), axis=0)
-        else:
-            data_full = np.reshape(data_full, newshape=(1, self.nScans, -1, nRD))
-            for scan in range(self.nScans):
-                data_prov[scan, :] = np.reshape(data_full[:, scan, :, :], -1)
-        data_full = np.reshape(data_prov, -1)
+        # Assemble the readouts of all the batches and scans in acquisition order and in k-space order
+        readouts_per_batch = np.array(n_readouts) // nRD
+        acq_map = self.getKSpaceMap(readouts_per_batch, self.nScans)
+        lines = np.reshape(np.arange(nSL)[:, np.newaxis] * nPH + np.array(ind)[np.newaxis, :], -1)
+        k_map = self.getKSpaceMap(readouts_per_batch, self.nScans, lines=lines, n_lines=nSL * nPH)
 
         # Save data_full to save it in .h5
-        self.data_fullmat = data_full
+        self.data_fullmat = np.reshape(self.assembleKSpace(data_full, acq_map, nRD), -1)
+        data_full = np.reshape(self.assembleKSpace(data_full, k_map, nRD), newshape=(self.nScans, nSL, nPH, nRD))
 
         # Get index for krd = 0
         # Average data
-        data_prov = np.reshape(data_full, newshape=(self.nScans, nRD * nPH * nSL))
-        data_prov = np.average(data_prov, axis=0)
-        # Reorganize the data acording to sweep mode
-        data_prov = np.reshape(data_prov, newshape=(nSL, nPH, nRD))
-        data_temp = np.zeros_like(data_prov)
-        for ii in range(nPH):
-            data_temp[:, ind[ii], :] = data_prov[:, ii, :]
-        data_prov = data_temp
+        data_prov = np.average(data_full, axis=0)
         # Get central line
         data_prov = data_prov[int(self.nPoints[2] / 2), int(nPH / 2), :]
         indkrd0 = np.argmax(np.abs(data_prov))
@@ -767,12 +755,7 @@ class RARE_T2prep_pp(blankSeq.MRIBLANKSEQ):
             indkrd0 = int(nRD / 2)
 
         # Get individual images
-        data_full = np.reshape(data_full, newshape=(self.nScans, nSL, nPH, nRD))
         data_full = data_full[:, :, :, indkrd0 - int(self.nPoints[0] / 2):indkrd0 + int(self.nPoints[0] / 2)]
-        data_temp = np.zeros_like(data_full)
-        for ii in range(nPH):
-            data_temp[:, :, ind[ii], :] = data_full[:, :, ii, :]
-        data_full = data_temp
         self.mapVals['data_full'] = data_full
 
         # Average data
@@ -798,7 +781,7 @@ class RARE_T2prep_pp(blankSeq.MRIBLANKSEQ):
         dPhase = np.exp(-2 * np.pi * 1j * (self.dfov[0] * kRD + self.dfov[1] * kPH + self.dfov[2] * kSL))
         data = np.reshape(data * dPhase, newshape=(self.nPoints[2], self.nPoints[1], self.nPoints[0]))
         self.mapVals['kSpace3D'] = data
-        img = np.fft.ifftshift(np.fft.ifftn(np.fft.ifftshift(data)))
+        img = ifftnc(data)
         self.mapVals['image3D'] = img
         data = np.reshape(data, newshape=(1, self.nPoints[0] * self.nPoints[1] * self.nPoints[2]))
 
@@ -833,7 +816,7 @@ class RARE_T2prep_pp(blankSeq.MRIBLANKSEQ):
             tVector = np.linspace(-acqTime/2, acqTime/2, nPoints[0])
             sVector = self.mapVals['sampled'][:, 3]
             fVector = np.linspace(-bw/2, bw/2, nPoints[0])
-            iVector = np.fft.ifftshift(np.fft.ifftn(np.fft.ifftshift(sVector)))
+            iVector = ifftnc(sVector)
 
             # Plots to show into the GUI
             result1 = {}
@@ -1039,7 +1022,7 @@ class RARE_T2prep_pp(blankSeq.MRIBLANKSEQ):
         image_3d = np.reshape(image[3, :], self.nPoints[-1::-1])
         
         # Generate k-space
-        kspace_3d = np.fft.fftshift(np.fft.fftn(np.fft.fftshift(image_3d)))
+        kspace_3d = fftnc(image_3d)
         
         kspace = np.reshape(kspace_3d, (1, -1))
         
@@ -1056,11 +1039,10 @@ class RARE_T2prep_pp(blankSeq.MRIBLANKSEQ):
         1. Generate a timestamp-based filename and directory path for the output file.
         2. Initialize the ISMRMRD dataset with the generated path.
         3. Populate the header and write the XML header to the dataset. Informations can be added.
-        4. Reshape the raw data matrix and iterate over scans, slices, and phases to write each acquisition. WARNING : RARE sequence follows ind order to fill the k-space.
-        5. Set acquisition flags and properties.
-        6. Append the acquisition data to the dataset.
-        7. Reshape and save the reconstructed images.
-        8. Close the dataset.
+        4. Build the headers of all the acquisitions (scans, slices and phases) with their flags and properties. WARNING : RARE sequence follows ind order to fill the k-space.
+        5. Append the raw data matrix and the headers to the dataset in blocks.
+        6. Reshape and save the reconstructed images.
+        7. Close the dataset.
 
         Attribute:
         - self.data_full_mat (numpy.array): Full matrix of raw data to be reshaped and saved.
@@ -1090,7 +1072,6 @@ class RARE_T2prep_pp(blankSeq.MRIBLANKSEQ):
         nPH = self.nPoints[1]
         nSL = self.nPoints[2]
         ind = self.getIndex(self.etl, nPH, 1)
-        nRep = (nPH//etl)*nSL
         bw = self.mapVals['bw_MHz']
         
         axesOrientation = self.axesOrientation
@@ -1126,71 +1107,18 @@ class RARE_T2prep_pp(blankSeq.MRIBLANKSEQ):
                 
         
         
-        new_data = np.zeros((nPH * nSL * nScans, nRD + 2*hw.addRdPoints))
-        new_data = np.reshape(self.data_fullmat, (nScans, nSL, nPH, nRD+ 2*hw.addRdPoints))
-        
-        counter=0  
-        for scan in range(nScans):
-            for slice_idx in range(nSL):
-                for phase_idx in range(nPH):
-                    
-                    line = new_data[scan, slice_idx, phase_idx, :]
-                    line2d = np.reshape(line, (1, nRD+2*hw.addRdPoints))
-                    acq = ismrmrd.Acquisition.from_array(line2d, None)
-                    
-                    index_in_repetition = phase_idx % etl
-                    current_repetition = (phase_idx // etl) + (slice_idx * (nPH // etl))
-                    
-                    acq.clearAllFlags()
-                    
-                    if index_in_repetition == 0: 
-                        acq.setFlag(ismrmrd.ACQ_FIRST_IN_CONTRAST)
-                    elif index_in_repetition == etl - 1:
-                        acq.setFlag(ismrmrd.ACQ_LAST_IN_CONTRAST)
-                    
-                    if ind[phase_idx]== 0:
-                        acq.setFlag(ismrmrd.ACQ_FIRST_IN_PHASE)
-                    elif ind[phase_idx] == nPH - 1:
-                        acq.setFlag(ismrmrd.ACQ_LAST_IN_PHASE)
-                    
-                    if slice_idx == 0:
-                        acq.setFlag(ismrmrd.ACQ_FIRST_IN_SLICE)
-                    elif slice_idx == nSL - 1:
-                        acq.setFlag(ismrmrd.ACQ_LAST_IN_SLICE)
-                        
-                    if int(current_repetition) == 0:
-                        acq.setFlag(ismrmrd.ACQ_FIRST_IN_REPETITION)
-                    elif int(current_repetition) == nRep - 1:
-                        acq.setFlag(ismrmrd.ACQ_LAST_IN_REPETITION)
-                        
-                    if scan == 0:
-                        acq.setFlag(ismrmrd.ACQ_FIRST_IN_AVERAGE)
-                    elif scan == nScans-1:
-                        acq.setFlag(ismrmrd.ACQ_LAST_IN_AVERAGE)
-                    
-                    
-                    counter += 1 
-                    
-                    # +1 to start at 1 instead of 0
-                    acq.idx.repetition = int(current_repetition + 1)
-                    acq.idx.kspace_encode_step_1 = ind[phase_idx]+1 # phase
-                    acq.idx.slice = slice_idx + 1
-                    acq.idx.contrast = index_in_repetition + 1
-                    acq.idx.average = scan + 1 # scan
-                    
-                    acq.scan_counter = counter
-                    acq.discard_pre = hw.addRdPoints
-                    acq.discard_post = hw.addRdPoints
-                    acq.sample_time_us = 1/bw
-                    self.dfov = np.array(self.dfov)
-                    acq.position = (ctypes.c_float * 3)(*self.dfov.flatten())
-
-                    
-                    acq.read_dir = (ctypes.c_float * 3)(*read_dir)
-                    acq.phase_dir = (ctypes.c_float * 3)(*phase_dir)
-                    acq.slice_dir = (ctypes.c_float * 3)(*slice_dir)
-                    
-                    dset.append_acquisition(acq) # Append the acquisition to the dataset
+        # Acquisitions sorted by scan, slice and phase, written in blocks
+        self.dfov = np.array(self.dfov)
+        header = get_rare_header(nScans, nSL, nPH, etl, ind)
+        header.update(discard_pre=hw.addRdPoints,
+                      discard_post=hw.addRdPoints,
+                      sample_time_us=1/bw,
+                      position=self.dfov.flatten(),
+                      read_dir=read_dir,
+                      phase_dir=phase_dir,
+                      slice_dir=slice_dir)
+        lines = np.reshape(self.data_fullmat, (nScans * nSL * nPH, nRD + 2*hw.addRdPoints))
+        append_acquisitions(dset, lines, header)
                         
                         
         image=self.mapVals['image3D']
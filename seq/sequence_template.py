@@ -25,7 +25,7 @@ import controller.experiment_gui as ex
 import configs.hw_config as hw  # Import the scanner hardware config
 import configs.units as units
 import seq.mriBlankSeq as blankSeq  # Import the mriBlankSequence for any new sequence.
-from marga_pulseq.interpreter import PSInterpreter  # Import the flocra-pulseq interpreter
+from manager.pulseqmanager import SequenceInterpreter  # Import the flocra-pulseq interpreter without batch files
 import pypulseq as pp  # Import PyPulseq
 
 # Template Class for MRI Sequences
@@ -146,7 +146,7 @@ class SEQUENCE_TEMPLATE(blankSeq.MRIBLANKSEQ):
         instructions for the scanner hardware.
         '''
 
-        flo_interpreter = PSInterpreter(
+        flo_interpreter = SequenceInterpreter(
             tx_warmup=hw.blkTime,  # Transmit chain warm-up time (us)
             rf_center=hw.larmorFreq * 1e6,  # Larmor frequency (Hz)
             rf_amp_max=hw.b1Efficiency / (2 * np.pi) * 1e6,  # Maximum RF amplitude (Hz)
@@ -297,11 +297,10 @@ class SEQUENCE_TEMPLATE(blankSeq.MRIBLANKSEQ):
             for repetition in range(self.nRepetitions):
                 # Check if a new batch is needed (either first batch or exceeding readout points limit)
                 if seq_idx == 0 or n_rd_points + self.nPoints > hw.maxRdPoints:
-                    # If a previous batch exists, write and interpret it
+                    # If a previous batch exists, interpret it
                     if seq_idx > 0:
-                        batches[batch_num].write(batch_num + ".seq")
-                        waveforms[batch_num], param_dict = flo_interpreter.interpret(batch_num + ".seq")
-                        print(f"{batch_num}.seq ready!")
+                        waveforms[batch_num], param_dict = self.interpretBatch(flo_interpreter, batches[batch_num], batch_num)
+                        print(f"{batch_num} ready!")
 
                     # Update to the next batch
                     seq_idx += 1
@@ -310,17 +309,16 @@ class SEQUENCE_TEMPLATE(blankSeq.MRIBLANKSEQ):
                     batch_num = f"batch_{seq_idx}"
                     batches[batch_num], n_rd_points, n_adc_0 = initializeBatch()  # Initialize new batch
                     n_adc += n_adc_0
-                    print(f"Creating {batch_num}.seq...")
+                    print(f"Creating {batch_num}...")
 
                 # Add sequence blocks (RF, ADC, repetition delay) to the current batch
                 batches[batch_num].add_block(rf_ex, adc, delay_repetition)
                 n_rd_points += self.nPoints  # Accounts for additional acquired points in each adc block
                 n_adc += 1
 
-            # After final repetition, save and interpret the last batch
-            batches[batch_num].write(batch_num + ".seq")
-            waveforms[batch_num], param_dict = flo_interpreter.interpret(batch_num + ".seq")
-            print(f"{batch_num}.seq ready!")
+            # After final repetition, interpret the last batch
+            waveforms[batch_num], param_dict = self.interpretBatch(flo_interpreter, batches[batch_num], batch_num)
+            print(f"{batch_num} ready!")
             print(f"{len(batches)} batches created. Sequence ready!")
 
             # Update the number of acquired ponits in the last batch
@@ -337,7 +335,7 @@ class SEQUENCE_TEMPLATE(blankSeq.MRIBLANKSEQ):
         The decimated data is shifted to account for CIC delay, so data is synchronized with real-time signal
         '''
 
-        waveforms, n_readouts, n_adc = createBatches()
+        waveforms, n_readouts, n_adc = self.getCachedBatches(createBatches)
         return self.runBatches(waveforms=waveforms,
                                n_readouts=n_readouts,
                                n_adc=n_adc,
@@ -26,6 +26,7 @@ import seq.mriBlankSeq as blankSeq  # Import the mriBlankSequence for any new se
 import scipy.signal as sig
 import configs.hw_config as hw
 import configs.units as units
+from manager.fftmanager import ifftnc
 
 
 class ShimmingSweep(blankSeq.MRIBLANKSEQ):
@@ -134,7 +135,7 @@ class ShimmingSweep(blankSeq.MRIBLANKSEQ):
         dataFWHM = np.zeros((3, self.nShimming))
         for ii in range(3):
             for jj in range(self.nShimming):
-                spectrum = np.abs(np.fft.ifftshift(np.fft.ifftn(np.fft.ifftshift(data[ii, jj, :]))))
+                spectrum = np.abs(ifftnc(data[ii, jj, :]))
                 dataFFT[ii, jj] = np.max(spectrum)
                 dataFWHM[ii, jj] = getFHWM(spectrum)
         self.mapVals['amplitudeVSshimming'] = dataFFT
@@ -286,7 +287,7 @@ class ShimmingSweep(blankSeq.MRIBLANKSEQ):
             data = np.reshape(data, (self.nShimming, -1))
             dataFFT = np.zeros(self.nShimming)
             for ii in range(self.nShimming):
-                dataFFT[ii] = np.max(np.abs(np.fft.ifftshift(np.fft.ifftn(np.fft.ifftshift(data[ii, :])))))
+                dataFFT[ii] = np.max(np.abs(ifftnc(data[ii, :])))
             if axis=='x':
                 self.shimming0[0] = sxVector[np.argmax(dataFFT)]
             elif axis=='y':
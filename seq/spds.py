@@ -26,7 +26,9 @@ import controller.experiment_gui as ex
 import configs.hw_config as hw  # Import the scanner hardware config
 import configs.units as units
 import seq.mriBlankSeq as blankSeq  # Import the mriBlankSequence for any new sequence.
-from marga_pulseq.interpreter import PSInterpreter  # Import the marga_pulseq interpreter
+from manager.flomanager import FloBudget
+from manager.csmanager import get_variable_density_mask
+from manager.pulseqmanager import SequenceInterpreter  # Import the marga_pulseq interpreter without batch files
 import pypulseq as pp  # Import PyPulseq
 
 
@@ -81,6 +83,15 @@ class spds(blankSeq.MRIBLANKSEQ):
                           tip='Shimming parameter to compensate B0 linear inhomogeneity.')
         self.addParameter(key='bw', string='Bandwidth (kHz)', val=50.0, units=units.kHz, field='IMG',
                           tip='Set acquisition bandwidth in kilohertz (kHz).')
+        self.addParameter(key='undersampling', string='Undersampling factor', val=1.0, field='IM',
+                          tip='Reduction of the number of k-space points with a random mask denser at the center. '
+                              'Use 1 to acquire the full k-space.')
+        self.addParameter(key='csMethod', string='CS reconstruction', val='TV', field='IM',
+                          tip="'TV', 'Wavelet' or 'None'. Compressed sensing reconstruction of undersampled k-space.")
+        self.addParameter(key='csLambda', string='CS regularization', val=0.01, field='IM',
+                          tip='Weight of the regularization relative to the maximum of the zero-filled image.')
+        self.addParameter(key='csIter', string='CS iterations', val=50, field='IM',
+                          tip='Maximum number of iterations of the compressed sensing reconstruction.')
 
 
     def sequenceInfo(self):
@@ -113,7 +124,7 @@ class spds(blankSeq.MRIBLANKSEQ):
         k_norm[:, 1] = np.reshape(ky, -1)
         k_norm[:, 2] = np.reshape(kz, -1)
         distance = np.sqrt(np.sum(k_norm ** 2, axis=1))
-        self.mask = distance <= 1
+        self.mask = get_variable_density_mask(distance, self.mapVals['undersampling'])
         n = np.sum(self.mask)
 
         tr = self.mapVals['repetitionTime'] * 1e-3  # s
@@ -173,7 +184,7 @@ class spds(blankSeq.MRIBLANKSEQ):
         instructions for the scanner hardware.
         '''
 
-        flo_interpreter = PSInterpreter(
+        flo_interpreter = SequenceInterpreter(
             tx_warmup=hw.blkTime,  # Transmit chain warm-up time (us)
             rf_center=hw.larmorFreq * 1e6,  # Larmor frequency (Hz)
             rf_amp_max=hw.b1Efficiency / (2 * np.pi) * 1e6,  # Maximum RF amplitude (Hz)
@@ -241,7 +252,8 @@ class spds(blankSeq.MRIBLANKSEQ):
         k_cartesian[:, 0] = k_norm[:, 0] * k_max[0]  # m^-1
         k_cartesian[:, 1] = k_norm[:, 1] * k_max[1]  # m^-1
         k_cartesian[:, 2] = k_norm[:, 2] * k_max[2]  # m^-1
-        self.mask = distance <= 1
+        self.mask = get_variable_density_mask(distance, self.undersampling)
+        self.mapVals['mask'] = self.mask
         self.mapVals['k_cartesian'] = k_cartesian
 
         # Get gradients
@@ -368,68 +380,58 @@ class spds(blankSeq.MRIBLANKSEQ):
         '''
         Step 7: Define your createBatches method.
         In this step you will populate the batches adding the blocks previously defined in step 4, and accounting for
-        number of acquired points to check if a new batch is required.
+        number of acquired points and instructions to check if a new batch is required.
         '''
 
+        def get_block(case, ii):
+            # Gradients, RF pulse and ADC of the ii-th point of the trajectory
+            if case == 'a':
+                g_rd_amp = np.array([gradients_a[ii - 1, 0], gradients_a[ii, 0], gradients_a[ii, 0]]) * hw.gammaB
+                g_ph_amp = np.array([gradients_a[ii - 1, 1], gradients_a[ii, 1], gradients_a[ii, 1]]) * hw.gammaB
+                g_sl_amp = np.array([gradients_a[ii - 1, 2], gradients_a[ii, 2], gradients_a[ii, 2]]) * hw.gammaB
+                block_rf, block_adc = block_rf_a, block_adc_a
+            elif case == 'b':
+                g_rd_amp = np.array([gradients_b[ii - 1, 0], gradients_b[ii, 0], gradients_b[ii, 0]]) * hw.gammaB
+                g_ph_amp = np.array([gradients_b[ii - 1, 1], gradients_b[ii, 1], gradients_b[ii, 1]]) * hw.gammaB
+                g_sl_amp = np.array([gradients_b[ii - 1, 2], gradients_b[ii, 2], gradients_b[ii, 2]]) * hw.gammaB
+                block_rf, block_adc = block_rf_b, block_adc_b
+            g_time = np.array([0.0, hw.grad_rise_time, self.repetitionTime])
+            return (pp.make_extended_trapezoid(channel=rd_channel,
+                                               amplitudes=g_rd_amp,
+                                               times=g_time),
+                    pp.make_extended_trapezoid(channel=ph_channel,
+                                               amplitudes=g_ph_amp,
+                                               times=g_time),
+                    pp.make_extended_trapezoid(channel=sl_channel,
+                                               amplitudes=g_sl_amp,
+                                               times=g_time),
+                    block_rf,
+                    block_adc)
+
+        def create_batch(case, first, last):
+            # Create a batch with the points from first to last (excluded) of the trajectory
+            batch, n_rd_points, n_adc = initialize_batch(case=case)
+            for ii in range(first, last):
+                batch.add_block(*get_block(case, ii))
+            return batch
+
         def create_batches(case='a'):
-            batches = {}  # Dictionary to save batches PyPulseq sequences
-            waveforms = {}  # Dictionary to store generated waveforms per each batch
+            # Split the points of the trajectory into batches that fit into the hardware limits
+            batch, n_rd_points, n_adc = initialize_batch(case=case)
+            steps = [FloBudget.from_blocks([get_block(case, ii)], hw.grad_raster_time)
+                     for ii in range(1, np.size(gradients_a, 0))]
+            ranges = FloBudget.from_blocks(batch, hw.grad_raster_time).plan_batches(steps, hw.maxOrders,
+                                                                                   hw.maxRdPoints)
+            batch_args = {}
             n_rd_points_dict = {}  # Dictionary to track readout points for each batch
-            n_adc = 0  # To account for number of adc windows
-            batch_name = f'sequence_{case}'
-
-            # Initialize new batch
-            batches[batch_name], n_rd_points, n_adc_0 = initialize_batch(case=case)
-            n_adc += n_adc_0
-
-            # Populate the sequence
-            for ii in range(1, np.size(gradients_a, 0)):
-                if case == 'a':
-                    g_rd_amp = np.array([gradients_a[ii - 1, 0], gradients_a[ii, 0], gradients_a[ii, 0]]) * hw.gammaB
-                    g_ph_amp = np.array([gradients_a[ii - 1, 1], gradients_a[ii, 1], gradients_a[ii, 1]]) * hw.gammaB
-                    g_sl_amp = np.array([gradients_a[ii - 1, 2], gradients_a[ii, 2], gradients_a[ii, 2]]) * hw.gammaB
-                    g_time = np.array([0.0, hw.grad_rise_time, self.repetitionTime])
-                    batches[batch_name].add_block(
-                        pp.make_extended_trapezoid(channel=rd_channel,
-                                                   amplitudes=g_rd_amp,
-                                                   times=g_time),
-                        pp.make_extended_trapezoid(channel=ph_channel,
-                                                   amplitudes=g_ph_amp,
-                                                   times=g_time),
-                        pp.make_extended_trapezoid(channel=sl_channel,
-                                                   amplitudes=g_sl_amp,
-                                                   times=g_time),
-                        block_rf_a,
-                        block_adc_a
-                    )
-                    n_adc += 1
-                    n_rd_points += n_rd
-                elif case == 'b':
-                    g_rd_amp = np.array([gradients_b[ii - 1, 0], gradients_b[ii, 0], gradients_b[ii, 0]]) * hw.gammaB
-                    g_ph_amp = np.array([gradients_b[ii - 1, 1], gradients_b[ii, 1], gradients_b[ii, 1]]) * hw.gammaB
-                    g_sl_amp = np.array([gradients_b[ii - 1, 2], gradients_b[ii, 2], gradients_b[ii, 2]]) * hw.gammaB
-                    g_time = np.array([0.0, hw.grad_rise_time, self.repetitionTime])
-                    batches[batch_name].add_block(
-                        pp.make_extended_trapezoid(channel=rd_channel,
-                                                   amplitudes=g_rd_amp,
-                                                   times=g_time),
-                        pp.make_extended_trapezoid(channel=ph_channel,
-                                                   amplitudes=g_ph_amp,
-                                                   times=g_time),
-                        pp.make_extended_trapezoid(channel=sl_channel,
-                                                   amplitudes=g_sl_amp,
-                                                   times=g_time),
-                        block_rf_b,
-                        block_adc_b
-                    )
-                    n_adc += 1
-                    n_rd_points += n_rd
-
-            # Write sequence file and interpret the sequence to get the waveform
-            batches[batch_name].write(batch_name + ".seq")
-            waveforms[batch_name], param_dict = flo_interpreter.interpret(batch_name + ".seq")
-            print(f"{batch_name}.seq ready!")
-            n_rd_points_dict[batch_name] = n_rd_points
+            for batch_idx, (first, last) in enumerate(ranges):
+                batch_name = f'sequence_{case}{batch_idx + 1}'
+                batch_args[batch_name] = (case, first + 1, last + 1)
+                n_rd_points_dict[batch_name] = n_rd_points + (last - first) * n_rd
+            n_adc = len(ranges) * n_adc + len(steps)
+
+            # Create the batches and interpret them to get the waveforms
+            waveforms = self.compileBatches(flo_interpreter, create_batch, batch_args)
 
             return waveforms, n_rd_points_dict, n_adc
 
@@ -442,8 +444,8 @@ class spds(blankSeq.MRIBLANKSEQ):
         '''
 
         # Create batches
-        waveforms_a, n_readouts_a, n_adc_a = create_batches(case='a')
-        waveforms_b, n_readouts_b, n_adc_b = create_batches(case='b')
+        waveforms_a, n_readouts_a, n_adc_a = self.getCachedBatches(create_batches, 'a')
+        waveforms_b, n_readouts_b, n_adc_b = self.getCachedBatches(create_batches, 'b')
 
         # Run sequence a
         if self.runBatches(waveforms=waveforms_a,
@@ -504,29 +506,28 @@ class spds(blankSeq.MRIBLANKSEQ):
         data_a = self.mapVals['data_decimated_a']
         data_b = self.mapVals['data_decimated_b']
         k_points = self.mapVals['k_cartesian']
-        mask = self.mask
-
-        # Delete the addRdPoints
-        data_a = np.reshape(data_a, (-1, 1 + 2 * hw.addRdPoints))
-        data_b = np.reshape(data_b, (-1, 1 + 2 * hw.addRdPoints))
-        data_a = data_a[:, hw.addRdPoints]
-        data_b = data_b[:, hw.addRdPoints]
-
-        # Fill k_space
-        k_data_a = np.zeros(np.size(k_points, 0), dtype=complex)
-        k_data_b = np.zeros(np.size(k_points, 0), dtype=complex)
-        jj = 0
-        for ii in range(np.size(mask)):
-            if mask[ii]:
-                k_data_a[ii] = data_a[jj]
-                k_data_b[ii] = data_b[jj]
-                jj += 1
+        mask = np.asarray(self.mapVals['mask'], dtype=bool)
+
+        # Fill k_space with the points of the mask, deleting the addRdPoints
+        lines = np.flatnonzero(np.reshape(mask, -1))
+        k_map = self.getKSpaceMap([np.size(lines)], lines=lines, n_lines=np.size(k_points, 0))
+        k_data_a = self.assembleKSpace(data_a, k_map, 1 + 2 * hw.addRdPoints)[0, :, hw.addRdPoints]
+        k_data_b = self.assembleKSpace(data_b, k_map, 1 + 2 * hw.addRdPoints)[0, :, hw.addRdPoints]
 
         # Get images
         k_data_a = np.reshape(k_data_a, (self.nPoints[2], self.nPoints[1], self.nPoints[0]))
         k_data_b = np.reshape(k_data_b, (self.nPoints[2], self.nPoints[1], self.nPoints[0]))
-        i_data_a = self.runIFFT(k_data_a)
-        i_data_b = self.runIFFT(k_data_b)
+        if self.undersampling > 1 and self.csMethod.lower() in ['tv', 'wavelet']:
+            # Both acquisitions are reconstructed as a batch
+            i_data = self.runCSReconstruction(np.stack((k_data_a, k_data_b)),
+                                              mask=np.reshape(mask, k_data_a.shape),
+                                              method=self.csMethod.lower(),
+                                              lam=self.csLambda,
+                                              n_iter=int(self.csIter))
+            i_data_a, i_data_b = i_data[0], i_data[1]
+        else:
+            i_data_a = self.runIFFT(k_data_a)
+            i_data_b = self.runIFFT(k_data_b)
         self.mapVals['space_k_a'] = k_data_a
         self.mapVals['space_k_b'] = k_data_b
         self.mapVals['space_i_a'] = i_data_a
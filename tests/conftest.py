@@ -0,0 +1,27 @@
+"""
+@author: J.M. Algarín, MRILab, i3M, CSIC, Valencia
+@email: josalggui@i3m.upv.es
+@Summary: configuration of the tests of the managers. Run from the MaRGE folder: python -m pytest tests
+"""
+
+import os
+import sys
+import importlib.util
+from importlib.machinery import SourceFileLoader
+
+# Add the MaRGE and marcos_client folders to sys.path
+main_directory = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+parent_directory = os.path.dirname(main_directory)
+sys.path.insert(0, main_directory)
+sys.path.append(os.path.join(parent_directory, 'marcos_client'))
+
+# Use the templates of the configuration files if they were not renamed for a scanner yet
+for name in ['units', 'sys_config', 'hw_config']:
+    module_name = 'configs.%s' % name
+    if not os.path.exists(os.path.join(main_directory, 'configs', '%s.py' % name)) and module_name not in sys.modules:
+        file_path = os.path.join(main_directory, 'configs', '%s.py.copy' % name)
+        loader = SourceFileLoader(module_name, file_path)
+        spec = importlib.util.spec_from_loader(module_name, loader)
+        module = importlib.util.module_from_spec(spec)
+        loader.exec_module(module)
+        sys.modules[module_name] = module
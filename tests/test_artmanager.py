@@ -0,0 +1,77 @@
+"""
+@author: J.M. Algarín, MRILab, i3M, CSIC, Valencia
+@email: josalggui@i3m.upv.es
+@Summary: tests of the block ART reconstruction
+"""
+
+import numpy as np
+import pytest
+
+from manager.artmanager import EncodingBlock, art_reconstruction
+
+
+def _get_problem(n_samples=60, shape=(3, 4, 5), seed=0):
+    # Random k-space points over a grid with the fov of the reconstruction tab, and the full encoding matrix with the
+    # voxels in (z, y, x) order
+    rng = np.random.default_rng(seed)
+    fov = np.array([0.1, 0.12, 0.08])
+    nz, ny, nx = shape
+    x = np.linspace(-fov[0] / 2, fov[0] / 2, nx)
+    y = np.linspace(-fov[1] / 2, fov[1] / 2, ny)
+    z = np.linspace(-fov[2] / 2, fov[2] / 2, nz)
+    k = (rng.random((n_samples, 3)) - 0.5) * np.array([nx, ny, nz]) / fov
+    y_grid, z_grid, x_grid = np.meshgrid(y, z, x)
+    r = np.stack([np.ravel(x_grid), np.ravel(y_grid), np.ravel(z_grid)], axis=1)
+    a = np.exp(-2j * np.pi * k @ r.T)
+    return k, x, y, z, a, rng
+
+
+def _old_art(k, s, a, lbda, n_iter):
+    # Sample by sample ART of the reconstruction tab before the block engine
+    rho = np.zeros((a.shape[1], 1), dtype=complex)
+    index = np.arange(len(s))
+    for iteration in range(n_iter):
+        np.random.shuffle(index)
+        for ii in index:
+            x0 = np.reshape(a[ii, :], (-1, 1))
+            x1 = (x0.T @ rho) - s[ii]
+            rho -= lbda * x1 * np.conj(x0) / (np.conj(x0.T) @ x0)
+    return rho
+
+
+def test_encoding_block_matches_matrix():
+    k, x, y, z, a, rng = _get_problem()
+    block = EncodingBlock(k, x, y, z)
+    rho = rng.standard_normal(block.shape) + 1j * rng.standard_normal(block.shape)
+    r = rng.standard_normal(k.shape[0]) + 1j * rng.standard_normal(k.shape[0])
+
+    assert np.allclose(block.forward(rho), a @ np.ravel(rho))
+    assert np.allclose(np.ravel(block.adjoint(r)), np.conj(a.T) @ r)
+    assert np.allclose(block.gram(), a @ np.conj(a.T))
+
+
+def test_kaczmarz_with_single_samples_matches_old_art():
+    k, x, y, z, a, rng = _get_problem()
+    s = a @ (rng.standard_normal(a.shape[1]) + 1j * rng.standard_normal(a.shape[1]))
+
+    np.random.seed(1)
+    reference = _old_art(k, s, a, lbda=0.5, n_iter=2)
+    np.random.seed(1)
+    rho = art_reconstruction(k, s, x, y, z, lbda=0.5, n_iter=2, block_size=1, regularization=0)
+
+    assert rho.shape == (len(z), len(y), len(x))
+    assert np.allclose(np.ravel(rho), np.ravel(reference))
+
+
+@pytest.mark.parametrize("method, n_iter", [('kaczmarz', 20), ('sirt', 300)])
+def test_blocks_converge_to_the_image(method, n_iter):
+    # Overdetermined problem, the image is recovered from noiseless data
+    k, x, y, z, a, rng = _get_problem(n_samples=200)
+    image = rng.standard_normal(a.shape[1]) + 1j * rng.standard_normal(a.shape[1])
+    s = a @ image
+
+    np.random.seed(0)
+    rho = art_reconstruction(k, s, x, y, z, lbda=1.0, n_iter=n_iter, block_size=32, method=method,
+                             regularization=1e-6)
+    error = np.linalg.norm(np.ravel(rho) - image) / np.linalg.norm(image)
+    assert error < 0.05
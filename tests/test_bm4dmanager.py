@@ -0,0 +1,102 @@
+"""
+@author: J.M. Algarín, MRILab, i3M, CSIC, Valencia
+@email: josalggui@i3m.upv.es
+@Summary: tests of the tiled BM4D denoising and of the noise estimation
+"""
+
+import numpy as np
+import pytest
+import bm4d
+
+from manager import bm4dmanager
+from manager.bm4dmanager import bm4d_filter, estimate_noise_std, _get_tiles, _get_tile_weights
+
+
+def _get_image(shape=(8, 16, 16), seed=0):
+    # Noisy box over a constant background
+    rng = np.random.default_rng(seed)
+    image = np.ones(shape)
+    image[2:-2, 4:-4, 4:-4] = 3
+    return image + 0.2 * rng.standard_normal(shape)
+
+
+@pytest.mark.parametrize("shape, tile_size, overlap", [((8, 16, 16), 12, 6), ((30, 64, 70), 32, 12),
+                                                       ((1, 100, 5), 64, 12), ((64, 64, 64), 64, 12)])
+def test_tiles_cover_the_volume(shape, tile_size, overlap):
+    tiles = _get_tiles(shape, tile_size, overlap)
+    count = np.zeros(shape)
+    blend = np.zeros(shape)
+    for tile in tiles:
+        for axis, s in enumerate(tile):
+            assert 0 <= s.start < s.stop <= shape[axis]
+            assert s.stop - s.start <= tile_size
+        count[tile] += 1
+        blend[tile] += _get_tile_weights(tile, shape, overlap)
+    assert np.all(count >= 1)
+    assert np.all(blend > 0)
+
+    # Neighbouring tiles share at least `overlap` points
+    for axis in range(3):
+        starts = sorted({tile[axis].start for tile in tiles})
+        stops = sorted({tile[axis].stop for tile in tiles})
+        assert all(stop - start >= overlap for start, stop in zip(starts[1::], stops[0:-1]))
+
+
+def test_weights_sum_to_one_with_the_exact_overlap():
+    # Two tiles of 12 points along x with 4 points in common
+    shape = (4, 4, 20)
+    tiles = [(slice(0, 4), slice(0, 4), slice(0, 12)), (slice(0, 4), slice(0, 4), slice(8, 20))]
+    total = np.zeros(shape)
+    for tile in tiles:
+        total[tile] += _get_tile_weights(tile, shape, 4)
+    assert np.allclose(total, 1)
+
+
+def test_blending_keeps_the_image(monkeypatch):
+    # With the identity as denoiser, the blended tiles give back the image
+    monkeypatch.setattr(bm4dmanager, '_denoise_tile', lambda job: job[0])
+    image = _get_image(shape=(10, 30, 24))
+    result = bm4d_filter(image, 0.2, tile_size=12, overlap=4, n_workers=2)
+    assert np.allclose(result, image)
+
+
+def test_single_tile_is_bm4d():
+    image = _get_image()
+    result = bm4d_filter(image, 0.2, fast=True, tile_size=64, n_workers=4)
+    reference = bm4d.bm4d(image, sigma_psd=0.2, stage_arg=bm4d.BM4DStages.HARD_THRESHOLDING)
+    assert np.allclose(result, reference)
+
+
+def test_workers_give_the_same_image():
+    image = _get_image()
+    sequential = bm4d_filter(image, 0.2, fast=True, tile_size=12, overlap=6, n_workers=1)
+    threads = bm4d_filter(image, 0.2, fast=True, tile_size=12, overlap=6, n_workers=2)
+    processes = bm4d_filter(image, 0.2, fast=True, tile_size=12, overlap=6, n_workers=2, processes=True)
+    assert np.array_equal(threads, sequential)
+    assert np.array_equal(processes, sequential)
+
+    # The tiled image is denoised
+    clean = _get_image() - 0.2 * np.random.default_rng(0).standard_normal(image.shape)
+    assert np.linalg.norm(sequential - clean) < 0.5 * np.linalg.norm(image - clean)
+
+
+def test_noise_std_of_the_image():
+    # White noise of std 1 in each component, the image noise is std / sqrt(n_scans * n_points)
+    rng = np.random.default_rng(0)
+    noise = rng.standard_normal(60000) + 1j * rng.standard_normal(60000)
+    assert np.isclose(estimate_noise_std(noise, n_points=100, factor=1), 0.1, rtol=0.02)
+    assert np.isclose(estimate_noise_std(noise, n_points=100, n_scans=4, factor=1), 0.05, rtol=0.02)
+
+    # The decimation keeps 1 / factor of the noise power of white noise
+    std = estimate_noise_std(noise, n_points=1, factor=6)
+    assert np.isclose(std, np.sqrt(1 / 6), rtol=0.05)
+
+
+def test_noise_std_default_factor(monkeypatch):
+    # Without factor, the oversampling factor of the hardware at the time of the call
+    rng = np.random.default_rng(0)
+    noise = rng.standard_normal(60000) + 1j * rng.standard_normal(60000)
+    monkeypatch.setattr(bm4dmanager.hw, 'oversamplingFactor', 6)
+    assert estimate_noise_std(noise, n_points=1) == estimate_noise_std(noise, n_points=1, factor=6)
+    monkeypatch.setattr(bm4dmanager.hw, 'oversamplingFactor', 1)
+    assert estimate_noise_std(noise, n_points=1) == estimate_noise_std(noise, n_points=1, factor=1)
@@ -0,0 +1,73 @@
+"""
+@author: J.M. Algarín, MRILab, i3M, CSIC, Valencia
+@email: josalggui@i3m.upv.es
+@Summary: tests of the cache of compiled waveforms
+"""
+
+import numpy as np
+
+import configs.hw_config as hw
+from manager.cachemanager import WaveformCache
+
+
+class Sequence:
+    # Minimal sequence with the input parameters in mapVals
+    def __init__(self, **inputs):
+        self.mapKeys = list(inputs)
+        self.mapVals = dict(inputs)
+
+
+def test_key_depends_on_the_inputs():
+    cache = WaveformCache()
+    sequence = Sequence(nPoints=[60, 60, 1], etl=5, fov=np.array([0.1, 0.1, 0.1]))
+    key = cache.get_key(sequence, 'createBatches')
+
+    # The key does not depend on the order of the inputs or on the outputs in mapVals
+    reordered = Sequence(etl=5, fov=np.array([0.1, 0.1, 0.1]), nPoints=[60, 60, 1])
+    reordered.mapVals['data_full'] = np.zeros(10)
+    assert cache.get_key(reordered, 'createBatches') == key
+
+    # Any change of the inputs, the function or its arguments gives a new key
+    assert cache.get_key(Sequence(nPoints=[60, 60, 1], etl=6, fov=np.array([0.1, 0.1, 0.1])), 'createBatches') != key
+    assert cache.get_key(Sequence(nPoints=[60, 60, 1], etl=5, fov=np.array([0.1, 0.1, 0.2])), 'createBatches') != key
+    assert cache.get_key(sequence, 'createBatch') != key
+    assert cache.get_key(sequence, 'createBatches', 1) != key
+
+
+def test_key_depends_on_the_hardware():
+    cache = WaveformCache()
+    sequence = Sequence(etl=5)
+    key = cache.get_key(sequence)
+    larmor_freq = hw.larmorFreq
+    hw.larmorFreq = larmor_freq + 1e-3
+    try:
+        assert cache.get_key(sequence) != key
+    finally:
+        hw.larmorFreq = larmor_freq
+    assert cache.get_key(sequence) == key
+
+
+def test_lru_eviction():
+    cache = WaveformCache(max_bytes=3 * 800, max_items=10)
+    for key in 'abc':
+        cache.put(key, ({'g0': np.zeros(100)}, {'readout_number': 1}))
+    assert len(cache) == 3 and cache.n_bytes == 3 * 800
+
+    # Using 'a' makes 'b' the least recently used
+    assert cache.get('a') is not None
+    cache.put('d', {'g0': np.zeros(100)})
+    assert 'b' not in cache and all(key in cache for key in 'acd')
+    assert cache.get('b') is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # Values larger than the cache are not stored
+    cache.put('e', np.zeros(1000))
+    assert 'e' not in cache and len(cache) == 3
+
+    # Maximum number of items
+    cache.max_items = 2
+    cache.put('f', np.zeros(1))
+    assert len(cache) == 2 and 'f' in cache
+
+    cache.clear()
+    assert len(cache) == 0 and cache.n_bytes == 0 and cache.hits == 0
@@ -0,0 +1,101 @@
+"""
+@author: J.M. Algarín, MRILab, i3M, CSIC, Valencia
+@email: josalggui@i3m.upv.es
+@Summary: tests of the compressed sensing reconstruction and of the variable density masks
+"""
+
+import numpy as np
+import pytest
+
+from manager.csmanager import cs_reconstruction, get_variable_density_mask, _get_haar_plan, _haar_forward, \
+    _haar_inverse
+from manager.fftmanager import fftnc, ifftnc
+
+N_POINTS = (4, 32, 32)  # nz, ny, nx
+
+
+def _get_distance(shape=N_POINTS):
+    # Normalized distance to the center of k-space in the phase and slice directions, as in the sequences
+    axes = [np.linspace(-1, 1, n) if n > 1 else np.zeros(1) for n in shape[0:2]]
+    z, y = np.meshgrid(*axes, indexing='ij')
+    return np.sqrt(z ** 2 + y ** 2)
+
+
+def _get_phantom():
+    # Piecewise constant image, sparse in gradient and in Haar wavelets
+    image = np.zeros(N_POINTS)
+    image[:, 8:24, 8:24] = 1
+    image[:, 12:20, 14:18] = 2
+    return image, fftnc(image)
+
+
+def _get_mask(factor=3):
+    # Undersampling along the phase and slice directions, with full readouts
+    mask = get_variable_density_mask(_get_distance(), factor, center=0.15)
+    return np.broadcast_to(mask[:, :, np.newaxis], N_POINTS)
+
+
+@pytest.mark.parametrize("shape, levels", [((4, 8, 16), 3), ((1, 12, 10), 3), ((3, 5, 7), 2), ((2, 6, 8, 4), 2)])
+def test_haar_is_orthonormal(shape, levels):
+    rng = np.random.default_rng(0)
+    x = rng.standard_normal(shape) + 1j * rng.standard_normal(shape)
+    plan, low_shape = _get_haar_plan(shape[-3:], levels)
+    c = _haar_forward(x, plan)
+    assert np.isclose(np.linalg.norm(c), np.linalg.norm(x))
+    assert np.allclose(_haar_inverse(c, plan), x)
+
+
+def test_variable_density_mask():
+    distance = _get_distance((16, 64))
+    mask = get_variable_density_mask(distance, 4, center=0.2)
+    assert mask.dtype == bool
+    assert np.all(mask[distance <= 0.2])
+    assert not np.any(mask[distance > 1])
+    assert np.isclose(np.sum(mask), np.sum(distance <= 1) / 4, rtol=0.1)
+
+    # Reproducible with the same seed, different with other seed
+    assert np.array_equal(get_variable_density_mask(distance, 4, center=0.2), mask)
+    assert not np.array_equal(get_variable_density_mask(distance, 4, center=0.2, seed=1), mask)
+
+    # Without undersampling all the points inside the unit sphere are acquired
+    assert np.array_equal(get_variable_density_mask(distance, 1), distance <= 1)
+
+
+@pytest.mark.parametrize("method", ['tv', 'wavelet'])
+def test_improves_zero_filling(method):
+    image, k_space = _get_phantom()
+    mask = _get_mask()
+    zero_filled = ifftnc(np.where(mask, k_space, 0))
+    error_zero = np.linalg.norm(zero_filled - image)
+
+    result = cs_reconstruction(np.where(mask, k_space, 0), mask=mask, method=method, lam=0.01, n_iter=100)
+    assert result.shape == N_POINTS
+    assert np.linalg.norm(result - image) < 0.7 * error_zero
+
+    # Single precision gives the same image
+    single = cs_reconstruction(np.where(mask, k_space, 0), mask=mask, method=method, lam=0.01, n_iter=100,
+                               single=True)
+    assert single.dtype == np.complex64
+    assert np.allclose(single, result, atol=1e-3 * np.max(np.abs(result)))
+
+
+def test_unknown_method_gives_zero_filling():
+    image, k_space = _get_phantom()
+    mask = _get_mask()
+    zero_filled = ifftnc(np.where(mask, k_space, 0))
+    assert np.allclose(cs_reconstruction(k_space, mask=mask, method='unknown'), zero_filled)
+
+    # Without mask, the points different from zero are the acquired points
+    assert np.allclose(cs_reconstruction(np.where(mask, k_space, 0), method='unknown'), zero_filled)
+
+
+def test_leading_axes_are_a_batch():
+    image, k_space = _get_phantom()
+    mask = _get_mask()
+    single = cs_reconstruction(k_space, mask=mask, n_iter=10, threshold=0)
+    batch = cs_reconstruction(np.stack([k_space, k_space]), mask=mask, n_iter=10, threshold=0)
+    assert batch.shape == (2,) + N_POINTS
+    assert np.allclose(batch[0], single) and np.allclose(batch[1], single)
+
+    # lam is relative to the zero-filled image, so the result scales with the data
+    assert np.allclose(cs_reconstruction(2 * k_space, mask=mask, n_iter=10, threshold=0), 2 * single)
@@ -0,0 +1,64 @@
+"""
+@author: J.M. Algarín, MRILab, i3M, CSIC, Valencia
+@email: josalggui@i3m.upv.es
+@Summary: tests of the streaming decimation of the oversampled data
+"""
+
+import numpy as np
+import pytest
+import scipy.signal as sig
+
+from manager.decimationmanager import StreamDecimator
+
+
+def _get_data(n, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.standard_normal(n) + 1j * rng.standard_normal(n)
+
+
+@pytest.mark.parametrize("factor", [2, 5, 6])
+@pytest.mark.parametrize("offset", [0, 1, 2])
+@pytest.mark.parametrize("chunk", [7, 120, 1000])
+def test_equals_decimate(factor, offset, chunk):
+    data = _get_data(100 * factor * 6 + 3)
+    reference = sig.decimate(data[offset::], factor, ftype='fir', zero_phase=True)
+
+    decimator = StreamDecimator(n_points=data.size, factor=factor, offset=offset, keep_input=True)
+    for start in range(0, data.size, chunk):
+        decimator.feed(data[start:start + chunk])
+
+        # The samples decimated up to now do not change when more data arrives
+        n = decimator.data_decimated.size
+        assert np.allclose(decimator.data_decimated, reference[0:n])
+    result = decimator.finish()
+
+    assert result.shape == reference.shape
+    assert np.allclose(result, reference)
+    assert np.array_equal(decimator.data_over, data)
+
+
+def test_decimate_of_the_sequences():
+    # Same offset than MRIBLANKSEQ.decimate, scan after scan, with buffers smaller than the data
+    factor = 6
+    scans = [_get_data(40 * factor, seed) for seed in range(4)]
+    data = np.concatenate(scans)
+    offset = int((factor - 1) / 2)
+    reference = sig.decimate(data[offset::], factor, ftype='fir', zero_phase=True)
+
+    decimator = StreamDecimator(factor=factor, offset=offset)
+    outputs = [decimator.feed(scan).copy() for scan in scans]
+    result = decimator.finish()
+
+    assert np.allclose(result, reference)
+    assert np.allclose(np.concatenate(outputs), reference[0:sum(output.size for output in outputs)])
+    assert decimator.data_over is None
+
+
+def test_single_precision():
+    factor = 6
+    data = _get_data(60 * factor).astype(np.complex64)
+    decimator = StreamDecimator(n_points=data.size, factor=factor, dtype=np.complex64)
+    decimator.feed(data)
+    result = decimator.finish()
+    assert result.dtype == np.complex64
+    assert np.allclose(result, sig.decimate(data, factor, ftype='fir', zero_phase=True), atol=1e-5)
@@ -0,0 +1,63 @@
+"""
+@author: J.M. Algarín, MRILab, i3M, CSIC, Valencia
+@email: josalggui@i3m.upv.es
+@Summary: tests of the centered FFTs of the FFT service
+"""
+
+import numpy as np
+import pytest
+
+from manager.fftmanager import FftService, fftnc, ifftnc
+
+
+def _ifftnc(k_space, axes=None):
+    # Centered inverse FFT used before the FFT service
+    return np.fft.ifftshift(np.fft.ifftn(np.fft.ifftshift(k_space, axes=axes), axes=axes), axes=axes)
+
+
+def _fftnc(image, axes=None):
+    # Centered direct FFT used before the FFT service
+    return np.fft.fftshift(np.fft.fftn(np.fft.fftshift(image, axes=axes), axes=axes), axes=axes)
+
+
+def _get_data(shape, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.standard_normal(shape) + 1j * rng.standard_normal(shape)
+
+
+SHAPES_AXES = [((8,), None), ((7,), None), ((6, 5, 4), None), ((5, 7, 9), None), ((1, 6, 5), None),
+               ((4, 6, 3, 10), (1, 2, 3)), ((3, 5, 6, 7), (0, 2)), ((4, 5, 6), (-1,)), ((6, 4), ())]
+
+
+@pytest.mark.parametrize("shape, axes", SHAPES_AXES)
+def test_matches_the_shifted_transforms(shape, axes):
+    data = _get_data(shape)
+    copy = data.copy()
+    assert np.allclose(ifftnc(data, axes=axes), _ifftnc(data, axes=axes))
+    assert np.allclose(fftnc(data, axes=axes), _fftnc(data, axes=axes))
+
+    # The input is not modified by the in-place operations
+    assert np.array_equal(data, copy)
+
+
+@pytest.mark.parametrize("backend", ['scipy', 'numpy'])
+@pytest.mark.parametrize("shape, axes", SHAPES_AXES[0:6])
+def test_backends_and_round_trip(backend, shape, axes):
+    service = FftService(backend=backend, workers=2)
+    data = _get_data(shape)
+    assert np.allclose(service.ifftn(data, axes=axes), _ifftnc(data, axes=axes))
+    assert np.allclose(service.fftn(service.ifftn(data, axes=axes), axes=axes), data)
+
+
+def test_single_precision():
+    service = FftService(single=True)
+    data = _get_data((6, 5, 8))
+    image = service.ifftn(data)
+    assert image.dtype == np.complex64
+    assert np.allclose(image, _ifftnc(data), atol=1e-5)
+
+
+def test_real_input():
+    data = np.random.default_rng(0).standard_normal((4, 7))
+    assert np.allclose(ifftnc(data), _ifftnc(data))
+    assert ifftnc(data).dtype == complex
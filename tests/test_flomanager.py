@@ -0,0 +1,150 @@
+"""
+@author: J.M. Algarín, MRILab, i3M, CSIC, Valencia
+@email: josalggui@i3m.upv.es
+@Summary: tests of the flo_dict buffers and of the estimation of the instructions and readout points of the batches
+"""
+
+import numpy as np
+import pypulseq as pp
+import pytest
+
+import configs.hw_config as hw
+from manager.flomanager import FloChannel, FloDict, FloBudget
+
+
+def test_channel_append_matches_concatenation():
+    rng = np.random.default_rng(0)
+    channel = FloChannel(dtype=complex, capacity=4)
+    times = [np.array([])]
+    amps = [np.array([], dtype=complex)]
+    for n in rng.integers(1, 50, size=100):
+        t = rng.random(n)
+        a = rng.random(n) + 1j * rng.random(n)
+        channel.append(t, a)
+        times.append(t)
+        amps.append(a)
+
+    # Same content than the old flo_dict, where the arrays were concatenated on every event
+    assert len(channel) == sum(t.size for t in times)
+    assert np.array_equal(channel[0], np.concatenate(times))
+    assert np.array_equal(channel[1], np.concatenate(amps))
+    t, a = channel
+    assert np.array_equal(t, channel.times) and np.array_equal(a, channel.amps)
+
+
+def test_channel_single_amplitude_is_broadcast():
+    channel = FloChannel()
+    channel.append([1.0, 2.0, 3.0], 0.5)
+    assert np.array_equal(channel.amps, [0.5, 0.5, 0.5])
+
+
+def test_channel_set_and_clear():
+    channel = FloChannel(capacity=2)
+    channel.append(np.arange(10), np.arange(10))
+    capacity = channel._times.shape[0]
+    channel.set([1, 2], [3, 4])
+    assert np.array_equal(channel[0], [1, 2]) and np.array_equal(channel[1], [3, 4])
+
+    # The values can be replaced in place only with the same length
+    channel[1] = [5, 6]
+    assert np.array_equal(channel[1], [5, 6])
+    with pytest.raises(ValueError):
+        channel[0] = [1, 2, 3]
+    with pytest.raises(IndexError):
+        channel[2]
+
+    # Clear keeps the allocated memory
+    channel.clear()
+    assert len(channel) == 0 and channel._times.shape[0] == capacity
+
+
+def test_flo_dict_channels():
+    flo_dict = FloDict()
+    assert set(flo_dict) == set(FloDict.channels)
+    assert flo_dict['tx0'][1].dtype == complex and flo_dict['g0'][1].dtype == float
+
+    flo_dict['g0'].append([0, 10], [0.1, 0])
+    copy = flo_dict.to_dict()
+    flo_dict.clear_channels()
+    assert all(len(channel) == 0 for channel in flo_dict.values())
+    assert np.array_equal(copy['g0'][0], [0, 10]) and np.array_equal(copy['g0'][1], [0.1, 0])
+
+
+def _get_baseline_batches(n_trains, n_rd_points_0, n_rd_points_per_train, max_rd_points):
+    # Number of batches of the planners of RARE_pp and MSE_PP before FloBudget: a new batch is started when the
+    # readout points of the next echo train do not fit
+    n_batches = 0
+    n_rd_points = 0
+    for idx in range(n_trains):
+        if idx == 0 or n_rd_points + n_rd_points_per_train > max_rd_points:
+            n_batches += 1
+            n_rd_points = n_rd_points_0
+        n_rd_points += n_rd_points_per_train
+    return n_batches
+
+
+@pytest.mark.parametrize("n_trains, n_rd_points_0, n_rd_points_per_train, max_rd_points",
+                         [(64, 0, 160, 2000), (64, 0, 160, 1500), (100, 80, 400, 2000), (7, 0, 2000, 2000),
+                          (30, 50, 300, 300)])
+def test_plan_batches_matches_baseline(n_trains, n_rd_points_0, n_rd_points_per_train, max_rd_points):
+    batch = FloBudget({'tx0': 10}, {'rx0': n_rd_points_0})
+    train = FloBudget({'tx0': 20, 'g0': 30}, {'rx0': n_rd_points_per_train})
+    ranges = batch.plan_batches([train] * n_trains, 2 ** 14, max_rd_points)
+
+    assert len(ranges) == _get_baseline_batches(n_trains, n_rd_points_0, n_rd_points_per_train, max_rd_points)
+    assert ranges[0][0] == 0 and ranges[-1][1] == n_trains
+    assert all(stop > start for start, stop in ranges)
+    assert all(ranges[idx][1] == ranges[idx + 1][0] for idx in range(len(ranges) - 1))
+
+
+def test_plan_batches_limited_by_orders():
+    batch = FloBudget({'tx0': 100})
+    train = FloBudget({'tx0': 300, 'g0': 200}, {'rx0': 10})
+    ranges = batch.plan_batches([train] * 10, 1200, 10 ** 6)
+    assert [stop - start for start, stop in ranges] == [2, 2, 2, 2, 2]
+    assert all((batch + train + train).fits(1200, 10 ** 6) for _ in ranges)
+    assert batch.get_repetitions(train, 1200, 10 ** 6) == 3
+    assert FloBudget({'tx0': 2000}).get_repetitions(train, 1200, 10 ** 6) == 0
+
+
+def test_mse_pp_budget_counts_decimated_points():
+    # Echo train of MSE_PP, with the adc oversampled by hw.oversamplingFactor, and the batch count of the original
+    # planner, that counted n_echo * (nRD + nRD_pre + nRD_post) readout points per echo train
+    n_rd, n_ph, n_echo, n_add, factor = 60, 64, 2, hw.addRdPoints, hw.oversamplingFactor
+    system = pp.Opts(rf_dead_time=hw.blkTime * 1e-6, max_grad=np.max(hw.gFactor) * 1e3, grad_unit='mT/m',
+                     max_slew=hw.max_slew_rate, slew_unit='mT/m/ms', grad_raster_time=hw.grad_raster_time,
+                     rise_time=hw.grad_rise_time, rf_raster_time=1e-6, block_duration_raster=1e-6)
+    rf_ex = pp.make_block_pulse(flip_angle=np.pi / 2, duration=50e-6, system=system)
+    rf_ref = pp.make_block_pulse(flip_angle=np.pi, duration=100e-6, system=system)
+    gr = pp.make_trapezoid(channel='x', area=1000, duration=2e-3, system=system)
+    gp = pp.make_trapezoid(channel='y', area=200, duration=1e-3, system=system)
+    adc = pp.make_adc(num_samples=(n_rd + 2 * n_add) * factor, dwell=5e-6 / factor, delay=1e-4)
+    train_blocks = [(rf_ex, pp.make_delay(1e-4)), (gr, pp.make_delay(2e-3))]
+    train_blocks += [(rf_ref, pp.make_delay(2e-4)), (gr, gp, adc)] * n_echo
+    train_blocks.append((pp.make_delay(0.1),))
+
+    train_budget = FloBudget.from_blocks(train_blocks, hw.grad_raster_time, factor)
+    assert train_budget.n_rd_points == n_echo * (n_rd + 2 * n_add)
+    assert FloBudget.from_blocks(train_blocks, hw.grad_raster_time).n_rd_points == n_echo * (n_rd + 2 * n_add) * factor
+
+    ranges = FloBudget().plan_batches([train_budget] * n_ph, hw.maxOrders, 2000)
+    assert len(ranges) == _get_baseline_batches(n_ph, 0, n_echo * (n_rd + 2 * n_add), 2000) == 6
+
+
+def test_mse_pp_batch_count():
+    # Full MSE_PP sequence in demo mode, it needs marcos_client next to the MaRGE folder
+    pytest.importorskip('experiment')
+    from seq.mse_pp import MSE
+
+    max_rd_points = hw.maxRdPoints
+    hw.maxRdPoints = 2000
+    try:
+        sequence = MSE()
+        sequence.mapVals['nPoints'] = [60, 64, 1]
+        sequence.mapVals['etl'] = 2
+        sequence.sequenceAtributes()
+        sequence.sequenceRun(plotSeq=False, demo=True)
+    finally:
+        hw.maxRdPoints = max_rd_points
+    n_rd_points_per_train = 2 * (60 + 2 * hw.addRdPoints)
+    assert len(sequence.seq_batches) == _get_baseline_batches(64, 0, n_rd_points_per_train, 2000)
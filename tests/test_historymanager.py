@@ -0,0 +1,99 @@
+"""
+@author: J.M. Algarín, MRILab, i3M, CSIC, Valencia
+@email: josalggui@i3m.upv.es
+@Summary: tests of the history of images with a RAM budget
+"""
+
+import gc
+import os
+import numpy as np
+import pytest
+
+from manager import historymanager
+from manager.historymanager import ImageHistory
+
+
+def _get_image(value, n=100):
+    # Complex image of n * 16 bytes
+    return np.full(n, value, dtype=complex)
+
+
+def test_least_recently_used_images_go_to_disk(tmp_path):
+    history = ImageHistory(directory=str(tmp_path), ram_budget=2 * 1600)
+    for key in ['a', 'b', 'c']:
+        history[key] = _get_image(ord(key))
+
+    # 'a' is moved to disk, and its file has the image
+    assert history.get_usage('a') == (0, os.path.getsize(os.path.join(str(tmp_path), os.listdir(str(tmp_path))[0])))
+    assert history.get_usage('b') == (1600, 0) and history.get_usage('c') == (1600, 0)
+    assert len(os.listdir(str(tmp_path))) == 1
+    assert list(history) == ['b', 'c', 'a'] and len(history) == 3 and 'a' in history
+
+    # Using 'b' makes 'c' the least recently used image
+    history['b']
+    history['d'] = _get_image(ord('d'))
+    assert history.get_usage('c')[0] == 0 and history.get_usage('b') == (1600, 0)
+
+    # Reading 'a' back loads it into RAM, deletes its file and moves another image to disk
+    image = history['a']
+    assert isinstance(image, np.ndarray) and not isinstance(image, np.memmap)
+    assert np.array_equal(image, _get_image(ord('a')))
+    assert history.get_usage('a') == (1600, 0)
+    assert len(os.listdir(str(tmp_path))) == 2
+    ram, disk = history.get_total_usage()
+    assert ram == 2 * 1600 and disk > 2 * 1600
+
+
+def test_last_image_is_kept_in_ram(tmp_path):
+    history = ImageHistory(directory=str(tmp_path), ram_budget=100)
+    history['a'] = _get_image(1)
+    assert history.get_usage('a') == (1600, 0)
+    history['b'] = _get_image(2)
+    assert history.get_usage('a')[0] == 0 and history.get_usage('b') == (1600, 0)
+
+    # A larger budget does not load the images back, a smaller one moves them to disk
+    history.ram_budget = 10 ** 6
+    assert history.get_usage('a')[0] == 0
+    history['a']
+    history.ram_budget = 0
+    assert history.get_usage('b')[0] == 0 and history.get_usage('a') == (1600, 0)
+
+
+def test_replace_and_delete(tmp_path):
+    history = ImageHistory(directory=str(tmp_path), ram_budget=1600)
+    history['a'] = _get_image(1)
+    history['b'] = _get_image(2)
+    history['a'] = _get_image(3)
+    assert np.array_equal(history['a'], _get_image(3))
+
+    del history['b']
+    assert 'b' not in history and len(history) == 1
+    with pytest.raises(KeyError):
+        del history['b']
+    with pytest.raises(KeyError):
+        history['b']
+    assert history.get_usage('b') == (0, 0)
+
+    history['b'] = _get_image(2)
+    history.clear()
+    assert len(history) == 0 and os.listdir(str(tmp_path)) == []
+
+
+def test_files_are_removed_with_the_history(tmp_path):
+    history = ImageHistory(directory=str(tmp_path), ram_budget=0)
+    for key in range(3):
+        history[key] = _get_image(key)
+    assert len(os.listdir(str(tmp_path))) == 2
+
+    del history
+    gc.collect()
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_ram_budget_from_hw_config(tmp_path, monkeypatch):
+    monkeypatch.setattr(historymanager.hw, 'history_ram_budget', 0.5, raising=False)
+    assert ImageHistory(directory=str(tmp_path)).ram_budget == 512 * 1024 ** 2
+
+    # Default budget for hw_config files without the setting
+    monkeypatch.delattr(historymanager.hw, 'history_ram_budget', raising=False)
+    assert ImageHistory(directory=str(tmp_path)).ram_budget == historymanager.RAM_BUDGET
@@ -0,0 +1,83 @@
+"""
+@author: J.M. Algarín, MRILab, i3M, CSIC, Valencia
+@email: josalggui@i3m.upv.es
+@Summary: tests of the selective reading of the .mat files
+"""
+
+import os
+import numpy as np
+import pytest
+from scipy.io import savemat, loadmat
+
+from manager import matmanager
+from manager.matmanager import MatReader
+
+
+def _get_raw_data(seed=0):
+    # Variables as in the .mat files of the acquisitions
+    rng = np.random.default_rng(seed)
+    return {'seqName': 'RARE',
+            'nPoints': np.array([60, 60, 1]),
+            'bandwidth': 0.03,
+            'dataFull': rng.standard_normal((2, 1, 60, 60)) + 1j * rng.standard_normal((2, 1, 60, 60)),
+            'sampledCartesian': rng.standard_normal((3600, 4)),
+            'dicom': {'rows': 60, 'columns': 60}}
+
+
+def _count_loads(monkeypatch):
+    # Record the variables read from the file
+    loads = []
+    load = matmanager._load
+
+    def _load(file_path, variable_names):
+        loads.append(list(variable_names))
+        return load(file_path, variable_names)
+
+    monkeypatch.setattr(matmanager, '_load', _load)
+    return loads
+
+
+def test_small_variables_first_and_large_on_access(tmp_path, monkeypatch):
+    file_path = str(tmp_path / 'raw.mat')
+    savemat(file_path, _get_raw_data())
+    reference = loadmat(file_path)
+    loads = _count_loads(monkeypatch)
+
+    reader = MatReader(file_path)
+    assert sorted(reader) == sorted(_get_raw_data()) and len(reader) == 6
+    assert sorted(loads[0]) == ['bandwidth', 'nPoints', 'seqName']
+    assert reader.is_loaded('nPoints') and not reader.is_loaded('dataFull') and not reader.is_loaded('dicom')
+    assert reader.shapes['dataFull'] == (2, 1, 60, 60)
+
+    # Large arrays are read once, with the same values as loadmat
+    assert np.array_equal(reader['dataFull'], reference['dataFull'])
+    reader['dataFull']
+    assert loads[1:] == [['dataFull']]
+    for name in ['seqName', 'nPoints', 'bandwidth', 'sampledCartesian']:
+        assert np.array_equal(reader[name], reference[name])
+    assert reader['dicom']['rows'] == reference['dicom']['rows']
+
+    assert 'dataFull' in reader and 'imgFull' not in reader
+    with pytest.raises(KeyError):
+        reader['imgFull']
+
+
+def test_metadata_is_cached_for_the_session(tmp_path, monkeypatch):
+    file_path = str(tmp_path / 'raw.mat')
+    savemat(file_path, _get_raw_data())
+    loads = _count_loads(monkeypatch)
+
+    MatReader(file_path)
+    reader = MatReader(file_path, variable_names=['dataFull', 'sampledCartesian', 'imgFull'])
+    assert len(loads) == 2
+    assert sorted(loads[1]) == ['dataFull', 'sampledCartesian']
+    assert reader.is_loaded('dataFull') and not reader.is_loaded('imgFull')
+
+    # A modified file is read again
+    data = _get_raw_data()
+    data['seqName'] = 'GRE3D'
+    savemat(file_path, data)
+    status = os.stat(file_path)
+    os.utime(file_path, ns=(status.st_atime_ns, status.st_mtime_ns + 10 ** 9))
+    assert MatReader(file_path)['seqName'] == 'GRE3D'
+    assert len(loads) == 3
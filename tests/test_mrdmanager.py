@@ -0,0 +1,271 @@
+"""
+@author: J.M. Algarín, MRILab, i3M, CSIC, Valencia
+@email: josalggui@i3m.upv.es
+@Summary: tests of the reading of ISMRMRD raw data and of the writing of the acquisitions in blocks
+"""
+
+import ctypes
+import h5py
+import numpy as np
+import pytest
+import ismrmrd
+
+from manager.mrdmanager import MrdReader, append_acquisitions, get_rare_header, get_gre_header
+
+N_SCANS, N_SL, N_PH, N_RD, N_ADD = 2, 3, 8, 6, 2
+
+
+def _get_data(n_channels=1, seed=0):
+    # Readouts with the added points, with shape (scans, slices, phases, channels, points)
+    rng = np.random.default_rng(seed)
+    shape = (N_SCANS, N_SL, N_PH, n_channels, N_RD + 2 * N_ADD)
+    return (rng.standard_normal(shape) + 1j * rng.standard_normal(shape)).astype(np.complex64)
+
+
+def _write_file(file_name, data, ind, start=1, skip=()):
+    # Acquisitions appended one by one with ismrmrd, in acquisition order, with the phase lines swept as ind
+    dset = ismrmrd.Dataset(file_name, '/dataset', True)
+    for scan in range(N_SCANS):
+        for slice_idx in range(N_SL):
+            for phase_idx in range(N_PH):
+                if (scan, slice_idx, phase_idx) in skip:
+                    continue
+                acq = ismrmrd.Acquisition.from_array(data[scan, slice_idx, phase_idx], None)
+                acq.idx.kspace_encode_step_1 = ind[phase_idx] + start
+                acq.idx.slice = slice_idx + start
+                acq.idx.average = scan + start
+                acq.discard_pre = N_ADD
+                acq.discard_post = N_ADD
+                dset.append_acquisition(acq)
+    dset.close()
+
+
+def _get_k_space(data, ind):
+    # k-space of the first channel without the added points, with shape (scans, slices, phases, points)
+    k_space = np.zeros(data.shape[0:3] + (N_RD,), dtype=np.complex64)
+    k_space[:, :, ind, :] = data[:, :, :, 0, N_ADD:N_ADD + N_RD]
+    return k_space
+
+
+def test_read_places_the_acquisitions(tmp_path):
+    file_name = str(tmp_path / 'raw.h5')
+    ind = np.random.default_rng(1).permutation(N_PH)
+    data = _get_data()
+    _write_file(file_name, data, ind)
+    reference = _get_k_space(data, ind)
+
+    with MrdReader(file_name) as reader:
+        assert (reader.n_averages, reader.n_slices, reader.n_phases) == (N_SCANS, N_SL, N_PH)
+        k_space = reader.read()
+        assert k_space.dtype == np.complex64
+        assert np.array_equal(k_space, reference)
+        assert np.array_equal(reader.read(discard=False)[:, :, ind], data[:, :, :, 0, :])
+
+        # Selection of slices and averages
+        assert np.array_equal(reader.read(slices=[2, 0], averages=1), reference[1:2][:, [2, 0]])
+        assert np.allclose(reader.read_mean(slices=[1]), np.mean(reference[:, 1:2], axis=0))
+
+        # Rows sorted as k-space and data of some rows, in the requested order
+        rows = reader.order
+        assert np.array_equal(reader.average[rows], np.repeat(np.arange(N_SCANS), N_SL * N_PH))
+        assert np.array_equal(reader.phase[rows], np.tile(np.arange(N_PH), N_SCANS * N_SL))
+        lines = reader.read_lines([5, 1, 5])
+        assert np.array_equal(lines, np.reshape(data, (-1, N_RD + 2 * N_ADD))[[5, 1, 5]])
+        assert reader.read_lines([]).shape == (0, 0)
+
+
+def test_first_channel_and_missing_acquisitions(tmp_path):
+    file_name = str(tmp_path / 'raw.h5')
+    ind = np.arange(N_PH)
+    data = _get_data(n_channels=2)
+    _write_file(file_name, data, ind, skip=[(0, 1, 3)])
+    reference = _get_k_space(data, ind)
+    reference[0, 1, 3] = 0
+
+    with MrdReader(file_name) as reader:
+        assert np.array_equal(reader.read(), reference)
+        assert reader.read_lines([0]).shape == (1, 2 * (N_RD + 2 * N_ADD))
+
+
+def test_indexes_starting_at_zero(tmp_path):
+    # Files of other writers with the encoding counters starting at 0
+    file_name = str(tmp_path / 'raw.h5')
+    ind = np.arange(N_PH)[::-1]
+    data = _get_data()
+    _write_file(file_name, data, ind, start=0)
+    with MrdReader(file_name) as reader:
+        assert (reader.n_averages, reader.n_slices, reader.n_phases) == (N_SCANS, N_SL, N_PH)
+        assert np.array_equal(reader.read(), _get_k_space(data, ind))
+
+
+# Fields of the header common to all the acquisitions, as in save_ismrmrd
+SAMPLE_TIME, POSITION, READ_DIR, PHASE_DIR, SLICE_DIR = 1 / 0.03, [1.0, 2.0, 3.0], [0, 0, 1], [0, 1, 0], [1, 0, 0]
+
+
+def _set_common(acq, discard):
+    if discard:
+        acq.discard_pre = N_ADD
+        acq.discard_post = N_ADD
+    acq.sample_time_us = SAMPLE_TIME
+    acq.position = (ctypes.c_float * 3)(*POSITION)
+    acq.read_dir = (ctypes.c_float * 3)(*READ_DIR)
+    acq.phase_dir = (ctypes.c_float * 3)(*PHASE_DIR)
+    acq.slice_dir = (ctypes.c_float * 3)(*SLICE_DIR)
+
+
+def _get_common(discard):
+    common = {'sample_time_us': SAMPLE_TIME, 'position': POSITION, 'read_dir': READ_DIR, 'phase_dir': PHASE_DIR,
+              'slice_dir': SLICE_DIR}
+    if discard:
+        common.update(discard_pre=N_ADD, discard_post=N_ADD)
+    return common
+
+
+def _old_rare(dset, data, n_scans, etl, ind, averages=True):
+    # Acquisition by acquisition writing of RARE before append_acquisitions
+    n_rep = (N_PH // etl) * N_SL
+    counter = 0
+    for scan in range(n_scans):
+        for slice_idx in range(N_SL):
+            for phase_idx in range(N_PH):
+                acq = ismrmrd.Acquisition.from_array(np.reshape(data[scan, slice_idx, phase_idx], (1, -1)), None)
+                index_in_repetition = phase_idx % etl
+                current_repetition = (phase_idx // etl) + (slice_idx * (N_PH // etl))
+                acq.clearAllFlags()
+                if index_in_repetition == 0:
+                    acq.setFlag(ismrmrd.ACQ_FIRST_IN_CONTRAST)
+                elif index_in_repetition == etl - 1:
+                    acq.setFlag(ismrmrd.ACQ_LAST_IN_CONTRAST)
+                if ind[phase_idx] == 0:
+                    acq.setFlag(ismrmrd.ACQ_FIRST_IN_PHASE)
+                elif ind[phase_idx] == N_PH - 1:
+                    acq.setFlag(ismrmrd.ACQ_LAST_IN_PHASE)
+                if slice_idx == 0:
+                    acq.setFlag(ismrmrd.ACQ_FIRST_IN_SLICE)
+                elif slice_idx == N_SL - 1:
+                    acq.setFlag(ismrmrd.ACQ_LAST_IN_SLICE)
+                if int(current_repetition) == 0:
+                    acq.setFlag(ismrmrd.ACQ_FIRST_IN_REPETITION)
+                elif int(current_repetition) == n_rep - 1:
+                    acq.setFlag(ismrmrd.ACQ_LAST_IN_REPETITION)
+                if averages:
+                    if scan == 0:
+                        acq.setFlag(ismrmrd.ACQ_FIRST_IN_AVERAGE)
+                    elif scan == n_scans - 1:
+                        acq.setFlag(ismrmrd.ACQ_LAST_IN_AVERAGE)
+                    acq.idx.average = scan + 1
+                counter += 1
+                acq.idx.repetition = int(current_repetition + 1)
+                acq.idx.kspace_encode_step_1 = int(ind[phase_idx] + 1)
+                acq.idx.slice = slice_idx + 1
+                acq.idx.contrast = index_in_repetition + 1
+                acq.scan_counter = counter
+                _set_common(acq, averages)
+                dset.append_acquisition(acq)
+
+
+def _old_gre(dset, data, n_scans, averages=True):
+    # Acquisition by acquisition writing of GRE3D before append_acquisitions
+    counter = 0
+    for average in range(n_scans):
+        repetition = 0
+        for slice_idx in range(N_SL):
+            for phase_idx in range(N_PH):
+                acq = ismrmrd.Acquisition.from_array(np.reshape(data[average, slice_idx, phase_idx], (1, -1)), None)
+                counter += 1
+                repetition += 1
+                acq.idx.repetition = repetition
+                acq.idx.kspace_encode_step_1 = phase_idx + 1
+                acq.idx.slice = slice_idx + 1
+                if averages:
+                    acq.idx.average = average + 1
+                acq.clearAllFlags()
+                if phase_idx == 0:
+                    acq.setFlag(ismrmrd.ACQ_FIRST_IN_PHASE)
+                elif phase_idx == N_PH - 1:
+                    acq.setFlag(ismrmrd.ACQ_LAST_IN_PHASE)
+                if slice_idx == 0:
+                    acq.setFlag(ismrmrd.ACQ_FIRST_IN_SLICE)
+                elif slice_idx == N_SL - 1:
+                    acq.setFlag(ismrmrd.ACQ_LAST_IN_SLICE)
+                if repetition == 1:
+                    acq.setFlag(ismrmrd.ACQ_FIRST_IN_AVERAGE)
+                elif repetition == N_PH * N_SL:
+                    acq.setFlag(ismrmrd.ACQ_LAST_IN_AVERAGE)
+                acq.scan_counter = counter
+                _set_common(acq, averages)
+                dset.append_acquisition(acq)
+
+
+def _assert_same_acquisitions(file_name, reference_file_name):
+    # Same headers byte by byte, same data and empty trajectories
+    with h5py.File(file_name, 'r') as file, h5py.File(reference_file_name, 'r') as reference:
+        acquisitions = file['dataset/data']
+        reference_acquisitions = reference['dataset/data']
+        assert acquisitions.dtype == reference_acquisitions.dtype
+        assert acquisitions.shape == reference_acquisitions.shape
+        assert acquisitions.fields('head')[()].tobytes() == reference_acquisitions.fields('head')[()].tobytes()
+        for line, reference_line in zip(acquisitions.fields('data')[()], reference_acquisitions.fields('data')[()]):
+            assert line.dtype == reference_line.dtype and np.array_equal(line, reference_line)
+        assert all(trajectory.size == 0 for trajectory in acquisitions.fields('traj')[()])
+
+
+def _write_blocks(file_name, data, header, block_size=4096):
+    dset = ismrmrd.Dataset(file_name, '/dataset', True)
+    append_acquisitions(dset, np.reshape(data, (-1, data.shape[-1])), header, block_size=block_size)
+    dset.close()
+
+
+@pytest.mark.parametrize("averages, n_scans, block_size", [(True, 2, 4096), (True, 2, 7), (False, 1, 5)])
+def test_rare_blocks_match_the_acquisitions(tmp_path, averages, n_scans, block_size):
+    etl = 4
+    ind = np.random.default_rng(1).permutation(N_PH) if averages else np.arange(N_PH)
+    data = _get_data()[0:n_scans, :, :, 0, :]
+
+    reference_file_name = str(tmp_path / 'reference.h5')
+    dset = ismrmrd.Dataset(reference_file_name, '/dataset', True)
+    _old_rare(dset, data, n_scans, etl, ind, averages=averages)
+    dset.close()
+
+    header = get_rare_header(n_scans, N_SL, N_PH, etl, ind=ind if averages else None, averages=averages)
+    header.update(_get_common(averages))
+    _write_blocks(str(tmp_path / 'raw.h5'), data, header, block_size=block_size)
+    _assert_same_acquisitions(str(tmp_path / 'raw.h5'), reference_file_name)
+
+
+@pytest.mark.parametrize("averages, n_scans", [(True, 2), (False, 1)])
+def test_gre_blocks_match_the_acquisitions(tmp_path, averages, n_scans):
+    data = _get_data()[0:n_scans, :, :, 0, :]
+
+    reference_file_name = str(tmp_path / 'reference.h5')
+    dset = ismrmrd.Dataset(reference_file_name, '/dataset', True)
+    _old_gre(dset, data, n_scans, averages=averages)
+    dset.close()
+
+    header = get_gre_header(n_scans, N_SL, N_PH, averages=averages)
+    header.update(_get_common(averages))
+    _write_blocks(str(tmp_path / 'raw.h5'), data, header)
+    _assert_same_acquisitions(str(tmp_path / 'raw.h5'), reference_file_name)
+
+
+def test_blocks_are_appended_and_read_back(tmp_path):
+    # One call per scan appends to the same dataset, and the acquisitions are read with ismrmrd and with MrdReader
+    file_name = str(tmp_path / 'raw.h5')
+    data = _get_data()[:, :, :, 0, :]
+    header = get_rare_header(N_SCANS, N_SL, N_PH, N_PH)
+    header.update(_get_common(True))
+    n = N_SL * N_PH
+    dset = ismrmrd.Dataset(file_name, '/dataset', True)
+    for scan in range(N_SCANS):
+        rows = slice(scan * n, (scan + 1) * n)
+        header_scan = {key: value[rows] if np.ndim(value) == 1 and len(value) == N_SCANS * n else value
+                       for key, value in header.items()}
+        append_acquisitions(dset, np.reshape(data[scan], (n, -1)), header_scan)
+    assert dset.number_of_acquisitions() == N_SCANS * n
+    acq = dset.read_acquisition(n + 5)
+    assert np.array_equal(acq.data[0], np.reshape(data, (-1, data.shape[-1]))[n + 5])
+    assert acq.idx.average == 2 and acq.scan_counter == n + 6
+    dset.close()
+
+    with MrdReader(file_name) as reader:
+        assert np.array_equal(reader.read(), data[:, :, :, N_ADD:N_ADD + N_RD])
@@ -0,0 +1,90 @@
+"""
+@author: J.M. Algarín, MRILab, i3M, CSIC, Valencia
+@email: josalggui@i3m.upv.es
+@Summary: tests of the k-space assembler of the sequences. They need marcos_client next to the MaRGE folder
+"""
+
+import numpy as np
+import pytest
+
+pytest.importorskip('experiment')
+from seq.mriBlankSeq import MRIBLANKSEQ
+
+
+def _get_stream(readouts_per_batch, n_scans, n_rd, seed=0):
+    # Decimated data of all the batches, ordered as (batch, scan, readout)
+    rng = np.random.default_rng(seed)
+    n = int(np.sum(readouts_per_batch)) * n_scans * n_rd
+    return rng.standard_normal(n) + 1j * rng.standard_normal(n)
+
+
+def _old_rare(data_full, acq_points_per_batch, n_scans, n_sl, n_ph, n_rd, ind):
+    # Reorganization of RARE before the k-space assembler: split of the last batch, concatenation of the batches of
+    # each scan and sweep of the phase lines
+    n_batches = len(acq_points_per_batch)
+    data_prov = np.zeros([n_scans, n_sl * n_ph * n_rd], dtype=complex)
+    if n_batches > 1:
+        data_full_a = data_full[0:sum(acq_points_per_batch[0:-1])]
+        data_full_b = data_full[sum(acq_points_per_batch[0:-1])::]
+        data_full_a = np.reshape(data_full_a, (n_batches - 1, n_scans, -1, n_rd))
+        data_full_b = np.reshape(data_full_b, (1, n_scans, -1, n_rd))
+    else:
+        data_full = np.reshape(data_full, (n_batches, n_scans, -1, n_rd))
+    for scan in range(n_scans):
+        if n_batches > 1:
+            data_prov[scan, :] = np.concatenate((np.reshape(data_full_a[:, scan, :, :], -1),
+                                                 np.reshape(data_full_b[:, scan, :, :], -1)), axis=0)
+        else:
+            data_prov[scan, :] = np.reshape(data_full[:, scan, :, :], -1)
+    acquisition = np.reshape(data_prov, -1)
+
+    data_full = np.reshape(data_prov, (n_scans, n_sl, n_ph, n_rd))
+    data_temp = data_full * 0
+    for ii in range(n_ph):
+        data_temp[:, :, ind[ii], :] = data_full[:, :, ii, :]
+    return acquisition, data_temp
+
+
+@pytest.mark.parametrize("sweep_mode", [0, 1, 2])
+@pytest.mark.parametrize("n_batches, n_scans", [(1, 1), (1, 3), (3, 2)])
+def test_matches_the_old_rare_reorganization(sweep_mode, n_batches, n_scans):
+    n_sl, n_ph, n_rd, etl = 2, 8, 5, 4
+    ind = MRIBLANKSEQ().getIndex(etl, n_ph, sweep_mode)
+
+    # Equal batches but the last one, that takes the remaining readouts
+    n_readouts = n_sl * n_ph
+    readouts_per_batch = [n_readouts // n_batches] * (n_batches - 1)
+    readouts_per_batch.append(n_readouts - sum(readouts_per_batch))
+    acq_points_per_batch = [n * n_scans * n_rd for n in readouts_per_batch]
+    data_full = _get_stream(readouts_per_batch, n_scans, n_rd)
+    acquisition, reference = _old_rare(data_full.copy(), acq_points_per_batch, n_scans, n_sl, n_ph, n_rd, ind)
+
+    acq_map = MRIBLANKSEQ.getKSpaceMap(readouts_per_batch, n_scans)
+    lines = np.reshape(np.arange(n_sl)[:, np.newaxis] * n_ph + ind[np.newaxis, :], -1)
+    k_map = MRIBLANKSEQ.getKSpaceMap(readouts_per_batch, n_scans, lines=lines, n_lines=n_sl * n_ph)
+    assert np.array_equal(np.reshape(MRIBLANKSEQ.assembleKSpace(data_full, acq_map, n_rd), -1), acquisition)
+    k_space = MRIBLANKSEQ.assembleKSpace(data_full, k_map, n_rd)
+    assert np.array_equal(np.reshape(k_space, (n_scans, n_sl, n_ph, n_rd)), reference)
+
+
+def test_repetition_in_each_batch():
+    # The repetition restarts in each batch and scan, as the rf spoiling phase of GRE3D
+    readouts_per_batch = [3, 3, 2]
+    k_map = MRIBLANKSEQ.getKSpaceMap(readouts_per_batch, n_scans=2)
+    assert np.array_equal(k_map['repetition'], [0, 1, 2, 0, 1, 2, 0, 1, 2, 0, 1, 2, 0, 1, 0, 1])
+    assert np.array_equal(k_map['scan'], [0, 0, 0, 1, 1, 1, 0, 0, 0, 1, 1, 1, 0, 0, 1, 1])
+    assert np.array_equal(k_map['acquisition'], [0, 1, 2, 0, 1, 2, 3, 4, 5, 3, 4, 5, 6, 7, 6, 7])
+    assert k_map['shape'] == (2, 8)
+
+
+def test_lines_not_sampled_are_zero():
+    # Undersampled k-space, with the lines given by a mask
+    mask = np.array([1, 0, 1, 1, 0, 0, 1, 0], dtype=bool)
+    lines = np.nonzero(mask)[0][::-1]
+    n_rd = 3
+    data = _get_stream([2, 2], 1, n_rd)
+    k_map = MRIBLANKSEQ.getKSpaceMap([2, 2], lines=lines, n_lines=mask.size)
+    k_space = MRIBLANKSEQ.assembleKSpace(data, k_map, n_rd)
+    assert k_space.shape == (1, 8, 3)
+    assert np.all(k_space[0, ~mask] == 0)
+    assert np.array_equal(k_space[0, lines], np.reshape(data, (-1, n_rd)))
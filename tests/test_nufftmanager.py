@@ -0,0 +1,168 @@
+"""
+@author: J.M. Algarín, MRILab, i3M, CSIC, Valencia
+@email: josalggui@i3m.upv.es
+@Summary: tests of the NUFFT gridding, its disk cache and the conjugate-gradient reconstruction of non-Cartesian
+k-space data
+"""
+
+import os
+import time
+import numpy as np
+from scipy.interpolate import griddata
+
+from manager.nufftmanager import NufftGridder, get_gridder, prune_cache, cg_reconstruction
+
+N_POINTS = [16, 16, 1]
+K_MAX = np.array([80.0, 80.0, 5.0])  # 1/m
+
+
+def _get_cartesian(n_points=N_POINTS):
+    # Cartesian k-space points as in PETRA, flattened in (z, y, x) order
+    axes = [np.linspace(-K_MAX[axis], K_MAX[axis], n_points[axis]) if n_points[axis] > 1 else np.zeros(1)
+            for axis in range(3)]
+    ky, kz, kx = np.meshgrid(axes[1], axes[2], axes[0])
+    return np.stack([np.ravel(kx), np.ravel(ky), np.ravel(kz)], axis=1)
+
+
+def _get_radial(n_spokes=64, n_rd=32):
+    # 2D radial trajectory that covers the Cartesian grid
+    angles = np.linspace(0, np.pi, n_spokes, endpoint=False)
+    radius = np.linspace(-1.1, 1.1, n_rd) * K_MAX[0]
+    kx = np.outer(np.cos(angles), radius)
+    ky = np.outer(np.sin(angles), radius)
+    return np.stack([np.ravel(kx), np.ravel(ky), np.zeros(kx.size)], axis=1)
+
+
+def _get_signal(k):
+    # Smooth k-space of a Gaussian object, with a linear phase given by an off-center position
+    return np.exp(-(k[:, 0] ** 2 + k[:, 1] ** 2) / (2 * (K_MAX[0] / 3) ** 2)) * np.exp(-2j * np.pi * 0.01 * k[:, 0])
+
+
+def test_gridding_matches_the_cartesian_k_space():
+    k = _get_radial()
+    k_cartesian = _get_cartesian()
+    reference = np.reshape(_get_signal(k_cartesian), (1, 16, 16))
+
+    gridder = NufftGridder(k, k_cartesian, N_POINTS, axes=(0, 1))
+    k_space = gridder.grid(_get_signal(k))
+    error = np.linalg.norm(k_space - reference) / np.linalg.norm(reference)
+
+    # At least as accurate as the linear interpolation used before
+    k_space_griddata = griddata(k[:, 0:2], _get_signal(k), k_cartesian[:, 0:2], method='linear', fill_value=0)
+    error_griddata = np.linalg.norm(np.reshape(k_space_griddata, (1, 16, 16)) - reference) / np.linalg.norm(reference)
+    assert k_space.shape == (1, 16, 16)
+    assert error < 0.01
+    assert error < error_griddata
+
+
+def test_forward_is_the_adjoint():
+    rng = np.random.default_rng(0)
+    k = _get_radial()
+    gridder = NufftGridder(k, _get_cartesian(), N_POINTS)
+    image = rng.standard_normal((1, 16, 16)) + 1j * rng.standard_normal((1, 16, 16))
+    s = rng.standard_normal(k.shape[0]) + 1j * rng.standard_normal(k.shape[0])
+    assert np.isclose(np.vdot(gridder.image2samples(image), s), np.vdot(image, gridder.samples2image(s)))
+
+
+def test_axes_not_gridded_are_broadcast():
+    # Only x is gridded, the k-space along y takes the same values
+    k = _get_radial()
+    gridder = NufftGridder(k, _get_cartesian(), N_POINTS, axes=(0,))
+    k_space = gridder.grid(_get_signal(k))
+    assert k_space.shape == (1, 16, 16)
+    assert np.allclose(k_space, k_space[:, 0:1, :])
+
+
+def _get_residual(gridder, image, s):
+    # Weighted residual of the samples minimized by cg_reconstruction
+    scale = np.prod([gridder.n_os[axis] ** 2 / gridder.n_points[axis] for axis in range(3) if gridder.gridded[axis]])
+    weights = np.sqrt(gridder.dcf)
+    return np.linalg.norm(weights * (scale * gridder.image2samples(image) - s)) / np.linalg.norm(weights * s)
+
+
+def test_cg_improves_the_gridded_image():
+    k = _get_radial(n_spokes=24)
+    k_cartesian = _get_cartesian()
+    reference = np.reshape(_get_signal(k_cartesian), (1, 16, 16))
+    s = _get_signal(k)
+    gridder = NufftGridder(k, k_cartesian, N_POINTS, axes=(0, 1))
+
+    gridded = gridder.samples2image(gridder.dcf * s)
+    image = cg_reconstruction(gridder, s, n_iter=10)
+    assert image.shape == (1, 16, 16)
+    assert _get_residual(gridder, image, s) < _get_residual(gridder, gridded, s)
+    assert np.linalg.norm(gridder.image2kspace(image) - reference) < \
+           np.linalg.norm(gridder.image2kspace(gridded) - reference)
+
+    # Without iterations the gridded image is returned
+    assert np.allclose(cg_reconstruction(gridder, s, n_iter=0), gridded)
+
+    # The regularization reduces the norm of the image
+    regularized = cg_reconstruction(gridder, s, lbda=0.1, n_iter=10)
+    assert np.linalg.norm(regularized) < np.linalg.norm(image)
+
+
+def test_cache_reuses_the_gridder(tmp_path):
+    k = _get_radial()
+    k_cartesian = _get_cartesian()
+    cache_dir = str(tmp_path / 'nufft')
+    gridder = get_gridder(k, k_cartesian, N_POINTS, cache_dir=cache_dir)
+    files = os.listdir(cache_dir)
+    assert len(files) == 1 and files[0].startswith('nufft_') and files[0].endswith('.npz')
+
+    # The same trajectory loads the matrix and the density compensation from the file
+    cached = get_gridder(k, k_cartesian, N_POINTS, cache_dir=cache_dir)
+    assert os.listdir(cache_dir) == files
+    assert (cached.matrix != gridder.matrix).nnz == 0
+    assert np.array_equal(cached.dcf, gridder.dcf)
+    assert np.allclose(cached.grid(_get_signal(k)), gridder.grid(_get_signal(k)))
+
+    # Another trajectory or other gridding parameters give another file
+    get_gridder(k * 0.9, k_cartesian, N_POINTS, cache_dir=cache_dir)
+    get_gridder(k, k_cartesian, N_POINTS, oversampling=1.5, cache_dir=cache_dir)
+    assert len(os.listdir(cache_dir)) == 3
+
+    # Without cache_dir nothing is saved
+    uncached = get_gridder(k, k_cartesian, N_POINTS, cache_dir=None)
+    assert np.array_equal(uncached.dcf, gridder.dcf) and len(os.listdir(cache_dir)) == 3
+
+
+def test_corrupted_cache_is_rebuilt(tmp_path):
+    k = _get_radial()
+    k_cartesian = _get_cartesian()
+    cache_dir = str(tmp_path)
+    gridder = get_gridder(k, k_cartesian, N_POINTS, cache_dir=cache_dir)
+    file_name = os.path.join(cache_dir, os.listdir(cache_dir)[0])
+    with open(file_name, 'wb') as file:
+        file.write(b'not a npz file')
+
+    rebuilt = get_gridder(k, k_cartesian, N_POINTS, cache_dir=cache_dir)
+    assert np.array_equal(rebuilt.dcf, gridder.dcf)
+    with np.load(file_name) as data:
+        assert np.array_equal(data['dcf'], gridder.dcf)
+
+
+def test_cache_is_pruned(tmp_path):
+    k = _get_radial()
+    k_cartesian = _get_cartesian()
+    cache_dir = str(tmp_path)
+    for scale in [0.7, 0.8, 0.9]:
+        get_gridder(k * scale, k_cartesian, N_POINTS, cache_dir=cache_dir)
+    files = sorted((os.path.join(cache_dir, name) for name in os.listdir(cache_dir)), key=os.path.getmtime)
+    assert len(files) == 3
+    now = time.time()
+    for age, file_name in zip([100, 50, 10], files):
+        os.utime(file_name, (now - age, now - age))
+
+    # Files not used for longer than max_age
+    assert prune_cache(cache_dir, max_age=60) == [files[0]]
+
+    # Least recently used files above max_size, but not the one given in keep
+    size = os.path.getsize(files[1])
+    assert prune_cache(cache_dir, max_size=size, keep=files[1]) == [files[2]]
+    assert os.listdir(cache_dir) == [os.path.basename(files[1])]
+
+    # Loading a file marks it as used
+    get_gridder(k * 0.8, k_cartesian, N_POINTS, cache_dir=cache_dir)
+    assert os.path.getmtime(files[1]) > now - 1
+    assert prune_cache(cache_dir, max_age=60) == []
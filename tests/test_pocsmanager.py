@@ -0,0 +1,105 @@
+"""
+@author: J.M. Algarín, MRILab, i3M, CSIC, Valencia
+@email: josalggui@i3m.upv.es
+@Summary: tests of the partial Fourier reconstructions
+"""
+
+import numpy as np
+import pytest
+
+from manager.pocsmanager import pocs_reconstruction, homodyne_reconstruction
+
+N_POINTS = np.array([8, 32, 24])  # nz, ny, nx
+
+
+def _ifftnc(k_space):
+    return np.fft.ifftshift(np.fft.ifftn(np.fft.ifftshift(k_space)))
+
+
+def _fftnc(image):
+    return np.fft.fftshift(np.fft.fftn(np.fft.fftshift(image)))
+
+
+def _get_phantom():
+    # Ellipsoid with a smooth phase, and its k-space
+    z, y, x = np.meshgrid(*[np.linspace(-1, 1, n) for n in N_POINTS], indexing='ij')
+    image = ((x ** 2 + y ** 2 + z ** 2) < 0.6) * (1 + 0.5 * (x > 0)) * np.exp(1j * (0.8 * x + 0.5 * y + 0.3))
+    return image, _fftnc(image)
+
+
+def _get_partial(factors):
+    # Acquired points and points past the center of k-space of each axis, as in the reconstruction tab
+    mm = np.array([int(num) for num in (N_POINTS * factors)])
+    m = np.array([int(num) for num in (N_POINTS * factors - N_POINTS / 2)])
+    return mm, m
+
+
+def _old_pocs(k_space, mm, m, nb_point, n_iter):
+    # POCS loop of the reconstruction tab before pocs_reconstruction, with a fixed number of iterations
+    center = np.zeros_like(k_space)
+    idx0 = N_POINTS // 2 - m
+    idx1 = N_POINTS // 2 + m
+    center[idx0[0]:idx1[0], idx0[1]:idx1[1], idx0[2]:idx1[2]] = k_space[idx0[0]:idx1[0], idx0[1]:idx1[1],
+                                                                         idx0[2]:idx1[2]]
+    image_center = _ifftnc(center)
+    magnitude = np.abs(image_center)
+    phase = np.where(magnitude > 0, image_center / np.where(magnitude > 0, magnitude, 1), 0)  # Zero instead of nan
+
+    # Hanning filter
+    k_hanning = np.copy(k_space)
+    k_hanning[mm[0]::, :, :] = 0.0
+    k_hanning[:, mm[1]::, :] = 0.0
+    k_hanning[:, :, mm[2]::] = 0.0
+    window = np.hanning(nb_point * 2)[nb_point::]
+    for axis in range(3):
+        if not mm[axis] == N_POINTS[axis]:
+            for ii in range(nb_point):
+                index = [slice(None)] * 3
+                index[axis] = mm[axis] - nb_point + ii + 1
+                k_hanning[tuple(index)] *= window[ii]
+
+    previous = np.abs(_ifftnc(k_hanning))
+    for iteration in range(n_iter):
+        k_new = _fftnc(previous * phase)
+        k_new[0:mm[0], 0:mm[1], 0:mm[2]] = k_space[0:mm[0], 0:mm[1], 0:mm[2]]
+        previous = np.abs(_ifftnc(k_new))
+    return previous
+
+
+@pytest.mark.parametrize("factors", [[1.0, 0.625, 1.0], [1.0, 0.75, 0.625]])
+def test_pocs_matches_the_old_loop(factors):
+    image, k_space = _get_phantom()
+    mm, m = _get_partial(np.array(factors))
+    reference = _old_pocs(k_space, mm, m, nb_point=2, n_iter=10)
+    result = pocs_reconstruction(k_space, mm, m, nb_point=2, threshold=0, max_iter=9)
+    assert np.allclose(result, reference, atol=1e-10 * np.max(reference))
+
+
+def test_pocs_improves_zero_filling():
+    image, k_space = _get_phantom()
+    mm, m = _get_partial(np.array([1.0, 0.625, 1.0]))
+    zero_filled = k_space.copy()
+    zero_filled[:, mm[1]:, :] = 0
+    error_zero = np.linalg.norm(np.abs(_ifftnc(zero_filled)) - np.abs(image))
+
+    result = pocs_reconstruction(k_space, mm, m, threshold=1e-4)
+    assert np.linalg.norm(result - np.abs(image)) < error_zero
+    single = pocs_reconstruction(k_space, mm, m, threshold=1e-4, single=True)
+    assert single.dtype == np.float32
+    assert np.allclose(single, result, atol=1e-3 * np.max(result))
+
+    homodyne = homodyne_reconstruction(k_space, mm, m)
+    assert homodyne.shape == tuple(N_POINTS)
+    assert np.linalg.norm(homodyne - np.abs(image)) < error_zero
+
+
+def test_leading_axes_are_a_batch():
+    image, k_space = _get_phantom()
+    mm, m = _get_partial(np.array([1.0, 0.625, 1.0]))
+    single = pocs_reconstruction(k_space, mm, m, threshold=0, max_iter=5)
+    batch = pocs_reconstruction(np.stack([k_space, 2 * k_space]), mm, m, threshold=0, max_iter=5)
+    assert batch.shape == (2,) + tuple(N_POINTS)
+    assert np.allclose(batch[0], single) and np.allclose(batch[1], 2 * single)
+
+    homodyne = homodyne_reconstruction(np.stack([k_space, k_space]), mm, m)
+    assert np.allclose(homodyne[1], homodyne_reconstruction(k_space, mm, m))
@@ -0,0 +1,77 @@
+"""
+@author: J.M. Algarín, MRILab, i3M, CSIC, Valencia
+@email: josalggui@i3m.upv.es
+@Summary: tests of the interpretation and of the parallel compilation of the PyPulseq batches
+"""
+
+import numpy as np
+import pypulseq as pp
+import pytest
+
+import configs.hw_config as hw
+from manager import pulseqmanager
+from manager.pulseqmanager import SequenceInterpreter, compile_batches, get_batch_workers
+from manager.poolmanager import can_fork
+
+SYSTEM = pp.Opts(rf_dead_time=100e-6, adc_dead_time=10e-6, grad_raster_time=10e-6)
+
+
+def _create_batch(first, last):
+    # Batch with the readouts from first to last (excluded), with a different gradient area for each readout
+    batch = pp.Sequence(SYSTEM)
+    for idx in range(first, last):
+        batch.add_block(pp.make_block_pulse(np.pi / 2, duration=100e-6, system=SYSTEM))
+        batch.add_block(pp.make_trapezoid('x', area=10 * (idx + 1), duration=1e-3, system=SYSTEM),
+                        pp.make_adc(50, dwell=10e-6, system=SYSTEM))
+        batch.add_block(pp.make_delay(1e-3))
+    return batch
+
+
+def _get_interpreter():
+    return SequenceInterpreter(tx_warmup=100)
+
+
+def _assert_same_waveforms(waveforms, reference):
+    assert list(waveforms) == list(reference)
+    for key in reference:
+        assert np.array_equal(waveforms[key][0], reference[key][0])
+        assert np.array_equal(waveforms[key][1], reference[key][1])
+
+
+def test_interpret_sequence_matches_the_file(tmp_path):
+    batch = _create_batch(0, 5)
+    interpreter = _get_interpreter()
+    waveforms, param_dict = interpreter.interpret_sequence(batch)
+    batch.write(str(tmp_path / 'batch_1.seq'))
+    reference, reference_dict = _get_interpreter().interpret(str(tmp_path / 'batch_1.seq'))
+    _assert_same_waveforms(waveforms, reference)
+    assert param_dict['readout_number'] == reference_dict['readout_number'] == 5 * 50
+
+    # The interpreter is reused for the next batch
+    waveforms, param_dict = interpreter.interpret_sequence(_create_batch(0, 2))
+    assert param_dict['readout_number'] == 2 * 50
+
+
+@pytest.mark.skipif(not can_fork(), reason="Processes can not be forked")
+def test_processes_give_the_same_batches():
+    batch_args = [(0, 3), (3, 6), (6, 8)]
+    serial = compile_batches(_get_interpreter(), _create_batch, batch_args, n_workers=1)
+    parallel = compile_batches(_get_interpreter(), _create_batch, batch_args, n_workers=2)
+    assert len(parallel) == 3
+    for (batch, waveforms), (reference_batch, reference) in zip(parallel, serial):
+        assert len(batch.block_events) == len(reference_batch.block_events)
+        _assert_same_waveforms(waveforms, reference)
+
+
+def test_batch_workers_setting(monkeypatch):
+    monkeypatch.setattr(hw, 'batch_workers', 3, raising=False)
+    assert get_batch_workers() == (3 if can_fork() else 1)
+
+    # Without the setting, the number of CPUs up to MAX_BATCH_WORKERS
+    monkeypatch.delattr(hw, 'batch_workers', raising=False)
+    monkeypatch.setattr(pulseqmanager.os, 'cpu_count', lambda: 64)
+    assert get_batch_workers() == (pulseqmanager.MAX_BATCH_WORKERS if can_fork() else 1)
+
+    # Sequential compilation where the processes can not be forked
+    monkeypatch.setattr(pulseqmanager, 'can_fork', lambda: False)
+    assert get_batch_workers() == 1
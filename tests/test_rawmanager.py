@@ -0,0 +1,103 @@
+"""
+@author: J.M. Algarín, MRILab, i3M, CSIC, Valencia
+@email: josalggui@i3m.upv.es
+@Summary: tests of the HDF5 raw data files and of their conversion to .mat
+"""
+
+import h5py
+import numpy as np
+from scipy.io import savemat, loadmat
+
+from manager.rawmanager import RawDataWriter, RawDataReader, raw_to_mat
+
+
+def _get_map_vals(seed=0):
+    # Values as in the mapVals of a sequence
+    rng = np.random.default_rng(seed)
+    return {'seqName': 'RARE',
+            'fileName': 'RARE.2024.01.01.12.00.00.000',
+            'nScans': 2,
+            'larmorFreq': 3.066,
+            'shimming': [-12.5, -12.5, 7.5],
+            'nPoints': np.array([60, 60, 1]),
+            'dummyPulses': True,
+            'sampledCartesian': rng.standard_normal((3600, 4)),
+            'image3D': rng.standard_normal((1, 60, 60)) + 1j * rng.standard_normal((1, 60, 60)),
+            'dicom': {'rows': 60, 'columns': 60, 'modality': 'MR'},
+            'outputs': None}
+
+
+def _assert_same_mat(mat, reference):
+    assert sorted(mat) == sorted(reference)
+    for name in reference:
+        if name.startswith('__'):
+            continue
+        if name == 'dicom':
+            for key in ['rows', 'columns', 'modality']:
+                assert np.array_equal(mat[name][key][0, 0], reference[name][key][0, 0])
+        else:
+            assert mat[name].dtype.kind == reference[name].dtype.kind, name
+            assert np.array_equal(mat[name], reference[name]), name
+
+
+def test_raw_to_mat_matches_savemat(tmp_path):
+    map_vals = _get_map_vals()
+    writer = RawDataWriter(str(tmp_path / 'raw.h5'))
+    writer.write_dict(map_vals)
+    writer.close()
+    mat_file_name = raw_to_mat(str(tmp_path / 'raw.h5'))
+    assert mat_file_name == str(tmp_path / 'raw.mat')
+
+    savemat(str(tmp_path / 'reference.mat'), {key: value for key, value in map_vals.items() if value is not None})
+    reference = loadmat(str(tmp_path / 'reference.mat'))
+    mat = loadmat(mat_file_name)
+    for key in ['__header__', '__version__', '__globals__']:
+        mat.pop(key)
+        reference.pop(key)
+    _assert_same_mat(mat, reference)
+
+
+def test_reader_gives_the_loadmat_format(tmp_path):
+    map_vals = _get_map_vals()
+    writer = RawDataWriter(str(tmp_path / 'raw.h5'))
+    writer.write_dict(map_vals)
+    writer.close()
+
+    with RawDataReader(str(tmp_path / 'raw.h5')) as reader:
+        assert reader.complete
+        assert 'outputs' not in reader and 'image3D' in reader
+        assert np.array_equal(reader['seqName'], np.array(['RARE']))
+        assert np.array_equal(reader['nScans'], [[2]]) and np.array_equal(reader['shimming'], [[-12.5, -12.5, 7.5]])
+
+        # Large arrays are datasets read partially from the file
+        assert isinstance(reader['image3D'], h5py.Dataset)
+        assert np.array_equal(reader['image3D'][0, 10], map_vals['image3D'][0, 10])
+        reader.load(['image3D'])
+        assert np.array_equal(reader['image3D'], map_vals['image3D'])
+        assert reader['dicom']['modality'] == np.array(['MR'])
+
+
+def test_appended_data_survives_an_unfinished_acquisition(tmp_path):
+    rng = np.random.default_rng(0)
+    scans = [rng.standard_normal(500) + 1j * rng.standard_normal(500) for _ in range(3)]
+    writer = RawDataWriter(str(tmp_path / 'raw.h5'))
+    writer.write_dict({'seqName': 'RARE', 'nScans': 3})
+    for scan, data in enumerate(scans[0:2]):
+        writer.append('data_over', data)
+        writer.set_attributes(n_scans_acquired=scan + 1)
+
+    # The file can be read while it is being written, with the scans acquired up to now
+    with RawDataReader(str(tmp_path / 'raw.h5')) as reader:
+        assert not reader.complete
+        assert np.array_equal(reader['n_scans_acquired'], [[2]])
+        assert np.array_equal(reader['data_over'][()], np.concatenate(scans[0:2]))
+
+    # The analysis does not replace the appended data
+    assert 'data_over' in writer
+    writer.append('data_over', scans[2])
+    writer.write_dict({'data_over': np.zeros(10), 'data_full': np.ones(5)})
+    writer.close()
+    with RawDataReader(str(tmp_path / 'raw.h5')) as reader:
+        assert reader.complete
+        assert np.array_equal(reader['data_over'][()], np.concatenate(scans))
+        assert np.array_equal(reader['data_full'], np.ones((1, 5)))
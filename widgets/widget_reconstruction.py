@@ -1,4 +1,5 @@
-from PyQt5.QtWidgets import QPushButton, QVBoxLayout, QLabel, QLineEdit, QHBoxLayout, QGroupBox, QWidget
+from PyQt5.QtWidgets import QPushButton, QVBoxLayout, QLabel, QLineEdit, QHBoxLayout, QGroupBox, QWidget, QCheckBox, \
+    QComboBox
 
 
 class ReconstructionTabWidget(QWidget):
@@ -31,12 +32,15 @@ class ReconstructionTabWidget(QWidget):
         # Labels
         self.niter_label = QLabel('Number of iterations')
         self.lambda_label = QLabel('Lambda')
+        self.block_label = QLabel('Block size')
 
         # Text Fields
         self.niter_text_field = QLineEdit()
         self.niter_text_field.setText('1')
         self.lambda_text_field = QLineEdit()
         self.lambda_text_field.setText('1')
+        self.block_text_field = QLineEdit()
+        self.block_text_field.setText('256')
 
         # Layouts
         self.order_layout = QHBoxLayout()
@@ -44,6 +48,8 @@ class ReconstructionTabWidget(QWidget):
         self.order_layout.addWidget(self.niter_text_field)
         self.order_layout.addWidget(self.lambda_label)
         self.order_layout.addWidget(self.lambda_text_field)
+        self.order_layout.addWidget(self.block_label)
+        self.order_layout.addWidget(self.block_text_field)
 
         self.art_layout = QVBoxLayout()
         self.art_layout.addLayout(self.order_layout)
@@ -85,31 +91,71 @@ class ReconstructionTabWidget(QWidget):
         self.nb_points_layout.addWidget(self.nb_points_label)
         self.nb_points_layout.addWidget(self.nb_points_text_field)
 
-        self.threshold_label = QLabel('Correlation threshold')
+        self.threshold_label = QLabel('Convergence threshold')
         self.threshold_text_field = QLineEdit()
-        self.threshold_text_field.setText('1e-6')
+        self.threshold_text_field.setText('1e-3')
+        self.threshold_text_field.setStatusTip('Relative change of the image between POCS iterations to stop')
 
         self.threshold_layout = QHBoxLayout()
         self.threshold_layout.addWidget(self.threshold_label)
         self.threshold_layout.addWidget(self.threshold_text_field)
 
+        self.single_checkbox = QCheckBox('Single precision')
+
         self.pocs_button = QPushButton('Run POCS')
+        self.homodyne_button = QPushButton('Run homodyne')
         self.zero_button = QPushButton('Run iFFT with zero padding')
 
         self.pocs_layout = QVBoxLayout()
         self.pocs_layout.addLayout(self.factor_layout)
         self.pocs_layout.addLayout(self.nb_points_layout)
         self.pocs_layout.addLayout(self.threshold_layout)
+        self.pocs_layout.addWidget(self.single_checkbox)
         self.pocs_layout.addWidget(self.pocs_button)
+        self.pocs_layout.addWidget(self.homodyne_button)
         self.pocs_layout.addWidget(self.zero_button)
 
         self.pocs_group = QGroupBox("Partial Reconstruction")
         self.pocs_group.setLayout(self.pocs_layout)
 
+        # *****************
+        # Compressed sensing
+        # *****************
+        self.cs_method_label = QLabel('Method')
+        self.cs_method_combo_box = QComboBox()
+        self.cs_method_combo_box.addItems(['tv', 'wavelet'])
+        self.cs_method_combo_box.setStatusTip("'tv' for total variation or 'wavelet' for L1 of the wavelet coefficients")
+        self.cs_lambda_label = QLabel('Lambda')
+        self.cs_lambda_text_field = QLineEdit()
+        self.cs_lambda_text_field.setText('0.01')
+        self.cs_lambda_text_field.setStatusTip('Regularization weight relative to the maximum of the zero-filled image')
+        self.cs_niter_label = QLabel('Iterations')
+        self.cs_niter_text_field = QLineEdit()
+        self.cs_niter_text_field.setText('50')
+
+        self.cs_parameters_layout = QHBoxLayout()
+        self.cs_parameters_layout.addWidget(self.cs_method_label)
+        self.cs_parameters_layout.addWidget(self.cs_method_combo_box)
+        self.cs_parameters_layout.addWidget(self.cs_lambda_label)
+        self.cs_parameters_layout.addWidget(self.cs_lambda_text_field)
+        self.cs_parameters_layout.addWidget(self.cs_niter_label)
+        self.cs_parameters_layout.addWidget(self.cs_niter_text_field)
+
+        self.cs_button = QPushButton('Run CS')
+        self.cs_button.setStatusTip('Recover the k-space points equal to zero with compressed sensing')
+
+        self.cs_layout = QVBoxLayout()
+        self.cs_layout.addLayout(self.cs_parameters_layout)
+        self.cs_layout.addWidget(self.cs_button)
+
+        self.cs_group = QGroupBox("Compressed Sensing")
+        self.cs_group.setLayout(self.cs_layout)
+
         # Main layout
         self.reconstruction_layout = QVBoxLayout()
         self.reconstruction_layout.addWidget(self.art_group)
         self.reconstruction_layout.addWidget(self.fft_group)
         self.reconstruction_layout.addWidget(self.pocs_group)
+        self.reconstruction_layout.addWidget(self.cs_group)
         self.reconstruction_layout.addStretch()
         self.setLayout(self.reconstruction_layout)